@@ -0,0 +1,58 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from snudda import SnuddaInit, SnuddaPlace, SnuddaDetect
+
+# Compares the compiled synapse detection kernel (detect_synapses_helper) with the
+# pure python reference loop (detect_synapses_python) on the most crowded hyper voxel.
+#
+# Usage: python benchmark_detect_synapses.py [network_path] [num_neurons]
+#
+# If the network_path does not contain a placed network, a striatal network is created.
+
+network_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join("networks", "benchmark_detect")
+num_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+if not os.path.isfile(os.path.join(network_path, "network-neuron-positions.hdf5")):
+    si = SnuddaInit(network_path=network_path, struct_def={"Striatum": num_neurons}, random_seed=1234)
+    spl = SnuddaPlace(network_path=network_path)
+    spl.place()
+
+sd = SnuddaDetect(network_path=network_path, hyper_voxel_size=100)
+os.makedirs(os.path.dirname(sd.save_file), exist_ok=True)
+sd.setup_work_history(os.path.join(network_path, "log", "benchmark-detect-worklog.hdf5"))
+sd.distribute_neurons_parallel(d_view=None)
+
+neuron_ctr = dict([(hid, sd.hyper_voxels[hid]["neuronCtr"]) for hid in sd.hyper_voxels])
+hyper_id = max(neuron_ctr, key=neuron_ctr.get)
+
+print(f"Filling hyper voxel {hyper_id} ({neuron_ctr[hyper_id]} neurons)")
+
+# This fills the voxels, the voxel content is kept after the call so we can rerun detect_synapses
+sd.process_hyper_voxel(hyper_id)
+
+# First call compiles the kernel, do not include it in the timing
+sd.hyper_voxel_synapse_ctr = 0
+sd.detect_synapses(use_numba=True)
+
+result = dict()
+duration = dict()
+
+for use_numba in [True, False]:
+    sd.hyper_voxel_rng = np.random.default_rng(sd.hyper_voxels[hyper_id]["randomSeed"])
+    sd.hyper_voxel_synapse_ctr = 0
+
+    start_time = timeit.default_timer()
+    result[use_numba] = sd.detect_synapses(use_numba=use_numba).copy()
+    duration[use_numba] = timeit.default_timer() - start_time
+
+print(f"Synapses found: {result[True].shape[0]}")
+print(f"Identical result: {result[True].shape == result[False].shape and (result[True] == result[False]).all()}")
+print(f"Python loop: {duration[False]:.3f} s")
+print(f"Numba kernel: {duration[True]:.3f} s")
+print(f"Speedup: {duration[False] / max(duration[True], 1e-9):.1f}x")
+
+sd.work_history.close()
@@ -0,0 +1,92 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from snudda import SnuddaInit, SnuddaPlace, SnuddaDetect
+from snudda.detect.prune import SnuddaPrune
+from snudda.input.input import SnuddaInput
+
+# Compares the batched spike train generation (make_correlated_spikes_batch) with the reference
+# implementation that generates one spike train at a time (make_correlated_spikes_python).
+#
+# Usage: python benchmark_input.py [network_path] [num_neurons] [num_spike_trains] [frequency] [duration]
+#
+# For each neuron num_spike_trains correlated spike trains are generated, sharing 20% of their spikes
+# with a population unit spike train, and jittered by 1 ms. If the network_path does not contain a
+# network, a small striatal network is created (SnuddaInput needs a network file).
+
+network_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join("networks", "benchmark_input")
+num_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+num_spike_trains = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+freq = float(sys.argv[4]) if len(sys.argv) > 4 else 10.0
+duration = float(sys.argv[5]) if len(sys.argv) > 5 else 10.0
+
+p_keep = 0.2
+jitter_dt = 1e-3
+time_range = (0, duration)
+
+if not os.path.isfile(os.path.join(network_path, "network-synapses.hdf5")):
+    si = SnuddaInit(network_path=network_path, struct_def={"Striatum": 20}, random_seed=1234)
+    spl = SnuddaPlace(network_path=network_path)
+    spl.place()
+    sd = SnuddaDetect(network_path=network_path)
+    sd.detect()
+    sp = SnuddaPrune(network_path=network_path)
+    sp.prune()
+
+si = SnuddaInput(network_path=network_path, time=duration)
+
+population_unit_spikes = si.generate_spikes(freq=freq, time_range=time_range, rng=np.random.default_rng(1234))
+
+
+def run_python(seed):
+    num_spikes = 0
+    for neuron_id in range(num_neurons):
+        rng = np.random.default_rng(seed + neuron_id)
+        spikes = si.make_correlated_spikes_python(freq=freq, time_range=time_range, num_spike_trains=num_spike_trains,
+                                                  p_keep=p_keep, rng=rng,
+                                                  population_unit_spikes=population_unit_spikes,
+                                                  jitter_dt=jitter_dt)
+        num_spikes += sum([len(x) for x in spikes])
+    return num_spikes
+
+
+def run_batch(seed):
+    num_spikes = 0
+    for neuron_id in range(num_neurons):
+        rng = np.random.default_rng(seed + neuron_id)
+        spike_times, train_ptr, _ = si.make_correlated_spikes_batch(freq=freq, time_range=time_range,
+                                                                    num_spike_trains=num_spike_trains,
+                                                                    p_keep=p_keep, rng=rng,
+                                                                    population_unit_spikes=population_unit_spikes,
+                                                                    jitter_dt=jitter_dt)
+        num_spikes += len(spike_times)
+    return num_spikes
+
+
+start_time = timeit.default_timer()
+num_spikes_python = run_python(seed=1)
+duration_python = timeit.default_timer() - start_time
+
+start_time = timeit.default_timer()
+num_spikes_batch = run_batch(seed=1)
+duration_batch = timeit.default_timer() - start_time
+
+# Same seed must give the same spikes
+reproducible = (np.array_equal(si.make_correlated_spikes_batch(freq, time_range, num_spike_trains, p_keep,
+                                                               np.random.default_rng(5), population_unit_spikes,
+                                                               jitter_dt)[0],
+                               si.make_correlated_spikes_batch(freq, time_range, num_spike_trains, p_keep,
+                                                               np.random.default_rng(5), population_unit_spikes,
+                                                               jitter_dt)[0]))
+
+expected_spikes = num_neurons * num_spike_trains * freq * duration
+
+print(f"{num_neurons} neurons x {num_spike_trains} spike trains, {freq} Hz, {duration} s "
+      f"(expected {expected_spikes:.0f} spikes)")
+print(f"Python loop: {duration_python:.2f} s ({num_spikes_python} spikes)")
+print(f"Batched: {duration_batch:.2f} s ({num_spikes_batch} spikes)")
+print(f"Speedup: {duration_python / duration_batch:.1f}x")
+print(f"Reproducible with same seed: {reproducible}")
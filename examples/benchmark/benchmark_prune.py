@@ -0,0 +1,82 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from snudda import SnuddaInit, SnuddaPlace, SnuddaDetect
+from snudda.detect.prune import SnuddaPrune
+
+# Compares the compiled pruning kernel (get_keep_row_flag) with the pure python reference loop
+# (get_keep_row_flag_python) on a synthetic synapse matrix, using the pruning rules of a striatal network.
+#
+# Usage: python benchmark_prune.py [network_path] [num_synapses] [num_verify]
+#
+# The python reference is only run on the first num_verify synapses (it is slow), the compiled kernel is
+# timed on all num_synapses synapses. If the network_path does not contain a detected network,
+# a small striatal network is created.
+
+network_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join("networks", "benchmark_prune")
+num_synapses = int(sys.argv[2]) if len(sys.argv) > 2 else 10000000
+num_verify = int(sys.argv[3]) if len(sys.argv) > 3 else 1000000
+
+if not os.path.isfile(os.path.join(network_path, "log", "network-detect-worklog.hdf5")):
+    si = SnuddaInit(network_path=network_path, struct_def={"Striatum": 200}, random_seed=1234)
+    spl = SnuddaPlace(network_path=network_path)
+    spl.place()
+    sd = SnuddaDetect(network_path=network_path)
+    sd.detect()
+
+sp = SnuddaPrune(network_path=network_path)
+
+# Synthetic synapses, pairs of random neurons with on average 5 synapses per pair
+rng = np.random.default_rng(1234)
+num_neurons = len(sp.type_id_list)
+type_id = np.array(sp.type_id_list)
+
+channel_lookup = np.ones((type_id.max() + 1, type_id.max() + 1), dtype=np.int32)
+for pre_type_id, post_type_id, synapse_type_id in sp.connectivity_distributions:
+    channel_lookup[pre_type_id, post_type_id] = synapse_type_id
+
+pair_size = rng.poisson(4, size=num_synapses // 4) + 1
+pair_size = pair_size[:np.searchsorted(np.cumsum(pair_size), num_synapses) + 1]
+pre_id = rng.integers(0, num_neurons, size=len(pair_size))
+post_id = rng.integers(0, num_neurons, size=len(pair_size))
+
+synapses = np.zeros((np.sum(pair_size), 13), dtype=np.int32)
+synapses[:, 0] = np.repeat(pre_id, pair_size)
+synapses[:, 1] = np.repeat(post_id, pair_size)
+synapses[:, 2:5] = rng.integers(0, 1000, size=(synapses.shape[0], 3))
+synapses[:, 6] = channel_lookup[type_id[synapses[:, 0]], type_id[synapses[:, 1]]]
+synapses[:, 8] = rng.integers(0, 300, size=synapses.shape[0])
+synapses[:, 12] = rng.integers(0, 1000000, size=synapses.shape[0])
+
+# Same sort order as the merged synapse files: post synaptic neuron, pre synaptic neuron, synapse type
+synapses = synapses[np.lexsort((synapses[:, 6], synapses[:, 0], synapses[:, 1])), :]
+
+print(f"Synthetic synapses: {synapses.shape[0]}")
+
+# First call compiles the kernel, do not include it in the timing
+sp.get_keep_row_flag(synapses=synapses[:1000, :].copy(), merge_data_type="synapses")
+
+verify_synapses = synapses[:num_verify, :]
+
+start_time = timeit.default_timer()
+keep_python = sp.get_keep_row_flag_python(synapses=verify_synapses.copy(), merge_data_type="synapses")
+duration_python = timeit.default_timer() - start_time
+
+keep_numba = sp.get_keep_row_flag(synapses=verify_synapses.copy(), merge_data_type="synapses")
+
+print(f"Identical result ({verify_synapses.shape[0]} synapses, {np.sum(keep_python)} kept): "
+      f"{(keep_python == keep_numba).all()}")
+
+start_time = timeit.default_timer()
+keep_numba = sp.get_keep_row_flag(synapses=synapses, merge_data_type="synapses")
+duration_numba = timeit.default_timer() - start_time
+
+python_rate = verify_synapses.shape[0] / duration_python
+numba_rate = synapses.shape[0] / duration_numba
+
+print(f"Python loop: {duration_python:.1f} s ({python_rate / 1e6:.2f} M synapses/s)")
+print(f"Numba kernel: {duration_numba:.1f} s ({numba_rate / 1e6:.2f} M synapses/s, {np.sum(keep_numba)} kept)")
+print(f"Speedup: {numba_rate / python_rate:.1f}x")
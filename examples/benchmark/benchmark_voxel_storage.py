@@ -0,0 +1,59 @@
+import os
+import sys
+import timeit
+
+from snudda import SnuddaInit, SnuddaPlace, SnuddaDetect
+
+# Compares dense and sparse voxel storage (SnuddaDetect voxel_storage option) on the most crowded
+# hyper voxel: execution time, memory used by the voxel occupancy and that the synapses are identical.
+#
+# Usage: python benchmark_voxel_storage.py [network_path] [num_neurons] [hyper_voxel_size]
+#
+# If the network_path does not contain a placed network, a striatal network is created.
+
+network_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join("networks", "benchmark_detect")
+num_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+hyper_voxel_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+if not os.path.isfile(os.path.join(network_path, "network-neuron-positions.hdf5")):
+    si = SnuddaInit(network_path=network_path, struct_def={"Striatum": num_neurons}, random_seed=1234)
+    spl = SnuddaPlace(network_path=network_path)
+    spl.place()
+
+result = dict()
+
+for voxel_storage in ["dense", "sparse"]:
+
+    sd = SnuddaDetect(network_path=network_path, hyper_voxel_size=hyper_voxel_size, voxel_storage=voxel_storage)
+    os.makedirs(os.path.dirname(sd.save_file), exist_ok=True)
+    sd.setup_work_history(os.path.join(network_path, "log", f"benchmark-{voxel_storage}-worklog.hdf5"))
+    sd.distribute_neurons_parallel(d_view=None)
+
+    neuron_ctr = dict([(hid, sd.hyper_voxels[hid]["neuronCtr"]) for hid in sd.hyper_voxels])
+    hyper_id = max(neuron_ctr, key=neuron_ctr.get)
+
+    # Run twice, so numba compilation is not included in the timing
+    sd.process_hyper_voxel(hyper_id)
+
+    start_time = timeit.default_timer()
+    sd.process_hyper_voxel(hyper_id)
+    duration = timeit.default_timer() - start_time
+
+    if voxel_storage == "sparse":
+        voxel_bytes = sd.axon_sparse.nbytes() + sd.dend_sparse.nbytes()
+    else:
+        voxel_bytes = sum([x.nbytes for x in [sd.axon_voxels, sd.axon_voxel_ctr, sd.axon_soma_dist,
+                                              sd.dend_voxels, sd.dend_voxel_ctr, sd.dend_sec_id,
+                                              sd.dend_sec_x, sd.dend_soma_dist]])
+
+    result[voxel_storage] = (sd.hyper_voxel_synapses[:sd.hyper_voxel_synapse_ctr, :].copy(),
+                             sd.hyper_voxel_gap_junctions[:sd.hyper_voxel_gap_junction_ctr, :].copy())
+
+    print(f"{voxel_storage}: hyper voxel {hyper_id} ({neuron_ctr[hyper_id]} neurons), "
+          f"{sd.hyper_voxel_synapse_ctr} synapses, {sd.hyper_voxel_gap_junction_ctr} gap junctions, "
+          f"{sd.voxel_overflow_counter} overflows, {duration:.2f} s, voxel memory {voxel_bytes / 1e6:.1f} MB")
+
+    sd.work_history.close()
+
+identical = all([d.shape == s.shape and (d == s).all() for d, s in zip(result["dense"], result["sparse"])])
+print(f"Identical result: {identical}")
@@ -22,7 +22,7 @@ else:
     install_requires = [
         "bluepyopt>=1.9.126",
         "h5py>=3.1.0",
-        "ipyparallel>=6.3.0",
+        "ipyparallel>=7.0.0",
         "matplotlib>=3.3.4",
         "mpi4py>=3.0.3",
         "numpy>=1.20.1",
@@ -32,7 +32,8 @@ else:
         "setuptools",
         "psutil",
         "argparse",
-        "numexpr"
+        "numexpr",
+        "numba>=0.56.0"
     ]
     
 setuptools.setup(
@@ -12,6 +12,7 @@ from glob import glob
 import os
 import sys
 import json
+import hashlib
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -19,6 +20,7 @@ import matplotlib.patches as patches
 from mpl_toolkits.mplot3d import Axes3D
 
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.numpy_encoder import NumpyEncoder
 
 
 # !!! We need to parallelise the analysis script also!
@@ -63,6 +65,10 @@ class SnuddaAnalyse(object):
         self.all_types = None
         self.neuron_type_id = None
 
+        # Connection matrices for different filters, see get_connection_matrix
+        self.connection_matrix_cache = dict([])
+        self.save_cache = False
+
         if hdf5_file is None or hdf5_file == "last":
             hdf5_file = self.find_latest_file()
 
@@ -78,6 +84,8 @@ class SnuddaAnalyse(object):
         # First load all data but synapses
         self.network_load = SnuddaLoad(hdf5_file, load_synapses=False)
         self.network = self.network_load.data
+        self.hdf5_file_name = hdf5_file
+        self.file_hash = self.get_file_hash(hdf5_file)
 
         if "config" in self.network:
             self.config = json.loads(self.network["config"], object_pairs_hook=OrderedDict)
@@ -107,8 +115,8 @@ class SnuddaAnalyse(object):
             # self.connectionMatrix = self.createConnectionMatrix(synType=1,
             #                                                    lowMemory=lowMemory)
 
-            self.connection_matrix = self.create_connection_matrix(low_memory=low_memory)
-            self.connection_matrix_gj = self.create_connection_matrix_gj()
+            self.connection_matrix = self.get_connection_matrix()
+            self.connection_matrix_gj = self.get_connection_matrix(data_type="gapJunctions")
 
             # self.connectionMatrix = self.createConnectionMatrixSLOW(synType=1)
             self.make_pop_dict()
@@ -119,6 +127,9 @@ class SnuddaAnalyse(object):
             if save_cache:
                 self.save_cache_data(hdf5_file)
 
+        # Connection matrices created later (see get_connection_matrix) are added to the cache file
+        self.save_cache = save_cache
+
         self.worker_data = []
 
         self.neuron_colors = {"dSPN": (77. / 255, 151. / 255, 1.0),
@@ -192,6 +203,9 @@ class SnuddaAnalyse(object):
         out_file["nNeurons"] = self.num_neurons
         out_file.create_dataset("positions", data=self.positions)
 
+        for key in self.connection_matrix_cache:
+            self.write_connection_matrix_cache(out_file, key)
+
         try:
 
             dend_pos_bin = dict([])
@@ -282,6 +296,9 @@ class SnuddaAnalyse(object):
 
                         self.dend_position_edges = data["dendPositionEdges"][()]
 
+                        if "connectionMatrixCache" in data:
+                            self.read_connection_matrix_cache(data)
+
                         # import pdb
                         # pdb.set_trace()
 
@@ -301,11 +318,208 @@ class SnuddaAnalyse(object):
 
     ############################################################################
 
-    def create_connection_matrix(self, chunk_size=1000000,
+    def get_file_hash(self, hdf5_file):
+
+        """
+        Returns hash of the network file signature (file size, modification time, number of synapses and
+        gap junctions), used as key for cached connection matrices. Hashing the file content is too slow
+        for large networks.
+
+        Args:
+            hdf5_file (str) : Path to network file
+        """
+
+        file_stat = os.stat(hdf5_file)
+        signature = f"{file_stat.st_size}:{file_stat.st_mtime_ns}" \
+                    f":{self.network.get('nSynapses')}:{self.network.get('nGapJunctions')}"
+
+        return hashlib.sha1(signature.encode()).hexdigest()
+
+    ############################################################################
+
+    def get_connection_matrix_key(self, syn_type=None, min_dend_dist=None, max_dend_dist=None,
+                                  data_type="synapses"):
+
+        """ Returns key of the connection matrix with the given filters, for the current network file. """
+
+        key_str = f"{self.file_hash}:{data_type}:{syn_type}:{min_dend_dist}:{max_dend_dist}"
+
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    ############################################################################
+
+    def get_connection_matrix(self, syn_type=None, min_dend_dist=None, max_dend_dist=None,
+                              data_type="synapses"):
+
+        """
+        Returns connection matrix, element (i, j) is the number of synapses from neuron i to neuron j.
+        The matrices are cached by file hash and filter parameters, in memory and in the cache file
+        (see save_cache_data).
+
+        Args:
+            syn_type (int) : Only count synapses of this type (channel model ID), None = all synapses
+            min_dend_dist (float) : Only count synapses at least this far from soma (micrometers), along dendrite
+            max_dend_dist (float) : Only count synapses at most this far from soma (micrometers), along dendrite
+            data_type (str) : "synapses" or "gapJunctions"
+
+        Returns:
+            Connection matrix (scipy.sparse.csr_matrix)
+        """
+
+        key = self.get_connection_matrix_key(syn_type=syn_type, min_dend_dist=min_dend_dist,
+                                             max_dend_dist=max_dend_dist, data_type=data_type)
+
+        if key not in self.connection_matrix_cache:
+            connection_matrix = self.create_connection_matrix(syn_type=syn_type,
+                                                              min_dend_dist=min_dend_dist,
+                                                              max_dend_dist=max_dend_dist,
+                                                              data_type=data_type)
+
+            self.connection_matrix_cache[key] = ({"dataType": data_type,
+                                                  "synType": syn_type,
+                                                  "minDendDist": min_dend_dist,
+                                                  "maxDendDist": max_dend_dist},
+                                                 connection_matrix)
+
+            cache_file = self.hdf5_file_name + "-cache"
+
+            if self.save_cache and os.path.isfile(cache_file):
+                print(f"Adding connection matrix to {cache_file}")
+                with h5py.File(cache_file, "a") as out_file:
+                    self.write_connection_matrix_cache(out_file, key)
+
+        return self.connection_matrix_cache[key][1]
+
+    ############################################################################
+
+    def write_connection_matrix_cache(self, out_file, key):
+
+        """ Writes the cached connection matrix with key to out_file (group connectionMatrixCache). """
+
+        cache_group = out_file.require_group("connectionMatrixCache")
+
+        if key in cache_group:
+            return
+
+        filter_info, connection_matrix = self.connection_matrix_cache[key]
+
+        con_mat_group = cache_group.create_group(key)
+        con_mat_group.attrs["fileHash"] = self.file_hash
+        con_mat_group.attrs["filter"] = json.dumps(filter_info, cls=NumpyEncoder)
+
+        con_mat_group.create_dataset("data", data=connection_matrix.data, compression="gzip")
+        con_mat_group.create_dataset("indices", data=connection_matrix.indices, compression="gzip")
+        con_mat_group.create_dataset("indptr", data=connection_matrix.indptr, compression="gzip")
+        con_mat_group.create_dataset("shape", data=connection_matrix.shape)
+
+    ############################################################################
+
+    def read_connection_matrix_cache(self, data):
+
+        """ Reads the cached connection matrices of the current network file (see write_connection_matrix_cache). """
+
+        for key, con_mat_group in data["connectionMatrixCache"].items():
+
+            if con_mat_group.attrs["fileHash"] != self.file_hash:
+                continue
+
+            filter_info = json.loads(con_mat_group.attrs["filter"])
+            connection_matrix = sps.csr_matrix((con_mat_group["data"][()],
+                                                con_mat_group["indices"][()],
+                                                con_mat_group["indptr"][()]),
+                                               shape=tuple(con_mat_group["shape"][()]))
+
+            self.connection_matrix_cache[key] = (filter_info, connection_matrix)
+
+    ############################################################################
+
+    def create_connection_matrix(self, chunk_size=10000000,
                                  syn_type=None,
                                  min_dend_dist=None,
                                  max_dend_dist=None,
-                                 low_memory=False):
+                                 low_memory=False,
+                                 data_type="synapses"):
+
+        """
+        Creates connection matrix, element (i, j) is the number of synapses from neuron i to neuron j.
+        The synapses are read in chunks, the synapses passing the filters are counted per (pre, post) pair
+        using combined pair keys, and the CSR matrix is built directly from the sorted keys.
+
+        Args:
+            chunk_size (int) : Number of synapse rows read at a time
+            syn_type (int) : Only count synapses of this type (channel model ID), None = all synapses
+            min_dend_dist (float) : Only count synapses at least this far from soma (micrometers), along dendrite
+            max_dend_dist (float) : Only count synapses at most this far from soma (micrometers), along dendrite
+            low_memory (bool) : Not used, the matrix is always sparse
+            data_type (str) : "synapses" or "gapJunctions" (no filters for gap junctions)
+
+        Returns:
+            Connection matrix (scipy.sparse.csr_matrix, int16)
+        """
+
+        assert data_type == "synapses" or (syn_type is None and min_dend_dist is None and max_dend_dist is None), \
+            "create_connection_matrix: Filters are only supported for synapses"
+
+        t0 = timeit.default_timer()
+
+        num_neurons = int(self.num_neurons)
+        num_rows_total = self.network["nSynapses"] if data_type == "synapses" else self.network["nGapJunctions"]
+
+        pair_keys = [np.zeros((0,), dtype=np.int64)]
+        pair_counts = [np.zeros((0,), dtype=np.int64)]
+        row_ctr = 0
+
+        for synapses in self.network_load.synapse_iterator(chunk_size=chunk_size, data_type=data_type):
+
+            print(f"{data_type} row {row_ctr} - {100 * row_ctr / float(num_rows_total):.1f} % "
+                  f"time: {timeit.default_timer() - t0:.1f} seconds")
+
+            row_ctr += synapses.shape[0]
+
+            keep_flag = np.ones((synapses.shape[0],), dtype=bool)
+
+            if syn_type is not None:
+                keep_flag &= synapses[:, 6] == syn_type
+
+            if min_dend_dist is not None:
+                keep_flag &= synapses[:, 8] >= min_dend_dist
+
+            if max_dend_dist is not None:
+                keep_flag &= synapses[:, 8] <= max_dend_dist
+
+            keys, counts = np.unique(synapses[keep_flag, 0].astype(np.int64) * num_neurons + synapses[keep_flag, 1],
+                                     return_counts=True)
+            pair_keys.append(keys)
+            pair_counts.append(counts)
+
+        # A pair can be split between two chunks
+        keys, key_idx = np.unique(np.concatenate(pair_keys), return_inverse=True)
+        counts = np.zeros(keys.shape, dtype=np.int64)
+        np.add.at(counts, key_idx.ravel(), np.concatenate(pair_counts))
+
+        # Keys are sorted on pre_id, then post_id, i.e. CSR order
+        pre_id = keys // num_neurons
+        post_id = keys % num_neurons
+        indptr = np.searchsorted(pre_id, np.arange(num_neurons + 1))
+
+        connection_matrix = sps.csr_matrix((counts.astype(np.int16), post_id, indptr),
+                                           shape=(num_neurons, num_neurons))
+
+        t1 = timeit.default_timer()
+
+        print(f"Created {data_type} connection matrix {t1 - t0:.1f} seconds")
+
+        return connection_matrix
+
+    ############################################################################
+
+    def create_connection_matrix_python(self, chunk_size=1000000,
+                                        syn_type=None,
+                                        min_dend_dist=None,
+                                        max_dend_dist=None,
+                                        low_memory=False):
+
+        """ Reference implementation of create_connection_matrix, loops over the synapses in python. """
 
         t0 = timeit.default_timer()
 
@@ -377,46 +591,9 @@ class SnuddaAnalyse(object):
 
     def create_connection_matrix_gj(self):
 
-        t0 = timeit.default_timer()
-
-        connection_matrix_gj = sps.lil_matrix((self.num_neurons, self.num_neurons),
-                                              dtype=np.int16)
-
-        last_src_id = 0
-        last_dest_id = 0
-        last_count = 0
-
-        row_ctr = 0
-        num_gj_total = self.network["nGapJunctions"]
-
-        for gjList in self.network_load.gap_junction_iterator(chunk_size=100000):
-
-            if num_gj_total > 0:
-                print(f"GJ row : {row_ctr} - {100 * row_ctr / float(num_gj_total)} % "
-                      f" time : {timeit.default_timer() - t0} seconds")
-
-            for gjRow in gjList:
-                row_ctr += 1
-
-                src_id = gjRow[0]
-                dest_id = gjRow[1]
-
-                if last_src_id == src_id and last_dest_id == dest_id:
-                    last_count += 1
-                else:
-                    connection_matrix_gj[last_src_id, last_dest_id] += last_count
-
-                    last_src_id = src_id
-                    last_dest_id = dest_id
-                    last_count = 1
-
-            connection_matrix_gj[last_src_id, last_dest_id] += last_count
-            last_count = 0
-
-        t1 = timeit.default_timer()
-        print("Created gap junction connection matrix " + str(t1 - t0) + " seconds")
+        """ Creates gap junction connection matrix, see create_connection_matrix. """
 
-        return sps.csr_matrix(connection_matrix_gj, dtype=np.int16)
+        return self.create_connection_matrix(data_type="gapJunctions")
 
     ############################################################################
 
@@ -1355,7 +1532,141 @@ class SnuddaAnalyse(object):
                                num_bins=86,
                                num_points=10000000.0,
                                dist_3d=True,
-                               connection_type="synapses"):
+                               connection_type="synapses",
+                               rng=None,
+                               batch_size=10000000):
+
+        """
+        Calculates the connection probability as a function of soma distance, by sampling pairs of neurons.
+        On average num_points / len(pre_id) post synaptic neurons (without replacement) are sampled for each
+        pre synaptic neuron. The pairs are sampled in batches, and the distances and connectivity of each
+        batch are computed with array operations.
+
+        Args:
+            pre_id (list) : Pre synaptic neuron ID
+            post_id (list) : Post synaptic neuron ID
+            num_bins (int) : Number of distance bins (bin width 1700e-6 / (num_bins - 1) meters)
+            num_points (int) : Number of pairs to sample
+            dist_3d (bool) : Use 3D distance, otherwise 2D distance (xy) and pairs more than 70 micrometers
+                             apart in z-depth are rejected
+            connection_type (str) : "synapses" or "gapjunctions"
+            rng : Numpy random number generator, default np.random.default_rng()
+            batch_size (int) : Maximum number of random numbers generated at a time
+
+        Returns:
+            dist (bin edges), p_con, count_con, count_all
+        """
+
+        # Count the connected neurons
+        print("Counting connections")
+        dist = np.linspace(0.0, 1700.0e-6, num=num_bins)
+        delta_dist = dist[1] - dist[0]
+
+        count_con = np.zeros((num_bins, 1))
+        count_all = np.zeros((num_bins, 1))
+        count_rejected = 0
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        pre_id = np.array(pre_id, dtype=int)
+        post_id = np.array(post_id, dtype=int)
+
+        num_per_pair = num_points / len(pre_id)
+
+        if connection_type == "synapses":
+            con_mat = sps.csr_matrix(self.connection_matrix)
+        elif connection_type == "gapjunctions":
+            con_mat = sps.csr_matrix(self.connection_matrix_gj)
+        else:
+            assert False, "Unknown connection_type: " + str(connection_type)
+
+        # Each pre synaptic neuron gets floor or ceil of num_per_pair post synaptic neurons
+        num_sample_max = min(int(np.ceil(num_per_pair)), len(post_id))
+        num_pre_batch = max(1, int(batch_size // max(len(post_id), 1)))
+
+        for batch_start in range(0, len(pre_id), num_pre_batch):
+            t_a = timeit.default_timer()
+
+            batch_pre_id = pre_id[batch_start:batch_start + num_pre_batch]
+
+            num_pts = np.where(num_per_pair - np.floor(num_per_pair) > rng.random(len(batch_pre_id)),
+                               int(np.ceil(num_per_pair)), int(np.floor(num_per_pair)))
+            num_pts = np.minimum(num_pts, len(post_id))
+
+            # Random subset of post_id for each pre_id, the num_sample_max smallest random keys of each row.
+            # The first num_sample_max - 1 columns hold the smallest keys, so rows using fewer points
+            # also get a random subset (this holds also when all post_id are sampled)
+            if num_sample_max > 0:
+                random_keys = rng.random((len(batch_pre_id), len(post_id)), dtype=np.float32)
+                sample_idx = np.argpartition(random_keys, num_sample_max - 1, axis=1)[:, :num_sample_max]
+            else:
+                sample_idx = np.zeros((len(batch_pre_id), 0), dtype=int)
+
+            sample_flag = np.arange(num_sample_max) < num_pts[:, None]
+            x = np.repeat(batch_pre_id, num_sample_max)[sample_flag.ravel()]
+            y = post_id[sample_idx[sample_flag]]
+
+            # Do not count self connections in statistics!!
+            # This can lead to what looks like an artificial drop in connectivity proximally
+            keep_flag = x != y
+
+            if dist_3d:
+                d = np.linalg.norm(self.positions[x, :] - self.positions[y, :], axis=1)
+            else:
+                d = np.linalg.norm(self.positions[x, 0:2] - self.positions[y, 0:2], axis=1)
+
+                # We also need to check that z-distance is not too large
+
+                # Gilad email 2017-11-21:
+                # The 100 um is the lateral (XY) distance between somata of
+                # recorded cells. In terms of the Z axis, the slice
+                # thickness is 250 um but the recordings are all done in the
+                # upper half of the slice due to visibility of the cells. So
+                # lets say in a depth of roughly 40-110 um from the upper
+                # surface of the slice.
+                dz = np.abs(self.positions[x, 2] - self.positions[y, 2])
+
+                # Using dzMax = 70, see comment above from Gilad.
+                z_flag = dz <= 70e-6
+                count_rejected += np.sum(np.logical_and(keep_flag, ~z_flag))
+                keep_flag = np.logical_and(keep_flag, z_flag)
+
+            x, y, d = x[keep_flag], y[keep_flag], d[keep_flag]
+
+            idx = np.floor(d / delta_dist).astype(int)
+            assert (idx < num_bins).all(), "Idx too large " + str(np.max(idx))
+
+            connected = np.asarray(con_mat[x, y]).ravel() > 0
+
+            count_con[:, 0] += np.bincount(idx[connected], minlength=num_bins)
+            count_all[:, 0] += np.bincount(idx, minlength=num_bins)
+
+            t_b = timeit.default_timer()
+
+            if self.debug:
+                print(f"{batch_start + len(batch_pre_id)}/{len(pre_id)} {t_b - t_a}s")
+
+        p_con = np.divide(count_con, count_all)
+
+        print("Requested: " + str(num_points) + " calculated " + str(sum(count_all)))
+
+        if not dist_3d:
+            print("Rejected (too large z-depth): " + str(count_rejected))
+
+        return dist, p_con, count_con, count_all
+
+    ############################################################################
+
+    def connection_probability_python(self,
+                                      pre_id,
+                                      post_id,
+                                      num_bins=86,
+                                      num_points=10000000.0,
+                                      dist_3d=True,
+                                      connection_type="synapses"):
+
+        """ Reference implementation of connection_probability, loops over the pairs in python. """
 
         # Count the connected neurons
         print("Counting connections")
@@ -2328,12 +2639,208 @@ class SnuddaAnalyse(object):
 
     ############################################################################
 
-    def analyse_single_motifs(self, neuron_type, num_repeats=10000000):
+    @staticmethod
+    def get_pair_codes(con_mat, pre_id, post_id):
+
+        """
+        Returns indicator matrices (len(pre_id) x len(post_id)) of the pair codes 1, 2 and 3, where the
+        code of a pair is [pre -> post] + 2 * [post -> pre].
+
+        Args:
+            con_mat (scipy.sparse.csr_matrix) : Binary connection matrix (int)
+            pre_id (np.array) : Neuron ID of rows
+            post_id (np.array) : Neuron ID of columns
+        """
+
+        forward = con_mat[pre_id, :][:, post_id].tocsr()
+        backward = con_mat[post_id, :][:, pre_id].T.tocsr()
+        both = forward.multiply(backward).tocsr()
+
+        pair_codes = [(forward - both).tocsr(), (backward - both).tocsr(), both]
+
+        for pc in pair_codes:
+            pc.eliminate_zeros()
+
+        return pair_codes
+
+    ############################################################################
+
+    @staticmethod
+    def count_motif_block(x_codes, y_codes, z_codes):
+
+        """
+        Counts the triples (a, b, c) with pair codes (u, v, w), for a block of A neurons.
+
+        Args:
+            x_codes (list) : Pair code matrices (1, 2, 3) of A-B, rows are the block of A neurons
+            y_codes (list) : Pair code matrices (1, 2, 3) of A-C, rows are the block of A neurons
+            z_codes (list) : Pair code matrices (1, 2, 3) of B-C
+
+        Returns:
+            Array (3, 3, 3), element [u, v, w] is sum over a, b, c of X_u[a, b] * Y_v[a, c] * Z_w[b, c]
+        """
+
+        triple_count = np.zeros((3, 3, 3), dtype=np.int64)
+
+        for u, x in enumerate(x_codes):
+            for w, z in enumerate(z_codes):
+                xz = x @ z
+
+                for v, y in enumerate(y_codes):
+                    triple_count[u, v, w] = y.multiply(xz).sum()
+
+        return triple_count
+
+    ############################################################################
+
+    def count_motifs_exact(self, type_a, type_b, type_c, num_workers=None, block_size=1000):
+
+        """
+        Counts all three neuron motifs exactly, using sparse matrix products of the connection matrix.
+        Every triple of distinct neurons (a, b, c), with a of type_a, b of type_b and c of type_c, is counted
+        in one of 64 motif classes (same numbering as count_motifs):
+
+        bit 1 : A->B (1), bit 2 : A<-B (2), bit 3 : A->C (4), bit 4 : A<-C (8), bit 5 : B->C (16), bit 6 : B<-C (32)
+
+        The pair codes of A-B, A-C and B-C (code = [p->q] + 2 * [q->p]) are sparse indicator matrices for
+        codes 1-3. Code 0 (not connected) is written as all pairs minus codes 1-3, so the counts are sums of
+        sparse triple products and row/column sums. Triples where a neuron is picked twice (if the types
+        overlap) are removed by inclusion-exclusion.
+
+        Args:
+            type_a (str) : Neuron type A
+            type_b (str) : Neuron type B
+            type_c (str) : Neuron type C
+            num_workers (int) : Number of processes used for the triple products, None = serial
+            block_size (int) : Number of A neurons per block
+
+        Returns:
+            motif_ctr (np.array, 64 elements), type_a, type_b, type_c
+        """
+
+        print(f"Counting motifs between {type_a}, {type_b}, {type_c} (exact)")
+
+        id_a = np.array(self.populations[type_a], dtype=int)
+        id_b = np.array(self.populations[type_b], dtype=int)
+        id_c = np.array(self.populations[type_c], dtype=int)
+
+        con_mat = sps.csr_matrix((self.connection_matrix > 0).astype(np.int64))
+
+        x_codes = self.get_pair_codes(con_mat, id_a, id_b)
+        y_codes = self.get_pair_codes(con_mat, id_a, id_c)
+        z_codes = self.get_pair_codes(con_mat, id_b, id_c)
+
+        # triple_count[u, v, w] with basis 0 = all pairs, 1-3 = pair code indicator matrices
+        triple_count = np.zeros((4, 4, 4), dtype=np.int64)
+
+        blocks = [(x_start, min(x_start + block_size, len(id_a))) for x_start in range(0, len(id_a), block_size)]
+
+        if num_workers is not None and num_workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(SnuddaAnalyse.count_motif_block,
+                                           [x[start:end, :] for x in x_codes],
+                                           [y[start:end, :] for y in y_codes],
+                                           z_codes)
+                           for start, end in blocks]
+                for future in futures:
+                    triple_count[1:, 1:, 1:] += future.result()
+        else:
+            for start, end in blocks:
+                triple_count[1:, 1:, 1:] += self.count_motif_block([x[start:end, :] for x in x_codes],
+                                                                   [y[start:end, :] for y in y_codes],
+                                                                   z_codes)
+
+        num_a, num_b, num_c = len(id_a), len(id_b), len(id_c)
+
+        for u, x in enumerate(x_codes, start=1):
+            x_row, x_col = np.asarray(x.sum(axis=1)).ravel(), np.asarray(x.sum(axis=0)).ravel()
+            triple_count[u, 0, 0] = num_c * x.sum()
+
+            for v, y in enumerate(y_codes, start=1):
+                triple_count[u, v, 0] = np.dot(x_row, np.asarray(y.sum(axis=1)).ravel())
+
+            for w, z in enumerate(z_codes, start=1):
+                triple_count[u, 0, w] = np.dot(x_col, np.asarray(z.sum(axis=1)).ravel())
+
+        for v, y in enumerate(y_codes, start=1):
+            y_col = np.asarray(y.sum(axis=0)).ravel()
+            triple_count[0, v, 0] = num_b * y.sum()
+
+            for w, z in enumerate(z_codes, start=1):
+                triple_count[0, v, w] = np.dot(y_col, np.asarray(z.sum(axis=0)).ravel())
+
+        for w, z in enumerate(z_codes, start=1):
+            triple_count[0, 0, w] = num_a * z.sum()
+
+        triple_count[0, 0, 0] = num_a * num_b * num_c
+
+        # Code 0 is all pairs minus codes 1-3
+        basis = np.eye(4, dtype=np.int64)
+        basis[0, 1:] = -1
+
+        all_ctr = np.einsum("iu,jv,kw,uvw->ijk", basis, basis, basis, triple_count)
+
+        # Motif index is code(a, b) + 4 * code(a, c) + 16 * code(b, c), einsum gives [code_ab, code_ac, code_bc]
+        motif_ctr = all_ctr.transpose(2, 1, 0).ravel()
+
+        # Remove triples where the same neuron is picked twice (or three times)
+        swap_code = np.array([0, 2, 1, 3])
+        self_code = 3 * (con_mat.diagonal() > 0)
+        codes = np.arange(4)
+
+        def code_hist(neuron_id, other_id):
+            # Number of neurons in other_id with code(neuron_id, other) = 0, 1, 2, 3
+            pair_codes = self.get_pair_codes(con_mat, neuron_id, other_id)
+            hist = np.zeros((len(neuron_id), 4), dtype=np.int64)
+            for k, pc in enumerate(pair_codes, start=1):
+                hist[:, k] = np.asarray(pc.sum(axis=1)).ravel()
+            hist[:, 0] = len(other_id) - np.sum(hist, axis=1)
+            return hist
+
+        # a == b
+        id_ab = np.intersect1d(id_a, id_b)
+        np.add.at(motif_ctr, self_code[id_ab][:, None] + 20 * codes[None, :], -code_hist(id_ab, id_c))
+
+        # a == c
+        id_ac = np.intersect1d(id_a, id_c)
+        np.add.at(motif_ctr, codes[None, :] + 4 * self_code[id_ac][:, None] + 16 * swap_code[None, :],
+                  -code_hist(id_ac, id_b))
+
+        # b == c, code(a, n) = swap(code(n, a))
+        id_bc = np.intersect1d(id_b, id_c)
+        np.add.at(motif_ctr, 5 * swap_code[None, :] + 16 * self_code[id_bc][:, None], -code_hist(id_bc, id_a))
+
+        # a == b == c was removed three times, but counted once
+        id_abc = np.intersect1d(id_ab, id_c)
+        np.add.at(motif_ctr, 21 * self_code[id_abc], 2)
+
+        return motif_ctr, type_a, type_b, type_c
+
+    ############################################################################
+
+    def analyse_single_motifs(self, neuron_type, num_repeats=10000000, exact=True):
+
+        """
+        Prints the frequency of the three neuron motifs of neuron_type.
 
-        (motif_ctr, tA, tB, tC) = self.count_motifs(type_a=neuron_type,
-                                                    type_b=neuron_type,
-                                                    type_c=neuron_type,
-                                                    n_repeats=num_repeats)
+        Args:
+            neuron_type (str) : Neuron type
+            num_repeats (int) : Number of samples, if exact is False
+            exact (bool) : Count all motifs exactly (count_motifs_exact), otherwise sample (count_motifs)
+        """
+
+        if exact:
+            (motif_ctr, tA, tB, tC) = self.count_motifs_exact(type_a=neuron_type,
+                                                              type_b=neuron_type,
+                                                              type_c=neuron_type)
+            num_repeats = np.sum(motif_ctr)
+        else:
+            (motif_ctr, tA, tB, tC) = self.count_motifs(type_a=neuron_type,
+                                                        type_b=neuron_type,
+                                                        type_c=neuron_type,
+                                                        n_repeats=num_repeats)
 
         # !!! For debug
         # motifCtr = [bin(x).count('1') for x in np.arange(0,64)]
@@ -2409,7 +2916,10 @@ class SnuddaAnalyse(object):
     # If A is connected to B and C, what is probability that
     # B and C are connected?
 
-    def simple_motif(self, type_a, type_b, type_c, n_rep=1000):
+    def simple_motif(self, type_a, type_b, type_c, n_rep=1000, exact=True):
+
+        if exact:
+            return self.simple_motif_exact(type_a=type_a, type_b=type_b, type_c=type_c)
 
         ida = self.populations[type_a]
         idb = self.populations[type_b]
@@ -2472,6 +2982,48 @@ class SnuddaAnalyse(object):
 
     ############################################################################
 
+    def simple_motif_exact(self, type_a, type_b, type_c):
+
+        """
+        Exact version of simple_motif, uses all A neurons. For all pairs (b, c) with A->B and A->C,
+        counts how many have B->C, C->B and B<->C.
+
+        Args:
+            type_a (str) : Neuron type A
+            type_b (str) : Neuron type B
+            type_c (str) : Neuron type C
+
+        Returns:
+            con_bc, con_cb, con_bi, all_ctr
+        """
+
+        id_a = np.array(self.populations[type_a], dtype=int)
+        id_b = np.array(self.populations[type_b], dtype=int)
+        id_c = np.array(self.populations[type_c], dtype=int)
+
+        con_mat = sps.csr_matrix((self.connection_matrix > 0).astype(np.int64))
+
+        con_ab = con_mat[id_a, :][:, id_b]
+        con_ac = con_mat[id_a, :][:, id_c]
+        con_bc_mat = con_mat[id_b, :][:, id_c]
+        con_cb_mat = con_mat[id_c, :][:, id_b].T.tocsr()
+
+        # Sum over a, b, c of ab[a, b] * ac[a, c] * bc[b, c]
+        con_bc = con_ac.multiply(con_ab @ con_bc_mat).sum()
+        con_cb = con_ac.multiply(con_ab @ con_cb_mat).sum()
+        con_bi = con_ac.multiply(con_ab @ con_bc_mat.multiply(con_cb_mat)).sum()
+        all_ctr = np.dot(np.asarray(con_ab.sum(axis=1)).ravel(), np.asarray(con_ac.sum(axis=1)).ravel())
+
+        print("If " + str(type_a) + " connected to " + str(type_b) + " " \
+              + str(type_c) + ":")
+        print("P(" + type_b + "->" + type_c + ") = " + str((100.0 * con_bc) / all_ctr) + "%")
+        print("P(" + type_c + "->" + type_b + ") = " + str((100.0 * con_cb) / all_ctr) + "%")
+        print("P(" + type_b + "<->" + type_c + ") = " + str((100.0 * con_bi) / all_ctr) + "%")
+
+        return con_bc, con_cb, con_bi, all_ctr
+
+    ############################################################################
+
     # Pick a post synaptic neuron, find out the distance to its closest
     # presynaptic neighbour
 
@@ -6,6 +6,11 @@ import os
 import sys
 
 
+PARALLEL_HELP = "Run in parallel, using a running ipcluster"
+LOCAL_WORKERS_HELP = ("Run in parallel, starting N worker processes on this machine instead of using ipcluster "
+                      "(N=0 starts one worker per core)")
+
+
 def snudda_cli():
     """
     Command line parser for Snudda.
@@ -56,7 +61,9 @@ def snudda_cli():
     place_parser.add_argument("--profile", help="Run python cProfile", action="store_true")
     place_parser.add_argument("--verbose", action="store_true")
     place_parser.add_argument("--h5legacy", help="Use legacy hdf5 support", action="store_true")
-    place_parser.add_argument("-parallel", "--parallel", action="store_true", default=False)
+    place_parser.add_argument("-parallel", "--parallel", action="store_true", help=PARALLEL_HELP)
+    place_parser.add_argument("--localWorkers", dest="local_workers", type=int, default=None, metavar="N",
+                              help=LOCAL_WORKERS_HELP)
 
     detect_parser = sub_parsers.add_parser("detect")
     detect_parser.add_argument("path", help="Location of network")
@@ -68,7 +75,18 @@ def snudda_cli():
     detect_parser.add_argument("--profile", help="Run python cProfile", action="store_true")
     detect_parser.add_argument("--verbose", action="store_true")
     detect_parser.add_argument("--h5legacy", help="Use legacy hdf5 support", action="store_true")
-    detect_parser.add_argument("-parallel", "--parallel", action="store_true", default=False)
+    detect_parser.add_argument("--voxelStorage", dest="voxel_storage", default="dense", choices=["dense", "sparse"],
+                               help="Voxel occupancy storage, sparse uses less memory and has no voxel overflow")
+    detect_parser.add_argument("--hyperVoxelOrder", dest="hyper_voxel_order", default="size",
+                               choices=["size", "spatial"],
+                               help="Process hyper voxels largest first (size) or neighbours after each other (spatial)")
+    detect_parser.add_argument("--hyperVoxelParts", dest="hyper_voxel_parts", default=1, type=int,
+                               help="Divide detection in each hyper voxel into parts (slabs), so large hyper "
+                                    "voxels can be split between workers. Neurons crossing several slabs are "
+                                    "placed once per part")
+    detect_parser.add_argument("-parallel", "--parallel", action="store_true", help=PARALLEL_HELP)
+    detect_parser.add_argument("--localWorkers", dest="local_workers", type=int, default=None, metavar="N",
+                               help=LOCAL_WORKERS_HELP)
 
     prune_parser = sub_parsers.add_parser("prune")
     prune_parser.add_argument("path", help="Location of network")
@@ -82,7 +100,9 @@ def snudda_cli():
                               help="Keep temp and voxel files after pruning (e.g. useful if you want to rerun pruning)")
     prune_parser.add_argument("--savePutative", action="store_true",
                               help="Also saved network-putative-synapses.hdf5 with unpruned network")
-    prune_parser.add_argument("-parallel", "--parallel", action="store_true", default=False)
+    prune_parser.add_argument("-parallel", "--parallel", action="store_true", help=PARALLEL_HELP)
+    prune_parser.add_argument("--localWorkers", dest="local_workers", type=int, default=None, metavar="N",
+                              help=LOCAL_WORKERS_HELP)
 
     input_parser = sub_parsers.add_parser("input")
     input_parser.add_argument("path", help="Location of network")
@@ -96,7 +116,9 @@ def snudda_cli():
     input_parser.add_argument("--profile", help="Run python cProfile", action="store_true")
     input_parser.add_argument("--verbose", action="store_true")
     input_parser.add_argument("--h5legacy", help="Use legacy hdf5 support", action="store_true")
-    input_parser.add_argument("-parallel", "--parallel", action="store_true", default=False)
+    input_parser.add_argument("-parallel", "--parallel", action="store_true", help=PARALLEL_HELP)
+    input_parser.add_argument("--localWorkers", dest="local_workers", type=int, default=None, metavar="N",
+                              help=LOCAL_WORKERS_HELP)
 
     simulate_parser = sub_parsers.add_parser("simulate")
     simulate_parser.add_argument("path", help="Location of network")
@@ -108,6 +130,9 @@ def snudda_cli():
                                  dest="output_file", default=None)
 
     simulate_parser.add_argument("--time", type=float, default=2.5, help="Duration of simulation in seconds")
+    simulate_parser.add_argument("--outputWindow", type=float, default=None, dest="output_window",
+                                 help="Write output to disk every output window (seconds) during the simulation, "
+                                      "limits memory use for long simulations")
 
     simulate_parser.add_argument("--noVolt", "--novolt", dest="record_volt", action="store_false",
                                  help="Exclude voltage data, to save time and space.")
@@ -137,6 +162,10 @@ def snudda_cli():
 
     args = parser.parse_args()
 
+    if getattr(args, "local_workers", None) is not None:
+        # Local workers are passed on as parallel="local" (one per core) or "local:N"
+        args.parallel = "local" if args.local_workers == 0 else f"local:{args.local_workers}"
+
     snudda = Snudda(args.path)
 
     actions = {"init": snudda.init_config,
@@ -145,7 +145,7 @@ class Snudda(object):
             args : command line arguments from argparse
 
         Example:
-            snudda place [--raytraceBorders] [--profile] [--verbose] [--h5legacy] [-parallel] path
+            snudda place [--raytraceBorders] [--profile] [--verbose] [--h5legacy] [--parallel] [--localWorkers N] path
 
         """
         # self.networkPath = args.path
@@ -159,7 +159,7 @@ class Snudda(object):
         self.setup_log_file(log_file_name)  # sets self.logFile
 
         if args.parallel:
-            self.setup_parallel()  # sets self.d_view
+            self.setup_parallel(parallel=args.parallel)  # sets self.d_view
 
         from snudda.place.place import SnuddaPlace
 
@@ -193,7 +193,7 @@ class Snudda(object):
             args : command line arguments from argparse
 
         Example:
-            snudda detect [-cont] [-hvsize HVSIZE] [--volumeID VOLUMEID] [--profile] [--verbose] [--h5legacy] [-parallel] path
+            snudda detect [-cont] [-hvsize HVSIZE] [--volumeID VOLUMEID] [--profile] [--verbose] [--h5legacy] [--voxelStorage {dense,sparse}] [--hyperVoxelOrder {size,spatial}] [--hyperVoxelParts N] [--parallel] [--localWorkers N] path
 
         """
         # self.networkPath = args.path
@@ -228,7 +228,7 @@ class Snudda(object):
         self.setup_log_file(log_filename)  # sets self.logfile
 
         if args.parallel:
-            self.setup_parallel()  # sets self.d_view
+            self.setup_parallel(parallel=args.parallel)  # sets self.d_view
 
         if args.h5legacy:
             h5libver = "earliest"
@@ -249,6 +249,9 @@ class Snudda(object):
                           hyper_voxel_size=hyper_voxel_size,
                           h5libver=h5libver,
                           random_seed=random_seed,
+                          voxel_storage=args.voxel_storage,
+                          hyper_voxel_order=args.hyper_voxel_order,
+                          hyper_voxel_parts=args.hyper_voxel_parts,
                           verbose=args.verbose)
 
         if args.cont:
@@ -278,7 +281,7 @@ class Snudda(object):
             args : command line arguments from argparse
 
         Example:
-            snudda prune [--configFile CONFIG_FILE] [--profile] [--verbose] [--h5legacy] [--keepfiles] [-parallel] path
+            snudda prune [--configFile CONFIG_FILE] [--profile] [--verbose] [--h5legacy] [--keepfiles] [--parallel] [--localWorkers N] path
         """
 
         # self.networkPath = args.path
@@ -294,7 +297,7 @@ class Snudda(object):
         self.setup_log_file(log_filename)  # sets self.logfile
 
         if args.parallel:
-            self.setup_parallel()  # sets self.d_view
+            self.setup_parallel(parallel=args.parallel)  # sets self.d_view
 
         # Optionally set this
         scratch_path = None
@@ -332,7 +335,7 @@ class Snudda(object):
             args : command line arguments from argparse
 
         Example:
-            snudda input [--input INPUT] [--inputFile INPUT_FILE] [--networkFile NETWORK_FILE] [--time TIME] [-randomseed 123] [--profile] [--verbose] [--h5legacy] [-parallel] path
+            snudda input [--input INPUT] [--inputFile INPUT_FILE] [--networkFile NETWORK_FILE] [--time TIME] [-randomseed 123] [--profile] [--verbose] [--h5legacy] [--parallel] [--localWorkers N] path
         """
 
         print("Setting up inputs, assuming input.json exists")
@@ -340,7 +343,7 @@ class Snudda(object):
         self.setup_log_file(log_filename)  # sets self.logfile
 
         if args.parallel:
-            self.setup_parallel()  # sets self.d_view
+            self.setup_parallel(parallel=args.parallel)  # sets self.d_view
 
         from snudda.input.input import SnuddaInput
 
@@ -470,8 +473,8 @@ class Snudda(object):
 
         Example:
             snudda simulate [--networkFile NETWORK_FILE] [--inputFile INPUT_FILE] [--time TIME]
-            [--spikesOut SPIKES_OUT] [--neuromodulation NEUROMODULATION] [--noVolt] [--disableGJ]
-            [-mechdir MECH_DIR] [--profile] [--verbose] [--exportCoreNeuron] path
+            [--outputWindow OUTPUT_WINDOW] [--spikesOut SPIKES_OUT] [--neuromodulation NEUROMODULATION] [--noVolt]
+            [--disableGJ] [-mechdir MECH_DIR] [--profile] [--verbose] [--exportCoreNeuron] path
         """
 
         start = timeit.default_timer()
@@ -610,7 +613,13 @@ class Snudda(object):
 
         sim.check_memory_status()
         print(f"Running simulation for {t_sim} ms.")
-        sim.run(t_sim)  # In milliseconds
+
+        if args.output_window is not None:
+            output_window = args.output_window * 1000  # Convert from s to ms
+        else:
+            output_window = None
+
+        sim.run(t_sim, output_window=output_window, output_file=output_file)  # In milliseconds
 
         print("Simulation done, saving output")
         sim.write_output(output_file)
@@ -629,8 +638,14 @@ class Snudda(object):
 
     ############################################################################
 
-    def setup_parallel(self):
-        """Setup ipyparallel workers."""
+    def setup_parallel(self, parallel=True):
+        """
+        Setup ipyparallel workers, or local worker processes.
+
+        Args:
+            parallel : True (or "ipyparallel") to connect to a running ipcluster, "local" or "local:N" to start
+                       N worker processes on this machine (default one per core) instead
+        """
 
         self.slurm_id = os.getenv('SLURM_JOBID')
 
@@ -641,6 +656,20 @@ class Snudda(object):
 
         self.logfile.write(f"Using slurm_id: {self.slurm_id}")
 
+        from snudda.utils.local_cluster import LocalClient, parse_local_parallel
+
+        n_local_workers = parse_local_parallel(parallel)
+
+        if n_local_workers is not None:
+            print(f"Starting {n_local_workers} local workers")
+            self.logfile.write(f"Starting {n_local_workers} local workers\n")
+            self.rc = LocalClient(n_workers=n_local_workers)
+            self.d_view = self.rc.direct_view(targets='all')
+            return
+
+        assert parallel is True or parallel == "ipyparallel", \
+            f"Unknown parallel option {parallel}, use ipyparallel, local or local:N"
+
         ipython_profile = os.getenv('IPYTHON_PROFILE')
         if not ipython_profile:
             ipython_profile = "default"
@@ -674,7 +703,14 @@ class Snudda(object):
 
     def stop_parallel(self):
 
-        # Disable this function, keep the pool running for now
+        from snudda.utils.local_cluster import LocalClient
+
+        # Local workers are started for each step, ipyparallel engines are kept running
+        if isinstance(self.rc, LocalClient):
+            self.rc.shutdown()
+            self.rc = None
+            self.d_view = None
+
         return
 
         # if self.rc is not None:
@@ -18,6 +18,8 @@ import numpy as np
 import os
 import sys
 import itertools
+import operator
+import queue
 
 import time
 import timeit
@@ -29,8 +31,10 @@ import pickle
 from numba import jit
 
 from snudda.neurons.neuron_morphology import NeuronMorphology
+from snudda.neurons.morphology_pool import MorphologyPool
 from snudda.neurons.neuron_prototype import NeuronPrototype
 
+from snudda.detect.sparse_voxel_space import SparseVoxelSpace
 from snudda.utils.load import SnuddaLoad
 
 import snudda.utils.memory
@@ -62,7 +66,12 @@ class SnuddaDetect(object):
                  axon_stump_id_flag=False,
                  h5libver=None,  # Default: "latest"
                  random_seed=None,
-                 debug_flag=False):
+                 debug_flag=False,
+                 voxel_storage=None,  # Default: "dense"
+                 morphology_pool=None,
+                 neuron_cache_size=None,  # Default: 1000
+                 hyper_voxel_order=None,  # Default: "size"
+                 hyper_voxel_parts=None):  # Default: 1
 
         """
         Constructor.
@@ -86,6 +95,27 @@ class SnuddaDetect(object):
             h5libver (string, optional): h5py library version (default "latest")
             random_seed (int, optional): Random seed
             debug_flag (bool, optional): Save additional information for debugging (Default: False)
+            voxel_storage (str, optional): Voxel occupancy storage, "dense" (default) uses preallocated
+                                           num_bins^3 x max_axon/max_dend matrices, "sparse" uses append-only
+                                           lists (SparseVoxelSpace) whose memory scales with occupied voxels,
+                                           and which can not overflow.
+            morphology_pool (str, optional): Directory with a MorphologyPool, if given the prototype morphologies
+                                             are memory mapped from the pool instead of loaded from file.
+                                             Used by the workers, the pool is published by setup_parallel.
+            neuron_cache_size (int, optional): Number of placed (rotated and translated) neurons to keep between
+                                               hyper voxels, least recently used are evicted (default 1000, 0 = off)
+            hyper_voxel_order (str, optional): Order to process hyper voxels in, "size" (default, largest predicted
+                                               execution time first) or
+                                               "spatial" (Morton order, so neighbouring hyper voxels that share
+                                               neurons are processed close in time and reuse the neuron cache)
+            hyper_voxel_parts (int, optional): Number of parts (slabs along x) the synapse and gap junction detection
+                                               in a hyper voxel is divided into, each part has its own random stream.
+                                               When running in parallel, oversized hyper voxels are split and their
+                                               parts processed by different workers. The result depends on the
+                                               number of parts, but not on how the work is split (default 1).
+                                               Each part job only fills its own slab, but places every neuron
+                                               that reaches the slab, so neurons crossing several slabs are
+                                               placed once per part job (unless in the worker's neuron cache)
 
         """
 
@@ -108,6 +138,46 @@ class SnuddaDetect(object):
 
         self.debug_flag = debug_flag
 
+        if not voxel_storage:
+            self.voxel_storage = "dense"
+        else:
+            self.voxel_storage = voxel_storage
+
+        assert self.voxel_storage in ["dense", "sparse"], \
+            f"SnuddaDetect: voxel_storage must be dense or sparse, got {self.voxel_storage}"
+
+        if neuron_cache_size is None:
+            self.neuron_cache_size = 1000
+        else:
+            self.neuron_cache_size = neuron_cache_size
+
+        # Placed neurons, neuron_id as key, in least recently used order
+        self.neuron_cache = OrderedDict()
+        self.neuron_cache_hits = 0
+        self.neuron_cache_misses = 0
+
+        # Number of hyper voxels left to process for each neuron, used to drop neurons no longer needed from the cache
+        self.neuron_cache_remaining = None
+
+        if not hyper_voxel_order:
+            self.hyper_voxel_order = "size"
+        else:
+            self.hyper_voxel_order = hyper_voxel_order
+
+        assert self.hyper_voxel_order in ["size", "spatial"], \
+            f"SnuddaDetect: hyper_voxel_order must be size or spatial, got {self.hyper_voxel_order}"
+
+        if hyper_voxel_parts is None:
+            self.hyper_voxel_parts = 1
+        else:
+            self.hyper_voxel_parts = int(hyper_voxel_parts)
+
+        # Parts of the current hyper voxel to detect synapses in, None means all parts
+        self.hyper_voxel_part_list = None
+
+        # Execution time of hyper voxels in the previous run, used to predict the cost of each hyper voxel
+        self.exec_time_history = None
+
         self.random_seed = random_seed
 
         if config_file and not network_path:
@@ -190,6 +260,10 @@ class SnuddaDetect(object):
         self.dend_sec_x = None
         self.dend_soma_dist = None
 
+        # Used instead of the matrices above when voxel_storage is "sparse"
+        self.axon_sparse = None
+        self.dend_sparse = None
+
         self.axon_stump_id_flag = axon_stump_id_flag
 
         self.neurons = None
@@ -264,8 +338,18 @@ class SnuddaDetect(object):
         # self.connectivityDistributionsGJ = dict([])
         self.next_channel_model_id = 10
 
+        # Array versions of the neuron types and connectivity_distributions, used by the numba kernels
+        self.neuron_type_id = None
+        self.synapse_type_lookup = None
+        self.gap_junction_type_lookup = None
+
         self.prototype_neurons = dict([])
 
+        if morphology_pool:
+            self.morphology_pool = MorphologyPool(morphology_pool)
+        else:
+            self.morphology_pool = None
+
         self.axon_cum_density_cache = dict([])
 
         self.delete_old_merge()
@@ -277,6 +361,8 @@ class SnuddaDetect(object):
         # Read positions
         self.read_neuron_positions(position_file)
 
+        self.setup_connectivity_lookup()
+
     def detect(self, restart_detection_flag=True, rc=None):
 
         """
@@ -299,6 +385,10 @@ class SnuddaDetect(object):
         else:
             d_view = None
 
+        # Neurons might have moved since a previous call, do not reuse placed neurons
+        self.neuron_cache.clear()
+        self.neuron_cache_remaining = None
+
         if self.role == "master":
 
             # Make sure path exists
@@ -314,6 +404,7 @@ class SnuddaDetect(object):
 
             if restart_detection_flag:
                 if os.path.isfile(self.work_history_file):
+                    self.read_exec_time_history(self.work_history_file)
                     self.write_log("Removing old work history file")
                     os.remove(self.work_history_file)
 
@@ -383,11 +474,18 @@ class SnuddaDetect(object):
         """
         Distributes touch detection in hyper voxels to workers.
 
+        Jobs are dispatched longest predicted execution time first (see predict_hyper_voxel_cost) to idle workers.
+        Completion is signalled by callbacks on the workers' futures, so the master sleeps until a worker is done.
+        If hyper_voxel_parts > 1, hyper voxels that would take longer than the average work per worker are split
+        into parts processed by different workers, and then merged (see plan_hyper_voxel_jobs).
+
         Args:
             rc (ipyparallel.Client, optional): Remote client, for parallel execution
 
         """
 
+        from ipyparallel import Reference
+
         self.write_log("Starting parallelProcessHyperVoxels")
 
         start_time = timeit.default_timer()
@@ -397,83 +495,84 @@ class SnuddaDetect(object):
             self.setup_process_hyper_voxel_state_history()
 
         n_workers = len(rc.ids)
-        worker_status = [None for x in rc.ids]
-        worker_idx = 0
-        job_idx = 0
-        busy_ctr = 0
-        no_change_ctr = 0
-        num_syn = 1  # If nSyn is zero delay in loop is shorter
-
         self.write_log(f"parallel_process_hyper_voxels: Using {n_workers} worker")
 
-        info_msg_written = False
+        job_queue = self.plan_hyper_voxel_jobs(remaining, n_workers=n_workers)
 
-        while job_idx < len(remaining) or busy_ctr > 0:
+        # Callbacks are called from the ipyparallel thread, they put the finished jobs in the done_queue
+        done_queue = queue.Queue()
+        idle_workers = list(rc.ids)
+        num_running = 0
 
-            if worker_status[worker_idx] is not None:
+        # Results for hyper voxels that are split in parts, until all parts are done
+        part_results = dict()
 
-                # We have an async result, check status of it
-                if worker_status[worker_idx].ready():
-                    
-                    # Result is ready, get it
-                    hyper_voxel_data = rc[worker_idx]["result"]
+        info_msg_written = False
 
-                    hyper_id = hyper_voxel_data[0]
-                    num_syn = hyper_voxel_data[1]
-                    n_gj = hyper_voxel_data[2]
-                    exec_time = hyper_voxel_data[3]
-                    voxel_overflow_ctr = hyper_voxel_data[4]
+        while len(job_queue) > 0 or num_running > 0:
 
-                    self.update_process_hyper_voxel_state(hyper_id=hyper_id,
-                                                          num_syn=num_syn,
-                                                          num_gj=n_gj,
-                                                          exec_time=exec_time,
-                                                          voxel_overflow_counter=voxel_overflow_ctr)
-                    worker_status[worker_idx] = None
-                    rc[worker_idx]["result"] = None  # Clear to be safe
-                    busy_ctr -= 1
+            while len(idle_workers) > 0 and len(job_queue) > 0:
+                worker_id = idle_workers.pop(0)
+                job = job_queue.pop(0)
+                hyper_id, part_list, merge_flag, predicted_cost = job
 
-                    if voxel_overflow_ctr > 0:
-                        self.write_log(f"!!! HyperID {hyper_id} OVERFLOWED {voxel_overflow_ctr} TIMES"
-                                       f"(execution time {exec_time} s)", is_error=True)
-                        self.voxel_overflow_counter += voxel_overflow_ctr
-                    else:
-                        if exec_time > 100 or self.verbose:
-                            # Only print the long running hyper voxels
-                            self.write_log(f"HyperID {hyper_id} completed " 
-                                           f"- {num_syn} synapses found ({np.around(exec_time,1)} s)",
-                                           force_print=True)
-                        elif not info_msg_written:
-                            self.write_log(f"Suppressing printouts for hyper voxels that complete in < 100 seconds.",
-                                           force_print=True)
-                            info_msg_written = True
-
-            # Check that there are neurons in the hyper voxel, otherwise skip it.
-            if worker_status[worker_idx] is None and job_idx < len(remaining):
                 self.write_log(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}"
-                               f" Starting hyper voxel {remaining[job_idx]} on worker {worker_idx}")
+                               f" Starting hyper voxel {hyper_id} {'merge ' if merge_flag else ''}"
+                               f"{'' if part_list is None or merge_flag else f'parts {part_list} '}"
+                               f"on worker {worker_id} (predicted {predicted_cost:.1f})")
 
-                cmd_str = f"result = sd.process_hyper_voxel({remaining[job_idx]})"
-                worker_status[worker_idx] = rc[worker_idx].execute(cmd_str, block=False)
+                # Calls the method on the worker's sd object
+                if merge_flag:
+                    job_call = operator.methodcaller("merge_hyper_voxel_parts", hyper_id, part_list)
+                else:
+                    job_call = operator.methodcaller("process_hyper_voxel", hyper_id, part_list)
 
-                job_idx += 1
-                busy_ctr += 1
-                no_change_ctr = 0
+                future = rc[worker_id].apply_async(job_call, Reference("sd"))
 
-            else:
-                no_change_ctr += 1
+                future.add_done_callback(lambda f, w=worker_id, j=job: done_queue.put((w, j, f)))
+                num_running += 1
 
-            worker_idx = (worker_idx + 1) % n_workers
+            # Wait for a worker to finish
+            worker_id, job, future = done_queue.get()
+            num_running -= 1
+            idle_workers.append(worker_id)
 
-            if no_change_ctr >= n_workers:
-                # If all workers were working, sleep for a bit, then reset counter
-                if num_syn > 0:
-                    time.sleep(0.010)
-                else:
-                    # If previous hyper voxel had no synapses, be faster
-                    time.sleep(1e-6)
+            hyper_id, part_list, merge_flag, _ = job
+            (_, num_syn, n_gj, exec_time, voxel_overflow_ctr) = future.get()
+
+            if part_list is not None and not merge_flag:
+                # Part of a split hyper voxel, merge when all parts are done
+                part_results.setdefault(hyper_id, []).append((part_list, exec_time))
+
+                if sum([len(x[0]) for x in part_results[hyper_id]]) == self.hyper_voxel_parts:
+                    # Merge first, the parts take disk space
+                    job_queue.insert(0, (hyper_id, [x[0] for x in part_results[hyper_id]], True, 0))
+
+                continue
+
+            if merge_flag:
+                exec_time += sum([x[1] for x in part_results.pop(hyper_id)])
+
+            self.update_process_hyper_voxel_state(hyper_id=hyper_id,
+                                                  num_syn=num_syn,
+                                                  num_gj=n_gj,
+                                                  exec_time=exec_time,
+                                                  voxel_overflow_counter=voxel_overflow_ctr)
 
-                no_change_ctr = 0
+            if voxel_overflow_ctr > 0:
+                self.write_log(f"!!! HyperID {hyper_id} OVERFLOWED {voxel_overflow_ctr} TIMES"
+                               f"(execution time {exec_time} s)", is_error=True)
+                self.voxel_overflow_counter += voxel_overflow_ctr
+            else:
+                if exec_time > 100 or self.verbose:
+                    # Only print the long running hyper voxels
+                    self.write_log(f"HyperID {hyper_id} completed "
+                                   f"- {num_syn} synapses found ({np.around(exec_time,1)} s)",
+                                   force_print=True)
+                elif not info_msg_written:
+                    self.write_log(f"Suppressing printouts for hyper voxels that complete in < 100 seconds.",
+                                   force_print=True)
+                    info_msg_written = True
 
         end_time = timeit.default_timer()
 
@@ -485,6 +584,125 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def read_exec_time_history(self, work_history_file):
+
+        """
+        Reads the execution time of the hyper voxels from a previous run's work history file.
+
+        Args:
+            work_history_file (str): Path to old work history file
+        """
+
+        self.exec_time_history = None
+
+        try:
+            with h5py.File(work_history_file, "r") as f:
+                if "execTime" not in f or "meta/hyperVoxelIDs" not in f:
+                    return
+
+                num_completed = int(f["nCompleted"][0])
+
+                # Used to check that the old run had the same hyper voxels
+                self.exec_time_history = {"hyperVoxelIDs": f["meta/hyperVoxelIDs"][()],
+                                          "simulationOrigo": f["meta/simulationOrigo"][()],
+                                          "hyperVoxelSize": f["meta/hyperVoxelSize"][()],
+                                          "completed": f["completed"][:num_completed],
+                                          "execTime": f["execTime"][:num_completed]}
+        except:
+            self.write_log(f"Unable to read execution time history from {work_history_file}")
+
+    ############################################################################
+
+    def predict_hyper_voxel_cost(self, hyper_id_list):
+
+        """
+        Predicts the execution time of each hyper voxel. The cost is assumed to scale with the number of neuron pairs
+        (neuronCtr squared). If the previous run had the same hyper voxels, its execution times are used, and the
+        model is scaled to match them for the hyper voxels without history.
+
+        Args:
+            hyper_id_list (list): Hyper voxel IDs
+
+        Returns:
+            predicted_cost (np.array): Predicted cost (in seconds if there was a history)
+        """
+
+        hyper_id_list = np.array(hyper_id_list, dtype=int)
+        neuron_ctr = np.array([self.hyper_voxels[x]["neuronCtr"] for x in hyper_id_list], dtype=float)
+        predicted_cost = neuron_ctr ** 2
+
+        history = self.exec_time_history
+
+        if history is not None \
+                and history["hyperVoxelSize"] == self.hyper_voxel_size \
+                and np.array_equal(history["hyperVoxelIDs"], self.hyper_voxel_id_lookup) \
+                and np.allclose(history["simulationOrigo"], self.simulation_origo):
+
+            exec_time = dict(zip(history["completed"], history["execTime"]))
+            has_history = np.array([x in exec_time for x in hyper_id_list], dtype=bool)
+
+            if np.any(has_history):
+                old_time = np.array([exec_time[x] for x in hyper_id_list[has_history]])
+                old_ctr = neuron_ctr[has_history] ** 2
+
+                if np.sum(old_ctr) > 0:
+                    predicted_cost *= np.sum(old_time) / np.sum(old_ctr)
+
+                predicted_cost[has_history] = old_time
+
+                self.write_log(f"Using execution time history for {np.sum(has_history)} hyper voxels")
+
+        elif history is not None:
+            self.write_log("Execution time history from other hyper voxel layout, ignoring it.")
+
+        return predicted_cost
+
+    ############################################################################
+
+    def plan_hyper_voxel_jobs(self, remaining, n_workers):
+
+        """
+        Creates the job list for the workers, with the longest predicted jobs first (unless hyper_voxel_order is
+        spatial, then the order of remaining is kept). Hyper voxels whose predicted cost is larger than the average
+        work per worker are split into parts (at most hyper_voxel_parts), that can run on different workers.
+
+        Args:
+            remaining (list): Hyper voxel IDs to process
+            n_workers (int): Number of workers
+
+        Returns:
+            job_list (list): List of (hyper_id, part_list, merge_flag, predicted_cost) tuples,
+                             part_list is None if the whole hyper voxel is processed
+        """
+
+        if len(remaining) == 0:
+            return []
+
+        predicted_cost = self.predict_hyper_voxel_cost(remaining)
+        work_per_worker = np.sum(predicted_cost) / n_workers
+
+        job_list = []
+
+        for hyper_id, cost in zip(remaining, predicted_cost):
+
+            if self.hyper_voxel_parts > 1 and cost > work_per_worker > 0:
+                num_splits = int(min(self.hyper_voxel_parts, np.ceil(cost / work_per_worker)))
+            else:
+                num_splits = 1
+
+            if num_splits == 1:
+                job_list.append((hyper_id, None, False, cost))
+            else:
+                for part_list in np.array_split(np.arange(0, self.hyper_voxel_parts), num_splits):
+                    job_list.append((hyper_id, [int(x) for x in part_list], False, cost / num_splits))
+
+        if self.hyper_voxel_order == "size":
+            job_list = sorted(job_list, key=lambda x: -x[3])
+
+        return job_list
+
+    ############################################################################
+
     def generate_hyper_voxel_random_seeds(self):
 
         """ Generates a seed sequence for each hyper voxel based on the master seed for touch detection. """
@@ -763,7 +981,7 @@ class SnuddaDetect(object):
         Returns:
             progress_data (list, int, list, int) : The items returned are (all_hyper_id_list, num_completed,
                                                    remaining, voxel_overflow_counter). The remaining hypervoxel id list
-                                                   is sorted descending by size.
+                                                   is sorted according to hyper_voxel_order.
 
         """
 
@@ -773,7 +991,7 @@ class SnuddaDetect(object):
             all_hyper_id_list = set(self.work_history["allHyperIDs"])
             num_completed = int(self.work_history["nCompleted"][0])
             completed = set(self.work_history["completed"][:num_completed])
-            remaining = self.sort_remaining_by_size(all_hyper_id_list - completed)
+            remaining = self.sort_remaining(all_hyper_id_list - completed)
             voxel_overflow_counter = self.work_history["voxelOverflowCounter"][0]
 
         else:
@@ -793,7 +1011,7 @@ class SnuddaDetect(object):
             # Remove the empty hyper IDs
             (valid_hyper_id, empty_hyper_id) = self.remove_empty(all_hyper_id_list)
             all_hyper_id_list = valid_hyper_id
-            remaining = self.sort_remaining_by_size(all_hyper_id_list)
+            remaining = self.sort_remaining(all_hyper_id_list)
 
             if len(self.connectivity_distributions) == 0:
                 # We have no possible connections specified -- mark all voxels as done
@@ -812,6 +1030,7 @@ class SnuddaDetect(object):
             self.work_history.create_dataset("nHypervoxelGapJunctions",
                                              data=np.zeros(num_hyper_voxels, ), dtype=np.int64)
             self.work_history.create_dataset("voxelOverflowCounter", data=np.zeros(num_hyper_voxels, ), dtype=np.int64)
+            self.work_history.create_dataset("execTime", data=np.zeros(num_hyper_voxels, ), dtype=np.float64)
 
         return all_hyper_id_list, num_completed, remaining, voxel_overflow_counter
 
@@ -820,6 +1039,60 @@ class SnuddaDetect(object):
     # We want to do the hyper voxels with most neurons first, to minimize
     # the time waiting for lone cpu worker stragglers at the end.
 
+    def sort_remaining(self, remaining):
+
+        """
+        Sorts the remaining hypervoxel ID list, by size or spatially depending on hyper_voxel_order.
+
+        Args:
+            remaining (list): List of hypervoxels
+
+        Returns:
+            sorted_remaining (list): Sorted list of hypervoxels
+        """
+
+        if self.hyper_voxel_order == "spatial":
+            return self.sort_remaining_spatially(remaining)
+        else:
+            return self.sort_remaining_by_size(remaining)
+
+    ############################################################################
+
+    def sort_remaining_spatially(self, remaining):
+
+        """
+        Sorts the remaining hypervoxel ID list in Morton (Z-curve) order of the hyper voxel grid position, so that
+        hyper voxels processed after each other are mostly neighbours, and share many neurons.
+
+        Args:
+            remaining (list): List of hypervoxels
+
+        Returns:
+            sorted_remaining (list): Sorted list of hypervoxels
+        """
+
+        remaining = np.array(list(remaining), dtype=int)
+
+        # Grid position of each hyper voxel ID
+        hyper_voxel_coords = np.zeros((self.hyper_voxel_id_lookup.size, 3), dtype=np.int64)
+        hyper_voxel_coords[self.hyper_voxel_id_lookup.flatten(), :] = \
+            np.array(np.unravel_index(np.arange(self.hyper_voxel_id_lookup.size),
+                                      self.hyper_voxel_id_lookup.shape)).T
+
+        morton_code = np.zeros(len(remaining), dtype=np.int64)
+        coords = hyper_voxel_coords[remaining, :]
+
+        # Interleave the bits of the x, y, z grid coordinates
+        for bit in range(0, 21):
+            for dim in range(0, 3):
+                morton_code |= ((coords[:, dim] >> bit) & 1) << (3 * bit + dim)
+
+        sort_idx = np.argsort(morton_code, kind="stable")
+
+        return remaining[sort_idx]
+
+    ############################################################################
+
     def sort_remaining_by_size(self, remaining):
 
         """
@@ -943,7 +1216,7 @@ class SnuddaDetect(object):
             hyper_id (int) : Hypervoxel id completed
             num_syn (int) : Number of synapses detected in hyper voxel
             num_gj (int) : Number of gap junctions detected in hyper voxel
-            exec_time : Execution time (currently not used!)
+            exec_time : Execution time, used to predict hyper voxel cost in the next run
             voxel_overflow_counter : How many synapses/gap junctions did we miss due to memory overflow? (Should be 0)
 
         """
@@ -955,6 +1228,9 @@ class SnuddaDetect(object):
         self.work_history["nHypervoxelGapJunctions"][num_completed] = num_gj
         self.work_history["voxelOverflowCounter"][num_completed] = voxel_overflow_counter
 
+        if "execTime" in self.work_history:
+            self.work_history["execTime"][num_completed] = exec_time
+
         num_completed += 1
         self.work_history["nCompleted"][0] = num_completed
 
@@ -1001,6 +1277,23 @@ class SnuddaDetect(object):
         # Used by plotHyperVoxel to make sure synapses are displayed correctly
         self.hyper_voxel_offset = None
 
+        self.voxel_overflow_counter = 0
+
+        if self.voxel_storage == "sparse":
+            if self.axon_sparse is None:
+                self.axon_sparse = SparseVoxelSpace(num_bins=self.num_bins,
+                                                    columns={"soma_dist": np.int16})
+                self.dend_sparse = SparseVoxelSpace(num_bins=self.num_bins,
+                                                    columns={"sec_id": np.int16,
+                                                             "sec_x": np.float64,
+                                                             "soma_dist": np.int16})
+            else:
+                self.axon_sparse.clear()
+                self.dend_sparse.clear()
+
+            # No dense matrices needed
+            return
+
         # Which axons populate the different voxels
         if self.axon_voxels is None:
             self.axon_voxels = np.zeros((self.num_bins[0],
@@ -1058,16 +1351,110 @@ class SnuddaDetect(object):
             self.dend_sec_x[:] = 0
             self.dend_soma_dist[:] = 0
 
-        self.voxel_overflow_counter = 0
+    ############################################################################
+
+    def get_hyper_voxel_parts(self, stream_id):
+
+        """
+        Returns the parts of the current hyper voxel to detect synapses or gap junctions in.
+
+        The hyper voxel is divided into hyper_voxel_parts slabs along x. With a single part the hyper voxel
+        random generator is used, otherwise each part has its own random stream, so the result does not depend on
+        which parts are processed together.
+
+        Args:
+            stream_id (int): Random stream to use for the parts, 0 = synapses, 1 = gap junctions
+
+        Returns:
+            List of (x_start, x_end, rng) for each part in hyper_voxel_part_list (default all parts)
+        """
+
+        part_width = int(np.ceil(self.num_bins[0] / self.hyper_voxel_parts))
+
+        if self.hyper_voxel_part_list is None:
+            part_list = range(0, self.hyper_voxel_parts)
+        else:
+            part_list = self.hyper_voxel_part_list
+
+        parts = []
+
+        for part_id in part_list:
+            if self.hyper_voxel_parts == 1:
+                part_rng = self.hyper_voxel_rng
+            else:
+                random_seed = self.hyper_voxels[self.hyper_voxel_id]["randomSeed"]
+                part_rng = np.random.default_rng([random_seed, part_id, stream_id])
+
+            parts.append((part_id * part_width, min((part_id + 1) * part_width, self.num_bins[0]), part_rng))
+
+        return parts
+
+    ############################################################################
+
+    def get_hyper_voxel_fill_range(self):
+
+        """
+        Returns the range of voxels along x to fill with axons and dendrites, the slab covering the parts in
+        hyper_voxel_part_list. Synapse and gap junction detection only looks at the content of each voxel,
+        so a part does not need the voxels outside its own slab.
+
+        Returns:
+            (x_start, x_end)
+        """
+
+        if self.hyper_voxel_part_list is None:
+            return 0, int(self.num_bins[0])
+
+        part_width = int(np.ceil(self.num_bins[0] / self.hyper_voxel_parts))
+
+        return (min(self.hyper_voxel_part_list) * part_width,
+                min((max(self.hyper_voxel_part_list) + 1) * part_width, int(self.num_bins[0])))
+
+    ############################################################################
+
+    def neuron_in_fill_range(self, neuron_id):
+
+        """
+        Checks if the neuron can reach the slab being filled (see get_hyper_voxel_fill_range), using the soma
+        position and the maximal axon and dendrite radius of the neuron. Neurons outside do not need to be placed.
+
+        Args:
+            neuron_id (int): ID of neuron
+        """
+
+        if self.hyper_voxel_part_list is None:
+            return True
+
+        # The unplaced morphology of the neuron, it has the same radius
+        neuron_info = self.neurons[neuron_id]
+        morphology = self.prototype_neurons[neuron_info["name"]].clone(parameter_id=neuron_info["parameterID"],
+                                                                       morphology_id=neuron_info["morphologyID"],
+                                                                       parameter_key=neuron_info["parameterKey"],
+                                                                       morphology_key=neuron_info["morphologyKey"],
+                                                                       get_cache_original=True)
+        radius = max(morphology.max_axon_radius, morphology.max_dend_radius) + morphology.soma[0, 3]
+
+        # One voxel margin, in case the voxel coordinates are rounded differently when filling
+        x_start, x_end = self.get_hyper_voxel_fill_range()
+        vx_min = np.floor((neuron_info["position"][0] - radius - self.hyper_voxel_origo[0]) / self.voxel_size) - 1
+        vx_max = np.floor((neuron_info["position"][0] + radius - self.hyper_voxel_origo[0]) / self.voxel_size) + 1
+
+        return vx_max >= x_start and vx_min < x_end
 
     ############################################################################
 
     # hyperID is only needed if we have neurons without axons, ie we use
     # axon density
 
-    def detect_synapses(self):
+    def detect_synapses(self, use_numba=True):
+
+        """
+        Helper function, triggers detection of synapses. Called by process_hyper_voxel.
 
-        """ Helper function, triggers detection of synapses. Called by process_hyper_voxel. """
+        Args:
+            use_numba (bool): Use the compiled kernel detect_synapses_helper (default True), otherwise
+                              use the pure python reference implementation. Both give identical synapses.
+        """
 
         start_time = timeit.default_timer()
 
@@ -1075,14 +1462,97 @@ class SnuddaDetect(object):
         #   and self.hyperVoxelSynapses is not None, \
         #   "setupHyperVoxel must be called before detecting synapses"
 
-        # Find all voxels that contain axon and dendrites
-        [x_syn, y_syn, z_syn] = np.where(np.bitwise_and(self.dend_voxel_ctr > 0,
-                                                        self.axon_voxel_ctr > 0))
+        if self.voxel_storage == "sparse":
+            assert use_numba, "detect_synapses: python reference implementation requires dense voxel storage"
 
-        if True:
-            # This gives us some statistics, turn off later for speed
-            self.max_axon_voxel_ctr = np.amax(self.axon_voxel_ctr)
-            self.max_dend_voxel_ctr = np.amax(self.dend_voxel_ctr)
+            # Find all voxels that contain axon and dendrites, same order as np.where for dense
+            syn_voxels = np.intersect1d(self.axon_sparse.voxel_list, self.dend_sparse.voxel_list)
+            [x_syn, y_syn, z_syn] = self.dend_sparse.voxel_coords(syn_voxels)
+
+            self.max_axon_voxel_ctr = self.axon_sparse.max_count()
+            self.max_dend_voxel_ctr = self.dend_sparse.max_count()
+
+        else:
+            # Find all voxels that contain axon and dendrites
+            [x_syn, y_syn, z_syn] = np.where(np.bitwise_and(self.dend_voxel_ctr > 0,
+                                                            self.axon_voxel_ctr > 0))
+
+            if True:
+                # This gives us some statistics, turn off later for speed
+                self.max_axon_voxel_ctr = np.amax(self.axon_voxel_ctr)
+                self.max_dend_voxel_ctr = np.amax(self.dend_voxel_ctr)
+
+        for x_start, x_end, part_rng in self.get_hyper_voxel_parts(stream_id=0):
+            self.hyper_voxel_rng = part_rng
+            part_idx = np.flatnonzero(np.logical_and(x_start <= x_syn, x_syn < x_end))
+
+            if use_numba:
+                self.detect_synapses_kernel(x_syn[part_idx], y_syn[part_idx], z_syn[part_idx])
+            else:
+                self.detect_synapses_python(x_syn[part_idx], y_syn[part_idx], z_syn[part_idx])
+
+        # Sort the synapses (note sortIdx will not contain the empty rows
+        # at the end.
+
+        self.sort_synapses()
+
+        # Convert from hyper voxel local coordinates to simulation coordinates
+        # basically how many voxel steps do we need to take to go from
+        # simulationOrigo to hyperVoxelOrigo (those were not included, so add them)
+        hyper_voxel_offset = np.round((self.hyper_voxel_origo - self.simulation_origo)
+                                      / self.hyper_voxel_width).astype(int) \
+                             * self.hyper_voxel_size
+
+        # Just a double check...
+        assert self.hyper_voxel_id_lookup[int(np.round(hyper_voxel_offset[0] / self.hyper_voxel_size))][
+                   int(np.round(hyper_voxel_offset[1] / self.hyper_voxel_size))][
+                   int(np.round(hyper_voxel_offset[2] / self.hyper_voxel_size))] == self.hyper_voxel_id, \
+            "Internal inconsistency, have hyper voxel numbering or coordinates been changed?"
+
+        self.hyper_voxel_synapses[:self.hyper_voxel_synapse_ctr, :][:, range(2, 5)] \
+            += hyper_voxel_offset
+
+        # We need this in case plotHyperVoxel is called
+        self.hyper_voxel_offset = hyper_voxel_offset
+
+        # These are used when doing the heap sort of the hyper voxels
+        self.hyper_voxel_synapse_lookup \
+            = self.create_lookup_table(data=self.hyper_voxel_synapses,
+                                       n_rows=self.hyper_voxel_synapse_ctr,
+                                       data_type="synapses",
+                                       num_neurons=len(self.neurons),
+                                       max_synapse_type=self.next_channel_model_id)
+
+        # if(self.hyperVoxelSynapseCtr > 0 and self.hyperVoxelSynapseCtr < 10):
+        #  self.plotHyperVoxel()
+        #  import pdb
+        #  pdb.set_trace()
+
+        end_time = timeit.default_timer()
+
+        self.write_log(f"detect_synapses: {self.hyper_voxel_synapse_ctr} took {end_time - start_time:.1f} s")
+
+        if False and self.hyper_voxel_synapse_ctr > 0:
+            print("First plot shows dendrites, and the voxels that were marked")
+            print("Second plot same, but for axons")
+            self.plot_hyper_voxel(plot_neurons=True, draw_axons=False)
+            self.plot_hyper_voxel(plot_neurons=True, draw_dendrites=False)
+            # This is for debug purposes
+            import pdb
+            pdb.set_trace()
+
+        return self.hyper_voxel_synapses[:self.hyper_voxel_synapse_ctr, :]
+
+    ############################################################################
+
+    def detect_synapses_python(self, x_syn, y_syn, z_syn):
+
+        """
+        Pure python reference implementation of the voxel pair loop in detect_synapses.
+
+        Args:
+            x_syn, y_syn, z_syn : Voxel coordinates of voxels containing both axon and dendrite
+        """
 
         for x, y, z in zip(x_syn, y_syn, z_syn):
             axon_id_list = self.axon_voxels[x, y, z, :self.axon_voxel_ctr[x, y, z]]
@@ -1154,57 +1624,189 @@ class SnuddaDetect(object):
 
                             self.hyper_voxel_synapse_ctr += 1
 
-        # Sort the synapses (note sortIdx will not contain the empty rows
-        # at the end.
+    ############################################################################
 
-        self.sort_synapses()
+    def detect_synapses_kernel(self, x_syn, y_syn, z_syn):
 
-        # Convert from hyper voxel local coordinates to simulation coordinates
-        # basically how many voxel steps do we need to take to go from
-        # simulationOrigo to hyperVoxelOrigo (those were not included, so add them)
-        hyper_voxel_offset = np.round((self.hyper_voxel_origo - self.simulation_origo)
-                                      / self.hyper_voxel_width).astype(int) \
-                             * self.hyper_voxel_size
+        """
+        Compiled version of the voxel pair loop in detect_synapses. The synapses are first counted,
+        so that the synapse matrix can be resized once, then they are added in a single pass.
+        The random numbers are drawn from self.hyper_voxel_rng in the same order as in
+        detect_synapses_python, so the result is identical for a given hyper voxel seed.
 
-        # Just a double check...
-        assert self.hyper_voxel_id_lookup[int(np.round(hyper_voxel_offset[0] / self.hyper_voxel_size))][
-                   int(np.round(hyper_voxel_offset[1] / self.hyper_voxel_size))][
-                   int(np.round(hyper_voxel_offset[2] / self.hyper_voxel_size))] == self.hyper_voxel_id, \
-            "Internal inconsistency, have hyper voxel numbering or coordinates been changed?"
+        Args:
+            x_syn, y_syn, z_syn : Voxel coordinates of voxels containing both axon and dendrite
+        """
 
-        self.hyper_voxel_synapses[:self.hyper_voxel_synapse_ctr, :][:, range(2, 5)] \
-            += hyper_voxel_offset
+        if self.synapse_type_lookup is None:
+            self.setup_connectivity_lookup()
+
+        con_count, con_channel_id, con_mu, con_sigma, con_min_cond = self.synapse_type_lookup
+
+        axon_start, axon_count, axon_id, axon_dist = self.get_axon_voxel_content(x_syn, y_syn, z_syn)
+        dend_start, dend_count, dend_id, dend_sec_id, dend_sec_x, dend_dist = \
+            self.get_dend_voxel_content(x_syn, y_syn, z_syn)
+
+        num_synapses = self.count_synapses_helper(axon_start=axon_start, axon_count=axon_count, axon_id=axon_id,
+                                                  dend_start=dend_start, dend_count=dend_count, dend_id=dend_id,
+                                                  neuron_type_id=self.neuron_type_id,
+                                                  con_count=con_count)
+
+        if self.hyper_voxel_synapse_ctr + num_synapses > self.max_synapses:
+            self.resize_hyper_voxel_synapses_matrix(
+                new_size=max(int(np.ceil(1.5 * self.max_synapses)), self.hyper_voxel_synapse_ctr + num_synapses))
+
+        self.hyper_voxel_synapse_ctr = \
+            self.detect_synapses_helper(x_syn=x_syn, y_syn=y_syn, z_syn=z_syn,
+                                        axon_start=axon_start,
+                                        axon_count=axon_count,
+                                        axon_id=axon_id,
+                                        axon_dist=axon_dist,
+                                        dend_start=dend_start,
+                                        dend_count=dend_count,
+                                        dend_id=dend_id,
+                                        dend_sec_id=dend_sec_id,
+                                        dend_sec_x=dend_sec_x,
+                                        dend_dist=dend_dist,
+                                        neuron_type_id=self.neuron_type_id,
+                                        con_count=con_count,
+                                        con_channel_id=con_channel_id,
+                                        con_mu=con_mu,
+                                        con_sigma=con_sigma,
+                                        con_min_cond=con_min_cond,
+                                        hyper_voxel_id=self.hyper_voxel_id,
+                                        rng=self.hyper_voxel_rng,
+                                        synapses=self.hyper_voxel_synapses,
+                                        synapse_ctr=self.hyper_voxel_synapse_ctr)
 
-        # We need this in case plotHyperVoxel is called
-        self.hyper_voxel_offset = hyper_voxel_offset
+    @staticmethod
+    @jit(nopython=True, cache=True)
+    def count_synapses_helper(axon_start, axon_count, axon_id,
+                              dend_start, dend_count, dend_id,
+                              neuron_type_id, con_count):
 
-        # These are used when doing the heap sort of the hyper voxels
-        self.hyper_voxel_synapse_lookup \
-            = self.create_lookup_table(data=self.hyper_voxel_synapses,
-                                       n_rows=self.hyper_voxel_synapse_ctr,
-                                       data_type="synapses",
-                                       num_neurons=len(self.neurons),
-                                       max_synapse_type=self.next_channel_model_id)
+        """ Helper function for detect_synapses_kernel, counts the number of synapses in the hyper voxel. """
 
-        # if(self.hyperVoxelSynapseCtr > 0 and self.hyperVoxelSynapseCtr < 10):
-        #  self.plotHyperVoxel()
-        #  import pdb
-        #  pdb.set_trace()
+        num_synapses = 0
 
-        end_time = timeit.default_timer()
+        for i in range(len(axon_start)):
+            for ia in range(axon_start[i], axon_start[i] + axon_count[i]):
+                ax_id = axon_id[ia]
+                pre_type = neuron_type_id[ax_id]
 
-        self.write_log(f"detect_synapses: {self.hyper_voxel_synapse_ctr} took {end_time - start_time:.1f} s")
+                for idd in range(dend_start[i], dend_start[i] + dend_count[i]):
+                    d_id = dend_id[idd]
 
-        if False and self.hyper_voxel_synapse_ctr > 0:
-            print("First plot shows dendrites, and the voxels that were marked")
-            print("Second plot same, but for axons")
-            self.plot_hyper_voxel(plot_neurons=True, draw_axons=False)
-            self.plot_hyper_voxel(plot_neurons=True, draw_dendrites=False)
-            # This is for debug purposes
-            import pdb
-            pdb.set_trace()
+                    if ax_id != d_id:
+                        num_synapses += con_count[pre_type, neuron_type_id[d_id]]
 
-        return self.hyper_voxel_synapses[:self.hyper_voxel_synapse_ctr, :]
+        return num_synapses
+
+    # fastmath is left off here, the conductances must match detect_synapses_python exactly
+
+    @staticmethod
+    @jit(nopython=True, cache=True)
+    def detect_synapses_helper(x_syn, y_syn, z_syn,
+                               axon_start, axon_count, axon_id, axon_dist,
+                               dend_start, dend_count, dend_id, dend_sec_id, dend_sec_x, dend_dist,
+                               neuron_type_id,
+                               con_count, con_channel_id, con_mu, con_sigma, con_min_cond,
+                               hyper_voxel_id, rng,
+                               synapses, synapse_ctr):
+
+        """
+        Helper function for detect_synapses_kernel, static method needed for NUMBA.
+        The content of voxel i is found at axon_start[i] : axon_start[i] + axon_count[i] in the axon arrays,
+        and similarly for the dendrite arrays (see get_axon_voxel_content, get_dend_voxel_content).
+        The synapses matrix must have room for all synapses, see count_synapses_helper.
+
+        Returns updated synapse counter.
+        """
+
+        for i in range(len(x_syn)):
+            for ia in range(axon_start[i], axon_start[i] + axon_count[i]):
+                ax_id = axon_id[ia]
+                ax_dist = axon_dist[ia]
+                pre_type = neuron_type_id[ax_id]
+
+                for idd in range(dend_start[i], dend_start[i] + dend_count[i]):
+                    d_id = dend_id[idd]
+
+                    if ax_id == d_id:
+                        # Avoid self connections
+                        continue
+
+                    post_type = neuron_type_id[d_id]
+
+                    for ic in range(con_count[pre_type, post_type]):
+
+                        # lognormal distribution -- https://www.nature.com/articles/nrn3687
+                        cond = rng.lognormal(con_mu[pre_type, post_type, ic], con_sigma[pre_type, post_type, ic])
+                        cond = max(cond, con_min_cond[pre_type, post_type, ic])
+
+                        param_id = rng.integers(0, 1000000)
+
+                        synapses[synapse_ctr, 0] = ax_id
+                        synapses[synapse_ctr, 1] = d_id
+                        synapses[synapse_ctr, 2] = x_syn[i]
+                        synapses[synapse_ctr, 3] = y_syn[i]
+                        synapses[synapse_ctr, 4] = z_syn[i]
+                        synapses[synapse_ctr, 5] = hyper_voxel_id
+                        synapses[synapse_ctr, 6] = con_channel_id[pre_type, post_type, ic]
+                        synapses[synapse_ctr, 7] = ax_dist
+                        synapses[synapse_ctr, 8] = dend_dist[idd]
+                        synapses[synapse_ctr, 9] = dend_sec_id[idd]
+                        synapses[synapse_ctr, 10] = dend_sec_x[idd] * 1000
+                        synapses[synapse_ctr, 11] = cond * 1e12
+                        synapses[synapse_ctr, 12] = param_id
+
+                        synapse_ctr += 1
+
+        return synapse_ctr
+
+    ############################################################################
+
+    def get_axon_voxel_content(self, x, y, z):
+
+        """
+        Returns the axon content of voxels (x, y, z) in a storage independent (CSR-style) format.
+
+        Returns:
+            start, count : content of voxel i is found at start[i] : start[i] + count[i] in the arrays below
+            neuron_id, soma_dist : flat arrays with neuron ID and axonal distance to soma
+        """
+
+        if self.voxel_storage == "sparse":
+            start, count = self.axon_sparse.lookup(self.axon_sparse.voxel_index(x, y, z))
+            return start, count, self.axon_sparse.get("neuron_id"), self.axon_sparse.get("soma_dist")
+
+        # The dense matrices reshaped are flat arrays with max_axon slots for each voxel
+        start = ((np.asarray(x, dtype=np.int64) * self.num_bins[1] + y) * self.num_bins[2] + z) * self.max_axon
+        count = self.axon_voxel_ctr[x, y, z]
+
+        return start, count, self.axon_voxels.reshape(-1), self.axon_soma_dist.reshape(-1)
+
+    def get_dend_voxel_content(self, x, y, z):
+
+        """
+        Returns the dendrite content of voxels (x, y, z) in a storage independent (CSR-style) format.
+
+        Returns:
+            start, count : content of voxel i is found at start[i] : start[i] + count[i] in the arrays below
+            neuron_id, sec_id, sec_x, soma_dist : flat arrays with neuron ID, section ID, section X
+                                                  and dendritic distance to soma
+        """
+
+        if self.voxel_storage == "sparse":
+            start, count = self.dend_sparse.lookup(self.dend_sparse.voxel_index(x, y, z))
+            return (start, count, self.dend_sparse.get("neuron_id"), self.dend_sparse.get("sec_id"),
+                    self.dend_sparse.get("sec_x"), self.dend_sparse.get("soma_dist"))
+
+        start = ((np.asarray(x, dtype=np.int64) * self.num_bins[1] + y) * self.num_bins[2] + z) * self.max_dend
+        count = self.dend_voxel_ctr[x, y, z]
+
+        return (start, count, self.dend_voxels.reshape(-1), self.dend_sec_id.reshape(-1),
+                self.dend_sec_x.reshape(-1), self.dend_soma_dist.reshape(-1))
 
     ############################################################################
 
@@ -1298,6 +1900,22 @@ class SnuddaDetect(object):
 
             neuron_id = na_neuron["neuronID"]
 
+            # The random points are drawn for the whole hyper voxel, so the slabs get the same points
+            x_start, x_end = self.get_hyper_voxel_fill_range()
+            in_slab = np.logical_and(x_start <= na_voxel_coords[:, 0], na_voxel_coords[:, 0] < x_end)
+            na_voxel_coords = na_voxel_coords[in_slab, :]
+            na_axon_dist = np.asarray(na_axon_dist)[in_slab]
+
+            if self.voxel_storage == "sparse":
+                # Only the first point in each voxel is kept, same as for dense storage below
+                voxel_idx = self.axon_sparse.voxel_index(na_voxel_coords[:, 0],
+                                                         na_voxel_coords[:, 1],
+                                                         na_voxel_coords[:, 2])
+                _, first_idx = np.unique(voxel_idx, return_index=True)
+                self.axon_sparse.append(voxel_idx[first_idx], neuron_id,
+                                        soma_dist=np.asarray(na_axon_dist)[first_idx])
+                continue
+
             for idx in range(0, na_voxel_coords.shape[0]):
                 x_idx = na_voxel_coords[idx, 0]
                 y_idx = na_voxel_coords[idx, 1]
@@ -1560,6 +2178,31 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def resize_hyper_voxel_gap_junctions_matrix(self, new_size=None):
+
+        """
+        Increase the maximal size of the gap junction matrix used for the hypervoxel.
+
+        Args:
+            new_size (int): Number of rows in gap junction matrix
+        """
+
+        old = self.hyper_voxel_gap_junctions
+
+        if new_size is None:
+            new_size = int(np.ceil(1.5 * old.shape[0]))
+        else:
+            new_size = max(new_size, int(np.ceil(1.5 * old.shape[0])))
+
+        assert new_size >= self.hyper_voxel_gap_junction_ctr, "Cannot shrink below existing number of gap junctions"
+
+        self.write_log(f"Increasing max gap junctions to {new_size}")
+        self.hyper_voxel_gap_junctions = np.zeros((new_size, 11), dtype=np.int32)
+        self.hyper_voxel_gap_junctions[:old.shape[0], :] = old
+        del old
+
+    ############################################################################
+
     # This truncates and sorts the hyper voxel synapse matrix
 
     def sort_synapses(self):
@@ -1684,9 +2327,15 @@ class SnuddaDetect(object):
 
     # Gap junctions are stored in self.hyperVoxelGapJunctions
 
-    def detect_gap_junctions(self):
+    def detect_gap_junctions(self, vectorised=True):
 
-        """ Helper function, triggers detection of gap junctions. Called by process_hyper_voxel. """
+        """
+        Helper function, triggers detection of gap junctions. Called by process_hyper_voxel.
+
+        Args:
+            vectorised (bool): Use the vectorised detect_gap_junctions_vectorised (default True), otherwise
+                               use the pure python reference implementation. Both give identical gap junctions.
+        """
 
         if not self.includes_gap_junctions():
             self.write_log("detect_gap_junctions: No gap junctions defined in connectivity rules")
@@ -1697,13 +2346,53 @@ class SnuddaDetect(object):
         assert self.hyper_voxel_gap_junction_ctr == 0 and self.hyper_voxel_gap_junctions is not None, \
             "setup_hyper_voxel must be called before detecting gap junctions"
 
+        for x_start, x_end, part_rng in self.get_hyper_voxel_parts(stream_id=1):
+            self.hyper_voxel_rng = part_rng
+
+            if vectorised or self.voxel_storage == "sparse":
+                self.detect_gap_junctions_vectorised(x_range=(x_start, x_end))
+            else:
+                self.detect_gap_junctions_python(x_range=(x_start, x_end))
+
+        self.sort_gap_junctions()
+
+        # We also translate from local hyper voxel coordinates to simulation
+        # voxel coordinates
+
+        hyper_voxel_offset = np.round((self.hyper_voxel_origo - self.simulation_origo)
+                                      / self.hyper_voxel_width).astype(int) * self.hyper_voxel_size
+
+        self.hyper_voxel_gap_junctions[:self.hyper_voxel_gap_junction_ctr, :][:, range(6, 9)] += hyper_voxel_offset
+
+        self.hyper_voxel_gap_junction_lookup = self.create_lookup_table(data=self.hyper_voxel_gap_junctions,
+                                                                        n_rows=self.hyper_voxel_gap_junction_ctr,
+                                                                        data_type="gap_junctions",
+                                                                        num_neurons=len(self.neurons),
+                                                                        max_synapse_type=self.next_channel_model_id)
+        end_time = timeit.default_timer()
+
+        self.write_log(f"detectGapJunctions: {end_time - start_time:.1f} s")
+
+        return self.hyper_voxel_gap_junctions[:self.hyper_voxel_gap_junction_ctr, :]
+
+    ############################################################################
+
+    def detect_gap_junctions_python(self, x_range=None):
+
+        """
+        Pure python reference implementation of the dendrite voxel pair loop in detect_gap_junctions.
+
+        Args:
+            x_range (int, int): Only detect gap junctions in voxels with x_range[0] <= x < x_range[1]
+        """
+
         [x_dv, y_dv, z_dv] = np.where(self.dend_voxel_ctr > 0)
 
-        for x, y, z in zip(x_dv, y_dv, z_dv):
+        if x_range is not None:
+            keep_idx = np.flatnonzero(np.logical_and(x_range[0] <= x_dv, x_dv < x_range[1]))
+            x_dv, y_dv, z_dv = x_dv[keep_idx], y_dv[keep_idx], z_dv[keep_idx]
 
-            neuron_id_list = self.dend_voxels[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-            seg_id = self.dend_sec_id[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-            seg_x = self.dend_sec_x[x, y, z, :self.dend_voxel_ctr[x, y, z]]
+        for x, y, z in zip(x_dv, y_dv, z_dv):
 
             # All possible pairs
             for pairs in itertools.combinations(np.arange(0, self.dend_voxel_ctr[x, y, z]), 2):
@@ -1738,31 +2427,105 @@ class SnuddaDetect(object):
 
                         gj_cond = np.maximum(gj_cond, mean_gj_cond * 0.1)  # Avoid negative cond
 
+                        if self.hyper_voxel_gap_junction_ctr >= self.hyper_voxel_gap_junctions.shape[0]:
+                            self.resize_hyper_voxel_gap_junctions_matrix()
+
                         self.hyper_voxel_gap_junctions[self.hyper_voxel_gap_junction_ctr, :] = \
                             [neuron_id1, neuron_id2, seg_id1, seg_id2, seg_x1 * 1e3, seg_x2 * 1e3,
                              x, y, z, self.hyper_voxel_id, gj_cond * 1e12]
                         self.hyper_voxel_gap_junction_ctr += 1
 
-        self.sort_gap_junctions()
+    ############################################################################
 
-        # We also translate from local hyper voxel coordinates to simulation
-        # voxel coordinates
+    def detect_gap_junctions_vectorised(self, voxel_chunk_size=100000, x_range=None):
 
-        hyper_voxel_offset = np.round((self.hyper_voxel_origo - self.simulation_origo)
-                                      / self.hyper_voxel_width).astype(int) * self.hyper_voxel_size
+        """
+        Vectorised version of the dendrite voxel pair loop in detect_gap_junctions.
 
-        self.hyper_voxel_gap_junctions[:self.hyper_voxel_gap_junction_ctr, :][:, range(6, 9)] += hyper_voxel_offset
+        The candidate pairs for a chunk of voxels are enumerated using the upper triangle of a
+        max_ctr x max_ctr matrix, keeping only the pairs where both indexes are within the voxel's count.
+        This gives the pairs in the same order as itertools.combinations, so the conductances
+        (drawn in bulk) are identical to detect_gap_junctions_python for a given hyper voxel seed.
 
-        self.hyper_voxel_gap_junction_lookup = self.create_lookup_table(data=self.hyper_voxel_gap_junctions,
-                                                                        n_rows=self.hyper_voxel_gap_junction_ctr,
-                                                                        data_type="gap_junctions",
-                                                                        num_neurons=len(self.neurons),
-                                                                        max_synapse_type=self.next_channel_model_id)
-        end_time = timeit.default_timer()
+        Args:
+            voxel_chunk_size (int): Number of voxels to process at a time, limits memory usage
+            x_range (int, int): Only detect gap junctions in voxels with x_range[0] <= x < x_range[1]
+        """
 
-        self.write_log(f"detectGapJunctions: {end_time - start_time:.1f} s")
+        if self.gap_junction_type_lookup is None:
+            self.setup_connectivity_lookup()
 
-        return self.hyper_voxel_gap_junctions[:self.hyper_voxel_gap_junction_ctr, :]
+        gj_flag, gj_mu, gj_sigma, gj_min_cond = self.gap_junction_type_lookup
+
+        # Only voxels with at least two dendrites can have gap junctions
+        if self.voxel_storage == "sparse":
+            [x_dv, y_dv, z_dv] = self.dend_sparse.voxel_coords(
+                self.dend_sparse.voxel_list[self.dend_sparse.voxel_count > 1])
+        else:
+            [x_dv, y_dv, z_dv] = np.where(self.dend_voxel_ctr > 1)
+
+        if x_range is not None:
+            keep_idx = np.flatnonzero(np.logical_and(x_range[0] <= x_dv, x_dv < x_range[1]))
+            x_dv, y_dv, z_dv = x_dv[keep_idx], y_dv[keep_idx], z_dv[keep_idx]
+
+        for chunk_start in range(0, len(x_dv), voxel_chunk_size):
+            x = x_dv[chunk_start:chunk_start + voxel_chunk_size]
+            y = y_dv[chunk_start:chunk_start + voxel_chunk_size]
+            z = z_dv[chunk_start:chunk_start + voxel_chunk_size]
+
+            voxel_start, voxel_ctr, dend_id, dend_sec_id, dend_sec_x, _ = self.get_dend_voxel_content(x, y, z)
+            idx1, idx2 = np.triu_indices(np.max(voxel_ctr), k=1)
+
+            # Row-major order of the (voxel, pair) mask preserves the itertools.combinations order
+            voxel_idx, pair_idx = np.nonzero(idx2[np.newaxis, :] < voxel_ctr[:, np.newaxis])
+            pair_idx1 = idx1[pair_idx]
+            pair_idx2 = idx2[pair_idx]
+
+            vx, vy, vz = x[voxel_idx], y[voxel_idx], z[voxel_idx]
+
+            # Index into the flat dendrite arrays
+            pair_idx1 = voxel_start[voxel_idx] + pair_idx1
+            pair_idx2 = voxel_start[voxel_idx] + pair_idx2
+
+            neuron_id1 = dend_id[pair_idx1]
+            neuron_id2 = dend_id[pair_idx2]
+
+            pre_type = self.neuron_type_id[neuron_id1]
+            post_type = self.neuron_type_id[neuron_id2]
+
+            keep_idx = np.flatnonzero(gj_flag[pre_type, post_type])
+            num_gj = len(keep_idx)
+
+            if num_gj == 0:
+                continue
+
+            pre_type, post_type = pre_type[keep_idx], post_type[keep_idx]
+            vx, vy, vz = vx[keep_idx], vy[keep_idx], vz[keep_idx]
+            pair_idx1, pair_idx2 = pair_idx1[keep_idx], pair_idx2[keep_idx]
+
+            # lognormal distribution https://www.nature.com/articles/nrn3687
+            gj_cond = self.hyper_voxel_rng.lognormal(gj_mu[pre_type, post_type], gj_sigma[pre_type, post_type])
+            gj_cond = np.maximum(gj_cond, gj_min_cond[pre_type, post_type])  # Avoid negative cond
+
+            if self.hyper_voxel_gap_junction_ctr + num_gj > self.hyper_voxel_gap_junctions.shape[0]:
+                self.resize_hyper_voxel_gap_junctions_matrix(new_size=self.hyper_voxel_gap_junction_ctr + num_gj)
+
+            gj_block = np.zeros((num_gj, 11), dtype=np.float64)
+            gj_block[:, 0] = neuron_id1[keep_idx]
+            gj_block[:, 1] = neuron_id2[keep_idx]
+            gj_block[:, 2] = dend_sec_id[pair_idx1]
+            gj_block[:, 3] = dend_sec_id[pair_idx2]
+            gj_block[:, 4] = dend_sec_x[pair_idx1] * 1e3
+            gj_block[:, 5] = dend_sec_x[pair_idx2] * 1e3
+            gj_block[:, 6] = vx
+            gj_block[:, 7] = vy
+            gj_block[:, 8] = vz
+            gj_block[:, 9] = self.hyper_voxel_id
+            gj_block[:, 10] = gj_cond * 1e12
+
+            self.hyper_voxel_gap_junctions[self.hyper_voxel_gap_junction_ctr:
+                                           self.hyper_voxel_gap_junction_ctr + num_gj, :] = gj_block
+            self.hyper_voxel_gap_junction_ctr += num_gj
 
     ############################################################################
 
@@ -1895,6 +2658,9 @@ class SnuddaDetect(object):
                                                            virtual_neuron=virtual_neuron,
                                                            axon_stump_id_flag=axon_stump_id_flag)
 
+            if self.morphology_pool is not None:
+                self.morphology_pool.attach(name, self.prototype_neurons[name])
+
             if "axonDensity" in definition:
 
                 # We need to do this so we can apply the axon densities below
@@ -2007,6 +2773,71 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def setup_connectivity_lookup(self):
+
+        """
+        Creates array versions of the neuron types and connectivity_distributions for the numba kernels.
+
+        self.neuron_type_id : type ID for each neuron
+        self.synapse_type_lookup : (con_count, con_channel_id, con_mu, con_sigma, con_min_cond) where
+                                   con_count[pre_type_id, post_type_id] is the number of (non gap junction)
+                                   synapse types between the neuron types, and the other matrices
+                                   (n_types x n_types x max_con) hold channel model ID, lognormal mu and sigma,
+                                   and the minimum conductance (10% of mean) for each synapse type.
+        self.gap_junction_type_lookup : (gj_flag, gj_mu, gj_sigma, gj_min_cond) where gj_flag is a boolean
+                                        n_types x n_types matrix, True if gap junctions are defined between
+                                        the neuron types, the other matrices hold the conductance parameters.
+        """
+
+        neuron_types = [n["type"] for n in self.neurons]
+        type_names = sorted(set(neuron_types) | set([t for key in self.connectivity_distributions for t in key]))
+        type_lookup = dict([(name, idx) for idx, name in enumerate(type_names)])
+
+        self.neuron_type_id = np.array([type_lookup[t] for t in neuron_types], dtype=np.int64)
+
+        num_types = len(type_names)
+        max_con = max([len(con_dict) for con_dict in self.connectivity_distributions.values()], default=0)
+        max_con = max(max_con, 1)
+
+        con_count = np.zeros((num_types, num_types), dtype=np.int64)
+        con_channel_id = np.zeros((num_types, num_types, max_con), dtype=np.int64)
+        con_mu = np.zeros((num_types, num_types, max_con), dtype=np.float64)
+        con_sigma = np.zeros((num_types, num_types, max_con), dtype=np.float64)
+        con_min_cond = np.zeros((num_types, num_types, max_con), dtype=np.float64)
+
+        gj_flag = np.zeros((num_types, num_types), dtype=bool)
+        gj_mu = np.zeros((num_types, num_types), dtype=np.float64)
+        gj_sigma = np.zeros((num_types, num_types), dtype=np.float64)
+        gj_min_cond = np.zeros((num_types, num_types), dtype=np.float64)
+
+        for (pre_type, post_type), con_dict in self.connectivity_distributions.items():
+            pre_id = type_lookup[pre_type]
+            post_id = type_lookup[post_type]
+
+            if "GapJunction" in con_dict:
+                gj_flag[pre_id, post_id] = True
+                gj_mu[pre_id, post_id], gj_sigma[pre_id, post_id] = con_dict["GapJunction"]["lognormal_mu_sigma"]
+                gj_min_cond[pre_id, post_id] = con_dict["GapJunction"]["conductance"][0] * 0.1
+
+            # Same order as we loop over con_dict in detect_synapses_python, needed for reproducibility
+            for con_type in con_dict:
+                if con_type == "GapJunction":
+                    continue
+
+                idx = con_count[pre_id, post_id]
+                con_channel_id[pre_id, post_id, idx] = con_dict[con_type]["channelModelID"]
+                con_mu[pre_id, post_id, idx], con_sigma[pre_id, post_id, idx] = \
+                    con_dict[con_type]["lognormal_mu_sigma"]
+                con_min_cond[pre_id, post_id, idx] = con_dict[con_type]["conductance"][0] * 0.1
+                con_count[pre_id, post_id] += 1
+
+        assert (con_min_cond[con_channel_id > 0] > 0).all(), "Conductance should be larger than 0."
+
+        self.synapse_type_lookup = (con_count, con_channel_id, con_mu, con_sigma, con_min_cond)
+        self.gap_junction_type_lookup = (gj_flag, gj_mu, gj_sigma, gj_min_cond)
+
+    ############################################################################
+
     # If the detect is rerun we need to make sure there are not old MERGE
     # files left that might remember old run accidentally
 
@@ -2031,13 +2862,24 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def get_hyper_voxel_file_name(self, hyper_id, part_list=None):
+
+        """ Returns name of the hyper voxel file, or the part file if part_list is given. """
+
+        if part_list is None:
+            return self.save_file.replace(".hdf5", f"-{hyper_id}.hdf5")
+        else:
+            return self.save_file.replace(".hdf5", f"-{hyper_id}-part-{min(part_list)}.hdf5")
+
+    ############################################################################
+
     def write_hyper_voxel_to_hdf5(self):
 
         """ Saves hyper voxel synapses to data file. """
 
         start_time = timeit.default_timer()
 
-        output_name = self.save_file.replace(".hdf5", f"-{self.hyper_voxel_id}.hdf5")
+        output_name = self.get_hyper_voxel_file_name(self.hyper_voxel_id, self.hyper_voxel_part_list)
 
         with h5py.File(output_name, "w", libver=self.h5libver) as out_file:
 
@@ -2094,7 +2936,14 @@ class SnuddaDetect(object):
             network_group.create_dataset("maxChannelTypeID", data=self.next_channel_model_id, dtype=int)
 
             # Additional information useful for debugging
-            if self.debug_flag:
+            if self.debug_flag and self.voxel_storage == "sparse":
+                debug_group = out_file.create_group("debug")
+
+                for name in ["voxel_idx", "neuron_id"]:
+                    debug_group.create_dataset(f"dendSparse/{name}", data=self.dend_sparse.get(name))
+                    debug_group.create_dataset(f"axonSparse/{name}", data=self.axon_sparse.get(name))
+
+            elif self.debug_flag:
                 debug_group = out_file.create_group("debug")
 
                 debug_group.create_dataset("dendVoxels", data=self.dend_voxels)
@@ -2113,6 +2962,105 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def merge_hyper_voxel_parts(self, hyper_id, part_lists):
+
+        """
+        Combines the part files of a split hyper voxel into the hyper voxel file, and removes the part files.
+        Since the sorting is stable, the result is identical to processing the whole hyper voxel at once.
+
+        Args:
+            hyper_id (int): ID of hyper voxel
+            part_lists (list): List of part lists, one for each part file
+
+        Returns:
+            (hyper_id, num_synapses, num_gap_junctions, exec_time, voxel_overflow_counter)
+        """
+
+        start_time = timeit.default_timer()
+
+        synapses = []
+        gap_junctions = []
+        max_axon_voxel_ctr = []
+        max_dend_voxel_ctr = []
+        voxel_overflow_counter = 0
+
+        part_files = [self.get_hyper_voxel_file_name(hyper_id, part_list)
+                      for part_list in sorted(part_lists, key=min)]
+
+        for part_file in part_files:
+            with h5py.File(part_file, "r") as f:
+                synapses.append(f["network/synapses"][()])
+                gap_junctions.append(f["network/gapJunctions"][()])
+                # Each part only fills its own slab, so the overflows are counted once
+                voxel_overflow_counter += f["meta/voxelOverflowCounter"][()]
+
+                if "maxAxonVoxelCtr" in f["meta"]:
+                    max_axon_voxel_ctr.append(f["meta/maxAxonVoxelCtr"][()])
+                if "maxDendVoxelCtr" in f["meta"]:
+                    max_dend_voxel_ctr.append(f["meta/maxDendVoxelCtr"][()])
+
+        self.hyper_voxel_id = hyper_id
+        self.hyper_voxel_origo = self.hyper_voxels[hyper_id]["origo"]
+        self.hyper_voxel_part_list = None
+
+        synapses = np.concatenate(synapses)
+        gap_junctions = np.concatenate(gap_junctions)
+
+        # Reuse the hyper voxel matrices, increase their size if needed
+        if self.hyper_voxel_synapses is None:
+            self.hyper_voxel_synapses = np.zeros((self.max_synapses, 13), dtype=np.int32)
+            self.hyper_voxel_gap_junctions = np.zeros((self.max_synapses, 11), dtype=np.int32)
+
+        self.hyper_voxel_synapse_ctr = 0
+        self.hyper_voxel_gap_junction_ctr = 0
+
+        if synapses.shape[0] > self.max_synapses:
+            self.resize_hyper_voxel_synapses_matrix(new_size=synapses.shape[0])
+
+        if gap_junctions.shape[0] > self.hyper_voxel_gap_junctions.shape[0]:
+            self.resize_hyper_voxel_gap_junctions_matrix(new_size=gap_junctions.shape[0])
+
+        self.hyper_voxel_synapse_ctr = synapses.shape[0]
+        self.hyper_voxel_synapses[:self.hyper_voxel_synapse_ctr, :] = synapses
+        self.hyper_voxel_gap_junction_ctr = gap_junctions.shape[0]
+        self.hyper_voxel_gap_junctions[:self.hyper_voxel_gap_junction_ctr, :] = gap_junctions
+
+        self.max_axon_voxel_ctr = max(max_axon_voxel_ctr) if len(max_axon_voxel_ctr) > 0 else None
+        self.max_dend_voxel_ctr = max(max_dend_voxel_ctr) if len(max_dend_voxel_ctr) > 0 else None
+        self.voxel_overflow_counter = voxel_overflow_counter
+
+        self.sort_synapses()
+        self.sort_gap_junctions()
+
+        self.hyper_voxel_synapse_lookup \
+            = self.create_lookup_table(data=self.hyper_voxel_synapses,
+                                       n_rows=self.hyper_voxel_synapse_ctr,
+                                       data_type="synapses",
+                                       num_neurons=len(self.neurons),
+                                       max_synapse_type=self.next_channel_model_id)
+
+        self.hyper_voxel_gap_junction_lookup \
+            = self.create_lookup_table(data=self.hyper_voxel_gap_junctions,
+                                       n_rows=self.hyper_voxel_gap_junction_ctr,
+                                       data_type="gap_junctions",
+                                       num_neurons=len(self.neurons),
+                                       max_synapse_type=self.next_channel_model_id)
+
+        self.write_hyper_voxel_to_hdf5()
+
+        for part_file in part_files:
+            os.remove(part_file)
+
+        end_time = timeit.default_timer()
+
+        self.write_log(f"merge_hyper_voxel_parts: {hyper_id} ({len(part_files)} parts) "
+                       f"took {end_time - start_time:.1f} s")
+
+        return (hyper_id, self.hyper_voxel_synapse_ctr, self.hyper_voxel_gap_junction_ctr,
+                end_time - start_time, self.voxel_overflow_counter)
+
+    ############################################################################
+
     def load_neuron(self, neuron_info):
 
         """
@@ -2123,7 +3071,7 @@ class SnuddaDetect(object):
                           'modulationID', 'rotation', 'position'
         """
 
-        # Clone prototype neuron (it is centred, and not rotated)
+        # Clone prototype neuron (it is centred, and not rotated), coordinates are placed when first accessed
         neuron = self.prototype_neurons[neuron_info["name"]].clone(parameter_id=neuron_info["parameterID"],
                                                                    morphology_id=neuron_info["morphologyID"],
                                                                    modulation_id=neuron_info["modulationID"],
@@ -2131,12 +3079,66 @@ class SnuddaDetect(object):
                                                                    morphology_key=neuron_info["morphologyKey"],
                                                                    modulation_key=neuron_info["modulationKey"],
                                                                    rotation=neuron_info["rotation"],
-                                                                   position=neuron_info["position"])
+                                                                   position=neuron_info["position"],
+                                                                   lazy=True)
+
+        return neuron
+
+    ############################################################################
+
+    def load_placed_neuron(self, neuron_id):
+
+        """
+        Returns placed (rotated and translated) neuron, reusing it from the neuron cache if it was
+        placed for a previous hyper voxel. The least recently used neurons are evicted when the cache is full.
+
+        Args:
+            neuron_id (int): ID of neuron
+        """
+
+        if neuron_id in self.neuron_cache:
+            self.neuron_cache_hits += 1
+            self.neuron_cache.move_to_end(neuron_id)
+            return self.neuron_cache[neuron_id]
+
+        self.neuron_cache_misses += 1
+        neuron = self.load_neuron(self.neurons[neuron_id])
+
+        if self.neuron_cache_size > 0:
+            self.neuron_cache[neuron_id] = neuron
+
+            while len(self.neuron_cache) > self.neuron_cache_size:
+                self.neuron_cache.popitem(last=False)
 
         return neuron
 
     ############################################################################
 
+    def release_placed_neurons(self, neuron_id_list):
+
+        """
+        Called when a hyper voxel is processed, for a split hyper voxel by the job with the last part.
+        Each worker counts down, per neuron, from the number of hyper voxels the neuron is present in,
+        and removes the neuron from its neuron cache at zero. In parallel runs a worker only processes
+        some of the hyper voxels, so the neurons are mostly removed when the cache is full (neuron_cache_size).
+
+        Args:
+            neuron_id_list (list): Neuron IDs in the processed hyper voxel
+        """
+
+        if self.neuron_cache_remaining is None:
+            # Number of hyper voxels each neuron is in, from distribute_neurons
+            self.neuron_cache_remaining = np.zeros((len(self.neurons),), dtype=int)
+            for hyper_voxel in self.hyper_voxels.values():
+                self.neuron_cache_remaining[hyper_voxel["neurons"][:hyper_voxel["neuronCtr"]]] += 1
+
+        self.neuron_cache_remaining[neuron_id_list] -= 1
+
+        for neuron_id in neuron_id_list[self.neuron_cache_remaining[neuron_id_list] <= 0]:
+            self.neuron_cache.pop(neuron_id, None)
+
+    ############################################################################
+
     def distribute_neurons_parallel(self, d_view=None):
 
         """ Locates which hyper voxel each neuron is present in."""
@@ -2522,6 +3524,11 @@ class SnuddaDetect(object):
         d_view.scatter('logfile_name', engine_logfile, block=True)
         self.write_log("Scatter done.")
 
+        # Publish the prototype morphologies once, the workers memory map them instead of loading their own copies
+        morphology_pool_dir = os.path.join(os.path.dirname(self.save_file), "morphology-pool")
+        self.write_log(f"Publishing morphology pool to {morphology_pool_dir}")
+        MorphologyPool(morphology_pool_dir).publish(self.prototype_neurons)
+
         d_view.push({"position_file": self.position_file,
                      "config_file": self.config_file,
                      "voxel_size": self.voxel_size,
@@ -2529,14 +3536,20 @@ class SnuddaDetect(object):
                      "verbose": self.verbose,
                      "slurm_id": self.slurm_id,
                      "save_file": self.save_file,
-                     "random_seed": self.random_seed},
+                     "random_seed": self.random_seed,
+                     "voxel_storage": self.voxel_storage,
+                     "morphology_pool": morphology_pool_dir,
+                     "neuron_cache_size": self.neuron_cache_size,
+                     "hyper_voxel_parts": self.hyper_voxel_parts},
                     block=True)
 
         self.write_log("Init values pushed to workers")
 
         cmd_str = ("sd = SnuddaDetect(config_file=config_file, position_file=position_file,voxel_size=voxel_size," 
                    "hyper_voxel_size=hyper_voxel_size,verbose=verbose,logfile_name=logfile_name[0]," 
-                   "save_file=save_file,slurm_id=slurm_id,role='worker', random_seed=random_seed)")
+                   "save_file=save_file,slurm_id=slurm_id,role='worker', random_seed=random_seed,"
+                   "voxel_storage=voxel_storage, morphology_pool=morphology_pool,"
+                   "neuron_cache_size=neuron_cache_size, hyper_voxel_parts=hyper_voxel_parts)")
         d_view.execute(cmd_str, block=True)
 
         self.write_log(f"Workers setup: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
@@ -2672,9 +3685,10 @@ class SnuddaDetect(object):
         assert v_radius < 1000, \
             f"fill_voxels_soma: v_radius={v_radius} soma coords = {soma_coord} (BIG SOMA, not SI units?)"
 
-        # Range check, so we stay within hypervoxel
-        vx_min = max(0, v_coords[0] - v_radius)
-        vx_max = min(self.hyper_voxel_size, v_coords[0] + v_radius + 1)
+        # Range check, so we stay within hypervoxel (and the slab that is filled)
+        x_start, x_end = self.get_hyper_voxel_fill_range()
+        vx_min = max(x_start, v_coords[0] - v_radius)
+        vx_max = min(x_end, v_coords[0] + v_radius + 1)
 
         vy_min = max(0, v_coords[1] - v_radius)
         vy_max = min(self.hyper_voxel_size, v_coords[1] + v_radius + 1)
@@ -2751,7 +3765,8 @@ class SnuddaDetect(object):
                                                           self_voxel_size=self.voxel_size,
                                                           self_num_bins=self.num_bins,
                                                           self_max_dend=self.max_dend,
-                                                          self_step_multiplier=self.step_multiplier)
+                                                          self_step_multiplier=self.step_multiplier,
+                                                          self_x_range=self.get_hyper_voxel_fill_range())
 
         self.voxel_overflow_counter += voxel_overflow_ctr
 
@@ -2767,9 +3782,12 @@ class SnuddaDetect(object):
                                 coords, links,
                                 seg_id, seg_x, neuron_id,
                                 self_hyper_voxel_origo, self_voxel_size, self_num_bins, self_max_dend,
-                                self_step_multiplier):
+                                self_step_multiplier, self_x_range):
 
-        """ Helper function for fill_voxels_dend, static method needed for NUMBA. """
+        """
+        Helper function for fill_voxels_dend, static method needed for NUMBA.
+        Only voxels with x in self_x_range (x_start, x_end) are marked, see get_hyper_voxel_fill_range.
+        """
 
         # segID gives segment ID for each link
         # segX gives segmentX for each link
@@ -2788,6 +3806,10 @@ class SnuddaDetect(object):
             vp1_inside = ((vp1 >= 0).all() and (vp1 < self_num_bins).all())
             vp2_inside = ((vp2 >= 0).all() and (vp2 < self_num_bins).all())
 
+            if max(vp1[0], vp2[0]) < self_x_range[0] or min(vp1[0], vp2[0]) >= self_x_range[1]:
+                # Line does not reach the slab of the hyper voxel that is filled, skip
+                continue
+
             # Four cases, if neither inside, skip line
             # If one inside but not the other, start at inside point and
             # continue until outside
@@ -2843,6 +3865,10 @@ class SnuddaDetect(object):
                             # Rest of line outside
                             break
 
+                        if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                            # Outside the slab that is filled
+                            continue
+
                         v_ctr = voxel_space_ctr[vp[0], vp[1], vp[2]]
                         if v_ctr > 0 and voxel_space[vp[0], vp[1], vp[2], v_ctr - 1] == neuron_id:
                             # Voxel already contains neuronID, skip
@@ -2879,6 +3905,10 @@ class SnuddaDetect(object):
                         # Rest of line outside
                         break
 
+                    if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                        # Outside the slab that is filled
+                        continue
+
                     v_ctr = voxel_space_ctr[vp[0], vp[1], vp[2]]
 
                     if v_ctr > 0 and voxel_space[vp[0], vp[1], vp[2], v_ctr - 1] == neuron_id:
@@ -2912,6 +3942,10 @@ class SnuddaDetect(object):
                     s_x = segmentX[0] + ds * i  # float
                     soma_dist = int(p1_dist + dd * i)
 
+                    if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                        # Outside the slab that is filled
+                        continue
+
                     v_ctr = voxel_space_ctr[vp[0], vp[1], vp[2]]
 
                     if v_ctr > 0 and voxel_space[vp[0], vp[1], vp[2], v_ctr - 1] == neuron_id:
@@ -2965,7 +3999,8 @@ class SnuddaDetect(object):
                                                           self_voxel_size=self.voxel_size,
                                                           self_num_bins=self.num_bins,
                                                           self_max_axon=self.max_axon,
-                                                          self_step_multiplier=self.step_multiplier)
+                                                          self_step_multiplier=self.step_multiplier,
+                                                          self_x_range=self.get_hyper_voxel_fill_range())
 
         self.voxel_overflow_counter += voxel_overflow_ctr
 
@@ -2979,9 +4014,13 @@ class SnuddaDetect(object):
                                 self_voxel_size,
                                 self_num_bins,
                                 self_max_axon,
-                                self_step_multiplier):
+                                self_step_multiplier,
+                                self_x_range):
 
-        """ Helper function to mark axon voxels, needed for NUMBA. See fill_voxels_axon."""
+        """
+        Helper function to mark axon voxels, needed for NUMBA. See fill_voxels_axon.
+        Only voxels with x in self_x_range (x_start, x_end) are marked, see get_hyper_voxel_fill_range.
+        """
 
         # segID gives segment ID for each link
         # segX gives segmentX for each link
@@ -3000,6 +4039,10 @@ class SnuddaDetect(object):
             vp1_inside = ((vp1 >= 0).all() and (vp1 < self_num_bins).all())
             vp2_inside = ((vp2 >= 0).all() and (vp2 < self_num_bins).all())
 
+            if max(vp1[0], vp2[0]) < self_x_range[0] or min(vp1[0], vp2[0]) >= self_x_range[1]:
+                # Line does not reach the slab of the hyper voxel that is filled, skip
+                continue
+
             # Four cases, if neither inside, skip line
             # If one inside but not the other, start at inside point and
             # continue until outside
@@ -3052,6 +4095,10 @@ class SnuddaDetect(object):
                             # Rest of line outside
                             break
 
+                        if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                            # Outside the slab that is filled
+                            continue
+
                         v_ctr = voxel_space_ctr[vp[0], vp[1], vp[2]]
                         if v_ctr > 0 and voxel_space[vp[0], vp[1], vp[2], v_ctr - 1] == neuron_id:
                             # Voxel already has neuronID, skip
@@ -3084,6 +4131,10 @@ class SnuddaDetect(object):
                         # Rest of line outside
                         break
 
+                    if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                        # Outside the slab that is filled
+                        continue
+
                     v_ctr = voxel_space_ctr[vp[0], vp[1], vp[2]]
                     if v_ctr > 0 and voxel_space[vp[0], vp[1], vp[2], v_ctr - 1] == neuron_id:
                         # Voxel already has neuronID, skip
@@ -3110,6 +4161,10 @@ class SnuddaDetect(object):
                     vp = (vp1 + dv * i).astype(np.int64)
                     ax_dist = int(p1_dist + dd * i)
 
+                    if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                        # Outside the slab that is filled
+                        continue
+
                     v_ctr = voxel_space_ctr[vp[0], vp[1], vp[2]]
                     if v_ctr > 0 and voxel_space[vp[0], vp[1], vp[2], v_ctr - 1] == neuron_id:
                         # Voxel already has neuronID, skip
@@ -3133,22 +4188,239 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def fill_voxels_sparse(self, neuron, neuron_id):
+
+        """
+        Adds the axon, soma and dendrites of a neuron to self.axon_sparse and self.dend_sparse.
+        Used instead of fill_voxels_axon, fill_voxels_soma and fill_voxels_dend when voxel_storage is "sparse".
+        The voxels marked are the same as for the dense storage, only the first point of the neuron
+        in each voxel is kept.
+
+        Args:
+            neuron (NeuronMorphology): Neuron, rotated and positioned
+            neuron_id (int): ID of the neuron
+        """
+
+        x_range = self.get_hyper_voxel_fill_range()
+
+        axon_voxel_idx, _, _, axon_dist = \
+            self.fill_voxels_sparse_helper(coords=neuron.axon,
+                                           links=neuron.axon_links,
+                                           seg_id=np.zeros((neuron.axon_links.shape[0],), dtype=np.int64),
+                                           seg_x=np.zeros((neuron.axon_links.shape[0], 2)),
+                                           self_hyper_voxel_origo=self.hyper_voxel_origo,
+                                           self_voxel_size=self.voxel_size,
+                                           self_num_bins=self.num_bins,
+                                           self_step_multiplier=self.step_multiplier,
+                                           self_x_range=x_range,
+                                           max_points=self.sparse_max_points(neuron.axon, neuron.axon_links))
+
+        _, first_idx = np.unique(axon_voxel_idx, return_index=True)
+        self.axon_sparse.append(axon_voxel_idx[first_idx], neuron_id, soma_dist=axon_dist[first_idx])
+
+        # Soma is added before the dendrites, so soma voxels take precedence
+        soma_voxel_idx = self.soma_voxels_sparse(neuron.soma)
+
+        dend_voxel_idx, dend_sec_id, dend_sec_x, dend_dist = \
+            self.fill_voxels_sparse_helper(coords=neuron.dend,
+                                           links=neuron.dend_links,
+                                           seg_id=neuron.dend_sec_id,
+                                           seg_x=neuron.dend_sec_x,
+                                           self_hyper_voxel_origo=self.hyper_voxel_origo,
+                                           self_voxel_size=self.voxel_size,
+                                           self_num_bins=self.num_bins,
+                                           self_step_multiplier=self.step_multiplier,
+                                           self_x_range=x_range,
+                                           max_points=self.sparse_max_points(neuron.dend, neuron.dend_links))
+
+        voxel_idx = np.concatenate([soma_voxel_idx, dend_voxel_idx])
+        sec_id = np.concatenate([np.zeros(soma_voxel_idx.shape, dtype=np.int16), dend_sec_id])  # Soma is 0
+        sec_x = np.concatenate([0.5 * np.ones(soma_voxel_idx.shape), dend_sec_x])
+        soma_dist = np.concatenate([np.zeros(soma_voxel_idx.shape, dtype=np.int16), dend_dist])
+
+        _, first_idx = np.unique(voxel_idx, return_index=True)
+        self.dend_sparse.append(voxel_idx[first_idx], neuron_id,
+                                sec_id=sec_id[first_idx], sec_x=sec_x[first_idx], soma_dist=soma_dist[first_idx])
+
+    ############################################################################
+
+    def soma_voxels_sparse(self, soma_coord):
+
+        """
+        Returns the (flat) voxel index of all voxels inside the soma, see fill_voxels_soma.
+
+        Args:
+            soma_coord : (x,y,z,r) location of soma to place, and radius
+        """
+
+        v_coords = np.floor((soma_coord[0, :3] - self.hyper_voxel_origo) / self.voxel_size).astype(int)
+        radius2 = soma_coord[0, 3] ** 2
+        v_radius = np.ceil(soma_coord[0, 3] / self.voxel_size).astype(int)
+
+        assert v_radius < 1000, \
+            f"soma_voxels_sparse: v_radius={v_radius} soma coords = {soma_coord} (BIG SOMA, not SI units?)"
+
+        x_start, x_end = self.get_hyper_voxel_fill_range()
+
+        vx, vy, vz = np.meshgrid(np.arange(max(x_start, v_coords[0] - v_radius),
+                                           min(x_end, v_coords[0] + v_radius + 1)),
+                                 np.arange(max(0, v_coords[1] - v_radius),
+                                           min(self.hyper_voxel_size, v_coords[1] + v_radius + 1)),
+                                 np.arange(max(0, v_coords[2] - v_radius),
+                                           min(self.hyper_voxel_size, v_coords[2] + v_radius + 1)),
+                                 indexing="ij")
+
+        d2 = (((vx + 0.5) * self.voxel_size + self.hyper_voxel_origo[0] - soma_coord[0, 0]) ** 2
+              + ((vy + 0.5) * self.voxel_size + self.hyper_voxel_origo[1] - soma_coord[0, 1]) ** 2
+              + ((vz + 0.5) * self.voxel_size + self.hyper_voxel_origo[2] - soma_coord[0, 2]) ** 2)
+
+        inside = d2 < radius2
+
+        return self.dend_sparse.voxel_index(vx[inside], vy[inside], vz[inside])
+
+    ############################################################################
+
+    def sparse_max_points(self, coords, links):
+
+        """
+        Upper bound for the number of points fill_voxels_sparse_helper can return for the links.
+
+        Args:
+            coords : neuron vertices, n x 3 matrix
+            links : how do vertices link up to for segments n x 2 matrix
+        """
+
+        if len(links) == 0:
+            return 0
+
+        vp = np.floor((coords[:, :3] - self.hyper_voxel_origo) / self.voxel_size).astype(np.int64)
+        steps = np.max(np.abs(vp[links[:, 1], :] - vp[links[:, 0], :]), axis=1) * self.step_multiplier
+
+        # Margin of one voxel in each end of the links, in case fastmath rounds differently
+        return int(np.sum(steps + 1 + 2 * self.step_multiplier))
+
+    ############################################################################
+
+    @staticmethod
+    @jit(nopython=True, fastmath=True, cache=True)
+    def fill_voxels_sparse_helper(coords, links, seg_id, seg_x,
+                                  self_hyper_voxel_origo, self_voxel_size, self_num_bins,
+                                  self_step_multiplier, self_x_range, max_points):
+
+        """
+        Helper function for fill_voxels_sparse, static method needed for NUMBA.
+
+        Walks the links the same way as fill_voxels_dend_helper and fill_voxels_axon_helper, but returns
+        the visited voxels instead of marking them in a dense matrix. A voxel can be returned multiple times.
+        Only voxels with x in self_x_range (x_start, x_end) are returned, see get_hyper_voxel_fill_range.
+        max_points must be an upper bound for the number of points, see sparse_max_points.
+
+        Returns:
+            voxel_idx (flat voxel index), sec_id, sec_x, soma_dist
+        """
+
+        voxel_idx = np.zeros((max_points,), dtype=np.int64)
+        voxel_sec_id = np.zeros((max_points,), dtype=np.int16)
+        voxel_sec_x = np.zeros((max_points,), dtype=np.float64)
+        voxel_soma_dist = np.zeros((max_points,), dtype=np.int16)
+
+        ctr = 0
+
+        for line, segmentID, segmentX in zip(links, seg_id, seg_x):
+            p1 = coords[line[0], :3]
+            p2 = coords[line[1], :3]
+            p1_dist = coords[line[0], 4] * 1e6  # Dist to soma
+            p2_dist = coords[line[1], 4] * 1e6
+
+            vp1 = np.floor((p1 - self_hyper_voxel_origo) / self_voxel_size).astype(np.int64)
+            vp2 = np.floor((p2 - self_hyper_voxel_origo) / self_voxel_size).astype(np.int64)
+
+            vp1_inside = ((vp1 >= 0).all() and (vp1 < self_num_bins).all())
+            vp2_inside = ((vp2 >= 0).all() and (vp2 < self_num_bins).all())
+
+            if max(vp1[0], vp2[0]) < self_x_range[0] or min(vp1[0], vp2[0]) >= self_x_range[1]:
+                # Line does not reach the slab of the hyper voxel that is filled, skip
+                continue
+
+            if not vp1_inside and not vp2_inside:
+                # No points inside, skip
+                continue
+
+            if (vp1 == vp2).all():
+                # Line is only one voxel, steps will be 0, so treat it separately
+                voxel_idx[ctr] = (vp1[0] * self_num_bins[1] + vp1[1]) * self_num_bins[2] + vp1[2]
+                voxel_sec_id[ctr] = segmentID
+                voxel_sec_x[ctr] = segmentX[0]
+                voxel_soma_dist[ctr] = p1_dist
+                ctr += 1
+                continue
+
+            # Start at a point inside, continue until outside cube (or end of line)
+            steps = max(np.abs(vp2 - vp1)) * self_step_multiplier
+
+            if vp1_inside:
+                v_start, s_start, d_start = vp1, segmentX[0], p1_dist
+                dv = (vp2 - vp1) / steps
+                ds = (segmentX[1] - segmentX[0]) / steps
+                dd = (p2_dist - p1_dist) / steps
+            else:
+                v_start, s_start, d_start = vp2, segmentX[1], p2_dist
+                dv = (vp1 - vp2) / steps
+                ds = (segmentX[0] - segmentX[1]) / steps
+                dd = (p1_dist - p2_dist) / steps
+
+            # We want the end element "steps" also, hence +1
+            for i in range(0, steps + 1):
+                vp = (v_start + dv * i).astype(np.int64)
+
+                if (vp < 0).any() or (vp >= self_num_bins).any():
+                    # Rest of line outside
+                    break
+
+                if vp[0] < self_x_range[0] or vp[0] >= self_x_range[1]:
+                    # Outside the slab that is filled
+                    continue
+
+                v_idx = (vp[0] * self_num_bins[1] + vp[1]) * self_num_bins[2] + vp[2]
+
+                if ctr > 0 and voxel_idx[ctr - 1] == v_idx:
+                    # Same voxel as previous point, only first point in voxel is kept anyway
+                    continue
+
+                voxel_idx[ctr] = v_idx
+                voxel_sec_id[ctr] = segmentID
+                voxel_sec_x[ctr] = s_start + ds * i  # float
+                voxel_soma_dist[ctr] = int(d_start + dd * i)
+                ctr += 1
+
+        return voxel_idx[:ctr], voxel_sec_id[:ctr], voxel_sec_x[:ctr], voxel_soma_dist[:ctr]
+
+    ############################################################################
+
     # TODO: Add a filter, neurons that are not included in connectivity definition as either
     #       source or target are excluded. Also, if none of their sources/targets are in hypervoxel
     #       then the neurons are also excluded.
 
-    def process_hyper_voxel(self, hyper_id):
+    def process_hyper_voxel(self, hyper_id, part_list=None):
 
         """
         Process hyper voxel, ie do touch detection, and save results.
 
         Args:
             hyper_id : ID of hyper voxel to process
+            part_list (list, optional) : Only detect synapses and gap junctions in these parts of the hyper voxel
+                                         (see hyper_voxel_parts), the result is written to a part file that is
+                                         combined with the other parts by merge_hyper_voxel_parts
         """
 
         start_time = timeit.default_timer()
         end_time = None
 
+        if part_list is not None and len(part_list) == self.hyper_voxel_parts:
+            part_list = None
+
+        self.hyper_voxel_part_list = part_list
+
         try:
             if self.hyper_voxels[hyper_id]["neuronCtr"] == 0:
                 # No neurons, return quickly - do not write hdf5 file
@@ -3170,7 +4442,15 @@ class SnuddaDetect(object):
 
             for neuron_id in self.hyper_voxels[hyper_id]["neurons"][:num_neurons]:
 
-                neuron = self.load_neuron(self.neurons[neuron_id])
+                if not self.neuron_in_fill_range(neuron_id):
+                    # Only the slab of the parts is filled, and the neuron does not reach it
+                    continue
+
+                neuron = self.load_placed_neuron(neuron_id)
+
+                if self.voxel_storage == "sparse":
+                    self.fill_voxels_sparse(neuron, neuron_id)
+                    continue
 
                 self.fill_voxels_axon(self.axon_voxels,
                                       self.axon_voxel_ctr,
@@ -3204,6 +4484,15 @@ class SnuddaDetect(object):
                                         self.axon_voxel_ctr,
                                         self.axon_soma_dist)
 
+            if part_list is None or self.hyper_voxel_parts - 1 in part_list:
+                # The parts of a hyper voxel are dispatched in order, so no later part of it will need the neurons
+                self.release_placed_neurons(self.hyper_voxels[hyper_id]["neurons"][:num_neurons])
+
+            if self.voxel_storage == "sparse":
+                # All neurons added, sort the voxel content and build lookup tables
+                self.axon_sparse.finalise()
+                self.dend_sparse.finalise()
+
             # This detects the synapses where we use a density distribution for axons
             # self.detectSynapsesNoAxonSLOW (hyperID) # --replaced by placeSynapseNoAxon
 
@@ -3217,6 +4506,8 @@ class SnuddaDetect(object):
             end_time = timeit.default_timer()
 
             self.write_log(f"process_hyper_voxel: {hyper_id} took {end_time - start_time:.1f} s")
+            self.write_log(f"Neuron cache: {self.neuron_cache_hits} hits, {self.neuron_cache_misses} misses "
+                           f"({len(self.neuron_cache)} neurons cached)")
 
         except Exception as e:
             # Write error to log file to help trace it.
@@ -3257,6 +4548,8 @@ class SnuddaDetect(object):
 
         """
 
+        assert self.voxel_storage == "dense", "plot_hyper_voxel requires voxel_storage='dense'"
+
         import matplotlib.pyplot as plt
         from mpl_toolkits.mplot3d import Axes3D
 
@@ -3359,6 +4652,8 @@ class SnuddaDetect(object):
 
         """ Export CSV file with voxel data, used for visualisation."""
 
+        assert self.voxel_storage == "dense", "export_voxel_visualisation_csv requires voxel_storage='dense'"
+
         # x,y,z = coords
         # shape = "cube" or "sphere"
         # type = "axon", "dendrite", "synapse"
@@ -3430,6 +4725,8 @@ class SnuddaDetect(object):
             dpi : Resolution of output file
         """
 
+        assert self.voxel_storage == "dense", "plot_neurons_in_hyper_voxel requires voxel_storage='dense'"
+
         if axon_alpha is None:
             axon_alpha = np.ones((len(neuron_id),))
 
@@ -29,7 +29,6 @@ import math
 import numexpr
 import collections
 
-import heapq  # Priority queue
 
 import time
 import timeit
@@ -71,7 +70,8 @@ class SnuddaPrune(object):
                  h5libver="latest",
                  random_seed=None,
                  keep_files=False,   # If True then you can redo pruning multiple times without reruning detect
-                 all_neuron_pair_synapses_share_parameter_id=True):
+                 all_neuron_pair_synapses_share_parameter_id=True,
+                 merge_buffer_size=2000000):
 
         """
         Constructor.
@@ -94,6 +94,8 @@ class SnuddaPrune(object):
             all_neuron_pair_synapses_share_parameter_id (bool): Instead of each synapse having a unique parameter_id
                                                                 all synapses between the same neuron pair will have
                                                                 the same parameter id.
+            merge_buffer_size (int): Number of synapse rows read into memory at a time when merging the hyper voxel
+                                     files, shared between the files (each row is 52 bytes)
         """
 
         self.rc = rc
@@ -154,6 +156,7 @@ class SnuddaPrune(object):
         # These are for the merge code
         self.synapse_write_buffer = None
         self.synapse_buffer_size = 100000
+        self.merge_buffer_size = merge_buffer_size
         self.next_buffer_write_pos = 0
         self.next_file_write_pos = 0
         self.buffer_out_file = None
@@ -190,6 +193,12 @@ class SnuddaPrune(object):
         self.type_id_lookup = None
         self.type_id_list = None
 
+        # Pruning parameters in array form for the compiled pruning kernel, set by setup_pruning_parameters
+        self.pruning_parameter_lookup = None
+        self.pruning_parameters = None
+        self.pruning_dist_expr = None
+        self.pruning_cluster = None
+
         self.next_file_read_pos = None
         self.next_buffer_read_pos = None
 
@@ -269,6 +278,9 @@ class SnuddaPrune(object):
 
         self.write_log(f"prune synapses and gap junctions: {end_time - start_time:.1f}s")
 
+        # Row ranges of the synapses onto each neuron, lets SnuddaSimulate read only the synapses of its neurons
+        self.write_synapse_row_index()
+
         # Close output file
         try:
             if self.out_file:
@@ -280,6 +292,47 @@ class SnuddaPrune(object):
 
     ############################################################################
 
+    def write_synapse_row_index(self, chunk_size=10000000):
+
+        """
+        Writes network/synapseRowPtr to the output file (network-synapses.hdf5). The synapses onto neuron_id are
+        in rows synapseRowPtr[neuron_id] to synapseRowPtr[neuron_id+1]-1 of the (sorted) synapse matrix.
+
+        Args:
+            chunk_size (int) : Number of synapse rows to read at a time
+        """
+
+        if self.out_file is not None:
+            out_file = self.out_file
+        else:
+            out_file = h5py.File(os.path.join(self.network_path, "network-synapses.hdf5"), "r+",
+                                 libver=self.h5libver, driver=self.h5driver)
+
+        num_neurons = out_file["network/neurons/neuronID"].shape[0]
+        num_synapses = int(out_file["network/nSynapses"][0])
+
+        synapse_ctr = np.zeros((num_neurons,), dtype=np.int64)
+        last_dest_id = 0
+
+        for row_start in range(0, num_synapses, chunk_size):
+            dest_id = out_file["network/synapses"][row_start:min(row_start + chunk_size, num_synapses), 1]
+
+            assert last_dest_id <= dest_id[0] and (np.diff(dest_id) >= 0).all(), \
+                "write_synapse_row_index: Synapses must be sorted on destination neuron"
+
+            synapse_ctr += np.bincount(dest_id, minlength=num_neurons)
+            last_dest_id = dest_id[-1]
+
+        if "synapseRowPtr" in out_file["network"]:
+            del out_file["network/synapseRowPtr"]
+
+        out_file["network"].create_dataset("synapseRowPtr", data=np.append(0, np.cumsum(synapse_ctr)))
+
+        if out_file is not self.out_file:
+            out_file.close()
+
+    ############################################################################
+
     def save_merge_info(self,
                         merge_files_syn, merge_neuron_range_syn, merge_syn_ctr,
                         merge_files_gj, merge_neuron_range_gj, merge_gj_ctr):
@@ -732,6 +785,52 @@ class SnuddaPrune(object):
 
                 self.connectivity_distributions[pre_type_id, post_type_id, synapse_type_id] = (pruning, pruning_other)
 
+        self.setup_pruning_parameters()
+
+    ############################################################################
+
+    def setup_pruning_parameters(self):
+
+        """
+        Converts connectivity_distributions to arrays used by the compiled pruning kernel (see get_keep_row_flag).
+
+        pruning_parameter_lookup[pre_type_id, post_type_id, synapse_type_id, between_units] is the index of the
+        pruning parameters (-1 if the connection is not pruned, i.e. removed), where between_units is 1 if
+        the two neurons belong to different population units. For each index pruning_parameters contains
+        f1, softMax, mu2, a3 (NaN if not used), pruning_dist_expr the distance dependent pruning expression
+        and pruning_cluster the cluster flag.
+        """
+
+        parameter_list = []
+        parameter_idx = dict()
+
+        def get_parameter_idx(c_info):
+            if id(c_info) not in parameter_idx:
+                parameter_idx[id(c_info)] = len(parameter_list)
+                parameter_list.append(c_info)
+            return parameter_idx[id(c_info)]
+
+        max_type_id = max(self.type_id_list, default=0)
+        max_synapse_type_id = max([x[2] for x in self.connectivity_distributions], default=0)
+
+        self.pruning_parameter_lookup = -np.ones((max_type_id + 1, max_type_id + 1, max_synapse_type_id + 1, 2),
+                                                 dtype=np.int32)
+
+        for (pre_type_id, post_type_id, synapse_type_id), con_info in self.connectivity_distributions.items():
+            within_idx = get_parameter_idx(con_info[0])
+            between_idx = within_idx if con_info[1] is None else get_parameter_idx(con_info[1])
+
+            self.pruning_parameter_lookup[pre_type_id, post_type_id, synapse_type_id, :] = [within_idx, between_idx]
+
+        def to_float(value):
+            return np.nan if value is None else float(value)
+
+        self.pruning_parameters = np.array([[to_float(c_info["f1"]), to_float(c_info["softMax"]),
+                                             to_float(c_info["mu2"]), to_float(c_info["a3"])]
+                                            for c_info in parameter_list], dtype=float).reshape((-1, 4))
+        self.pruning_dist_expr = [c_info["distPruning"] for c_info in parameter_list]
+        self.pruning_cluster = np.array([bool(c_info["cluster"]) for c_info in parameter_list], dtype=bool)
+
     ############################################################################
 
     # This makes sure all the variables exist, that way prune_synapses_helper
@@ -1329,11 +1428,13 @@ class SnuddaPrune(object):
         d_view.scatter('logfile_name', engine_log_file, block=True)
         d_view.push({"network_path": self.network_path,
                      "random_seed": self.random_seed,
-                     "config_file": self.config_file}, block=True)
+                     "config_file": self.config_file,
+                     "merge_buffer_size": self.merge_buffer_size}, block=True)
 
         cmd_str = ("sp = SnuddaPrune(network_path=network_path, logfile_name=logfile_name[0]," 
                    "                 config_file=config_file,"
-                   "                 role='worker',random_seed=random_seed)")
+                   "                 role='worker',random_seed=random_seed,"
+                   "                 merge_buffer_size=merge_buffer_size)")
         d_view.execute(cmd_str, block=True)
 
         self.write_log(f"Workers setup: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
@@ -1402,6 +1503,13 @@ class SnuddaPrune(object):
                 self.next_buffer_write_pos = 0
                 # Ok, now we have clean buffer, back to normal program
 
+            if synapses.shape[0] >= self.synapse_buffer_size:
+                # Large blocks (e.g. from big_merge_helper) are written directly, without the buffer
+                end_file_idx = self.next_file_write_pos + synapses.shape[0]
+                self.buffer_out_file[synapse_matrix_loc][self.next_file_write_pos:end_file_idx, :] = synapses
+                self.next_file_write_pos = end_file_idx
+                synapses = synapses[:0, :]
+
             end_buf_idx = self.next_buffer_write_pos + synapses.shape[0]
             self.synapse_write_buffer[self.next_buffer_write_pos:end_buf_idx, :] = synapses
             self.next_buffer_write_pos += synapses.shape[0]
@@ -1544,6 +1652,10 @@ class SnuddaPrune(object):
         """
         Gathers synapses (or gap junctions) belonging to neuron_range from multiple hyper voxels into one merge file.
 
+        The hyper voxel files are read in blocks, and merged block wise (k-way merge on the unique id of the
+        neuron pair), the files are only open while a block is read. At most self.merge_buffer_size rows are
+        kept in the read buffers, split between the files.
+
         Args:
             neuron_range : Range of neurons
             merge_data_type : "synapses" or "gapJunctions"
@@ -1565,24 +1677,14 @@ class SnuddaPrune(object):
             # Locations of data within the file
             h5_syn_mat, h5_hyp_syn_n, h5_syn_n, h5_syn_lookup = self.data_loc[merge_data_type]
 
-            synapse_heap = []
-            file_list = dict([])
-            file_mat_iterator = dict([])
-            chunk_size = 10000
+            # Files to merge, h_id as key. Each has the range of rows in the lookup table that are relevant
+            merge_sources = dict()
 
-            # Next we need to open all the relevant files
             h_file_name_mask = os.path.join(self.network_path, "voxels", "network-putative-synapses-%s.hdf5")
 
             max_axon_voxel_ctr = 0
             max_dend_voxel_ctr = 0
 
-            # !!! Special code to increase h5py cache size
-            propfaid = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
-            settings = list(propfaid.get_cache())
-            settings[2] *= 20
-            propfaid.set_cache(*settings)
-            # !!! End special cache code
-
             n_hv = int(self.hist_file["nCompleted"][0])
             n_total = 0
 
@@ -1599,60 +1701,43 @@ class SnuddaPrune(object):
                     h_filename = h_file_name_mask % str(h_id)
                     self.write_log(f"Opening voxel file: {h_filename}")
 
-                    # Low level opening hdf5 file, to have greater cache size #ACC_RDWR
-                    fid = h5py.h5f.open(h_filename.encode(), flags=h5py.h5f.ACC_RDONLY, fapl=propfaid)
-                    file_list[h_id] = h5py.File(fid, drive=self.h5driver)
+                    with h5py.File(h_filename, "r", driver=self.h5driver) as hv_file:
 
-                    # Verify hyper voxel
-                    if merge_data_type == "synapses":
-                        # No need to do it for both synapses and gap junctions, since same hyper voxels
-                        self.check_hyper_voxel_integrity(file_list[h_id], h_filename.encode(), verbose=True)
+                        # Verify hyper voxel
+                        if merge_data_type == "synapses":
+                            # No need to do it for both synapses and gap junctions, since same hyper voxels
+                            self.check_hyper_voxel_integrity(hv_file, h_filename.encode(), verbose=True)
 
-                    if self.max_channel_type:
-                        if self.max_channel_type != file_list[h_id]["network/maxChannelTypeID"][()]:
-                            self.write_log("Investigate", is_error=True)
-                            self.write_log(f"{self.max_channel_type} != "
-                                           f"{file_list[h_id]['network/maxChannelTypeID'][()]}", is_error=True)
-                            # import pdb
-                            # pdb.set_trace()
-
-                        # These should be the same for all hypervoxels
-                        assert self.max_channel_type == file_list[h_id]["network/maxChannelTypeID"][()], \
-                            (f"max_channel_type = {self.max_channel_type} "
-                             f"(differ with what is in file {file_list[h_id]['network/maxChannelTypeID'][()]})")
-                    else:
-                        self.max_channel_type = file_list[h_id]["network/maxChannelTypeID"][()]
-                        self.write_log(f"Setting max_channel_type to {self.max_channel_type} from h_id={h_id}")
-
-                    lookup_iterator = \
-                        self.file_row_lookup_iterator_subset(h5mat_lookup=file_list[h_id][h5_syn_lookup],
-                                                             min_dest_id=neuron_range[0],
-                                                             max_dest_id=neuron_range[1],
-                                                             chunk_size=chunk_size)
-
-                    file_mat_iterator[h_id] \
-                        = self.synapse_set_iterator(h5mat_lookup=file_list[h_id][h5_syn_lookup],
-                                                    h5mat=file_list[h_id][h5_syn_mat],
-                                                    chunk_size=chunk_size,
-                                                    lookup_iterator=lookup_iterator)
-
-                    syn_set, unique_id = next(file_mat_iterator[h_id], (None, None))
-
-                    if syn_set is None:
-                        # There were synapses in the hyper voxel, but none relevant to our
-                        # selected files. Clear file List and fileMatIterator for this worker
-                        del file_list[h_id]
-                        del file_mat_iterator[h_id]
-                        continue
-
-                    # Create a heap containing the first subset of all files
-                    heapq.heappush(synapse_heap, (unique_id, h_id, syn_set))
-
-                    # This is so we can optimize the axon/dend voxelCtr and size
-                    if "maxAxonVoxelCtr" in file_list[h_id]["meta"]:
-                        max_axon_voxel_ctr = max(max_axon_voxel_ctr, file_list[h_id]["meta/maxAxonVoxelCtr"][()])
-                    if "maxDendVoxelCtr" in file_list[h_id]["meta"]:
-                        max_dend_voxel_ctr = max(max_dend_voxel_ctr, file_list[h_id]["meta/maxDendVoxelCtr"][()])
+                        if self.max_channel_type:
+                            if self.max_channel_type != hv_file["network/maxChannelTypeID"][()]:
+                                self.write_log("Investigate", is_error=True)
+                                self.write_log(f"{self.max_channel_type} != "
+                                               f"{hv_file['network/maxChannelTypeID'][()]}", is_error=True)
+
+                            # These should be the same for all hypervoxels
+                            assert self.max_channel_type == hv_file["network/maxChannelTypeID"][()], \
+                                (f"max_channel_type = {self.max_channel_type} "
+                                 f"(differ with what is in file {hv_file['network/maxChannelTypeID'][()]})")
+                        else:
+                            self.max_channel_type = hv_file["network/maxChannelTypeID"][()]
+                            self.write_log(f"Setting max_channel_type to {self.max_channel_type} from h_id={h_id}")
+
+                        lookup_range = self.find_lookup_range(h5mat_lookup=hv_file[h5_syn_lookup],
+                                                              min_dest_id=neuron_range[0],
+                                                              max_dest_id=neuron_range[1])
+
+                        if lookup_range[0] == lookup_range[1]:
+                            # There were synapses in the hyper voxel, but none relevant to our selected neurons
+                            continue
+
+                        merge_sources[int(h_id)] = self.create_merge_source(filename=h_filename,
+                                                                            lookup_range=lookup_range)
+
+                        # This is so we can optimize the axon/dend voxelCtr and size
+                        if "maxAxonVoxelCtr" in hv_file["meta"]:
+                            max_axon_voxel_ctr = max(max_axon_voxel_ctr, hv_file["meta/maxAxonVoxelCtr"][()])
+                        if "maxDendVoxelCtr" in hv_file["meta"]:
+                            max_dend_voxel_ctr = max(max_dend_voxel_ctr, hv_file["meta/maxDendVoxelCtr"][()])
 
             # --- Start of special code for projection synapses from project.py
 
@@ -1666,50 +1751,30 @@ class SnuddaPrune(object):
                 # Since they were not created using hyper voxels, they get the special h_id = -1
                 proj_connection = -1
 
-                fid = h5py.h5f.open(self.projection_synapse_file.encode(),
-                                    flags=h5py.h5f.ACC_RDONLY, fapl=propfaid)
-                file_list[proj_connection] = h5py.File(fid, drive=self.h5driver)
+                with h5py.File(self.projection_synapse_file, "r", driver=self.h5driver) as proj_file:
 
-                if self.max_channel_type:
-                    assert self.max_channel_type == file_list[proj_connection]["network/maxChannelTypeID"][()], \
-                        "max_channel_type does not match for projection file"
-                else:
-                    self.max_channel_type = file_list[proj_connection]["network/maxChannelTypeID"][()]
-
-                assert file_list[proj_connection]["network/nSynapses"][()] == self.num_projection_synapses, \
-                    (f"Mismatch between work history file and data file. "
-                     f"nProjectionSynapses: {self.num_projection_synapses} vs {self.num_projection_synapses}")
-
-                if file_list[proj_connection]["network/nSynapses"][()] > 0:
-                    n_total += file_list[proj_connection]["network/nSynapses"][()]
-
-                    lookup_iterator = \
-                        self.file_row_lookup_iterator_subset(h5mat_lookup=file_list[proj_connection][h5_syn_lookup],
-                                                             min_dest_id=neuron_range[0],
-                                                             max_dest_id=neuron_range[1],
-                                                             chunk_size=chunk_size)
-
-                    file_mat_iterator[proj_connection] \
-                        = self.synapse_set_iterator(h5mat_lookup=file_list[proj_connection][h5_syn_lookup],
-                                                    h5mat=file_list[proj_connection][h5_syn_mat],
-                                                    chunk_size=chunk_size,
-                                                    lookup_iterator=lookup_iterator)
-
-                    syn_set, unique_id = next(file_mat_iterator[proj_connection], (None, None))
-
-                    if syn_set is None:
-                        # No synapse in our range, let this worker skip the file
-                        # Clear file List and fileMatIterator for this worker
-                        del file_list[proj_connection]
-                        del file_mat_iterator[proj_connection]
+                    if self.max_channel_type:
+                        assert self.max_channel_type == proj_file["network/maxChannelTypeID"][()], \
+                            "max_channel_type does not match for projection file"
                     else:
-                        # Create a heap containing the first subset of all files
-                        heapq.heappush(synapse_heap, (unique_id, proj_connection, syn_set))
+                        self.max_channel_type = proj_file["network/maxChannelTypeID"][()]
 
-                else:
-                    # No synapses in file, close it.
-                    file_list[proj_connection].close()
-                    del file_list[proj_connection]
+                    assert proj_file["network/nSynapses"][()] == self.num_projection_synapses, \
+                        (f"Mismatch between work history file and data file. "
+                         f"nProjectionSynapses: {self.num_projection_synapses} vs {self.num_projection_synapses}")
+
+                    if proj_file["network/nSynapses"][()] > 0:
+                        n_total += proj_file["network/nSynapses"][()]
+
+                        lookup_range = self.find_lookup_range(h5mat_lookup=proj_file[h5_syn_lookup],
+                                                              min_dest_id=neuron_range[0],
+                                                              max_dest_id=neuron_range[1])
+
+                        # If no synapse is in our range, let this worker skip the file
+                        if lookup_range[0] < lookup_range[1]:
+                            merge_sources[proj_connection] \
+                                = self.create_merge_source(filename=self.projection_synapse_file,
+                                                           lookup_range=lookup_range)
 
             # --- End of code for projection synapses
 
@@ -1737,69 +1802,50 @@ class SnuddaPrune(object):
                 self.buffer_out_file["meta"].create_dataset("maxDendVoxelCtr", data=max_dend_voxel_ctr)
                 self.write_log(f"max_dend_voxel_ctr = {max_dend_voxel_ctr}")
 
-            # Take the first (smallest uniqueID) element from the heap
-            if len(synapse_heap) > 0:
-                # Get the first file to read synapses from
-                (unique_id, h_id, syn_set) = heapq.heappop(synapse_heap)
-            else:
+            if len(merge_sources) == 0:
                 # No synapses at all, return
                 self.clean_up_merge_read_buffers()
                 return None, neuron_range, 0
 
-            # Store synapse
-            self.buffer_merge_write(h5_syn_mat, syn_set)
-            syn_ctr = syn_set.shape[0]
+            # Sources in h_id order, this is the order of synapses with the same unique id in the merged file
+            merge_sources = [merge_sources[h_id] for h_id in sorted(merge_sources.keys())]
+            block_size = max(1, self.merge_buffer_size // len(merge_sources))
 
-            loop_ctr = 0
-            done = False
+            self.write_log(f"Merging {len(merge_sources)} files, block size {block_size} rows")
 
-            while not done:
+            syn_ctr = 0
+            loop_ctr = 0
 
-                old_unique_id = unique_id
+            while True:
 
-                if loop_ctr % 1000000 == 0 and n_total > 1000000:
-                    self.write_log(f"Worker synapses: {syn_ctr}/{n_total} (heap size: {len(synapse_heap)})",
-                                   force_print=True)
+                for source in merge_sources:
+                    if source["keys"].shape[0] == 0 and source["lookup_pos"] < source["lookup_end"]:
+                        self.read_merge_block(source=source, block_size=block_size,
+                                              h5_syn_mat=h5_syn_mat, h5_syn_lookup=h5_syn_lookup)
 
-                # Get the next set of synapses from this file from the iterator
-                next_row_set = next(file_mat_iterator[h_id], None)
+                merge_sources = [x for x in merge_sources if x["keys"].shape[0] > 0]
 
-                if next_row_set is not None:
-                    # More synapses in file, push next pair to heap, and pop top pair
-                    syn_set, unique_id = next_row_set
-                    (unique_id, h_id, syn_set) = heapq.heappushpop(synapse_heap, (unique_id, h_id, syn_set))
-                elif len(synapse_heap) > 0:
-                    (unique_id, h_id, syn_set) = heapq.heappop(synapse_heap)
+                if len(merge_sources) == 0:
+                    break
 
-                else:
-                    done = True
-                    continue
+                if loop_ctr % 100 == 0 and n_total > 1000000:
+                    self.write_log(f"Worker synapses: {syn_ctr}/{n_total} ({len(merge_sources)} files)",
+                                   force_print=True)
 
-                assert unique_id >= old_unique_id, "uniqueID should be increasing in file"
+                synapses, _ = self.merge_blocks(merge_sources)
 
-                self.buffer_merge_write(h5_syn_mat, syn_set)
-                syn_ctr += syn_set.shape[0]
+                self.buffer_merge_write(h5_syn_mat, synapses)
+                syn_ctr += synapses.shape[0]
                 loop_ctr += 1
 
             if n_total > 1000000:
-                self.write_log(f"Worker {merge_data_type}: {syn_ctr}/{n_total} (heap size: {len(synapse_heap)})",
-                               force_print=True)
+                self.write_log(f"Worker {merge_data_type}: {syn_ctr}/{n_total}", force_print=True)
 
             self.write_log(f"Read {syn_ctr} out of total {n_total} {merge_data_type}", force_print=True)
 
             self.buffer_merge_write(h5_syn_mat, flush=True)
             self.write_log("big_merge_helper: done")
 
-            # Close the hyper voxel files
-            for f in file_list:
-                try:
-                    file_list[f].close()
-                except:
-                    import traceback
-                    t_str = traceback.format_exc()
-                    self.write_log(t_str)
-                    self.write_log(f"Problems closing files {f}, {file_list[f]}")
-
             self.buffer_out_file.close()
 
             return output_filename, neuron_range, syn_ctr
@@ -1811,6 +1857,133 @@ class SnuddaPrune(object):
 
     ############################################################################
 
+    def find_lookup_range(self, h5mat_lookup, min_dest_id, max_dest_id):
+
+        """
+        Finds the rows of the lookup table for synapses with dest_id in the range min_dest_id to max_dest_id.
+        Returns (start_row, end_row), end_row is exclusive.
+
+        Args:
+            h5mat_lookup : Synapse lookup table
+            min_dest_id : Minimum neuron destination ID for synapses  (inclusive)
+            max_dest_id : Maximum neuron destination ID for synapses (exclusive)
+        """
+
+        num_neurons = self.hist_file["network/neurons/neuronID"].shape[0]
+
+        assert self.max_channel_type is not None, "max_channel_type should not be None"
+
+        min_unique_id = min_dest_id * num_neurons * self.max_channel_type
+        max_unique_id = max_dest_id * num_neurons * self.max_channel_type
+
+        # The lookup table is sorted on unique id
+        unique_id = h5mat_lookup[:, 0]
+        start_row, end_row = np.searchsorted(unique_id, [min_unique_id, max_unique_id], side="left")
+
+        return int(start_row), int(end_row)
+
+    ############################################################################
+
+    @staticmethod
+    def create_merge_source(filename, lookup_range):
+
+        """
+        Creates the read state of one file in the k-way merge.
+
+        Args:
+            filename : Path to hyper voxel (or projection) file
+            lookup_range : (start_row, end_row) of the lookup table to merge
+        """
+
+        return {"filename": filename,
+                "lookup_pos": lookup_range[0],
+                "lookup_end": lookup_range[1],
+                "lookup_buffer": np.zeros((0, 3), dtype=np.int64),
+                "synapses": None,
+                "keys": np.zeros((0,), dtype=np.int64)}
+
+    ############################################################################
+
+    def read_merge_block(self, source, block_size, h5_syn_mat, h5_syn_lookup):
+
+        """
+        Reads the next block of rows from the source file, the block holds complete neuron pairs (lookup rows)
+        with up to block_size synapses in total (or one neuron pair, if it has more synapses).
+        The file is only open during the read.
+
+        Args:
+            source : Merge source, see create_merge_source
+            block_size : Maximal number of rows to read (unless a single neuron pair has more synapses)
+            h5_syn_mat : Location of synapse matrix in file
+            h5_syn_lookup : Location of lookup table in file
+        """
+
+        with h5py.File(source["filename"], "r", driver=self.h5driver) as f:
+
+            if source["lookup_buffer"].shape[0] == 0:
+                lookup_end = min(source["lookup_pos"] + block_size, source["lookup_end"])
+                source["lookup_buffer"] = f[h5_syn_lookup][source["lookup_pos"]:lookup_end, :].astype(np.int64)
+
+            lookup = source["lookup_buffer"]
+
+            # Neuron pairs are contiguous in the synapse matrix, read as many whole pairs as fit in the block
+            num_rows = lookup[:, 2] - lookup[0, 1]
+            num_pairs = max(1, int(np.searchsorted(num_rows, block_size, side="right")))
+
+            start_row = lookup[0, 1]
+            end_row = lookup[num_pairs - 1, 2]
+
+            source["synapses"] = f[h5_syn_mat][start_row:end_row, :]
+            source["keys"] = np.repeat(lookup[:num_pairs, 0], lookup[:num_pairs, 2] - lookup[:num_pairs, 1])
+
+        source["lookup_buffer"] = lookup[num_pairs:, :]
+        source["lookup_pos"] += num_pairs
+
+    ############################################################################
+
+    @staticmethod
+    def merge_blocks(merge_sources):
+
+        """
+        Merges the read blocks of the sources, returns (synapses, keys) for the synapses that can be written.
+
+        Each block holds complete neuron pairs, and the next block of a file only has larger unique ids.
+        All synapses with unique id up to the smallest last unique id of the blocks of the files not yet
+        fully read are therefore final. Those are removed from the blocks, and sorted on unique id.
+        The sort is stable, and the sources are in h_id order, so synapses with the same unique id are in h_id order.
+
+        Args:
+            merge_sources : List of merge sources (see create_merge_source), with non-empty blocks, in h_id order
+        """
+
+        read_keys = [x["keys"][-1] for x in merge_sources if x["lookup_pos"] < x["lookup_end"]]
+
+        if len(read_keys) > 0:
+            max_key = min(read_keys)
+        else:
+            max_key = max([x["keys"][-1] for x in merge_sources])
+
+        synapse_parts = []
+        key_parts = []
+
+        for source in merge_sources:
+            n_rows = np.searchsorted(source["keys"], max_key, side="right")
+
+            synapse_parts.append(source["synapses"][:n_rows, :])
+            key_parts.append(source["keys"][:n_rows])
+
+            source["synapses"] = source["synapses"][n_rows:, :]
+            source["keys"] = source["keys"][n_rows:]
+
+        synapses = np.concatenate(synapse_parts, axis=0)
+        keys = np.concatenate(key_parts)
+
+        sort_idx = np.argsort(keys, kind="stable")
+
+        return synapses[sort_idx, :], keys[sort_idx]
+
+    ############################################################################
+
     def prune_synapses(self, synapse_file, output_filename,
                        merge_data_type, row_range=None,
                        close_input_file=True,
@@ -1922,10 +2095,46 @@ class SnuddaPrune(object):
             merge_data_type : "synapses" or "gapJunctions"
 
         """
-        # Tried to use numba, but dictionaries and h5py._hl.files.File not supported
 
         h5_syn_mat, h5_hyp_syn_n, h5_syn_n, h5_syn_loc = self.data_loc[merge_data_type]
 
+        keep_row_flag = self.get_keep_row_flag(synapses=synapses, merge_data_type=merge_data_type)
+
+        # Time to write synapses to file
+        n_keep_tot = int(np.sum(keep_row_flag))
+        write_start_pos = int(output_file["network/" + h5_syn_n][0])
+        write_end_pos = write_start_pos + n_keep_tot
+
+        if n_keep_tot > 0:
+            output_file[h5_syn_mat].resize((write_end_pos, output_file[h5_syn_mat].shape[1]))
+            output_file[h5_syn_mat][write_start_pos:write_end_pos] = \
+                synapses[keep_row_flag, :]
+
+            # Update counters
+            output_file["network/" + h5_syn_n][0] = write_end_pos
+
+        else:
+            self.write_log("No synapses kept, resizing")
+            output_file[h5_syn_mat].resize((write_end_pos, output_file[h5_syn_mat].shape[1]))
+
+        return n_keep_tot
+
+    ############################################################################
+
+    def get_keep_row_flag_python(self, synapses, merge_data_type):
+
+        """
+        Reference implementation of get_keep_row_flag, walks through the synapses pair by pair in Python.
+        Slow, kept to verify the compiled version.
+
+        Args:
+            synapses: subset of synapse matrix, all synapses onto a neuron must be included
+            merge_data_type : "synapses" or "gapJunctions"
+
+        Returns:
+            keep_row_flag: Boolean array, True for synapses kept after pruning
+        """
+
         keep_row_flag = np.zeros((synapses.shape[0],), dtype=bool)
 
         next_read_pos = 0
@@ -2116,24 +2325,277 @@ class SnuddaPrune(object):
 
             next_read_pos = read_end_idx
 
-        # Time to write synapses to file
-        n_keep_tot = sum(keep_row_flag)
-        write_start_pos = int(output_file["network/" + h5_syn_n][0])
-        write_end_pos = write_start_pos + n_keep_tot
+        return keep_row_flag
 
-        if n_keep_tot > 0:
-            output_file[h5_syn_mat].resize((write_end_pos, output_file[h5_syn_mat].shape[1]))
-            output_file[h5_syn_mat][write_start_pos:write_end_pos] = \
-                synapses[keep_row_flag, :]
+    ############################################################################
 
-            # Update counters
-            output_file["network/" + h5_syn_n][0] = write_end_pos
+    def get_keep_row_flag(self, synapses, merge_data_type):
+
+        """
+        Decides which synapses (or gap junctions) are kept after pruning. The neuron pairs are found and pruned
+        by compiled kernels, the result is identical to get_keep_row_flag_python.
+
+        The random numbers are drawn from the post synaptic neuron's random generator, in the same order as
+        get_keep_row_flag_python draws them, the distance dependent pruning expressions are evaluated for all
+        synapses of a connection type at once.
+
+        Args:
+            synapses: subset of synapse matrix, all synapses onto a neuron must be included
+            merge_data_type : "synapses" or "gapJunctions"
+
+        Returns:
+            keep_row_flag: Boolean array, True for synapses kept after pruning
+        """
+
+        gap_junction_flag = merge_data_type == "gapJunctions"
+
+        keep_row_flag = np.zeros((synapses.shape[0],), dtype=bool)
+        dist_flag = np.ones((synapses.shape[0],), dtype=bool)
+
+        if synapses.shape[0] == 0:
+            return keep_row_flag
+
+        pair_start = self.find_pair_ranges(synapses=synapses, gap_junction_flag=gap_junction_flag,
+                                           share_parameter_id=self.all_neuron_pair_synapses_share_parameter_id)
+        pair_size = np.diff(pair_start)
+
+        # Pruning parameters for each pair, -1 means pair is removed
+        src_id = synapses[pair_start[:-1], 0]
+        dest_id = synapses[pair_start[:-1], 1]
 
+        if gap_junction_flag:
+            synapse_type = np.full(src_id.shape, 3)
         else:
-            self.write_log("No synapses kept, resizing")
-            output_file[h5_syn_mat].resize((write_end_pos, output_file[h5_syn_mat].shape[1]))
+            synapse_type = synapses[pair_start[:-1], 6]
 
-        return n_keep_tot
+        type_id = np.array(self.type_id_list)
+        between_units = (self.population_unit_id[src_id] != self.population_unit_id[dest_id]).astype(int)
+        known_type = synapse_type < self.pruning_parameter_lookup.shape[2]
+
+        pair_parameter = np.full(src_id.shape, -1, dtype=np.int32)
+        pair_parameter[known_type] = self.pruning_parameter_lookup[type_id[src_id[known_type]],
+                                                                   type_id[dest_id[known_type]],
+                                                                   synapse_type[known_type],
+                                                                   between_units[known_type]]
+
+        # Each pruned pair uses n_pair_synapses*3 + 2 random numbers, from the post synaptic neuron's generator,
+        # the generator is reseeded every time the post synaptic neuron changes
+        num_random = np.where(pair_parameter >= 0, 3 * pair_size + 2, 0)
+        random_start = np.concatenate([[0], np.cumsum(num_random)])
+        random_pool = np.zeros((random_start[-1],))
+
+        neuron_seeds = self.get_neuron_random_seeds()
+        new_dest = np.flatnonzero(np.concatenate([[True], dest_id[1:] != dest_id[:-1], [True]]))
+
+        for seg_start, seg_end in zip(new_dest[:-1], new_dest[1:]):
+            if random_start[seg_end] > random_start[seg_start]:
+                post_rng = np.random.default_rng(neuron_seeds[dest_id[seg_start]])
+                random_pool[random_start[seg_start]:random_start[seg_end]] = \
+                    post_rng.random(random_start[seg_end] - random_start[seg_start])
+
+        # Distance dependent pruning probability, evaluated once per expression for all rows using it
+        row_parameter = np.repeat(pair_parameter, pair_size)
+        dist_p = np.ones((synapses.shape[0],))
+
+        for dist_expr in set([x for x in self.pruning_dist_expr if x is not None]):
+            parameter_idx = [idx for idx, x in enumerate(self.pruning_dist_expr) if x == dist_expr]
+            row_mask = np.isin(row_parameter, parameter_idx)
+
+            if row_mask.any():
+                assert not gap_junction_flag, \
+                    "Distance dependent pruning currently only supported for synapses, not gap junctions"
+
+                dist_p[row_mask] = numexpr.evaluate(dist_expr, local_dict={"d": synapses[row_mask, 8] * 1e-6})
+
+        has_dist = np.array([x is not None for x in self.pruning_dist_expr], dtype=bool)
+
+        # softMax and mu2 probabilities, as a function of the number of kept synapses
+        n_keep = np.arange(0, np.max(pair_size) + 1)
+        soft_max_p_keep = np.zeros((len(self.pruning_parameters), len(n_keep)))
+        mu2_p = np.zeros((len(self.pruning_parameters), len(n_keep)))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for idx, (f1, soft_max, mu2, a3) in enumerate(self.pruning_parameters):
+                if not np.isnan(soft_max):
+                    soft_max_p_keep[idx, :] = np.divide(2 * soft_max, (1 + np.exp(-(n_keep - soft_max) / 5)) * n_keep)
+                if not np.isnan(mu2):
+                    # Markram et al, Cell 2015
+                    mu2_p[idx, :] = 1.0 / (1.0 + np.exp(-8.0 / mu2 * (n_keep - mu2)))
+
+        cluster_pairs = self.prune_pairs(pair_start=pair_start, pair_parameter=pair_parameter,
+                                         random_pool=random_pool, random_start=random_start,
+                                         dist_p=dist_p, has_dist=has_dist,
+                                         pruning_parameters=self.pruning_parameters,
+                                         cluster_flag=self.pruning_cluster,
+                                         soft_max_p_keep=soft_max_p_keep, mu2_p=mu2_p,
+                                         keep_row_flag=keep_row_flag, dist_flag=dist_flag)
+
+        # Synapses in a cluster are more likely to be kept, remap which synapses are kept
+        for pair_idx, n_keep in cluster_pairs:
+            row_start, row_end = pair_start[pair_idx], pair_start[pair_idx + 1]
+
+            # The rows that passed distance dependent pruning are: dist_flag
+            synapse_coords = synapses[row_start:row_end, 2:5]
+
+            if has_dist[pair_parameter[pair_idx]]:
+                pair_dist_flag = dist_flag[row_start:row_end]
+                synapse_coords = synapse_coords[pair_dist_flag, :]
+                lookup_idx = np.where(pair_dist_flag)[0]
+            else:
+                lookup_idx = None
+
+            # Smallest total distance to the other synapses are kept
+            synapse_dist = scipy.spatial.distance.cdist(synapse_coords, synapse_coords)
+            synapse_tot_dist = np.sum(synapse_dist, axis=0)
+            synapse_priority = np.argsort(synapse_tot_dist)
+
+            keep_idx = synapse_priority[:n_keep]
+            if lookup_idx is not None:
+                keep_idx = lookup_idx[keep_idx]
+
+            keep_row_flag[row_start:row_end] = 0
+            keep_row_flag[row_start + keep_idx] = 1
+
+        return keep_row_flag
+
+    ############################################################################
+
+    @staticmethod
+    @jit(nopython=True, cache=True)
+    def find_pair_ranges(synapses, gap_junction_flag, share_parameter_id):
+
+        """
+        Finds the ranges of rows with synapses between the same neuron pair (and of the same synapse type).
+
+        Args:
+            synapses: synapse matrix, sorted
+            gap_junction_flag (bool): Gap junction matrix (synapse type not checked)
+            share_parameter_id (bool): Set parameter ID (column 12) to the one of the pair's first synapse
+
+        Returns:
+            pair_start: Start row of each pair, last element is the number of rows
+        """
+
+        num_rows = synapses.shape[0]
+        pair_start = np.zeros((num_rows + 1,), dtype=np.int64)
+        num_pairs = 0
+        row_idx = 0
+
+        while row_idx < num_rows:
+            pair_start[num_pairs] = row_idx
+            num_pairs += 1
+
+            end_idx = row_idx + 1
+
+            while (end_idx < num_rows
+                   and synapses[end_idx, 0] == synapses[row_idx, 0]
+                   and synapses[end_idx, 1] == synapses[row_idx, 1]
+                   and (gap_junction_flag or synapses[end_idx, 6] == synapses[row_idx, 6])):
+                end_idx += 1
+
+            if share_parameter_id and not gap_junction_flag:
+                # Make all synapses between a particular pair of neurons have the same parameter ID
+                for idx in range(row_idx + 1, end_idx):
+                    synapses[idx, 12] = synapses[row_idx, 12]
+
+            row_idx = end_idx
+
+        pair_start[num_pairs] = num_rows
+
+        return pair_start[:num_pairs + 1]
+
+    ############################################################################
+
+    @staticmethod
+    @jit(nopython=True, cache=True)
+    def prune_pairs(pair_start, pair_parameter, random_pool, random_start, dist_p, has_dist,
+                    pruning_parameters, cluster_flag, soft_max_p_keep, mu2_p, keep_row_flag, dist_flag):
+
+        """
+        Pruning kernel, applies f1, distance dependent pruning, softMax, mu2 and a3 to each neuron pair.
+
+        Args:
+            pair_start: Start row of each pair (see find_pair_ranges)
+            pair_parameter: Index of pruning parameters for each pair, -1 if pair is removed
+            random_pool: Random numbers, n_pair_synapses*3 + 2 for each pruned pair
+            random_start: Start of each pair's random numbers in random_pool
+            dist_p: Distance dependent keep probability of each row
+            has_dist: Distance dependent pruning used for pruning parameter
+            pruning_parameters: f1, softMax, mu2, a3 for each pruning parameter index (NaN if not used)
+            cluster_flag: Cluster pruning used for pruning parameter
+            soft_max_p_keep: softMax keep probability, as function of number of synapses kept
+            mu2_p: mu2 keep probability, as function of number of synapses kept
+            keep_row_flag: (output) True for rows kept
+            dist_flag: (output) True for rows that passed distance dependent pruning
+
+        Returns:
+            cluster_pairs: (pair index, synapses kept) for pairs that need cluster pruning
+        """
+
+        num_pairs = len(pair_start) - 1
+        cluster_pairs = np.zeros((num_pairs, 2), dtype=np.int64)
+        num_cluster_pairs = 0
+
+        for pair_idx in range(num_pairs):
+
+            param_idx = pair_parameter[pair_idx]
+
+            if param_idx < 0:
+                # Not listed in connectivityDistribution, skip neuron pair
+                continue
+
+            row_start = pair_start[pair_idx]
+            n_pair_synapses = pair_start[pair_idx + 1] - row_start
+
+            # f1: 0:n, p: n:2n, soft_max: 2n:3n, p_mu: -2, a3: -1
+            rnd = random_pool[random_start[pair_idx]:random_start[pair_idx + 1]]
+
+            f1 = pruning_parameters[param_idx, 0]
+            soft_max = pruning_parameters[param_idx, 1]
+            mu2 = pruning_parameters[param_idx, 2]
+            a3 = pruning_parameters[param_idx, 3]
+
+            # 3. This is the last step of pruning, but no point doing the other steps if the pair is removed
+            if not np.isnan(a3) and rnd[-1] > a3:
+                continue
+
+            n_keep = 0
+
+            for idx in range(n_pair_synapses):
+                keep = rnd[idx] < f1
+
+                if has_dist[param_idx]:
+                    dist_flag[row_start + idx] = rnd[n_pair_synapses + idx] < dist_p[row_start + idx]
+                    keep = keep and dist_flag[row_start + idx]
+
+                keep_row_flag[row_start + idx] = keep
+                if keep:
+                    n_keep += 1
+
+            # Check if too many synapses, trim it down a bit
+            if not np.isnan(soft_max) and n_keep > soft_max:
+                p_keep = soft_max_p_keep[param_idx, n_keep]
+                n_keep = 0
+
+                for idx in range(n_pair_synapses):
+                    keep = p_keep > rnd[2 * n_pair_synapses + idx] and keep_row_flag[row_start + idx]
+                    keep_row_flag[row_start + idx] = keep
+                    if keep:
+                        n_keep += 1
+
+            # If too few synapses, remove all synapses
+            if not np.isnan(mu2) and mu2_p[param_idx, n_keep] < rnd[-2]:
+                for idx in range(n_pair_synapses):
+                    keep_row_flag[row_start + idx] = False
+
+                continue
+
+            if cluster_flag[param_idx] and n_keep > 0:
+                cluster_pairs[num_cluster_pairs, 0] = pair_idx
+                cluster_pairs[num_cluster_pairs, 1] = n_keep
+                num_cluster_pairs += 1
+
+        return cluster_pairs[:num_cluster_pairs, :]
 
     ############################################################################
 
@@ -0,0 +1,169 @@
+import numpy as np
+
+
+class SparseVoxelSpace(object):
+
+    """
+    Append-only (COO style) voxel occupancy store, used by SnuddaDetect when voxel_storage="sparse".
+
+    Each entry is a (voxel index, neuron ID) pair, plus optional extra columns (e.g. section ID, section X,
+    soma distance). Memory scales with the number of occupied voxels, and unlike the dense
+    num_bins^3 x max_axon / max_dend matrices there is no limit on how many neurons a voxel can hold.
+
+    Entries are appended neuron by neuron. When all neurons are added, finalise() sorts the entries by voxel
+    index (stable sort, so the neuron order within a voxel is preserved) and builds a CSR-style lookup.
+    """
+
+    def __init__(self, num_bins, columns=None, initial_size=100000):
+
+        """
+        Constructor.
+
+        Args:
+            num_bins (int, int, int): Number of voxels in each dimension of the hyper voxel
+            columns (dict, optional): Extra columns to store, name as key and numpy dtype as value
+            initial_size (int, optional): Number of entries to preallocate, the buffers grow as needed
+        """
+
+        self.num_bins = np.array(num_bins, dtype=int)
+
+        if columns is None:
+            columns = dict()
+
+        self.dtypes = dict([("voxel_idx", np.int64), ("neuron_id", np.int32)])
+        self.dtypes.update(columns)
+
+        self.data = dict([(name, np.zeros((initial_size,), dtype=dtype)) for name, dtype in self.dtypes.items()])
+        self.num_entries = 0
+
+        # Set by finalise
+        self.voxel_list = None
+        self.voxel_start = None
+        self.voxel_count = None
+
+    ############################################################################
+
+    def clear(self):
+
+        """ Removes all entries, keeps the allocated buffers. """
+
+        self.num_entries = 0
+        self.voxel_list = None
+        self.voxel_start = None
+        self.voxel_count = None
+
+    ############################################################################
+
+    def resize(self, new_size):
+
+        """ Grows the buffers to hold new_size entries. """
+
+        for name in self.data:
+            old = self.data[name]
+            self.data[name] = np.zeros((new_size,), dtype=old.dtype)
+            self.data[name][:self.num_entries] = old[:self.num_entries]
+
+    ############################################################################
+
+    def append(self, voxel_idx, neuron_id, **columns):
+
+        """
+        Appends entries to the store.
+
+        Args:
+            voxel_idx (np.array): Flat voxel index (see voxel_index) of each entry
+            neuron_id (int): Neuron ID of all the entries
+            columns: Values for the extra columns, one array (or scalar) per column name
+        """
+
+        num_new = len(voxel_idx)
+
+        if num_new == 0:
+            return
+
+        assert self.voxel_list is None, "append: SparseVoxelSpace already finalised, call clear first"
+
+        if self.num_entries + num_new > len(self.data["voxel_idx"]):
+            self.resize(max(2 * len(self.data["voxel_idx"]), self.num_entries + num_new))
+
+        idx = slice(self.num_entries, self.num_entries + num_new)
+        self.data["voxel_idx"][idx] = voxel_idx
+        self.data["neuron_id"][idx] = neuron_id
+
+        for name, value in columns.items():
+            self.data[name][idx] = value
+
+        self.num_entries += num_new
+
+    ############################################################################
+
+    def finalise(self):
+
+        """ Sorts the entries by voxel index and creates the CSR-style lookup (voxel_list, voxel_start, voxel_count). """
+
+        sort_idx = np.argsort(self.data["voxel_idx"][:self.num_entries], kind="stable")
+
+        for name in self.data:
+            self.data[name][:self.num_entries] = self.data[name][sort_idx]
+
+        self.voxel_list, self.voxel_start, self.voxel_count = \
+            np.unique(self.data["voxel_idx"][:self.num_entries], return_index=True, return_counts=True)
+
+    ############################################################################
+
+    def get(self, name):
+
+        """ Returns the used part of column name. """
+
+        return self.data[name][:self.num_entries]
+
+    ############################################################################
+
+    def lookup(self, voxel_idx):
+
+        """
+        Returns start index and number of entries for each voxel in voxel_idx (count 0 if voxel is empty).
+        Requires finalise to have been called.
+        """
+
+        if len(self.voxel_list) == 0:
+            return np.zeros(len(voxel_idx), dtype=int), np.zeros(len(voxel_idx), dtype=int)
+
+        pos = np.minimum(np.searchsorted(self.voxel_list, voxel_idx), len(self.voxel_list) - 1)
+        found = self.voxel_list[pos] == voxel_idx
+
+        start = np.where(found, self.voxel_start[pos], 0)
+        count = np.where(found, self.voxel_count[pos], 0)
+
+        return start, count
+
+    ############################################################################
+
+    def voxel_index(self, x, y, z):
+
+        """ Flat voxel index, ascending order is the same as the order np.where returns for a dense matrix. """
+
+        return (np.asarray(x, dtype=np.int64) * self.num_bins[1] + y) * self.num_bins[2] + z
+
+    def voxel_coords(self, voxel_idx):
+
+        """ Returns x, y, z voxel coordinates for flat voxel index. """
+
+        return np.unravel_index(voxel_idx, tuple(self.num_bins))
+
+    ############################################################################
+
+    def max_count(self):
+
+        """ Maximal number of entries in any voxel. """
+
+        if self.voxel_count is None or len(self.voxel_count) == 0:
+            return 0
+
+        return np.max(self.voxel_count)
+
+    def nbytes(self):
+
+        """ Memory used by the buffers (in bytes). """
+
+        return sum([d.nbytes for d in self.data.values()])
@@ -24,6 +24,7 @@ import h5py
 
 from snudda.neurons.neuron_prototype import NeuronPrototype
 from snudda.utils.snudda_path import snudda_parse_path
+from snudda.utils.numpy_encoder import NumpyEncoder
 from snudda.neurons.neuron_morphology import NeuronMorphology
 from snudda.utils.load import SnuddaLoad
 
@@ -208,20 +209,41 @@ class SnuddaInput(object):
 
     def write_hdf5(self):
 
-        """ Writes input spikes to HDF5 file. """
+        """
+        Writes input spikes to HDF5 file. The spike trains of each input type are concatenated (float32) with
+        an offset array, and the synapse meta data is stored in one table for the whole network.
+        See SnuddaLoadInput for a description of the layout, and for reading the file.
+        """
 
         self.write_log(f"Writing spikes to {self.spike_data_filename}", force_print=True)
 
-        out_file = h5py.File(self.spike_data_filename, 'w', libver=self.h5libver)
-        config_data = out_file.create_dataset("config", data=json.dumps(self.input_info, indent=4))
-        input_group = out_file.create_group("input")
+        input_types = []
 
-        for neuron_id in self.neuron_input:
+        # One block per (neuron, input type)
+        block_neuron_id = []
+        block_input_type = []
+        block_num_synapses = []
+        block_spike_row = []
+        block_num_spike_trains = []
+        block_conductance = []
+        block_population_unit_id = []
+        block_info_id = []
+
+        # Blocks of the same neuron type and input type usually share parameters, only store unique info once
+        info_list = []
+        info_lookup = dict()
 
-            nid_group = input_group.create_group(str(neuron_id))
+        section_id = []
+        section_x = []
+        distance_to_soma = []
+        parameter_id = []
+
+        spike_trains = dict()
+        population_unit_spikes = dict()
+
+        for neuron_id in sorted(self.neuron_input.keys()):
 
             neuron_type = self.neuron_type[neuron_id]
-            # nName = self.neuronName[neuronID]
 
             for input_type in self.neuron_input[neuron_id]:
 
@@ -230,68 +252,120 @@ class SnuddaInput(object):
                                    f" (input_type was commented with ! before name)")
                     continue
 
-                if input_type.lower() != "VirtualNeuron".lower():
-                    it_group = nid_group.create_group(input_type)
-
-                    neuron_in = self.neuron_input[neuron_id][input_type]
-                    spike_mat, num_spikes = self.create_spike_matrix(neuron_in["spikes"])
-
-                    it_group.create_dataset("spikes", data=spike_mat, compression="gzip", dtype=np.float32)
-                    it_group.create_dataset("nSpikes", data=num_spikes, dtype=np.int32)
-
-                    it_group.create_dataset("sectionID", data=neuron_in["location"][1].astype(int),
-                                            compression="gzip", dtype=np.int16)
-                    it_group.create_dataset("sectionX", data=neuron_in["location"][2],
-                                            compression="gzip", dtype=np.float16)
-                    it_group.create_dataset("distanceToSoma", data=neuron_in["location"][3],
-                                            compression="gzip", dtype=np.float16)
+                neuron_in = self.neuron_input[neuron_id][input_type]
 
-                    it_group.create_dataset("freq", data=neuron_in["freq"])
-                    it_group.create_dataset("correlation", data=neuron_in["correlation"])
-
-                    if "jitter" in neuron_in and neuron_in["jitter"]:
-                        it_group.create_dataset("jitter", data=neuron_in["jitter"])
-
-                    if "synapseDensity" in neuron_in and neuron_in["synapseDensity"]:
-                        it_group.create_dataset("synapseDensity", data=neuron_in["synapseDensity"])
-
-                    it_group.create_dataset("start", data=neuron_in["start"])
-                    it_group.create_dataset("end", data=neuron_in["end"])
-                    it_group.create_dataset("conductance", data=neuron_in["conductance"])
+                if input_type.lower() == "VirtualNeuron".lower():
+                    # Input is activity of a virtual neuron, it has no synapses
+                    input_type_name = "activity"
+                    spikes = [np.concatenate([np.ravel(x) for x in neuron_in["spikes"]] + [[]])]
+                    num_synapses = 0
+                    conductance = np.nan
+                    population_unit_id = -1
+                    info = {"generator": neuron_in["generator"]}
 
+                else:
+                    input_type_name = input_type
+                    spikes = neuron_in["spikes"]
+                    num_synapses = len(spikes)
+                    conductance = neuron_in["conductance"]
                     population_unit_id = int(neuron_in["populationUnitID"])
-                    it_group.create_dataset("populationUnitID", data=population_unit_id)
 
-                    # TODO: What to do with population_unit_spikes, should we have mandatory jittering for them?
+                    section_id.append(neuron_in["location"][1].astype(int))
+                    section_x.append(neuron_in["location"][2])
+                    distance_to_soma.append(neuron_in["location"][3])
+                    parameter_id.append(neuron_in["parameterID"])
 
-                    # population_unit_id = 0 means not population unit membership, so no population spikes available
+                    # population_unit_id = 0 means not population unit membership, so no population spikes
                     if neuron_type in self.population_unit_spikes and population_unit_id > 0 \
                             and input_type in self.population_unit_spikes[neuron_type]:
-                        chan_spikes = self.population_unit_spikes[neuron_type][input_type][population_unit_id]
+                        pop_spikes_name = f"populationUnitSpikes/{neuron_type}/{input_type}/{population_unit_id}"
+                        population_unit_spikes[pop_spikes_name] = \
+                            self.population_unit_spikes[neuron_type][input_type][population_unit_id]
                     else:
-                        chan_spikes = np.array([])
-
-                    it_group.create_dataset("populationUnitSpikes", data=chan_spikes, compression="gzip",
-                                            dtype=np.float32)
-
-                    it_group.create_dataset("generator", data=neuron_in["generator"])
-
-                    it_group.create_dataset("modFile", data=neuron_in["modFile"])
-                    if neuron_in["parameterFile"]:
-                        it_group.create_dataset("parameterFile", data=neuron_in["parameterFile"])
-                    # We need to convert this to string to be able to save it
-                    it_group.create_dataset("parameterList", data=json.dumps(neuron_in["parameterList"]))
-                    it_group.create_dataset("parameterID", data=neuron_in["parameterID"], dtype=np.int32)
-
-                else:
+                        pop_spikes_name = None
+
+                    info = {"freq": neuron_in["freq"],
+                            "correlation": neuron_in["correlation"],
+                            "jitter": neuron_in.get("jitter", None),
+                            "synapseDensity": neuron_in.get("synapseDensity", None),
+                            "start": neuron_in["start"],
+                            "end": neuron_in["end"],
+                            "generator": neuron_in["generator"],
+                            "modFile": neuron_in["modFile"],
+                            "parameterFile": neuron_in["parameterFile"],
+                            "parameterList": neuron_in["parameterList"],
+                            "populationUnitSpikes": pop_spikes_name}
+
+                if input_type_name not in input_types:
+                    input_types.append(input_type_name)
+                    spike_trains[input_type_name] = []
+
+                block_neuron_id.append(neuron_id)
+                block_input_type.append(input_types.index(input_type_name))
+                block_num_synapses.append(num_synapses)
+                block_spike_row.append(len(spike_trains[input_type_name]))
+                block_num_spike_trains.append(len(spikes))
+                block_conductance.append(conductance)
+                block_population_unit_id.append(population_unit_id)
+                info_str = json.dumps(info, cls=NumpyEncoder)
+                if info_str not in info_lookup:
+                    info_lookup[info_str] = len(info_list)
+                    info_list.append(info_str)
+
+                block_info_id.append(info_lookup[info_str])
+
+                spike_trains[input_type_name].extend(spikes)
+
+        num_neurons = len(self.neuron_id)
+        block_neuron_id = np.array(block_neuron_id, dtype=np.int32)
 
-                    # Input is activity of a virtual neuron
-                    a_group = nid_group.create_group("activity")
-                    spikes = self.neuron_input[neuron_id][input_type]["spikes"]
-
-                    a_group.create_dataset("spikes", data=spikes, compression="gzip")
-                    generator = self.neuron_input[neuron_id][input_type]["generator"]
-                    a_group.create_dataset("generator", data=generator)
+        out_file = h5py.File(self.spike_data_filename, 'w', libver=self.h5libver)
+        out_file.create_dataset("config", data=json.dumps(self.input_info, indent=4))
+        out_file.create_dataset("inputFormat", data="csr")
+
+        str_type = 'S' + str(max(1, max([len(x) for x in input_types], default=1)))
+        out_file.create_dataset("inputTypes", (len(input_types),), str_type, input_types)
+
+        block_group = out_file.create_group("neuronInput")
+        neuron_ptr = np.zeros((num_neurons + 1,), dtype=np.int64)
+        neuron_ptr[1:] = np.cumsum(np.bincount(block_neuron_id, minlength=num_neurons))
+        synapse_ptr = np.zeros((len(block_neuron_id) + 1,), dtype=np.int64)
+        synapse_ptr[1:] = np.cumsum(block_num_synapses)
+
+        block_group.create_dataset("neuronPtr", data=neuron_ptr)
+        block_group.create_dataset("neuronID", data=block_neuron_id)
+        block_group.create_dataset("inputType", data=np.array(block_input_type, dtype=np.int16))
+        block_group.create_dataset("synapsePtr", data=synapse_ptr)
+        block_group.create_dataset("spikeRow", data=np.array(block_spike_row, dtype=np.int64))
+        block_group.create_dataset("numSpikeTrains", data=np.array(block_num_spike_trains, dtype=np.int64))
+        block_group.create_dataset("conductance", data=np.array(block_conductance, dtype=float))
+        block_group.create_dataset("populationUnitID", data=np.array(block_population_unit_id, dtype=np.int32))
+        block_group.create_dataset("infoID", data=np.array(block_info_id, dtype=np.int32))
+        block_group.create_dataset("info", data=info_list, dtype=h5py.string_dtype(), compression="gzip")
+
+        synapse_group = out_file.create_group("synapses")
+        synapse_group.create_dataset("sectionID", data=np.concatenate(section_id + [[]]).astype(np.int16),
+                                     compression="gzip")
+        synapse_group.create_dataset("sectionX", data=np.concatenate(section_x + [[]]).astype(np.float16),
+                                     compression="gzip")
+        synapse_group.create_dataset("distanceToSoma", data=np.concatenate(distance_to_soma + [[]]).astype(np.float16),
+                                     compression="gzip")
+        synapse_group.create_dataset("parameterID", data=np.concatenate(parameter_id + [[]]).astype(np.int32),
+                                     compression="gzip")
+
+        spike_group = out_file.create_group("spikes")
+
+        for input_type_name, spikes in spike_trains.items():
+            spike_ptr = np.zeros((len(spikes) + 1,), dtype=np.int64)
+            spike_ptr[1:] = np.cumsum([len(x) for x in spikes])
+
+            it_group = spike_group.create_group(input_type_name)
+            it_group.create_dataset("spikeTimes", data=np.concatenate(spikes + [[]]).astype(np.float32),
+                                    compression="gzip")
+            it_group.create_dataset("spikePtr", data=spike_ptr, compression="gzip")
+
+        for pop_spikes_name, pop_spikes in population_unit_spikes.items():
+            out_file.create_dataset(pop_spikes_name, data=pop_spikes, compression="gzip", dtype=np.float32)
 
         out_file.close()
 
@@ -309,10 +383,12 @@ class SnuddaInput(object):
         num_spikes = np.array([len(x) for x in spikes])
         max_len = max(num_spikes)
 
+        # Row and column of each spike in the spike matrix
+        row_idx = np.repeat(np.arange(num_input_trains), num_spikes)
+        col_idx = np.arange(np.sum(num_spikes)) - np.repeat(np.cumsum(num_spikes) - num_spikes, num_spikes)
+
         spike_mat = -1 * np.ones((num_input_trains, max_len))
-        for idx, st in enumerate(spikes):
-            n = st.shape[0]
-            spike_mat[idx, :n] = st
+        spike_mat[row_idx, col_idx] = np.concatenate(spikes)
 
         return spike_mat, num_spikes
 
@@ -817,6 +893,105 @@ class SnuddaInput(object):
 
     ############################################################################
 
+    def get_time_segments(self, freq, time_range):
+
+        """
+        Returns arrays with start time, end time and frequency of each time segment. The time_range is either
+        a tuple (start, end) or a tuple of lists ([start0, start1, ...], [end0, end1, ...]).
+
+        Args:
+            freq: frequency, or list of frequencies (one per time segment)
+            time_range (tuple): start time, end time of spike train
+        """
+
+        if type(time_range[0]) == list:
+
+            if type(freq) != list:
+                freq = [freq for t in time_range[0]]
+
+            assert len(time_range[0]) == len(time_range[1]) == len(freq), \
+                (f"Frequency, start and end time vectors need to be of same length."
+                    f"\nfreq: {freq}\nstart: {time_range[0]}\nend:{time_range[1]}")
+
+            if self.time_interval_overlap_warning:
+                assert (np.array(time_range[0][1:]) - np.array(time_range[1][0:-1]) >= 0).all(), \
+                    f"Time range should not overlap: start: {time_range[0]}, end: {time_range[1]}"
+
+            return np.array(time_range[0], dtype=float), np.array(time_range[1], dtype=float), \
+                np.array(freq, dtype=float)
+
+        return np.array([time_range[0]], dtype=float), np.array([time_range[1]], dtype=float), \
+            np.array([freq], dtype=float)
+
+    ############################################################################
+
+    def generate_spikes_batch(self, freq, time_range, num_spike_trains, rng):
+
+        """
+        Generates num_spike_trains independent Poisson spike trains with one set of array operations.
+        The number of spikes in each train is drawn from a Poisson distribution, and the spikes are then
+        placed uniformly within the time range, which gives a Poisson process.
+
+        Args:
+            freq: frequency, or list of frequencies (one per time segment)
+            time_range (tuple): start time, end time of spike train (see get_time_segments)
+            num_spike_trains (int): number of spike trains to generate
+            rng: Numpy random number stream
+
+        Returns:
+            spike_times: sorted spike times of all trains, concatenated
+            train_ptr: spike times of train i are spike_times[train_ptr[i]:train_ptr[i+1]]
+        """
+
+        start_time, end_time, freq = self.get_time_segments(freq=freq, time_range=time_range)
+
+        spike_times = []
+        train_idx = []
+
+        for f, t_start, t_end in zip(freq, start_time, end_time):
+            duration = t_end - t_start
+
+            assert duration > 0, f"Start time = {t_start} and end time = {t_end} incorrect (duration > 0 required)"
+            assert not f < 0, "Negative frequency specified."
+
+            num_spikes = rng.poisson(f * duration, size=num_spike_trains)
+            train_idx.append(np.repeat(np.arange(num_spike_trains), num_spikes))
+            spike_times.append(t_start + duration * rng.random(np.sum(num_spikes)))
+
+        return self.sort_spike_trains(spike_times=np.concatenate(spike_times),
+                                      train_idx=np.concatenate(train_idx),
+                                      num_spike_trains=num_spike_trains)
+
+    ############################################################################
+
+    @staticmethod
+    def sort_spike_trains(spike_times, train_idx, num_spike_trains):
+
+        """
+        Sorts spikes by spike train, and by time within each spike train.
+
+        Args:
+            spike_times: spike times
+            train_idx: spike train of each spike
+            num_spike_trains: number of spike trains
+
+        Returns:
+            spike_times: sorted spike times of all trains, concatenated
+            train_ptr: spike times of train i are spike_times[train_ptr[i]:train_ptr[i+1]]
+        """
+
+        # Sort by time, then stable sort by spike train (radix sort for small integer types)
+        train_dtype = np.int16 if num_spike_trains < np.iinfo(np.int16).max else np.int64
+        sort_idx = np.argsort(spike_times)
+        sort_idx = sort_idx[np.argsort(train_idx[sort_idx].astype(train_dtype), kind="stable")]
+
+        train_ptr = np.zeros((num_spike_trains + 1,), dtype=int)
+        train_ptr[1:] = np.cumsum(np.bincount(train_idx.astype(int), minlength=num_spike_trains))
+
+        return spike_times[sort_idx], train_ptr
+
+    ############################################################################
+
     # This takes a list of spike trains and returns a single spike train
     # including all spikes
 
@@ -874,6 +1049,114 @@ class SnuddaInput(object):
 
         """
 
+        spike_times, train_ptr, population_unit_spikes = \
+            self.make_correlated_spikes_batch(freq=freq, time_range=time_range, num_spike_trains=num_spike_trains,
+                                              p_keep=p_keep, rng=rng, population_unit_spikes=population_unit_spikes,
+                                              jitter_dt=jitter_dt)
+
+        spike_trains = self.split_spike_trains(spike_times=spike_times, train_ptr=train_ptr)
+
+        if ret_pop_unit_spikes:
+            return spike_trains, population_unit_spikes
+        else:
+            return spike_trains
+
+    ############################################################################
+
+    @staticmethod
+    def split_spike_trains(spike_times, train_ptr):
+
+        """ Returns list of spike trains, spike_times[train_ptr[i]:train_ptr[i+1]] is spike train i. """
+
+        return [spike_times[start:end] for start, end in zip(train_ptr[:-1], train_ptr[1:])]
+
+    ############################################################################
+
+    def make_correlated_spikes_batch(self, freq, time_range, num_spike_trains, p_keep, rng,
+                                     population_unit_spikes=None, jitter_dt=None):
+
+        """
+        Make correlated spikes, all spike trains are generated together using array operations.
+
+        Args:
+            freq (float): frequency of spike train
+            time_range (tuple): start time, end time of spike train
+            num_spike_trains (int): number of spike trains to generate
+            p_keep (float): fraction of shared channel spikes to include in spike train, p_keep=1 (100% correlated)
+            rng: Numpy random number stream
+            population_unit_spikes: shared spikes, if None new population unit spikes are generated
+            jitter_dt (float): amount to jitter all spikes
+
+        Returns:
+            spike_times: sorted spike times of all trains, concatenated
+            train_ptr: spike times of train i are spike_times[train_ptr[i]:train_ptr[i+1]]
+            population_unit_spikes: shared spikes
+        """
+
+        assert (0 <= p_keep <= 1)
+
+        if population_unit_spikes is None:
+            population_unit_spikes = self.generate_spikes(freq, time_range, rng=rng)
+
+        population_unit_spikes = np.asarray(population_unit_spikes, dtype=float)
+
+        if type(freq) == list:
+            unique_freq = [f * (1 - p_keep) for f in freq]
+        else:
+            unique_freq = freq * (1 - p_keep)
+
+        unique_times, unique_ptr = self.generate_spikes_batch(freq=unique_freq, time_range=time_range,
+                                                              num_spike_trains=num_spike_trains, rng=rng)
+        unique_idx = np.repeat(np.arange(num_spike_trains), np.diff(unique_ptr))
+
+        # Each spike train keeps each of the population unit spikes with probability p_keep
+        keep_train_idx, keep_spike_idx = \
+            np.nonzero(rng.random((num_spike_trains, len(population_unit_spikes))) < p_keep)
+
+        spike_times = np.concatenate([unique_times, population_unit_spikes[keep_spike_idx]])
+        train_idx = np.concatenate([unique_idx, keep_train_idx])
+
+        if jitter_dt is not None:
+            spike_times = spike_times + rng.normal(0, jitter_dt, spike_times.shape)
+
+            # No modulo time jittering if list of times specified
+            if type(time_range[0]) != list:
+                start = time_range[0]
+                end = time_range[1]
+                spike_times = np.mod(spike_times - start, end - start) + start
+
+            # Remove any spikes that happened to go negative
+            keep_idx = np.where(spike_times >= 0)[0]
+            spike_times = spike_times[keep_idx]
+            train_idx = train_idx[keep_idx]
+
+        spike_times, train_ptr = self.sort_spike_trains(spike_times=spike_times, train_idx=train_idx,
+                                                        num_spike_trains=num_spike_trains)
+
+        return spike_times, train_ptr, population_unit_spikes
+
+    ############################################################################
+
+    def make_correlated_spikes_python(self, freq, time_range, num_spike_trains, p_keep, rng,
+                                      population_unit_spikes=None,
+                                      ret_pop_unit_spikes=False, jitter_dt=None):
+
+        """
+        Reference implementation of make_correlated_spikes, generates one spike train at a time.
+        Slow, kept to compare against the batched version.
+
+        Args:
+            freq (float): frequency of spike train
+            time_range (tuple): start time, end time of spike train
+            num_spike_trains (int): number of spike trains to generate
+            p_keep (float): fraction of shared channel spikes to include in spike train, p_keep=1 (100% correlated)
+            rng: Numpy random number stream
+            ret_pop_unit_spikes (bool): if false, returns only spikes,
+                                        if true returns (spikes, population unit spikes)
+            jitter_dt (float): amount to jitter all spikes
+
+        """
+
         assert (0 <= p_keep <= 1)
 
         if population_unit_spikes is None:
@@ -917,12 +1200,10 @@ class SnuddaInput(object):
             rng: numpy random number stream
         """
 
-        spike_trains = []
-
-        for i in range(0, n_spike_trains):
-            spike_trains.append(self.generate_spikes(freq, (t_start, t_end), rng))
+        spike_times, train_ptr = self.generate_spikes_batch(freq=freq, time_range=(t_start, t_end),
+                                                            num_spike_trains=n_spike_trains, rng=rng)
 
-        return spike_trains
+        return self.split_spike_trains(spike_times=spike_times, train_ptr=train_ptr)
 
     ############################################################################
 
@@ -15,6 +15,7 @@ from snudda.utils.reposition_neurons import RepositionNeurons
 from snudda.init.init import SnuddaInit
 from snudda.input.input import SnuddaInput
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.load_input import SnuddaLoadInput
 from snudda.simulate.simulate import SnuddaSimulate
 from snudda.core import Snudda
 import numpy as np
@@ -191,7 +192,7 @@ class InputTuning(object):
         network_file = os.path.join(self.network_path, "network-synapses.hdf5")
         network_info = SnuddaLoad(network_file)
 
-        input_data = h5py.File(self.input_spikes_file, "r")
+        input_data = SnuddaLoadInput(self.input_spikes_file)
 
         output_data_loader = SnuddaLoadNetworkSimulation(network_path=self.network_path)
         spike_data = output_data_loader.get_spikes()
@@ -219,14 +220,8 @@ class InputTuning(object):
 
         n_inputs_lookup = dict()
 
-        for neuron_label in input_data["input"]:
-            neuron_id = int(neuron_label)
-            n_inputs = 0
-
-            for input_type in input_data["input"][neuron_label]:
-                n_inputs += input_data["input"][neuron_label][input_type]["spikes"].shape[0]
-
-            n_inputs_lookup[neuron_id] = n_inputs
+        for neuron_id in input_data.get_neuron_id():
+            n_inputs_lookup[neuron_id] = input_data.get_num_inputs(neuron_id)
 
         frequency_data = dict()
         voltage_data = dict()
@@ -825,7 +820,7 @@ class InputTuning(object):
     def plot_generated_input(self, num_bins=50):
         # This function just checks that we have reasonable spikes generated
 
-        input_spike_data = h5py.File(self.input_spikes_file, 'r')
+        input_spike_data = SnuddaLoadInput(self.input_spikes_file)
         network_data = h5py.File(self.network_file, 'r')
 
         neuron_type = np.array([x.decode().split("_")[0].lower() for x in network_data["network/neurons/name"]])
@@ -842,15 +837,14 @@ class InputTuning(object):
             fig, ax = plt.subplots()
 
             for nid in neuron_id[neuron_idx]:
-                for input_type in input_spike_data["input"][str(nid)]:
-                    spikes = input_spike_data["input"][str(nid)][input_type]["spikes"][:].ravel()
-                    spikes = spikes[spikes >= 0]  # Negative -1 is filler values, remove them.
+                for input_type, input_info in input_spike_data.get_input(nid).items():
+                    spikes = input_info["spikeTimes"]
                     ax.hist(spikes, num_bins, histtype="step")
 
                     if input_type not in distance_to_soma:
                         distance_to_soma[input_type] = []
 
-                    distance_to_soma[input_type].append(input_spike_data["input"][str(nid)][input_type]["distanceToSoma"][:])
+                    distance_to_soma[input_type].append(input_info["distanceToSoma"])
 
             plt.title(f"Input to {nt}")
             plt.xlabel("Time (s)")
@@ -1,6 +1,6 @@
 import os
-import h5py
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.load_input import SnuddaLoadInput
 
 class InspectInput(object):
 
@@ -12,7 +12,7 @@ class InspectInput(object):
     # We just need this to identify which neuron is which
     self.network = SnuddaLoad(self.networkFile, load_synapses=False)
 
-    self.inputData = h5py.File(inputFile,'r')
+    self.inputData = SnuddaLoadInput(inputFile)
 
 
   def getMorphologies(self):
@@ -23,11 +23,10 @@ class InspectInput(object):
 
   def getInputTypes(self,cellID):
 
-    sCellID = [str(c) for c in cellID]
     inputTypes = set()
     
-    for scID in sCellID:
-      inpT = set([inp for inp in self.inputData["input"][scID]])
+    for cID in cellID:
+      inpT = set(self.inputData.get_input_types(cID))
       inputTypes = inputTypes.union(inpT)
       
     return list(inputTypes)
@@ -61,14 +60,15 @@ class InspectInput(object):
       
     # !!! TODO: We should split this by morphology also...
       
-    for cID in self.inputData['input']:
-      if cID in cellIDstr:
+    for cID in self.inputData.get_neuron_id():
+      if str(cID) in cellIDstr:
         morph = cellMorph[int(cID)]
         morphCounter[morph] += 1
-                          
+
+        cellInput = self.inputData.get_input(cID)
         for inp in inputTypeList:
-          if inp in self.inputData['input'][cID]:
-            nInput = len(self.inputData['input'][cID][inp]['nSpikes'])
+          if inp in cellInput:
+            nInput = len(cellInput[inp]['nSpikes'])
             inputCount[inp][morph] += nInput
 
     for inp in inputTypeList:
@@ -0,0 +1,142 @@
+import os
+import pickle
+
+import numpy as np
+
+from snudda.neurons.neuron_morphology import NeuronMorphology
+
+
+class MorphologyPool(object):
+
+    """
+    Read-only pool of prototype morphologies, shared between the workers.
+
+    The master writes the coordinate and link arrays of all prototype morphologies once to pool_dir (publish),
+    the workers then memory map the files (attach) instead of each loading their own copy. The operating system
+    keeps a single copy of the mapped files in memory per node, which all the workers share.
+
+    The pooled arrays are read-only, clones of the prototypes get their own coordinates (see
+    NeuronMorphology.clone) but share the link and section arrays.
+    """
+
+    array_names = ["soma", "axon", "dend", "axon_links", "dend_links", "dend_sec_id", "dend_sec_x"]
+    attribute_names = ["max_axon_radius", "max_dend_radius", "dend_density", "axon_density"]
+
+    def __init__(self, pool_dir):
+
+        """
+        Constructor.
+
+        Args:
+            pool_dir (str): Directory with the pool files
+        """
+
+        self.pool_dir = pool_dir
+        self.index_file = os.path.join(pool_dir, "morphology-pool-index.pickle")
+        self.index = None
+
+    ############################################################################
+
+    def publish(self, prototype_neurons):
+
+        """
+        Writes all morphologies of the prototype neurons to the pool, overwriting an old pool.
+
+        Args:
+            prototype_neurons (dict): NeuronPrototype objects, neuron name as key
+        """
+
+        os.makedirs(self.pool_dir, exist_ok=True)
+
+        index = dict()
+
+        for name, prototype in prototype_neurons.items():
+
+            prototype.instantiate()
+            index[name] = dict()
+
+            for morph_ctr, (morph_tag, morph) in enumerate(prototype.morphology_cache.items()):
+
+                assert not morph.rotated_flag, f"publish: Prototype {name} ({morph_tag}) should not be rotated"
+
+                file_prefix = f"{name}-{morph_ctr}"
+
+                for array_name in self.array_names:
+                    np.save(os.path.join(self.pool_dir, f"{file_prefix}-{array_name}.npy"),
+                            getattr(morph, array_name))
+
+                index[name][morph_tag] = {"file_prefix": file_prefix,
+                                          "swc_filename": morph.swc_filename,
+                                          "load_morphology": morph.load_morphology,
+                                          "attributes": dict([(x, getattr(morph, x))
+                                                              for x in self.attribute_names])}
+
+        # Write index last, and atomically, so workers never see a partially written pool
+        tmp_file = f"{self.index_file}-tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(index, f)
+
+        os.replace(tmp_file, self.index_file)
+
+        self.index = index
+
+    ############################################################################
+
+    def load_index(self):
+
+        """ Reads the pool index file. """
+
+        with open(self.index_file, "rb") as f:
+            self.index = pickle.load(f)
+
+    ############################################################################
+
+    def load_array(self, file_prefix, array_name):
+
+        """ Memory maps the pooled array (read-only). """
+
+        data = np.load(os.path.join(self.pool_dir, f"{file_prefix}-{array_name}.npy"), mmap_mode="r")
+
+        # Plain ndarray view of the memory map, the numba kernels do not accept np.memmap
+        return np.asarray(data)
+
+    ############################################################################
+
+    def attach(self, name, prototype):
+
+        """
+        Adds the pooled morphologies to the morphology cache of the prototype, so they are not loaded from file.
+
+        Args:
+            name (str): Neuron name, as used when publishing the pool
+            prototype (NeuronPrototype): Prototype to attach the morphologies to
+        """
+
+        if self.index is None:
+            self.load_index()
+
+        if name not in self.index:
+            return
+
+        for morph_tag, info in self.index[name].items():
+
+            morph = NeuronMorphology(swc_filename=info["swc_filename"],
+                                     param_data=prototype.parameter_path,
+                                     mech_filename=prototype.mechanism_path,
+                                     neuron_path=prototype.neuron_path,
+                                     name=prototype.neuron_name,
+                                     hoc=None,
+                                     load_morphology=False,
+                                     virtual_neuron=prototype.virtual_neuron,
+                                     axon_stump_id_flag=prototype.axon_stump_id_flag)
+
+            # Clones copy the morphology only if the parent has load_morphology set
+            morph.load_morphology = info["load_morphology"]
+
+            for array_name in self.array_names:
+                setattr(morph, array_name, self.load_array(info["file_prefix"], array_name))
+
+            for attribute_name, value in info["attributes"].items():
+                setattr(morph, attribute_name, value)
+
+            prototype.morphology_cache[morph_tag] = morph
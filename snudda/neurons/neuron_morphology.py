@@ -177,7 +177,8 @@ class NeuronMorphology(object):
               modulation_id=None,
               parameter_key=None,
               morphology_key=None,
-              modulation_key=None):
+              modulation_key=None,
+              lazy=False):
 
         """
         Creates a clone copy of a neuron.
@@ -195,6 +196,9 @@ class NeuronMorphology(object):
             morphology_key (str): Morphology Key for clone
             modulation_key (str): Modulation Key for clone
 
+            lazy (bool): Only store position and rotation in the clone, soma, axon and dend coordinates
+                         are computed from the parent the first time they are accessed (default False)
+
         """
 
         if load_morphology is None:
@@ -232,15 +236,30 @@ class NeuronMorphology(object):
             # Set the flag
             new_neuron.load_morphology = load_morphology
 
-            # Copy the data
-            new_neuron.axon = np.copy(self.axon)
-            new_neuron.dend = np.copy(self.dend)
-            new_neuron.soma = np.copy(self.soma)
+            if lazy:
+                if self.rotated_flag:
+                    new_neuron.write_log("!!! WARNING, rotating a rotated neuron...")
+
+                # Same check as in place, before the rotation is deferred
+                if new_neuron.rotation is not None:
+                    assert np.abs(np.linalg.det(new_neuron.rotation) - 1) < 1e-6, \
+                        "clone: determinant of rotation matrix should be 1 (did you miss matmul when multiplying?)"
+
+                # Coordinates are placed on first access, see __getattr__
+                del new_neuron.soma, new_neuron.axon, new_neuron.dend
+                new_neuron.lazy_source = self
+                new_neuron.rotated_flag = self.rotated_flag or new_neuron.rotation is not None
 
-            # Warn the user if the neuron is already rotated
-            new_neuron.rotated_flag = self.rotated_flag
+            else:
+                # Copy the data
+                new_neuron.axon = np.copy(self.axon)
+                new_neuron.dend = np.copy(self.dend)
+                new_neuron.soma = np.copy(self.soma)
+
+                # Warn the user if the neuron is already rotated
+                new_neuron.rotated_flag = self.rotated_flag
 
-            new_neuron.place()
+                new_neuron.place()
 
             # These dont change either, so skip np.copy
             new_neuron.axon_links = self.axon_links
@@ -271,6 +290,34 @@ class NeuronMorphology(object):
 
     ############################################################################
 
+    def __getattr__(self, name):
+
+        """ Places soma, axon and dend coordinates of a lazy clone the first time they are accessed. """
+
+        # Only called when normal attribute lookup fails, use __dict__ to avoid recursion
+        lazy_source = self.__dict__.get("lazy_source")
+
+        if lazy_source is None or name not in ["soma", "axon", "dend"]:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        coords = np.array(getattr(lazy_source, name))
+        soma = lazy_source.soma
+
+        # Same operations as in place, so lazy and non-lazy clones have identical coordinates
+        if len(coords) > 0:
+            if self.rotation is not None:
+                coords[:, 0:3] = np.transpose(np.matmul(self.rotation, np.transpose(coords[:, 0:3] - soma[0, 0:3])))
+                rotated_soma = np.transpose(np.matmul(self.rotation, np.transpose(soma[0:1, 0:3] - soma[0, 0:3])))
+                coords[:, 0:3] = coords[:, 0:3] - rotated_soma[0, :] + self.position
+            else:
+                coords[:, 0:3] = coords[:, 0:3] - soma[0, 0:3] + self.position
+
+        setattr(self, name, coords)
+
+        return coords
+
+    ############################################################################
+
     def write_log(self, text, is_error=False):
 
         """ Write text to log file. Prints on screen if self.verbose or is_error """
@@ -1069,9 +1116,6 @@ class NeuronMorphology(object):
 
         expected_synapses = self.get_expected_synapses_per_compartment(synapse_density=synapse_density)
 
-        if num_locations is not None:
-            expected_synapses *= num_locations / np.sum(expected_synapses)
-
         if cluster_size is not None:
             expected_synapses /= cluster_size
         else:
@@ -1081,48 +1125,90 @@ class NeuronMorphology(object):
         number_of_synapses = (expected_synapses + ((expected_synapses % 1)
                                                    > rng.random(len(expected_synapses)))).astype(int)
 
-        n_syn_tot = np.sum(number_of_synapses)
-        dist_syn_soma = []
+        comp_idx = np.repeat(np.arange(len(number_of_synapses)), number_of_synapses * cluster_size)
 
-        # x,y,z, secID, secX
-        input_loc = np.zeros((n_syn_tot*cluster_size, 5))
-        d = self.dend[:, 4]
+        # Return xyz,secID,secX, dist_to_soma (update: now also added distance synapse to soma)
+        return self.get_dendrite_locations(comp_idx=comp_idx, comp_x=rng.random(len(comp_idx)))
 
-        # Iterate over each compartment
-        syn_ctr = 0
-        for i_comp, n_syn in enumerate(number_of_synapses):
+    ############################################################################
 
-            # Add synapses to that compartment
-            for j in range(0, n_syn*cluster_size):
-                # print('Compartment containing a synapse',iComp)
-                # print('Distance from soma',self.dend[iComp][4]*1e6,'$mum$')
-                input_loc[syn_ctr, 3] = self.dend_sec_id[i_comp]
+    def get_dendrite_locations(self, comp_idx, comp_x):
 
-                # Cant have at endpoints 0 or 1
-                comp_x = rng.random()
-                dist_syn_soma = np.append(dist_syn_soma,
-                                          d[self.dend_links[i_comp, 0]] * (1 - comp_x)
-                                          + d[self.dend_links[i_comp, 1]] * comp_x)
+        """
+        Interpolates the positions along the dendrite compartments.
 
-                coords = (self.dend[self.dend_links[i_comp, 0], :3] * (1 - comp_x)
-                          + self.dend[self.dend_links[i_comp, 1], :3] * comp_x)
+        Args:
+            comp_idx (np.array) : Dendrite compartment (row in dend_links) of each location
+            comp_x (np.array) : Relative position (0-1) of each location along its compartment
 
-                input_loc[syn_ctr, :3] = coords
+        Returns:
+            xyz, sec_id, sec_x, dist_to_soma
+        """
 
-                # Use compX (where between comp endpoints) to calculate sectionX
-                # (where between section end points)
-                input_loc[syn_ctr, 4] = self.dend_sec_x[i_comp, 0] * (1 - comp_x) + comp_x * self.dend_sec_x[i_comp, 1]
+        start_idx = self.dend_links[comp_idx, 0]
+        end_idx = self.dend_links[comp_idx, 1]
 
-                syn_ctr += 1
+        xyz = self.dend[start_idx, :3] * (1 - comp_x[:, None]) + self.dend[end_idx, :3] * comp_x[:, None]
+        dist_to_soma = self.dend[start_idx, 4] * (1 - comp_x) + self.dend[end_idx, 4] * comp_x
 
-        assert syn_ctr == input_loc.shape[0], f"Not all input_loc was set. Rows {input_loc.shape[0]}, syn_ctr={syn_ctr}"
+        # Use compX (where between comp endpoints) to calculate sectionX (where between section end points)
+        sec_id = self.dend_sec_id[comp_idx].astype(float)
+        sec_x = self.dend_sec_x[comp_idx, 0] * (1 - comp_x) + comp_x * self.dend_sec_x[comp_idx, 1]
 
-        # if return_density:
-        #     # Return xyz,secID,secX,iDensity,distSynSoma
-        #     return input_loc[:, :3], input_loc[:, 3], input_loc[:, 4], i_density, dist_syn_soma
+        return xyz, sec_id, sec_x, dist_to_soma
 
-        # Return xyz,secID,secX, dist_to_soma (update: now also added distance synapse to soma)
-        return input_loc[:, :3], input_loc[:, 3], input_loc[:, 4], dist_syn_soma
+    ############################################################################
+
+    def dendrite_input_locations_batch(self, synapse_density, rng, num_neurons, num_locations=None,
+                                       cluster_size=None):
+
+        """
+        Randomises input locations on dendrites for num_neurons neurons sharing this morphology, the
+        synapse density is only evaluated once. Each neuron gets its locations placed as by
+        dendrite_input_locations. The coordinates are in the frame of this morphology, for neurons with
+        other positions and rotations apply them to xyz (relative to the soma).
+
+        Args:
+            synapse_density : Synapse density as a function f(d), d=distance from soma
+            rng : Numpy random stream
+            num_neurons (int) : Number of neurons
+            num_locations (int or list) : Number of input locations (clusters) for each neuron,
+                                          None = number given by synapse density (varies)
+            cluster_size (int): Number of synapses in each cluster (None = no clusters)
+
+        Returns:
+            xyz, sec_id, sec_x, dist_to_soma, location_ptr : Locations of neuron i are rows
+                                                             location_ptr[i]:location_ptr[i+1]
+        """
+
+        expected_synapses = self.get_expected_synapses_per_compartment(synapse_density=synapse_density)
+
+        if cluster_size is None:
+            cluster_size = 1
+
+        if num_locations is None:
+            expected_synapses /= cluster_size
+
+            num_clusters = (expected_synapses + ((expected_synapses % 1)
+                                                 > rng.random((num_neurons, len(expected_synapses))))).astype(int)
+
+            comp_idx = np.repeat(np.tile(np.arange(len(expected_synapses)), num_neurons),
+                                 num_clusters.ravel() * cluster_size)
+            num_neuron_synapses = np.sum(num_clusters, axis=1) * cluster_size
+        else:
+            num_locations = np.broadcast_to(np.array(num_locations, dtype=int), (num_neurons,))
+
+            p_cum = np.cumsum(expected_synapses)
+            rand_vals = rng.uniform(0, p_cum[-1], np.sum(num_locations))
+
+            comp_idx = np.repeat(np.searchsorted(p_cum, rand_vals, side="right"), cluster_size)
+            num_neuron_synapses = num_locations * cluster_size
+
+        xyz, sec_id, sec_x, dist_to_soma = self.get_dendrite_locations(comp_idx=comp_idx,
+                                                                       comp_x=rng.random(len(comp_idx)))
+        location_ptr = np.concatenate([[0], np.cumsum(num_neuron_synapses)]).astype(int)
+
+        return xyz, sec_id, sec_x, dist_to_soma, location_ptr
 
     ############################################################################
 
@@ -1176,6 +1262,116 @@ class NeuronMorphology(object):
         p_cum = np.cumsum(expected_synapses)
         rand_vals = rng.uniform(0, p_cum[-1], num_locations)
 
+        if cluster_size is None:
+            cluster_size = 1
+
+        comp_idx = np.repeat(np.searchsorted(p_cum, rand_vals, side="right"), cluster_size)
+
+        # Return xyz,secID,secX, dist_to_soma (update: now also added distance synapse to soma)
+        return self.get_dendrite_locations(comp_idx=comp_idx, comp_x=rng.random(len(comp_idx)))
+
+    ############################################################################
+
+    def dendrite_input_locations_python(self, synapse_density, rng, num_locations=None,
+                                        cluster_size=None):
+
+        """
+        Reference implementation of dendrite_input_locations, loops over compartments and synapses in python.
+
+        Args:
+            synapse_density : Synapse density as a function f(d), d=distance from soma
+            rng : Numpy random stream
+            num_locations : Number of input locations (this is average number returned, results vary)
+            cluster_size (int): Number of synapse clusters to place (None = no clusters, all placed independently)
+        """
+
+        if num_locations is not None:
+            # This function returns the exact number of synapses specified
+            return self.dendrite_input_locations_helper_python(synapse_density=synapse_density,
+                                                               rng=rng,
+                                                               num_locations=num_locations,
+                                                               cluster_size=cluster_size)
+
+        expected_synapses = self.get_expected_synapses_per_compartment(synapse_density=synapse_density)
+
+        if num_locations is not None:
+            expected_synapses *= num_locations / np.sum(expected_synapses)
+
+        if cluster_size is not None:
+            expected_synapses /= cluster_size
+        else:
+            cluster_size = 1
+
+        # Number of input synapses on each compartment
+        number_of_synapses = (expected_synapses + ((expected_synapses % 1)
+                                                   > rng.random(len(expected_synapses)))).astype(int)
+
+        n_syn_tot = np.sum(number_of_synapses)
+        dist_syn_soma = []
+
+        # x,y,z, secID, secX
+        input_loc = np.zeros((n_syn_tot*cluster_size, 5))
+        d = self.dend[:, 4]
+
+        # Iterate over each compartment
+        syn_ctr = 0
+        for i_comp, n_syn in enumerate(number_of_synapses):
+
+            # Add synapses to that compartment
+            for j in range(0, n_syn*cluster_size):
+                # print('Compartment containing a synapse',iComp)
+                # print('Distance from soma',self.dend[iComp][4]*1e6,'$mum$')
+                input_loc[syn_ctr, 3] = self.dend_sec_id[i_comp]
+
+                # Cant have at endpoints 0 or 1
+                comp_x = rng.random()
+                dist_syn_soma = np.append(dist_syn_soma,
+                                          d[self.dend_links[i_comp, 0]] * (1 - comp_x)
+                                          + d[self.dend_links[i_comp, 1]] * comp_x)
+
+                coords = (self.dend[self.dend_links[i_comp, 0], :3] * (1 - comp_x)
+                          + self.dend[self.dend_links[i_comp, 1], :3] * comp_x)
+
+                input_loc[syn_ctr, :3] = coords
+
+                # Use compX (where between comp endpoints) to calculate sectionX
+                # (where between section end points)
+                input_loc[syn_ctr, 4] = self.dend_sec_x[i_comp, 0] * (1 - comp_x) + comp_x * self.dend_sec_x[i_comp, 1]
+
+                syn_ctr += 1
+
+        assert syn_ctr == input_loc.shape[0], f"Not all input_loc was set. Rows {input_loc.shape[0]}, syn_ctr={syn_ctr}"
+
+        # if return_density:
+        #     # Return xyz,secID,secX,iDensity,distSynSoma
+        #     return input_loc[:, :3], input_loc[:, 3], input_loc[:, 4], i_density, dist_syn_soma
+
+        # Return xyz,secID,secX, dist_to_soma (update: now also added distance synapse to soma)
+        return input_loc[:, :3], input_loc[:, 3], input_loc[:, 4], dist_syn_soma
+
+    ############################################################################
+
+    def dendrite_input_locations_helper_python(self,
+                                               synapse_density,
+                                               rng,
+                                               num_locations,
+                                               cluster_size=1):
+
+        """
+        Reference implementation of dendrite_input_locations_helper, loops over locations in python.
+
+        Args:
+            synapse_density : Synapse density as a function f(d), d = distance on dendrite from soma
+            rng : Numpy random stream
+            num_locations (int) : Number of locations
+            cluster_size (int) : Size of synapse clusters
+        """
+
+        expected_synapses = self.get_expected_synapses_per_compartment(synapse_density=synapse_density)
+
+        p_cum = np.cumsum(expected_synapses)
+        rand_vals = rng.uniform(0, p_cum[-1], num_locations)
+
         if cluster_size is None:
             cluster_size = 1
 
@@ -368,7 +368,7 @@ class NeuronPrototype:
 
     def clone(self, parameter_id=None, morphology_id=None, modulation_id=None,
               parameter_key=None, morphology_key=None, modulation_key=None,
-              position=None, rotation=None, get_cache_original=False):
+              position=None, rotation=None, get_cache_original=False, lazy=False):
         """
         Creates a clone of the neuron prototype, with given position and rotation.
 
@@ -386,6 +386,7 @@ class NeuronPrototype:
             position (float,float,float) : position of neuron clone
             rotation : rotation (3x3 numpy matrix)
             get_cache_original (bool) : return the original rather than a clone
+            lazy (bool) : clone only stores position and rotation until the coordinates are accessed
 
         """
 
@@ -429,6 +430,7 @@ class NeuronPrototype:
                                                            modulation_id=modulation_id,
                                                            parameter_key=parameter_key,
                                                            morphology_key=morphology_key,
-                                                           modulation_key=modulation_key)
+                                                           modulation_key=modulation_key,
+                                                           lazy=lazy)
         return morph
 
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.load_input import SnuddaLoadInput
 
 
 class PlotInput(object):
@@ -29,17 +30,14 @@ class PlotInput(object):
             self.network_info = None
 
     def load_input(self, input_file):
-        self.input_data = h5py.File(input_file, "r")
+        self.input_data = SnuddaLoadInput(input_file)
 
     def extract_input(self, input_target):
 
         data = OrderedDict()
 
-        if input_target in self.input_data["input"]:
-            for input_type in self.input_data["input"][input_target]:
-                input_info = self.input_data["input"][input_target][input_type]
-
-                data[input_type] = input_info["spikes"][()]
+        for input_type in self.input_data.get_input_types(int(input_target)):
+            data[input_type] = self.input_data.get_spike_trains(int(input_target), input_type)
 
         return data
     
@@ -2,7 +2,7 @@ import os
 import h5py
 import numpy as np
 
-from snudda.utils import SnuddaLoad
+from snudda.utils import SnuddaLoad, SnuddaLoadInput
 from snudda.neurons.neuron_morphology import NeuronMorphology
 from snudda.neurons.neuron_prototype import NeuronPrototype
 import matplotlib.pyplot as plt
@@ -21,7 +21,7 @@ class SnuddaPlotInputLocations:
         self.snudda_load = SnuddaLoad(self.network_file)
 
         if os.path.exists(self.input_file):
-            self.input_data = h5py.File(self.input_file, "r")
+            self.input_data = SnuddaLoadInput(self.input_file)
         else:
             self.input_data = None
 
@@ -87,12 +87,12 @@ class SnuddaPlotInputLocations:
         section_id = []
         section_x = []
 
-        for input_name in self.input_data["input"][str(neuron_id)]:
+        for input_name, input_info in self.input_data.get_input(neuron_id).items():
             if input_type and input_name != input_type:
                 continue
 
-            section_id = section_id + list(self.input_data["input"][str(neuron_id)][input_name]["sectionID"])
-            section_x = section_x + list(self.input_data["input"][str(neuron_id)][input_name]["sectionX"])
+            section_id = section_id + list(input_info["sectionID"])
+            section_x = section_x + list(input_info["sectionX"])
 
         return np.array(section_id), np.array(section_x)
 
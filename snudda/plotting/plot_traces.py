@@ -8,6 +8,7 @@ import h5py
 import numpy as np
 from snudda.utils.load import SnuddaLoad
 from snudda.utils.load_network_simulation import SnuddaLoadNetworkSimulation
+from snudda.utils.load_input import SnuddaLoadInput
 import re
 import ntpath
 import time
@@ -57,14 +58,14 @@ class PlotTraces:
 
         if self.input_file is not None:
             print(f"Loading input info from {self.input_file}")
-            self.input_info = h5py.File(self.input_file, "r")
+            self.input_info = SnuddaLoadInput(self.input_file)
         else:
             network_path = os.path.dirname(os.path.dirname(output_file))
             input_file = os.path.join(network_path, "input-spikes.hdf5")
             if os.path.exists(input_file):
                 self.input_file = input_file
                 print(f"Loading input info from {self.input_file}")
-                self.input_info = h5py.File(self.input_file, "r")
+                self.input_info = SnuddaLoadInput(self.input_file)
             else:
                 self.input_info = None
 
@@ -194,9 +195,7 @@ class PlotTraces:
         plt.ylabel('Voltage')
 
         if title is None and self.input_info is not None and len(trace_id) == 1:
-            n_inputs = 0
-            for input_type in self.input_info["input"][str(trace_id[0])]:
-                n_inputs += self.input_info["input"][str(trace_id[0])][input_type]["spikes"].shape[0]
+            n_inputs = self.input_info.get_num_inputs(trace_id[0])
 
             title = f"{self.network_info.data['neurons'][trace_id[0]]['name']} receiving {n_inputs} inputs"
 
@@ -1,4 +1,5 @@
 import neuron
+import numpy as np
 import bluepyopt.ephys as ephys
 from bluepyopt.ephys.simulators import NrnSimulatorException
 
@@ -35,8 +36,16 @@ class NrnSimulatorParallel(ephys.simulators.NrnSimulator):
             tstop=None,
             dt=None,
             cvode_active=None,
-            random123_globalindex=None):
-        """Run protocol"""
+            random123_globalindex=None,
+            window=None,
+            window_callback=None):
+        """Run protocol
+
+        Args:
+            window (float): if given, the simulation is run in time windows of this length (ms),
+                window_callback is called after each window (including the last, possibly shorter, one)
+            window_callback (function): called without arguments after each time window
+        """
 
         self.neuron.h.tstop = tstop
 
@@ -81,7 +90,14 @@ class NrnSimulatorParallel(ephys.simulators.NrnSimulator):
             # self.neuron.h.run()
             self.neuron.h.finitialize()
 
-            self.pc.psolve(tstop)
+            if window is None:
+                self.pc.psolve(tstop)
+            else:
+                window_end = list(np.arange(window, tstop, window)) + [tstop]
+                for t_end in window_end:
+                    self.pc.psolve(t_end)
+                    window_callback()
+
             self.pc.barrier()
 
             # Using pc.barrier instead of runworker and done (which doesn't terminate)
@@ -28,6 +28,7 @@ import timeit
 
 from snudda.utils.save_network_activity import SnuddaSaveNetworkActivity
 from snudda.neurons.neuron_model_extended import NeuronModel
+from snudda.neurons.neuron_prototype import NeuronPrototype
 # from Network_place_neurons import NetworkPlaceNeurons
 import numpy as np
 from snudda.simulate.nrn_simulator_parallel import NrnSimulatorParallel
@@ -45,6 +46,7 @@ import snudda.utils.memory
 
 # If simulationConfig is set, those values override other values
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.load_input import SnuddaLoadInput
 from snudda.utils.snudda_path import snudda_parse_path
 
 
@@ -160,6 +162,10 @@ class SnuddaSimulate(object):
         self.sim = None
         self.neuron_nodes = []
 
+        # Relative simulation cost of a morphology point (there are several points per compartment), a synapse
+        # and an input spike, used to balance the workers
+        self.neuron_cost_weights = {"morphology_point": 0.1, "synapse": 0.3, "spike": 0.01}
+
         self.virtual_neurons = {}
 
         self.net_con_list = []  # Avoid premature garbage collection
@@ -181,6 +187,9 @@ class SnuddaSimulate(object):
         self.t_spikes = h.Vector()
         self.id_spikes = h.Vector()
 
+        # Set by run if the output is written in time windows during the simulation
+        self.output_stream = None
+
         # Make sure the output dir exists, so we don't fail at end because we
         # cant write file
         self.create_dir(os.path.join("save", "traces"))
@@ -256,11 +265,13 @@ class SnuddaSimulate(object):
         self.write_log(f"Worker {int(self.pc.id())} : Loading network from {network_file}")
 
         from snudda.utils.load import SnuddaLoad
-        self.snudda_loader = SnuddaLoad(network_file)
+
+        # Synapses are kept on disk, each worker only reads the synapses onto its own neurons (load_local_synapses)
+        self.snudda_loader = SnuddaLoad(network_file, load_synapses=False)
         self.network_info = self.snudda_loader.data
 
-        self.synapses = self.network_info["synapses"]
-        self.gap_junctions = self.network_info["gapJunctions"]
+        self.synapses = None
+        self.gap_junctions = self.network_info["gapJunctions"][()]
 
         # We are only passed information about neurons on our node if
         # SplitConnectionFile was run, so need to use nNeurons to know
@@ -294,27 +305,141 @@ class SnuddaSimulate(object):
         """
         Distribute neurons between workers.
         This code is run on all workers, will generate different lists on each
+
+        Each worker gets a contiguous range of neuron IDs. Place numbers the neurons so that spatially clustered
+        neurons have neighbouring IDs (see SnuddaPlace.cluster_neurons), so neurons on the same worker are close
+        and most synapses are between neurons on the same worker. The ranges are chosen so that the estimated
+        simulation cost (see estimate_neuron_cost) is about the same on all workers.
         """
 
         # This code is run on all workers, will generate different lists on each
         self.write_log("Distributing neurons.")
 
-        assert self.num_neurons >= int(self.pc.nhost()), \
-            f"Do not allocate more workers ({int(self.pc.nhost())}) than there are neurons ({self.num_neurons})."
+        num_workers = int(self.pc.nhost())
+
+        assert self.num_neurons >= num_workers, \
+            f"Do not allocate more workers ({num_workers}) than there are neurons ({self.num_neurons})."
 
-        self.neuron_id = range(int(self.pc.id()), self.num_neurons, int(self.pc.nhost()))
+        if num_workers > 1:
+            # Estimate the cost once, and share it with the other workers
+            neuron_cost = self.estimate_neuron_cost() if int(self.pc.id()) == 0 else None
+            neuron_cost = self.pc.py_broadcast(neuron_cost, 0)
+        else:
+            neuron_cost = np.ones((self.num_neurons,))
+
+        range_borders = self.partition_neurons(neuron_cost=neuron_cost, num_workers=num_workers)
 
-        # TODO: Change to these ranges: range_borders = np.linspace(0, num_neurons, n_workers + 1).astype(int)
-        #       will be faster, because of new numbering of neurons.
+        self.neuron_id = range(range_borders[int(self.pc.id())], range_borders[int(self.pc.id()) + 1])
 
-        range_borders = np.linspace(0, self.num_neurons, self.pc.nhost()+1).astype(int)
-        start_pos = range_borders[0]
-        neuron_nodes = []
-        for idx, end_pos in enumerate(range_borders[1:]):
-            neuron_nodes += [idx]*(end_pos - start_pos)
-            start_pos = end_pos
+        self.neuron_nodes = np.repeat(np.arange(0, num_workers), np.diff(range_borders)).tolist()
 
-        self.neuron_nodes = neuron_nodes
+        self.write_log(f"Worker {int(self.pc.id())} : neurons {self.neuron_id.start} to {self.neuron_id.stop - 1}, "
+                       f"estimated cost {np.sum(neuron_cost[self.neuron_id.start:self.neuron_id.stop]):.0f} "
+                       f"(of {np.sum(neuron_cost):.0f})")
+
+    ############################################################################
+
+    def estimate_neuron_cost(self):
+
+        """
+        Estimates the relative simulation cost of each neuron. The cost is a weighted sum (weights in
+        self.neuron_cost_weights) of the number of points in the morphology, the number of synapses
+        onto the neuron, and the number of input synapses and input spikes of the neuron.
+
+        Returns:
+            neuron_cost (np.array): Estimated cost of each neuron
+        """
+
+        weights = self.neuron_cost_weights
+
+        num_morphology_points = np.zeros((self.num_neurons,))
+        prototype_cache = dict()
+        swc_size_cache = dict()
+
+        for neuron_info in self.network_info["neurons"]:
+
+            if neuron_info["virtualNeuron"]:
+                continue
+
+            name = neuron_info["name"]
+
+            if name not in prototype_cache:
+                config = self.config["Neurons"][name]
+                prototype_cache[name] = NeuronPrototype(neuron_name=name,
+                                                        neuron_path=None,
+                                                        morphology_path=config["morphology"],
+                                                        parameter_path=config["parameters"],
+                                                        mechanism_path=config["mechanisms"],
+                                                        modulation_path=config.get("modulation", None),
+                                                        load_morphology=False)
+
+            morph_path = prototype_cache[name].get_morphology(parameter_id=neuron_info["parameterID"],
+                                                              morphology_id=neuron_info["morphologyID"],
+                                                              parameter_key=neuron_info["parameterKey"],
+                                                              morphology_key=neuron_info["morphologyKey"])
+
+            if morph_path not in swc_size_cache:
+                with open(morph_path, "r") as f:
+                    swc_size_cache[morph_path] = len([x for x in f if x.strip() and not x.startswith("#")])
+
+            num_morphology_points[neuron_info["neuronID"]] = swc_size_cache[morph_path]
+
+        num_synapses = np.diff(self.snudda_loader.get_synapse_row_ptr())
+
+        if self.input_file is not None and os.path.isfile(snudda_parse_path(self.input_file)):
+            input_loader = SnuddaLoadInput(self.input_file)
+            num_input_synapses, num_input_spikes = input_loader.get_input_count(num_neurons=self.num_neurons)
+            input_loader.close()
+        else:
+            num_input_synapses = np.zeros((self.num_neurons,))
+            num_input_spikes = np.zeros((self.num_neurons,))
+
+        neuron_cost = (weights["morphology_point"] * num_morphology_points
+                       + weights["synapse"] * (num_synapses + num_input_synapses)
+                       + weights["spike"] * num_input_spikes)
+
+        return neuron_cost
+
+    ############################################################################
+
+    @staticmethod
+    def partition_neurons(neuron_cost, num_workers):
+
+        """
+        Splits the neurons into num_workers contiguous ranges, with about the same total cost in each range.
+        Each range has at least one neuron.
+
+        Args:
+            neuron_cost (np.array): Cost of each neuron
+            num_workers (int): Number of workers
+
+        Returns:
+            range_borders (np.array): Worker idx gets neurons range_borders[idx] to range_borders[idx+1]-1
+        """
+
+        num_neurons = len(neuron_cost)
+        assert num_neurons >= num_workers, f"partition_neurons: More workers ({num_workers}) than neurons"
+
+        cum_cost = np.cumsum(neuron_cost)
+
+        if cum_cost[-1] <= 0:
+            return np.linspace(0, num_neurons, num_workers + 1).astype(int)
+
+        target_cost = cum_cost[-1] * np.arange(1, num_workers) / num_workers
+
+        # Border before or after the neuron where the target cost is reached, whichever is closest
+        idx = np.searchsorted(cum_cost, target_cost, side="left")
+        cost_before = np.where(idx > 0, cum_cost[np.maximum(idx - 1, 0)], 0)
+        borders = np.where(cum_cost[idx] - target_cost < target_cost - cost_before, idx + 1, idx)
+
+        range_borders = np.concatenate([[0], borders, [num_neurons]]).astype(int)
+
+        # Make sure all workers get at least one neuron
+        for worker_idx in range(1, num_workers):
+            range_borders[worker_idx] = min(max(range_borders[worker_idx], range_borders[worker_idx - 1] + 1),
+                                            num_neurons - (num_workers - worker_idx))
+
+        return range_borders
 
     ############################################################################
 
@@ -434,10 +559,10 @@ class SnuddaSimulate(object):
 
                 if self.input_data is None:
                     self.write_log(f"Using {self.input_file} for virtual neurons")
-                    self.input_data = h5py.File(snudda_parse_path(self.input_file), 'r')
+                    self.input_data = SnuddaLoadInput(self.input_file)
 
                 name = self.network_info["neurons"][ID]["name"]
-                spikes = self.input_data["input"][ID]["activity"]["spikes"][:, 0]
+                spikes = self.input_data.get_virtual_neuron_spikes(ID)
 
                 # Creating NEURON VecStim and vector
                 # https://www.neuron.yale.edu/phpBB/viewtopic.php?t=3125
@@ -541,6 +666,8 @@ class SnuddaSimulate(object):
 
         self.write_log("connect_network_synapses")
 
+        self.load_local_synapses()
+
         # This loops through all the synapses, and connects the relevant ones
         next_row = 0
         # nextRowSet = [ fromRow, toRow ) -- ie range(fromRow,toRow)
@@ -556,6 +683,20 @@ class SnuddaSimulate(object):
 
     ############################################################################
 
+    def load_local_synapses(self):
+
+        """
+        Reads the synapses onto the neurons on this worker (self.neuron_id) into self.synapses.
+        Only the row ranges of those neurons are read from the network file, using the synapse row index.
+        """
+
+        self.synapses = self.snudda_loader.load_post_synapses(np.sort(self.neuron_id))
+
+        self.write_log(f"Worker {int(self.pc.id())} : Loaded {self.synapses.shape[0]} synapses "
+                       f"(out of {self.network_info['nSynapses']})")
+
+    ############################################################################
+
     # This function starts at nextRow, then returns all synapses onto
     # a neuron which is located on the worker
 
@@ -1007,41 +1148,45 @@ class SnuddaSimulate(object):
 
         self.write_log(f"Adding external (cortical, thalamic) input from {input_file}")
 
-        self.input_data = h5py.File(input_file, 'r')
+        if self.input_data is None or self.input_data.input_file_name != input_file:
+            self.input_data = SnuddaLoadInput(input_file)
 
         for neuron_id, neuron in self.neurons.items():
 
             self.external_stim[neuron_id] = []
             name = neuron.name
 
-            if str(neuron_id) not in self.input_data["input"]:
+            neuron_input_data = self.input_data.get_input(neuron_id)
+
+            if len(neuron_input_data) == 0:
                 self.write_log(f"Warning - No input specified for {name}", is_error=True)
                 continue
 
-            for inputType in self.input_data["input"][str(neuron_id)]:
-                neuron_input = self.input_data["input"][str(neuron_id)][inputType]
+            for inputType, neuron_input in neuron_input_data.items():
 
                 loc_type = 1 * np.ones((neuron_input["sectionID"].shape[0],))  # Axon-Dend
 
                 sections = self.neurons[neuron_id].map_id_to_compartment(neuron_input["sectionID"])
 
                 # Setting individual parameters for synapses
-                mod_file = SnuddaLoad.to_str(neuron_input["modFile"][()])
-                param_list = json.loads(neuron_input["parameterList"][()], object_pairs_hook=OrderedDict)
+                mod_file = neuron_input["modFile"]
+                param_list = neuron_input["parameterList"]
 
                 # TODO: Sanity check mod_file string
                 eval_str = f"self.sim.neuron.h.{mod_file}"
                 channel_module = eval(eval_str)
 
-                for inputID, (section, section_x, paramID, nSpikes) \
+                spike_ptr = neuron_input["spikePtr"]
+
+                for inputID, (section, section_x, paramID) \
                         in enumerate(zip(sections,
                                          neuron_input["sectionX"],
-                                         neuron_input["parameterID"],
-                                         neuron_input["nSpikes"])):
+                                         neuron_input["parameterID"])):
                     # We need to find cellID (int) from neuronID (string, eg. MSD1_3)
 
                     idx = inputID
-                    spikes = neuron_input["spikes"][inputID, :nSpikes] * 1e3  # Neuron uses ms
+                    # Neuron uses ms
+                    spikes = neuron_input["spikeTimes"][spike_ptr[inputID]:spike_ptr[inputID + 1]].astype(float) * 1e3
                     assert (spikes >= 0).all(), \
                         "Negative spike times for neuron " + str(neuron_id) + " " + inputType
 
@@ -1076,7 +1221,7 @@ class SnuddaSimulate(object):
 
                     nc.delay = 0.0
                     # Should weight be between 0 and 1, or in microsiemens?
-                    nc.weight[0] = neuron_input["conductance"][()] * 1e6  # !! what is unit? microsiemens?
+                    nc.weight[0] = neuron_input["conductance"] * 1e6  # !! what is unit? microsiemens?
                     nc.threshold = 0.1
 
                     # Get the modifications of synapse parameters, specific to
@@ -1340,9 +1485,28 @@ class SnuddaSimulate(object):
 
     ############################################################################
 
-    def run(self, t=1000.0, hold_v=None):
+    def run(self, t=1000.0, hold_v=None, output_window=None, output_file=None):
+
+        """ Run simulation.
 
-        """ Run simulation. """
+        Args:
+            t (float): Duration of simulation (ms)
+            hold_v (float, optional): Holding voltage at initialisation (V)
+            output_window (float, optional): If given, the recorded voltages and spikes are written to disk
+                                             after each time window of this length (ms) and then cleared,
+                                             so memory use is bounded by the window size. Call write_output
+                                             after run to combine the data into the network output file.
+            output_file (str, optional): Network output file, used to name the files written during the run
+        """
+
+        if output_window is not None:
+            assert len(self.i_save) == 0, "Current recordings are not supported together with output_window"
+
+            self.output_stream = SnuddaSaveNetworkActivity(output_file=self.get_output_file_name(output_file),
+                                                           network_data=self.network_info)
+            window_callback = self.write_output_window
+        else:
+            window_callback = None
 
         self.setup_print_sim_time(t)
 
@@ -1365,7 +1529,7 @@ class SnuddaSimulate(object):
         self.pc.barrier()
         self.write_log(f"Running simulation for {t / 1000} s", force_print=True)
         # self.sim.psolve(t)
-        self.sim.run(t, dt=0.025)
+        self.sim.run(t, dt=0.025, window=output_window, window_callback=window_callback)
         self.pc.barrier()
         self.write_log("Simulation done.")
 
@@ -1399,7 +1563,11 @@ class SnuddaSimulate(object):
 
     def write_spikes(self, output_file=None):
 
-        """ Write spikes to output_file. """
+        """ Write spikes to output_file. Not available if run was called with output_window, then the spikes
+            are cleared after each window, and are instead saved in the network output file (see write_output). """
+
+        assert self.output_stream is None, \
+            "write_spikes: run was called with output_window, the spikes are saved by write_output"
 
         if output_file is None:
             output_file = self.get_spike_file_name()
@@ -1414,8 +1582,8 @@ class SnuddaSimulate(object):
                 else:
                     mode = 'a'
                 with open(output_file, mode) as spikeFile:
-                    for (t, id) in zip(self.t_spikes, self.id_spikes):
-                        spikeFile.write('%.3f\t%d\n' % (t, id))
+                    np.savetxt(spikeFile, np.column_stack([np.array(self.t_spikes), np.array(self.id_spikes)]),
+                               fmt=['%.3f', '%d'], delimiter='\t')
             self.pc.barrier()
 
     ############################################################################
@@ -1558,21 +1726,61 @@ class SnuddaSimulate(object):
 
     ############################################################################
 
-    def write_output(self, output_file=None):
+    def get_output_file_name(self, output_file=None):
 
-        """ Save neuron voltage to HDF5 file """
+        """ Returns path to network output file, default network-output.hdf5 in the simulation directory. """
 
         if not output_file:
             output_file = os.path.join(self.network_path, "simulation", "network-output.hdf5")
         elif os.path.sep not in output_file:
             output_file = os.path.join(self.network_path, "simulation", output_file)
-            
+
+        return output_file
+
+    ############################################################################
+
+    def write_output(self, output_file=None, merge_rank_files=False):
+
+        """ Save neuron voltage to HDF5 file
+
+        Args:
+            output_file (str, optional): Network output file
+            merge_rank_files (bool): Only used if run was called with output_window. If False the output file
+                                     references the per rank files written during the run (virtual datasets),
+                                     if True their data is copied into the output file and they are removed.
+        """
+
+        output_file = self.get_output_file_name(output_file)
+
+        if self.output_stream is not None:
+            self.output_stream.write_virtual(output_file=output_file, merge_rank_files=merge_rank_files)
+            return
+
         sv = SnuddaSaveNetworkActivity(output_file=output_file, network_data=self.network_info)
         sv.write(t_save=self.t_save, v_save=self.v_save, v_key=self.v_key,
                  t_spikes=self.t_spikes, id_spikes=self.id_spikes)
 
     ############################################################################
 
+    def write_output_window(self):
+
+        """ Writes the data recorded since the last call to disk, then clears the recording vectors
+            (NEURON keeps appending to them as the simulation continues). """
+
+        self.output_stream.write_window(t_save=self.t_save, v_save=self.v_save, v_key=self.v_key,
+                                        t_spikes=self.t_spikes, id_spikes=self.id_spikes)
+
+        if len(self.t_save) > 0:
+            self.t_save.resize(0)
+
+        for v in self.v_save:
+            v.resize(0)
+
+        self.t_spikes.resize(0)
+        self.id_spikes.resize(0)
+
+    ############################################################################
+
     # File format for csv voltage file:
     # -1,t0,t1,t2,t3 ... (time)
     # cellID,v0,v1,v2,v3, ... (voltage for cell #ID)
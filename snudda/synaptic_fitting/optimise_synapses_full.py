@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 import timeit
@@ -116,6 +117,10 @@ class OptimiseSynapsesFull(object):
             self.synapse_parameters = {}
 
         self.parameter_data_file_name = f"{self.data_file}-parameters-full.json"
+
+        # All parameter points evaluated by sobol scans, reused by later scans of the same model
+        self.sobol_cache_file_name = f"{self.data_file}-sobol-cache.jsonl"
+        self.sobol_cache = None
         self.load_parameters = load_parameters
         self.synapse_type = synapse_type
 
@@ -923,6 +928,192 @@ class OptimiseSynapsesFull(object):
 
     ############################################################################
 
+    def sobol_evaluate(self, t_stim, h_peak, parameter_sets, smooth_exp_trace8, smooth_exp_trace9):
+
+        """ Returns array with the error of each parameter set, the model must be setup by sobol_worker_setup.
+            Parameter sets that fail to simulate get error inf. """
+
+        errors = np.full((len(parameter_sets),), np.inf)
+
+        for idx, (u, tau_r, tau_f, tau_ratio, cond) in enumerate(parameter_sets):
+            try:
+                errors[idx] = self.neuron_synapse_helper_glut(t_stim, u, tau_r, tau_f, tau_ratio, cond,
+                                                              smooth_exp_trace8=smooth_exp_trace8,
+                                                              smooth_exp_trace9=smooth_exp_trace9,
+                                                              exp_peak_height=h_peak,
+                                                              return_type="error")
+            except:
+                import traceback
+                t_str = traceback.format_exc()
+                self.write_log(t_str)
+
+        return errors
+
+    ############################################################################
+
+    def sobol_scan_parallel(self, parameter_points, cache_key, section_id, section_x, batch_size=50):
+
+        """ Evaluates parameter_points on the workers of d_view, one batch per worker at a time. The results of
+            each batch are added to the parameter data and the sobol cache as the batch finishes.
+            The workers must be setup by sobol_worker_setup, and have stim_time and peak_height. """
+
+        if isinstance(self.d_view.targets, str) or self.d_view.targets is None:
+            engine_id = list(self.d_view.client.ids)
+        else:
+            engine_id = list(self.d_view.targets)
+
+        engine_views = [self.d_view.client[x] for x in engine_id]
+        batches = [parameter_points[i:i + batch_size] for i in range(0, len(parameter_points), batch_size)]
+
+        cmd_str = ("sobol_errors = ly.sobol_evaluate(t_stim=stim_time, h_peak=peak_height,"
+                   "                                 parameter_sets=sobol_points,"
+                   "                                 smooth_exp_trace8=ly.smooth_exp_volt8,"
+                   "                                 smooth_exp_trace9=ly.smooth_exp_volt9)")
+
+        running = dict()
+        next_batch = 0
+        num_done = 0
+
+        while num_done < len(batches):
+
+            # Give idle workers a new batch
+            for view in engine_views:
+                if view not in running and next_batch < len(batches):
+                    view.push({"sobol_points": batches[next_batch]}, block=True)
+                    running[view] = (next_batch, view.execute(cmd_str, block=False))
+                    next_batch += 1
+
+            finished = [view for view, (_, result) in running.items() if result.ready()]
+
+            if len(finished) == 0:
+                time.sleep(0.1)
+                continue
+
+            for view in finished:
+                batch_idx, result = running.pop(view)
+                result.get()  # Raises the worker exception, if any
+                errors = view.pull("sobol_errors", block=True)
+
+                self.add_sobol_results(cache_key=cache_key, parameter_points=batches[batch_idx], errors=errors,
+                                       section_id=section_id, section_x=section_x)
+                num_done += 1
+
+            self.write_log(f"{num_done} / {len(batches)} batches done, "
+                           f"best parameters {self.synapse_parameter_data.get_best_parameterset()}")
+
+    ############################################################################
+
+    def get_sobol_cache_key(self, params, section_id, section_x):
+
+        """ Returns key identifying the model: trace data, synapse type and parameters, neuron set and
+            synapse positions. Errors in the sobol cache are only valid for the same key. """
+
+        key_data = [self.data, self.synapse_type, params, self.neuron_set_file, self.normalise_trace,
+                    section_id, section_x]
+
+        return hashlib.sha256(json.dumps(key_data, cls=NumpyEncoder, sort_keys=True).encode()).hexdigest()
+
+    ############################################################################
+
+    def load_sobol_cache(self):
+
+        """ Reads the sobol cache file, dictionary with cache key as key, and parameters and error as values.
+            The file has one JSON line per evaluated batch, written by append_sobol_cache. """
+
+        if self.sobol_cache is None:
+            self.sobol_cache = dict()
+
+            if os.path.exists(self.sobol_cache_file_name):
+                with open(self.sobol_cache_file_name, "r") as f:
+                    for line in f:
+                        try:
+                            batch = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Incomplete line, if a scan was interrupted while writing
+                            continue
+
+                        cache_data = self.sobol_cache.setdefault(batch["key"], {"parameters": [], "error": []})
+                        cache_data["parameters"] += batch["parameters"]
+                        cache_data["error"] += batch["error"]
+
+        return self.sobol_cache
+
+    ############################################################################
+
+    def append_sobol_cache(self, cache_key, parameter_points, errors):
+
+        """ Appends one batch of evaluated parameter points to the sobol cache file (only master). """
+
+        if self.role != "master" or len(parameter_points) == 0:
+            return
+
+        line = json.dumps({"key": cache_key, "parameters": parameter_points, "error": errors}, cls=NumpyEncoder)
+
+        with open(self.sobol_cache_file_name, "ab+") as f:
+            # Start on a new line, if the last write was interrupted
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+            f.write(f"{line}\n".encode())
+
+    ############################################################################
+
+    def use_sobol_cache(self, cache_key, parameter_points, section_id, section_x):
+
+        """ Adds the parameter points already in the sobol cache (for cache_key) to the parameter data,
+            and returns the parameter points that still need to be evaluated. """
+
+        cache_data = self.load_sobol_cache().get(cache_key, {"parameters": [], "error": []})
+        cached_error = dict([(tuple(p), e) for p, e in zip(cache_data["parameters"], cache_data["error"])])
+
+        new_points = []
+        num_cached = 0
+
+        for p in parameter_points:
+            key = tuple([float(x) for x in p])
+
+            if key in cached_error:
+                self.synapse_parameter_data.add_parameters(parameter_set=np.array(p),
+                                                           section_id=section_id,
+                                                           section_x=section_x,
+                                                           error=cached_error[key])
+                num_cached += 1
+            else:
+                new_points.append(p)
+
+        self.write_log(f"Using {num_cached} cached parameter points, evaluating {len(new_points)} new points")
+
+        return new_points
+
+    ############################################################################
+
+    def add_sobol_results(self, cache_key, parameter_points, errors, section_id, section_x):
+
+        """ Adds evaluated parameter points to the parameter data, and saves them in the sobol cache.
+            Points that failed to simulate (error inf) are not cached. """
+
+        cache_data = self.load_sobol_cache().setdefault(cache_key, {"parameters": [], "error": []})
+        new_parameters, new_errors = [], []
+
+        for p, error in zip(parameter_points, errors):
+            self.synapse_parameter_data.add_parameters(parameter_set=np.array(p),
+                                                       section_id=section_id,
+                                                       section_x=section_x,
+                                                       error=error)
+
+            if np.isfinite(error):
+                new_parameters.append([float(x) for x in p])
+                new_errors.append(float(error))
+
+        cache_data["parameters"] += new_parameters
+        cache_data["error"] += new_errors
+
+        self.append_sobol_cache(cache_key=cache_key, parameter_points=new_parameters, errors=new_errors)
+
+    ############################################################################
+
     def best_random(self, synapse_model,
                     t_stim, h_peak,
                     model_bounds,
@@ -981,7 +1172,14 @@ class OptimiseSynapsesFull(object):
 
     ############################################################################
 
-    def parallel_optimise_single_cell(self, n_trials=10000, post_opt=False):
+    def parallel_optimise_single_cell(self, n_trials=10000, post_opt=False, batch_size=50):
+
+        """
+        Optimises the synapse parameters of the cell using a sobol scan, with n_trials new parameter points.
+        The points are evaluated in batches of batch_size, in parallel if d_view is set (ipyparallel or LocalClient).
+        The error of every evaluated point is saved to the sobol cache after each batch, so an interrupted scan
+        can be resumed, and points already evaluated for the same model are not simulated again.
+        """
 
         start_time = timeit.default_timer()
 
@@ -1023,67 +1221,54 @@ class OptimiseSynapsesFull(object):
         model_bounds = self.get_model_bounds()
         parameter_points = self.setup_parameter_set(model_bounds, n_trials)
 
+        # Parameter points evaluated in earlier runs (e.g. with different n_trials) are taken from the cache
+        section_id, section_x = synapse_model.synapse_section_id, synapse_model.synapse_section_x
+        cache_key = self.get_sobol_cache_key(params=params, section_id=section_id, section_x=section_x)
+        parameter_points = self.use_sobol_cache(cache_key=cache_key, parameter_points=parameter_points,
+                                                section_id=section_id, section_x=section_x)
+
         # 3. Send synapse positions to all workers, and split parameter points
         #    between workers
 
         if self.d_view is not None:
             self.setup_parallel(self.d_view)
 
-            self.d_view.scatter("parameter_points", parameter_points, block=True)
-
             self.d_view.push({"params": params,
-                              "synapse_section_id": synapse_model.synapse_section_id,
-                              "synapse_section_x": synapse_model.synapse_section_x,
+                              "synapse_section_id": section_id,
+                              "synapse_section_x": section_x,
                               "model_bounds": model_bounds,
                               "stim_time": self.stim_time,
                               "peak_height": peak_height},
                              block=True)
 
+            # Each worker builds the model once, and then evaluates batches of parameter points
             cmd_str_setup = \
                 "ly.sobol_worker_setup(params=params," \
                 + "synapse_position_override=(synapse_section_id,synapse_section_x))"
 
-            self.d_view.execute(f"ly.write_log('TESTING LOG A')", block=True)
-
             self.write_log("Calling sobol_worker_setup")
             self.d_view.execute(cmd_str_setup, block=True)
 
-            self.d_view.execute(f"ly.write_log('TESTING LOG B')", block=True)
-
-            cmd_str = ("res = ly.sobol_scan(t_stim = stim_time,"
-                       "                    h_peak = peak_height,"
-                       "                    parameter_sets=parameter_points,"
-                       "                    model_bounds=model_bounds,"
-                       "                    smooth_exp_trace8=ly.smooth_exp_volt8,"
-                       "                    smooth_exp_trace9=ly.smooth_exp_volt9)")
-
             self.write_log("Executing workers, bang bang")
-            self.d_view.execute(cmd_str, block=True)
-
-            # 5. Gather worker data
-            self.write_log("Gathering results from workers")
-            # res = self.d_view["res"]
-            res = self.d_view.gather("res", block=True)
-            self.write_log("Results gathered.")
-
-            #  for r in res:
-            self.synapse_parameter_data.merge(res)
-
-            self.save_parameter_data()
+            self.sobol_scan_parallel(parameter_points=parameter_points, cache_key=cache_key,
+                                     section_id=section_id, section_x=section_x, batch_size=batch_size)
 
         else:
 
             # No dView, run in serial mode...
             self.sobol_worker_setup(params=params,
-                                    synapse_position_override=(synapse_model.synapse_section_id,
-                                                               synapse_model.synapse_section_x))
+                                    synapse_position_override=(section_id, section_x))
+
+            for batch_start in range(0, len(parameter_points), batch_size):
+                batch_points = parameter_points[batch_start:batch_start + batch_size]
+                errors = self.sobol_evaluate(t_stim=self.stim_time,
+                                             h_peak=peak_height,
+                                             parameter_sets=batch_points,
+                                             smooth_exp_trace8=self.smooth_exp_volt8,
+                                             smooth_exp_trace9=self.smooth_exp_volt9)
 
-            self.sobol_scan(parameter_sets=parameter_points,
-                            t_stim=self.stim_time,
-                            h_peak=peak_height,
-                            model_bounds=model_bounds,
-                            smooth_exp_trace8=ly.smooth_exp_volt8,
-                            smooth_exp_trace9=ly.smooth_exp_volt9)
+                self.add_sobol_results(cache_key=cache_key, parameter_points=batch_points, errors=errors,
+                                       section_id=section_id, section_x=section_x)
 
         self.write_log(f"Sobol search done. Best parameter {self.synapse_parameter_data.get_best_parameterset()}")
 
@@ -1382,6 +1567,9 @@ if __name__ == "__main__":
 
     parser.add_argument("--data", help="Snudda data directory",
                         default=os.path.join("..", "..", "..", "BasalGangliaData", "data"))
+    parser.add_argument("--parallel", help="Run sobol scan on local worker processes, 'local' (all cores) or "
+                                           "'local:N' (N workers). Default is ipyparallel if IPYTHON_PROFILE is set.",
+                        default=None)
 
     args = parser.parse_args()
 
@@ -1409,7 +1597,15 @@ if __name__ == "__main__":
     print(f"IPYTHON_PROFILE = {os.getenv('IPYTHON_PROFILE')}")
     print(f"SNUDDA_DATA = {os.getenv('SNUDDA_DATA')}")
 
-    if os.getenv('IPYTHON_PROFILE') is not None or os.getenv('SLURMID') is not None:
+    from snudda.utils.local_cluster import LocalClient, parse_local_parallel
+    n_local_workers = parse_local_parallel(args.parallel)
+
+    if n_local_workers is not None:
+        print(f"Starting {n_local_workers} local workers")
+        rc = LocalClient(n_workers=n_local_workers)
+        d_view = rc.direct_view(targets='all')
+
+    elif os.getenv('IPYTHON_PROFILE') is not None or os.getenv('SLURMID') is not None:
         from ipyparallel import Client
 
         try:
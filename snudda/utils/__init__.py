@@ -3,6 +3,7 @@ from snudda.utils.numpy_encoder import NumpyEncoder
 from snudda.utils.snudda_path import snudda_parse_path
 from snudda.utils.cleanup import cleanup
 from snudda.utils.load_network_simulation import SnuddaLoadNetworkSimulation
+from snudda.utils.load_input import SnuddaLoadInput
 
 # Keep this one out, it imports neuron, which causes problems in some cases during pip install
 # from snudda.utils.save_network_activity import SnuddaSaveNetworkActivity
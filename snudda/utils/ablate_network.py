@@ -2,6 +2,7 @@
 import os.path
 from collections import OrderedDict
 
+from snudda.utils.cut import SnuddaCut
 from snudda.utils.load import SnuddaLoad
 import h5py
 import numpy as np
@@ -33,7 +34,15 @@ class SnuddaAblateNetwork:
 
     """
 
-    def __init__(self, network_file, verbose=False):
+    def __init__(self, network_file, random_seed=None, verbose=False):
+
+        """ Constructor.
+
+        Args:
+            network_file (str) : Path to network file
+            random_seed (int) : Random seed for neuron and connection removal, for reproducible ablations
+            verbose (bool) : Print more info
+        """
 
         self.snudda_load = SnuddaLoad(network_file=network_file, load_synapses=False, verbose=verbose)
         self.in_file = self.snudda_load.hdf5_file
@@ -43,6 +52,9 @@ class SnuddaAblateNetwork:
         self.keep_neuron_id = None
         self.removed_connection_type = None
 
+        self.random_seed = random_seed
+        self.rng = np.random.default_rng(random_seed)
+
         self.reset_network()
 
     def reset_network(self):
@@ -62,7 +74,7 @@ class SnuddaAblateNetwork:
         """ Remove neuron of type neuron_type with probability p_remove (default 1)"""
 
         remove_cell_id = self.snudda_load.get_neuron_id_of_type(neuron_type=neuron_type)
-        remove_flag = np.random.uniform(size=(len(remove_cell_id),)) <= p_remove
+        remove_flag = self.rng.uniform(size=(len(remove_cell_id),)) <= p_remove
         remove_cell_id = remove_cell_id[remove_flag]
 
         if len(remove_flag) > 0:
@@ -100,209 +112,121 @@ class SnuddaAblateNetwork:
         print(f"Marking {pre_neuron_type}, {post_neuron_type} synapses for removal (P={p_remove}).")
         self.removed_connection_type.append((pre_neuron_type, post_neuron_type, p_remove))
 
-    def filter_synapses(self, data_type):
-
-        """ Filters synapses, data_type is either 'synapses' or 'gapJunctions' """
-
-        synapse_data = self.in_file[f"network/{data_type}"]
-
-        keep_flag = np.zeros((synapse_data.shape[0],), dtype=bool)
+    def filter_synapses(self, data_type, chunk_size=1000000):
 
-        neuron_types = [n["type"] for n in self.snudda_load.data["neurons"]]
+        """ Filters synapses, data_type is either 'synapses' or 'gapJunctions'. Returns bool array with rows to keep.
 
-        prev_source = None
-        prev_dest = None
-        prev_status = None
+        Args:
+            data_type (str) : 'synapses' or 'gapJunctions'
+            chunk_size (int) : Number of rows to process at a time
+        """
 
+        synapse_data = self.in_file[f"network/{data_type}"]
         n_original_synapses = synapse_data.shape[0]
 
-        for idx, (pre_id, post_id) in enumerate(zip(synapse_data[:,0], synapse_data[:,1])):
-
-            if idx % 10000000 == 0:
-                print(f"{idx}/{n_original_synapses} synapses processed")
-
-            if pre_id == prev_source and post_id == prev_dest:
-                keep_flag[idx] = prev_status
-            else:
-                prev_source = pre_id
-                prev_dest = post_id
-
-                if pre_id in self.keep_neuron_id and post_id in self.keep_neuron_id:
-
-                    row_status = 1
-
-                    if self.removed_connection_type:
-                        for con_type in self.removed_connection_type:
-                            if neuron_types[pre_id] == con_type[0] and neuron_types[post_id] == con_type[1]:
-                                if np.random.uniform() <= con_type[2]:
-                                    # All synapses between a given neuron pair is removed together
-                                    row_status = 0
-                                    break
+        keep_flag = np.zeros((n_original_synapses,), dtype=bool)
+        keep_function = self.get_synapse_filter()
 
-                    keep_flag[idx] = row_status
-                    prev_status = row_status
-                else:
-                    prev_status = 0
+        for row_start in range(0, n_original_synapses, chunk_size):
+            row_end = min(row_start + chunk_size, n_original_synapses)
+            keep_flag[row_start:row_end] = keep_function(synapse_data[row_start:row_end, :])
+            print(f"{row_end}/{n_original_synapses} synapses processed")
 
-        print(f"{n_original_synapses}/{n_original_synapses} synapses processed")
         print("Filtering done.")
 
         return keep_flag
 
-    def write_network(self, out_file_name=None):
-
-        """ Write network to hdf5 file: output_file_name """
-
-        if not out_file_name:
-            out_file_name = f"{self.in_file.filename}-modified.hdf5"
-
-        assert out_file_name != self.in_file.filename, f"In and out file must be different."
-
-        print(f"Writing to {out_file_name}")
-        out_file = h5py.File(out_file_name, "w", libver=self.h5libver, driver=self.h5driver)
-
-        if "config" in out_file:
-            self.in_file.copy("config", out_file)
-
-        self.in_file.copy("meta", out_file)
-
-        if "morphologies" in self.in_file:
-            print("Copying morphologies")
-            self.in_file.copy("morphologies", out_file)
-
-        soma_keep_id = list(self.keep_neuron_id)
-        num_soma_keep = len(soma_keep_id)
-
-        print(f"Keeping {num_soma_keep} neurons.")
-
-        # We need to remap neuronID in the synapses and gap junction matrix
-        # remap_id = dict([])
-        # Try using a np array for lookup instead of dict, faster?
-        remap_id = np.full((len(self.snudda_load.data["neurons"]),), np.nan, dtype=int)
-        for new_id, old_id in enumerate(soma_keep_id):
-            remap_id[old_id] = new_id
-
-        network_group = out_file.create_group("network")
-        neuron_group = network_group.create_group("neurons")
-
-        for var_name in self.in_file["network/neurons"]:
-
-            data = self.in_file[f"network/neurons/{var_name}"]
-
-            if len(data.shape) == 0:
-                # Scalar data, just copy
-                self.in_file.copy(f"network/neurons/{var_name}", neuron_group)
-                continue
+    def get_synapse_filter(self):
 
-            elif len(data.shape) == 1:
-                # 1D data, we only keep nSomaKeep of them
-                data_shape = (num_soma_keep,)
-            elif len(data.shape) == 2:
-                # 2D data, need to make sure to maintain dimensions
-                data_shape = (num_soma_keep, data.shape[1])
-            else:
-                print("writeCutSlice: Only handle 0D, 1D and 2D data, update code!")
-                sys.exit(-1)
+        """ Returns a function that takes consecutive blocks of a synapse (or gap junction) matrix, and returns
+            a bool array with the rows to keep. Rows are kept if both neurons are kept and the connection
+            is not removed. All synapses between a neuron pair (consecutive rows) are removed together,
+            using one random draw per pair. The state of the last pair is carried over to the next block,
+            so the result does not depend on the block size. """
 
-            if var_name == "neuronID":
-                # We need to remap
-                neuron_group.create_dataset(var_name, data_shape, data.dtype,
-                                            [remap_id[data[x]] for x in soma_keep_id],
-                                            compression=data.compression)
+        num_neurons = len(self.snudda_load.data["neurons"])
+        keep_neuron_flag = np.zeros((num_neurons,), dtype=bool)
+        keep_neuron_flag[list(self.keep_neuron_id)] = True
 
-                # Double check that it is OK, should be in order after
-                assert (np.diff(neuron_group["neuronID"][()]) == 1).all(), "Problem with neuron remapping!"
+        neuron_types, neuron_type_idx = np.unique(self.snudda_load.get_neuron_types(), return_inverse=True)
 
-            else:
-                try:
-                    neuron_group.create_dataset(var_name, data_shape, data.dtype,
-                                                [data[x] for x in soma_keep_id],
-                                                compression=data.compression)
-                except:
-                    import traceback
-                    tstr = traceback.format_exc()
-                    print(tstr)
-                    sys.exit(-1)
+        # Probability to keep connection between neuron types, removal probabilities of multiple matches combine
+        p_keep = np.ones((len(neuron_types), len(neuron_types)))
+        for pre_type, post_type, p_remove in self.removed_connection_type:
+            p_keep[np.ix_(neuron_types == pre_type, neuron_types == post_type)] *= 1 - p_remove
 
-        if "synapses" in self.in_file["network"]:
+        prev_pre_id, prev_post_id, prev_keep = -1, -1, False
 
-            # Next deal with synapses
-            keep_syn_flag = self.filter_synapses(data_type="synapses")
+        def keep_function(synapses):
 
-            # Lastly deal with gap junctions
-            keep_gj_flag = self.filter_synapses(data_type="gapJunctions")
+            nonlocal prev_pre_id, prev_post_id, prev_keep
 
-            num_syn = np.sum(keep_syn_flag)
-            num_synapses = np.zeros((1,), dtype=np.uint64) + num_syn
+            if synapses.shape[0] == 0:
+                return np.zeros((0,), dtype=bool)
 
-            num_gj = np.sum(keep_gj_flag)
-            num_gap_junctions = np.zeros((1,), dtype=np.uint64) + num_gj
+            pre_id = synapses[:, 0]
+            post_id = synapses[:, 1]
 
-            network_group.create_dataset("nSynapses", data=num_synapses, dtype=np.uint64)
-            network_group.create_dataset("nGapJunctions", data=num_gap_junctions,
-                                         dtype=np.uint64)
+            # Mark the first row of each neuron pair
+            new_pair = np.ones((len(pre_id),), dtype=bool)
+            new_pair[1:] = np.logical_or(pre_id[1:] != pre_id[:-1], post_id[1:] != post_id[:-1])
+            new_pair[0] = pre_id[0] != prev_pre_id or post_id[0] != prev_post_id
 
-            # TODO: !!!! might need to handle chunk size differently based on size...
+            pair_pre_id = pre_id[new_pair]
+            pair_post_id = post_id[new_pair]
 
-            syn_mat = self.in_file["network/synapses"]
-            gj_mat = self.in_file["network/gapJunctions"]
+            pair_keep = np.logical_and(keep_neuron_flag[pair_pre_id], keep_neuron_flag[pair_post_id])
 
-            print("Copying synapses and gap junctions")
+            if self.removed_connection_type:
+                pair_p_keep = p_keep[neuron_type_idx[pair_pre_id], neuron_type_idx[pair_post_id]]
+                pair_keep = np.logical_and(pair_keep, self.rng.uniform(size=len(pair_pre_id)) < pair_p_keep)
 
-            n_synapses = syn_mat.shape[0]
+            # Rows continuing the last pair of the previous block get index 0
+            keep_flag = np.append(prev_keep, pair_keep)[np.cumsum(new_pair)]
 
-            temp_syn_mat = np.zeros((num_syn, syn_mat.shape[1]), dtype=np.int32)
-            temp_gj_mat = np.zeros((num_gj, gj_mat.shape[1]), dtype=np.int32)
+            prev_pre_id, prev_post_id, prev_keep = pre_id[-1], post_id[-1], keep_flag[-1]
 
-            syn_keep_idx = np.where(keep_syn_flag)[0]
-            for idx, row_idx in enumerate(syn_keep_idx):
+            return keep_flag
 
-                if idx % 50000 == 0:
-                    print(f"{idx} / {num_syn} synapse rows parsed")
+        return keep_function
 
-                # We need to remap the neuronID if some neurons have been removed!!
-                row = syn_mat[row_idx, :]
-                row[0] = remap_id[row[0]]
-                row[1] = remap_id[row[1]]
-                temp_syn_mat[idx, :] = row
+    def write_network(self, out_file_name=None, chunk_size=1000000):
 
-            network_group.create_dataset("synapses",
-                                         data=temp_syn_mat,
-                                         dtype=np.int32, shape=(num_syn, syn_mat.shape[1]),
-                                         chunks=syn_mat.chunks, maxshape=(None, syn_mat.shape[1]),
-                                         compression=syn_mat.compression)
+        """ Write network to hdf5 file: output_file_name
 
-            print(f"{n_synapses} / {num_syn} synapse rows parsed")
-            print("Synapse matrix written.")
+        Args:
+            out_file_name (str) : Path to new network file (default original file name with -modified.hdf5 appended)
+            chunk_size (int) : Number of synapse rows to process at a time
+        """
 
-            print(f"Keeping {num_syn} synapses (out of {syn_mat.shape[0]})")
+        if not out_file_name:
+            out_file_name = f"{self.in_file.filename}-modified.hdf5"
 
-            n_gj = gj_mat.shape[0]
+        assert out_file_name != self.in_file.filename, f"In and out file must be different."
 
-            for idx, row_idx in enumerate(np.where(keep_gj_flag)[0]):
+        print(f"Writing to {out_file_name}")
+        out_file = h5py.File(out_file_name, "w", libver=self.h5libver, driver=self.h5driver)
 
-                if idx % 50000 == 0:
-                    print(f"{idx} / {num_gj} gap junction rows parsed")
+        if "config" in out_file:
+            self.in_file.copy("config", out_file)
 
-                # We need to remap the neuronID if some neurons have been removed!!
-                row = gj_mat[row_idx, :]
-                row[0] = remap_id[row[0]]
-                row[1] = remap_id[row[1]]
-                temp_gj_mat[idx, :] = row
+        self.in_file.copy("meta", out_file)
 
-            network_group.create_dataset("gapJunctions",
-                                         data=temp_gj_mat,
-                                         dtype=np.int32, shape=(num_gj, gj_mat.shape[1]),
-                                         chunks=gj_mat.chunks, maxshape=(None, gj_mat.shape[1]),
-                                         compression=gj_mat.compression)
+        if "morphologies" in self.in_file:
+            print("Copying morphologies")
+            self.in_file.copy("morphologies", out_file)
 
-            print(f"{num_gj} / {num_gj} gap junction rows parsed")
-            print("Gap junction matrix written.")
-            print(f"Keeping {num_gj}  gap junctions (out of {gj_mat.shape[0]})")
+        print(f"Keeping {len(self.keep_neuron_id)} neurons.")
 
-        else:
+        if "synapses" not in self.in_file["network"]:
             print("No synapses found (assuming this was a save file with only position information).")
 
+        # Synapses are filtered block by block as they are written
+        SnuddaCut.write_network_subset(in_file=self.in_file, out_file=out_file, keep_neuron_id=self.keep_neuron_id,
+                                       keep_syn_function=self.get_synapse_filter(),
+                                       keep_gj_function=self.get_synapse_filter(),
+                                       chunk_size=chunk_size)
+
         out_file.close()
 
 
@@ -322,9 +246,10 @@ def snudda_ablate_network_cli():
     parser.add_argument("--remove_neuron_id", type=str, help="Neuron ID to remove (e.g. 4,5,6)", default=None)
     parser.add_argument("--remove_connection", type=str, help="Connection to remove (e.g. 'dSPN','iSPN'", default=None)
     parser.add_argument("--p_remove_connection", type=float, help="Probability to remove connection", default=1.0)
+    parser.add_argument("--randomseed", type=int, help="Random seed", default=None)
     args = parser.parse_args()
 
-    mod_network = SnuddaAblateNetwork(network_file=args.original_network)
+    mod_network = SnuddaAblateNetwork(network_file=args.original_network, random_seed=args.randomseed)
 
     if args.config:
         if not os.path.isfile(args.config):
@@ -29,7 +29,8 @@ class BenchmarkLogging:
 
         Args:
             network_path (str): Path to network
-            parallel_flag (bool): Running in parallel, should we determine number of workers?
+            parallel_flag (bool or str): Running in parallel, should we determine number of workers?
+                                         "local:N" means N local workers (see LocalClient)
             log_file (str) : Log file to save text to
             running_neuron (bool) : Are we running NEURON? (Sets method for determining number of workers)
         """
@@ -46,17 +47,18 @@ class BenchmarkLogging:
         self.pc = None  # Used if running neuron
 
         if parallel_flag or running_neuron:
-            self.num_workers = self.get_number_of_workers(running_neuron=running_neuron)
+            self.num_workers = self.get_number_of_workers(running_neuron=running_neuron, parallel_flag=parallel_flag)
         else:
             self.num_workers = 1
 
-    def get_number_of_workers(self, running_neuron):
+    def get_number_of_workers(self, running_neuron, parallel_flag=True):
 
         """
         Returns number of workers.
 
         Args:
             running_neuron (bool) : Are we running NEURON? Used when determining number of workers).
+            parallel_flag (bool or str) : "local:N" if running with N local workers
 
         """
 
@@ -69,6 +71,12 @@ class BenchmarkLogging:
 
             # Is there a simpler way to get the number of workers?
 
+        from snudda.utils.local_cluster import parse_local_parallel
+        n_local_workers = parse_local_parallel(parallel_flag)
+
+        if n_local_workers is not None:
+            return n_local_workers + 1  # We also include the master node
+
         ipython_profile = os.getenv('IPYTHON_PROFILE')
         if not ipython_profile:
             ipython_profile = "default"
@@ -304,9 +304,158 @@ class ConvHurt(object):
 
     ############################################################################
 
+    # Same output as write_edges, but the edges are written one chunk at a time,
+    # so the whole edge set does not need to be in memory.
+    # edge_chunks yields (edge_group, edge_group_index, edge_type_id, source_id, target_id, data)
+    # for consecutive chunks of edges, the edges must be sorted on target_id.
+
+    def write_edges_chunks(self, edge_file,
+                           edge_population_name,
+                           edge_chunks,
+                           source_population_name=None,
+                           target_population_name=None,
+                           chunk_size=1000000):
+
+        if source_population_name is None:
+            source_population_name = edge_population_name
+            print(f"No source population name given, using edge_population_name: {edge_population_name}")
+
+        if target_population_name is None:
+            target_population_name = edge_population_name
+            print(f"No source population name given, using edgePopulationName: {edge_population_name}")
+
+        with h5py.File(os.path.join(self.network_dir, edge_file), 'w', libver=self.h5py_libver) as f:
+            edg_group = f.create_group("edges")
+            e_group = edg_group.create_group(edge_population_name)
+
+            num_edges = 0
+            last_target_id = None
+            missing_targets = False
+
+            for edge_group, edge_group_index, edge_type_id, source_id, target_id, data in edge_chunks:
+
+                if len(target_id) == 0:
+                    continue
+
+                assert (np.diff(target_id) >= 0).all() and (last_target_id is None or last_target_id <= target_id[0]), \
+                    "write_edges_chunks: Edges must be sorted on target_id"
+
+                # This finds the positions where the sorted targetID increases
+                new_target = np.ones((len(target_id),), dtype=bool)
+                new_target[1:] = np.diff(target_id) > 0
+
+                if last_target_id is not None:
+                    new_target[0] = target_id[0] > last_target_id
+                    missing_targets = missing_targets or target_id[0] - last_target_id > 1
+
+                # We assume all neurons has at least one synapse, the diff should never jump by two
+                missing_targets = missing_targets or (np.diff(target_id) > 1).any()
+
+                self.append_dataset(e_group, "edge_group", edge_group)
+                self.append_dataset(e_group, "edge_group_index", edge_group_index)
+                self.append_dataset(e_group, "edge_type_id", edge_type_id)
+                self.append_dataset(e_group, "index_pointer", (np.where(new_target)[0] + num_edges).astype(float))
+                self.append_dataset(e_group, "source_node_id", source_id)
+                self.append_dataset(e_group, "target_node_id", target_id)
+
+                for g in np.unique(edge_group):
+                    idx = np.where(edge_group == g)[0]
+                    group_group = e_group.require_group(str(g))
+
+                    for data_type, values in data.items():
+                        if len(values.shape) in [1, 2]:
+                            self.append_dataset(group_group, data_type, values[idx])
+                        else:
+                            print("Unsupported width of data column.")
+
+                num_edges += len(target_id)
+                last_target_id = target_id[-1]
+
+            if missing_targets:
+                print("!!! Not all neurons have synapses!")
+
+            if num_edges == 0:
+                print("No edges to write.")
+                return
+
+            e_group["source_node_id"].attrs["node_population"] = source_population_name
+            e_group["target_node_id"].attrs["node_population"] = target_population_name
+
+            # We need to create the indices needed by Allen Institute
+            self.create_index(e_group["source_node_id"], e_group, index_source=True, chunk_size=chunk_size)
+            self.create_index(e_group["target_node_id"], e_group, index_source=False, chunk_size=chunk_size)
+
+    ############################################################################
+
+    @staticmethod
+    def append_dataset(group, name, values):
+
+        """ Appends values to the resizable dataset name in group, creating it if needed. """
+
+        if name not in group:
+            group.create_dataset(name, data=values, chunks=True, maxshape=(None,) + values.shape[1:])
+        else:
+            ds = group[name]
+            old_len = ds.shape[0]
+            ds.resize(old_len + values.shape[0], axis=0)
+            ds[old_len:] = values
+
+    ############################################################################
+
     # createIndex provided by Kael Dai from Allen Institute, 2018-11-27
+    # The node ID are read in chunks, and the ranges (runs of the same node ID) found using numpy
+
+    def create_index(self, node_ids_ds, output_grp, index_source=0, chunk_size=1000000):
+
+        if not index_source:
+            output_grp = output_grp.create_group('indices/target_to_source')
+        else:
+            output_grp = output_grp.create_group('indices/source_to_target')
+
+        num_edges = node_ids_ds.shape[0]
+
+        range_node = []
+        range_begin = []
+        prev_node = None
+
+        for row_start in range(0, num_edges, chunk_size):
+            edge_nodes = np.array(node_ids_ds[row_start:min(row_start + chunk_size, num_edges)], dtype=np.int64)
+
+            new_range = np.ones((len(edge_nodes),), dtype=bool)
+            new_range[1:] = edge_nodes[1:] != edge_nodes[:-1]
+            if prev_node is not None:
+                new_range[0] = edge_nodes[0] != prev_node
+
+            range_node.append(edge_nodes[new_range])
+            range_begin.append(np.where(new_range)[0] + row_start)
+            prev_node = edge_nodes[-1]
+
+        range_node = np.concatenate(range_node + [np.zeros((0,), dtype=np.int64)])
+        range_begin = np.concatenate(range_begin + [np.zeros((0,), dtype=np.int64)])
+        range_end = np.append(range_begin[1:], num_edges)
+
+        n_targets = np.max(range_node, initial=-1)
+
+        # Ranges ordered by node, and in edge order for each node
+        sort_idx = np.argsort(range_node, kind="stable")
+        range_to_edge_id = np.stack([range_begin[sort_idx], range_end[sort_idx]], axis=1)
+
+        num_ranges = np.bincount(range_node, minlength=n_targets + 1)
+        range_ptr = np.cumsum(num_ranges)
+
+        node_id_to_range = np.zeros((n_targets + 1, 2))
+        has_range = num_ranges > 0
+        node_id_to_range[has_range, 0] = (range_ptr - num_ranges)[has_range]
+        node_id_to_range[has_range, 1] = range_ptr[has_range]
+
+        output_grp.create_dataset('range_to_edge_id', data=range_to_edge_id, dtype='uint64')
+        output_grp.create_dataset('node_id_to_ranges', data=node_id_to_range, dtype='uint64')
+
+    ############################################################################
+
+    # Reference implementation of create_index, reads all node ID into memory
 
-    def create_index(self, node_ids_ds, output_grp, index_source=0):
+    def create_index_python(self, node_ids_ds, output_grp, index_source=0):
 
         if not index_source:
             edge_nodes = np.array(node_ids_ds, dtype=np.int64)
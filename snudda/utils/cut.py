@@ -74,142 +74,206 @@ class SnuddaCut(object):
 
     ############################################################################
 
-    # TODO: Split this function, so that one writes slice, but requires info about what to write
-    #       while other function determines what we should keep/remove
-
-    def write_cut_slice(self, cut_equation_lambda):
+    def write_cut_slice(self, cut_equation_lambda, chunk_size=1000000):
 
         """ Write cut slice to file.
 
         Args:
             cut_equation_lambda : lamba function with cut equation
+            chunk_size (int) : Number of synapse rows to process at a time
         """
 
         # Remove the neurons from the data
         soma_keep_flag = self.soma_inside(cut_equation_lambda)
         soma_keep_id = np.where(soma_keep_flag)[0]
-        soma_remove_id = np.where(soma_keep_flag == False)[0]
         num_soma_keep = np.sum(soma_keep_flag)
 
         if num_soma_keep == 0:
             print("No somas left, aborting!")
             sys.exit(-1)
 
-        print(f"Keeping {num_soma_keep} out of {len(soma_keep_flag)}" 
+        print(f"Keeping {num_soma_keep} out of {len(soma_keep_flag)} "
               "neurons (the others have soma outside of cut plane)")
 
-        # We need to remap neuronID in the synapses and gap junction matrix
-        remap_id = dict([])
-        for new_id, old_id in enumerate(soma_keep_id):
-            remap_id[old_id] = new_id
-
         # TODO: Write unit test, that takes a connection matrix, notes how some of the cells are connected
         #       then does cut / ablation, and then verifies that those cells are still connected the same way, if left
         #       + extra unit test, som kollar att inga nya variabler lagts till i load, då vill vi få en krasch
         #       och varning
 
-        network_group = self.out_file.create_group("network")
-        neuron_group = network_group.create_group("neurons")
+        if "synapses" in self.in_file["network"]:
+            # Synapses to or from removed neurons are filtered out by the writer
+            keep_syn_flag = self.synapses_inside(cut_equation_lambda, data_type="synapses", chunk_size=chunk_size)
+            keep_gj_flag = self.synapses_inside(cut_equation_lambda, data_type="gapJunctions", chunk_size=chunk_size)
+        else:
+            print("No synapses found (assuming this was a save file with only position information).")
+            keep_syn_flag = None
+            keep_gj_flag = None
+
+        self.write_network_subset(in_file=self.in_file, out_file=self.out_file, keep_neuron_id=soma_keep_id,
+                                  keep_syn_flag=keep_syn_flag, keep_gj_flag=keep_gj_flag, chunk_size=chunk_size)
 
-        for var_name in self.in_file["network/neurons"]:
+    ############################################################################
+
+    @staticmethod
+    def write_network_subset(in_file, out_file, keep_neuron_id, keep_syn_flag=None, keep_gj_flag=None,
+                             keep_syn_function=None, keep_gj_function=None, chunk_size=1000000):
+
+        """ Writes the neurons keep_neuron_id, and the synapses and gap junctions between them, from in_file
+            to out_file. The kept neurons are renumbered 0, 1, 2, ... in the order of their old neuron ID.
+            Also used by SnuddaAblateNetwork.
+
+        Args:
+            in_file : Open hdf5 file with the original network
+            out_file : Open hdf5 file to write network group to
+            keep_neuron_id : Neuron ID of neurons to keep
+            keep_syn_flag : bool array, synapses to keep (default all synapses between kept neurons)
+            keep_gj_flag : bool array, gap junctions to keep (default all gap junctions between kept neurons)
+            keep_syn_function : function taking consecutive blocks of the synapse matrix, returning bool array
+                                with the rows to keep (alternative to keep_syn_flag)
+            keep_gj_function : same as keep_syn_function, for gap junctions
+            chunk_size (int) : Number of synapse rows to process at a time
+        """
+
+        keep_neuron_id = np.array(sorted(set(keep_neuron_id)), dtype=int)
+        num_neurons = in_file["network/neurons/neuronID"].shape[0]
+
+        # Lookup table old neuron ID -> new neuron ID, -1 for removed neurons
+        remap_id = np.full((num_neurons,), -1, dtype=np.int64)
+        remap_id[keep_neuron_id] = np.arange(len(keep_neuron_id))
+
+        network_group = out_file.create_group("network")
+        SnuddaCut.write_neurons(in_file=in_file, network_group=network_group, keep_neuron_id=keep_neuron_id,
+                                remap_id=remap_id)
+
+        if "synapses" not in in_file["network"]:
+            return
+
+        network_group.create_dataset("nSynapses", data=np.zeros((1,), dtype=np.uint64), dtype=np.uint64)
+        network_group.create_dataset("nGapJunctions", data=np.zeros((1,), dtype=np.uint64), dtype=np.uint64)
+
+        print("Copying synapses and gap junctions")
+
+        num_syn, synapse_ctr = SnuddaCut.write_synapse_matrix(in_file=in_file, network_group=network_group,
+                                                              data_type="synapses", remap_id=remap_id,
+                                                              keep_flag=keep_syn_flag,
+                                                              keep_function=keep_syn_function,
+                                                              chunk_size=chunk_size)
+        network_group["nSynapses"][0] = num_syn
+        print(f"Keeping {num_syn} synapses (out of {in_file['network/synapses'].shape[0]})")
+
+        num_gj, _ = SnuddaCut.write_synapse_matrix(in_file=in_file, network_group=network_group,
+                                                   data_type="gapJunctions", remap_id=remap_id,
+                                                   keep_flag=keep_gj_flag, keep_function=keep_gj_function,
+                                                   chunk_size=chunk_size)
+        network_group["nGapJunctions"][0] = num_gj
+        print(f"Keeping {num_gj} gap junctions (out of {in_file['network/gapJunctions'].shape[0]})")
+
+        if "synapseRowPtr" in in_file["network"]:
+            # Remapping preserves the order of the neurons, so the synapses are still sorted on destination
+            network_group.create_dataset("synapseRowPtr", data=np.append(0, np.cumsum(synapse_ctr)))
+
+    ############################################################################
 
-            data = self.in_file[f"network/neurons/{var_name}"]
+    @staticmethod
+    def write_neurons(in_file, network_group, keep_neuron_id, remap_id):
+
+        """ Copies the neuron data of keep_neuron_id (sorted) from in_file to network_group/neurons.
+
+        Args:
+            in_file : Open hdf5 file with the original network
+            network_group : hdf5 group to write neurons group to
+            keep_neuron_id : Sorted array with neuron ID to keep
+            remap_id : Lookup table from old to new neuron ID
+        """
+
+        neuron_group = network_group.create_group("neurons")
+
+        for var_name, data in in_file["network/neurons"].items():
 
             if len(data.shape) == 0:
                 # Scalar data, just copy
-                self.in_file.copy(f"network/neurons/{var_name}", neuron_group)
+                in_file.copy(f"network/neurons/{var_name}", neuron_group)
                 continue
 
-            elif len(data.shape) == 1:
-                # 1D data, we only keep nSomaKeep of them
-                data_shape = (num_soma_keep,)
-            elif len(data.shape) == 2:
-                # 2D data, need to make sure to maintain dimensions
-                data_shape = (num_soma_keep, data.shape[1])
-            else:
-                print("writeCutSlice: Only handle 0D, 1D and 2D data, update code!")
+            elif len(data.shape) > 2:
+                print("write_neurons: Only handle 0D, 1D and 2D data, update code!")
                 sys.exit(-1)
 
+            # 1D and 2D data, we only keep the rows of keep_neuron_id
+            values = data[()][keep_neuron_id]
+
             if var_name == "neuronID":
                 # We need to remap
-                neuron_group.create_dataset(var_name, data_shape, data.dtype,
-                                            [remap_id[data[x]] for x in soma_keep_id],
-                                            compression=data.compression)
+                values = remap_id[values].astype(data.dtype)
 
                 # Double check that it is OK, should be in order after
-                assert (np.diff(neuron_group["neuronID"][()]) == 1).all(), \
-                    "Problem with neuron remapping!"
-
-            else:
-                try:
-                    neuron_group.create_dataset(var_name, data_shape, data.dtype,
-                                                [data[x] for x in soma_keep_id],
-                                                compression=data.compression)
-                except:
-                    import traceback
-                    tstr = traceback.format_exc()
-                    print(tstr)
-                    sys.exit(-1)
+                assert (np.diff(values) == 1).all(), "Problem with neuron remapping!"
 
-        if "synapses" in self.in_file["network"]:
+            neuron_group.create_dataset(var_name, data=values, dtype=data.dtype, compression=data.compression)
 
-            # Next deal with synapses
-            keep_syn_flag = self.synapses_inside(cut_equation_lambda, data_type="synapses")
-            keep_syn_flag = self.filter_neurons_synapses(soma_remove_id,
-                                                         keep_flag=keep_syn_flag,
-                                                         data_type="synapses")
+    ############################################################################
 
-            # Lastly deal with gap junctions
-            keep_gj_flag = self.synapses_inside(cut_equation_lambda, data_type="gapJunctions")
-            keep_gj_flag = self.filter_neurons_synapses(soma_remove_id,
-                                                        keep_flag=keep_gj_flag,
-                                                        data_type="gapJunctions")
+    @staticmethod
+    def write_synapse_matrix(in_file, network_group, data_type, remap_id, keep_flag=None, keep_function=None,
+                             chunk_size=1000000):
 
-            num_syn = np.sum(keep_syn_flag)
-            num_synapses = np.zeros((1,), dtype=np.uint64) + num_syn
+        """ Copies the synapses (or gap junctions) between kept neurons to network_group, renumbering the
+            neuron ID. The matrix is read in contiguous blocks of chunk_size rows, and the kept rows of each
+            block are appended to the output in one write.
 
-            num_gj = np.sum(keep_gj_flag)
-            num_gap_junctions = np.zeros((1,), dtype=np.uint64) + num_gj
+        Args:
+            in_file : Open hdf5 file with the original network
+            network_group : hdf5 group to write data_type matrix to
+            data_type : "synapses" or "gapJunctions"
+            remap_id : Lookup table from old to new neuron ID, -1 for removed neurons
+            keep_flag : bool array, which rows are available to keep (default all rows)
+            keep_function : function called with each block (in order), returning bool array with rows to keep
+            chunk_size (int) : Number of rows to process at a time
 
-            network_group.create_dataset("nSynapses", data=num_synapses, dtype=np.uint64)
-            network_group.create_dataset("nGapJunctions", data=num_gap_junctions,
-                                         dtype=np.uint64)
+        Returns:
+            num_rows : Number of rows written
+            row_ctr : Number of rows written for each (new) destination neuron ID
+        """
 
-            # TODO: !!!! might need to handle chunk size differently based on size...
+        syn_mat = in_file[f"network/{data_type}"]
+        num_cols = syn_mat.shape[1]
 
-            syn_mat = self.in_file["network/synapses"]
-            gj_mat = self.in_file["network/gapJunctions"]
+        if keep_flag is not None:
+            assert len(keep_flag) == syn_mat.shape[0], \
+                f"write_synapse_matrix: keep_flag has {len(keep_flag)} rows, {data_type} has {syn_mat.shape[0]}"
 
-            print("Copying synapses and gap junctions")
+        out_mat = network_group.create_dataset(data_type, dtype=np.int32, shape=(0, num_cols),
+                                               chunks=syn_mat.chunks if syn_mat.chunks else True,
+                                               maxshape=(None, num_cols),
+                                               compression=syn_mat.compression)
 
-            network_group.create_dataset("synapses", dtype=np.int32, shape=(num_syn, syn_mat.shape[1]),
-                                         chunks=syn_mat.chunks, maxshape=(None, syn_mat.shape[1]),
-                                         compression=syn_mat.compression)
+        row_ctr = np.zeros((np.sum(remap_id >= 0),), dtype=np.int64)
+        num_rows = 0
 
-            network_group.create_dataset("gapJunctions", dtype=np.int32, shape=(num_gj, gj_mat.shape[1]),
-                                         chunks=gj_mat.chunks, maxshape=(None, gj_mat.shape[1]),
-                                         compression=gj_mat.compression)
+        for row_start in range(0, syn_mat.shape[0], chunk_size):
+            row_end = min(row_start + chunk_size, syn_mat.shape[0])
+            block = syn_mat[row_start:row_end, :]
 
-            for idx, row_idx in enumerate(np.where(keep_syn_flag)[0]):
-                # We need to remap the neuronID if some neurons have been removed!!
-                row = syn_mat[row_idx, :]
-                row[0] = remap_id[row[0]]
-                row[1] = remap_id[row[1]]
-                network_group["synapses"][idx, :] = row
+            new_src_id = remap_id[block[:, 0]]
+            new_dest_id = remap_id[block[:, 1]]
 
-            print(f"Keeping {num_syn} synapses (out of {syn_mat.shape[0]})")
+            keep = np.logical_and(new_src_id >= 0, new_dest_id >= 0)
+            if keep_flag is not None:
+                keep = np.logical_and(keep, keep_flag[row_start:row_end])
+            if keep_function is not None:
+                keep = np.logical_and(keep, keep_function(block))
 
-            for idx, row_idx in enumerate(np.where(keep_gj_flag)[0]):
-                # We need to remap the neuronID if some neurons have been removed!!
-                row = gj_mat[row_idx, :]
-                row[0] = remap_id[row[0]]
-                row[1] = remap_id[row[1]]
-                network_group["gapJunctions"][idx, :] = row
+            block = block[keep, :]
+            block[:, 0] = new_src_id[keep]
+            block[:, 1] = new_dest_id[keep]
 
-            print(f"Keeping {num_gj}  gap junctions (out of {gj_mat.shape[0]})")
+            if block.shape[0] > 0:
+                out_mat.resize((num_rows + block.shape[0], num_cols))
+                out_mat[num_rows:num_rows + block.shape[0], :] = block
+                num_rows += block.shape[0]
+                row_ctr += np.bincount(block[:, 1], minlength=len(row_ctr))
 
-        else:
-            print("No synapses found (assuming this was a save file with only position information).")
+        return num_rows, row_ctr
 
     ############################################################################
 
@@ -220,39 +284,57 @@ class SnuddaCut(object):
         """ Check if soma are inside cut_equation_lambda. Returns a boolean numpy array. """
 
         pos = self.in_file["network/neurons/position"][()]
-        inside_flag = np.array([cut_equation_lambda(x, y, z) for x, y, z in pos], dtype=bool)
+        inside_flag = self.evaluate_cut(cut_equation_lambda, pos)
 
         return inside_flag
 
     ############################################################################
 
-    def synapses_inside(self, cut_equation_lambda, data_type="synapses"):
-
+    def synapses_inside(self, cut_equation_lambda, data_type="synapses", chunk_size=1000000):
 
         """ Check if synapses are inside cut_equation_lambda. Returns a numpy bool array.
 
         Args:
             cut_equation_lambda : lambda function representing cut
             data_type : e.g. 'synapses' or 'gapJunctions'
+            chunk_size (int) : Number of rows to process at a time
         """
 
         voxel_size = self.in_file["meta/voxelSize"][()]
         sim_origo = self.in_file["meta/simulationOrigo"][()]
 
         if data_type == "synapses":
-            pos = self.in_file["network/synapses"][:, 2:5] * voxel_size + sim_origo
+            pos_cols = slice(2, 5)
         elif data_type == "gapJunctions":
-            pos = self.in_file["network/gapJunctions"][:, 6:9] * voxel_size + sim_origo
+            pos_cols = slice(6, 9)
         else:
             print(f"filterNeuronsSynapses: Unknown data_type: {data_type} (valid are 'synapses' or 'gapJunctions'")
             sys.exit(-1)
 
-        inside_flag = np.array([cut_equation_lambda(x, y, z) for x, y, z in pos], dtype=bool)
+        syn_mat = self.in_file[f"network/{data_type}"]
+        inside_flag = np.zeros((syn_mat.shape[0],), dtype=bool)
+
+        for row_start in range(0, syn_mat.shape[0], chunk_size):
+            row_end = min(row_start + chunk_size, syn_mat.shape[0])
+            pos = syn_mat[row_start:row_end, pos_cols] * voxel_size + sim_origo
+            inside_flag[row_start:row_end] = self.evaluate_cut(cut_equation_lambda, pos)
 
         return inside_flag
 
     ############################################################################
 
+    @staticmethod
+    def evaluate_cut(cut_equation_lambda, pos):
+
+        """ Evaluates cut_equation_lambda for all points in pos (N x 3 matrix). Returns a numpy bool array. """
+
+        inside_flag = cut_equation_lambda(pos[:, 0], pos[:, 1], pos[:, 2])
+
+        # Equations that do not depend on x, y, z give a scalar
+        return np.broadcast_to(np.asarray(inside_flag, dtype=bool), (pos.shape[0],)).copy()
+
+    ############################################################################
+
     # Returns the row numbers that do not contain the neuronID, ie filters
     # the synapses belonging to neuronID out...
 
@@ -260,10 +342,10 @@ class SnuddaCut(object):
 
     def filter_neurons_synapses(self, neuron_id, keep_flag=None, data_type="synapses"):
 
-        """ Filter synapse matrix, to only keep those synapses that belong to neuronID.
+        """ Filter synapse matrix, to remove the synapses that belong to neuron_id.
 
         Args:
-            neuron_id : Neuron ID to keep
+            neuron_id : Neuron ID to remove
             keep_flag : Which synapses are available to pick from
             data_type : "synapses" or "gapJunctions"
 
@@ -285,10 +367,9 @@ class SnuddaCut(object):
         src_id = self.in_file[data_str][:, 0]
         dest_id = self.in_file[data_str][:, 1]
 
-        # This will be very slow for large networks, should be done smarter if a bottleneck
-        for n_id in neuron_id:
-            keep_flag = np.logical_and(keep_flag,
-                                       np.logical_and(src_id != n_id, dest_id != n_id))
+        keep_flag = np.logical_and(keep_flag,
+                                   np.logical_not(np.logical_or(np.isin(src_id, neuron_id),
+                                                                np.isin(dest_id, neuron_id))))
 
         return keep_flag
 
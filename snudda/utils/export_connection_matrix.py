@@ -1,31 +1,57 @@
 #!/usr/bin/env python3
 
+import os
+
+import h5py
 import numpy as np
+import scipy.sparse
+
 from snudda.utils.load import SnuddaLoad
 
+
 class SnuddaExportConnectionMatrix(object):
 
-    """ Exports a connection matrix from network. """
+    """ Exports a connection matrix from network.
+
+        The connection matrix is a scipy.sparse CSR matrix (row = src, column = dest) with the number of
+        synapses between each pair of neurons. The output format is given by the extension of out_file:
+
+          .npz : scipy.sparse.save_npz file
+          .hdf5 or .h5 : CSR layout (data, indices, indptr, shape) in HDF5
+          otherwise : CSV, either (src, dest, count) rows (save_sparse=True) or the full matrix
 
-    def __init__(self, in_file, out_file, save_sparse=True, save_on_init=True):
+        With save_type_pairs=True the sub-matrix for each (pre type, post type) pair is also saved,
+        as separate npz files or as groups in the HDF5 file (not supported for CSV).
+    """
+
+    def __init__(self, in_file, out_file, save_sparse=True, save_on_init=True, save_type_pairs=False,
+                 chunk_size=1000000):
 
         """ Constructor.
 
         Args:
             in_file : Network file
             out_file : Connection matrix file
-            save_sparse : Should data be saved in sparse format?
+            save_sparse : Should data be saved in sparse format? (CSV only)
+            save_on_init : Save connection matrix when object is created
+            save_type_pairs : Also save the sub-matrices of each (pre type, post type) pair (npz and HDF5 only)
+            chunk_size : Number of synapses to read at a time
         """
 
-        self.sl = SnuddaLoad(in_file)
+        assert not save_type_pairs or os.path.splitext(out_file)[1].lower() in [".npz", ".hdf5", ".h5"], \
+            f"Saving type pairs requires npz or HDF5 output, not {out_file}"
+
+        # Synapses are read from file in chunks, they are not kept in memory
+        self.sl = SnuddaLoad(in_file, load_synapses=False)
 
         self.outFile = out_file
         self.out_file_meta = f"{out_file}-meta"
         self.save_sparse = save_sparse
+        self.save_type_pairs = save_type_pairs
 
         data = self.sl.data
 
-        self.con_mat = self.create_con_mat()
+        self.con_mat = self.create_con_mat(chunk_size=chunk_size)
         self.neuron_type = [x["type"] for x in data["neurons"]]
         self.neuron_name = [x["name"] for x in data["neurons"]]
         self.neuron_morph = [x["morphology"] for x in data["neurons"]]
@@ -37,22 +63,27 @@ class SnuddaExportConnectionMatrix(object):
 
     def save(self):
 
-        print(f"Writing {self.outFile} (row = src, column=dest)")
-        print(f"Saving {np.sum(np.sum(self.con_mat))} synapses, over {np.count_nonzero(self.con_mat)} coupled pairs.")
+        """ Saves connection matrix to self.outFile, the format is given by the file extension. """
 
-        if self.save_sparse:
-            x_pos, y_pos = np.where(self.con_mat)
-            sparse_data = np.zeros((len(x_pos), 3), dtype=int)
-            for idx, (x, y) in enumerate(zip(x_pos, y_pos)):
-                sparse_data[idx, :] = [x, y, self.con_mat[x, y]]
+        print(f"Writing {self.outFile} (row = src, column=dest)")
+        print(f"Saving {self.con_mat.sum()} synapses, over {self.con_mat.count_nonzero()} coupled pairs.")
 
-            np.savetxt(self.outFile, sparse_data, delimiter=",", fmt="%d")
+        file_ext = os.path.splitext(self.outFile)[1].lower()
 
-            # Test to verify
-            for row in sparse_data:
-                assert self.con_mat[row[0], row[1]] == row[2]
+        if file_ext == ".npz":
+            self.save_npz(self.outFile)
+        elif file_ext in [".hdf5", ".h5"]:
+            self.save_hdf5(self.outFile)
+        elif self.save_sparse:
+            self.write_sparse_csv(self.outFile)
         else:
-            np.savetxt(self.outFile, self.con_mat, delimiter=",", fmt="%d")
+            self.write_dense_csv(self.outFile)
+
+        if self.save_type_pairs and file_ext == ".npz":
+            for (pre_type, post_type), (sub_mat, _, _) in self.get_type_pair_matrices().items():
+                type_pair_file = f"{os.path.splitext(self.outFile)[0]}-{pre_type}-{post_type}.npz"
+                print(f"Writing {type_pair_file}")
+                scipy.sparse.save_npz(type_pair_file, sub_mat)
 
         print("Writing " + self.out_file_meta)
         with open(self.out_file_meta, "w") as f_out_meta:
@@ -63,9 +94,141 @@ class SnuddaExportConnectionMatrix(object):
 
     ############################################################################
 
-    def create_con_mat(self):
+    def save_npz(self, out_file):
+
+        """ Saves connection matrix in scipy.sparse npz format. """
+
+        scipy.sparse.save_npz(out_file, self.con_mat)
+
+    ############################################################################
+
+    def save_hdf5(self, out_file):
+
+        """ Saves connection matrix in CSR layout to HDF5 file, with type pair sub-matrices if save_type_pairs. """
+
+        with h5py.File(out_file, "w") as f:
+            self.write_csr_group(f.create_group("connectionMatrix"), self.con_mat)
+
+            f.create_dataset("neuronID", data=np.arange(self.con_mat.shape[0]))
+            f.create_dataset("neuronType", data=[x.encode() for x in self.neuron_type])
+
+            if self.save_type_pairs:
+                type_pair_group = f.create_group("typePairs")
+
+                for (pre_type, post_type), (sub_mat, pre_id, post_id) in self.get_type_pair_matrices().items():
+                    pair_group = type_pair_group.create_group(f"{pre_type},{post_type}")
+                    self.write_csr_group(pair_group, sub_mat)
+                    pair_group.create_dataset("preID", data=pre_id)
+                    pair_group.create_dataset("postID", data=post_id)
+
+    ############################################################################
+
+    @staticmethod
+    def write_csr_group(group, mat):
+
+        """ Writes CSR matrix mat to hdf5 group as data, indices, indptr and shape. """
+
+        group.create_dataset("data", data=mat.data, compression="gzip")
+        group.create_dataset("indices", data=mat.indices, compression="gzip")
+        group.create_dataset("indptr", data=mat.indptr, compression="gzip")
+        group.create_dataset("shape", data=np.array(mat.shape))
+
+    ############################################################################
+
+    @staticmethod
+    def read_csr_group(group):
+
+        """ Reads CSR matrix from hdf5 group written by write_csr_group. """
+
+        return scipy.sparse.csr_matrix((group["data"][()], group["indices"][()], group["indptr"][()]),
+                                       shape=tuple(group["shape"][()]))
+
+    ############################################################################
+
+    def get_type_pair_matrices(self):
+
+        """ Returns dictionary with (pre type, post type) as key, and (sub-matrix, pre neuron ID, post neuron ID)
+            as value. Row i of the sub-matrix is neuron pre neuron ID[i], column j is post neuron ID[j]. """
+
+        neuron_type = np.array(self.neuron_type)
+        type_pair_matrices = dict()
+
+        for pre_type in sorted(set(self.neuron_type)):
+            pre_id = np.where(neuron_type == pre_type)[0]
+            pre_mat = self.con_mat[pre_id, :].tocsc()
+
+            for post_type in sorted(set(self.neuron_type)):
+                post_id = np.where(neuron_type == post_type)[0]
+                type_pair_matrices[pre_type, post_type] = (pre_mat[:, post_id].tocsr(), pre_id, post_id)
+
+        return type_pair_matrices
+
+    ############################################################################
+
+    def write_sparse_csv(self, out_file, num_rows=10000):
+
+        """ Writes (src, dest, count) rows to CSV file, processing num_rows rows of the connection matrix at a time.
+        """
+
+        with open(out_file, "w") as f:
+            for row_start in range(0, self.con_mat.shape[0], num_rows):
+                sub_mat = self.con_mat[row_start:row_start + num_rows, :]
+                sparse_data = np.zeros((sub_mat.nnz, 3), dtype=int)
+                sparse_data[:, 0] = np.repeat(np.arange(sub_mat.shape[0]), np.diff(sub_mat.indptr)) + row_start
+                sparse_data[:, 1] = sub_mat.indices
+                sparse_data[:, 2] = sub_mat.data
+
+                np.savetxt(f, sparse_data, delimiter=",", fmt="%d")
+
+    ############################################################################
+
+    def write_dense_csv(self, out_file, num_rows=1000):
+
+        """ Writes the full connection matrix to CSV file, num_rows rows at a time. """
+
+        with open(out_file, "w") as f:
+            for row_start in range(0, self.con_mat.shape[0], num_rows):
+                np.savetxt(f, self.con_mat[row_start:row_start + num_rows, :].toarray(), delimiter=",", fmt="%d")
+
+    ############################################################################
+
+    def create_con_mat(self, chunk_size=1000000):
+
+        """ Creates the (sparse CSR) connection matrix from the synapse matrix data.
+
+        Args:
+            chunk_size : Number of synapses to read at a time
+        """
+
+        num_neurons = self.sl.data["nNeurons"]
+
+        pair_keys = []
+        pair_counts = []
+
+        for syn_chunk in self.sl.synapse_iterator(chunk_size=chunk_size, data_type="synapses"):
+            # Synapses between the same pair of neurons are counted together
+            keys, counts = np.unique(syn_chunk[:, 0].astype(np.int64) * num_neurons + syn_chunk[:, 1],
+                                     return_counts=True)
+            pair_keys.append(keys)
+            pair_counts.append(counts)
+
+        pair_keys = np.concatenate(pair_keys + [np.zeros((0,), dtype=np.int64)])
+        pair_counts = np.concatenate(pair_counts + [np.zeros((0,), dtype=int)])
+
+        # Pairs split between chunks are summed when converting to CSR
+        con_mat = scipy.sparse.coo_matrix((pair_counts, (pair_keys // num_neurons, pair_keys % num_neurons)),
+                                          shape=(num_neurons, num_neurons), dtype=int).tocsr()
+
+        assert con_mat.sum() == self.sl.data["nSynapses"], \
+            "Synapse numbers in connection matrix does not match"
+
+        return con_mat
+
+    ############################################################################
+
+    def create_con_mat_python(self):
 
-        """ Creates the connection matrix from the synapse matrix data. """
+        """ Creates the (dense) connection matrix from the synapse matrix data, reference implementation. """
 
         num_neurons = self.sl.data["nNeurons"]
 
@@ -98,10 +261,13 @@ class SnuddaExportConnectionMatrix(object):
 if __name__ == "__main__":
     from argparse import ArgumentParser
 
-    parser = ArgumentParser(description="Export connection matrix to CSV file")
+    parser = ArgumentParser(description="Export connection matrix to CSV, npz or HDF5 file")
     parser.add_argument("inFile", help="Snudda HDF5 file with network")
-    parser.add_argument("outFile", help="CSV output file")
+    parser.add_argument("outFile", help="Output file (.npz, .hdf5 or CSV)")
     parser.add_argument("--full", action="store_false", dest="sparse")
+    parser.add_argument("--typePairs", action="store_true",
+                        help="Also save sub-matrix of each neuron type pair (npz or HDF5 output only)")
     args = parser.parse_args()
 
-    secm = SnuddaExportConnectionMatrix(args.inFile, args.outFile, save_sparse=args.sparse)
+    secm = SnuddaExportConnectionMatrix(args.inFile, args.outFile, save_sparse=args.sparse,
+                                        save_type_pairs=args.typePairs)
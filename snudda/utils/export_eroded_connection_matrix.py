@@ -21,8 +21,10 @@ class SnuddaExportErodedConnectionMatrix(SnuddaExportConnectionMatrix):
     @staticmethod
     def erode(mat, fraction_kept=1.0):
 
-        erode_mat = np.random.uniform(size=mat.shape) <= fraction_kept
-        mat = np.multiply(erode_mat, mat)
+        # Only the coupled pairs (stored elements of the sparse matrix) need a random draw
+        mat = mat.copy()
+        mat.data *= np.random.uniform(size=mat.data.shape) <= fraction_kept
+        mat.eliminate_zeros()
 
         return mat
 
@@ -32,7 +34,11 @@ class SnuddaExportErodedConnectionMatrix(SnuddaExportConnectionMatrix):
         row_permute = np.random.permutation(mat.shape[0])
         col_permute = np.random.permutation(mat.shape[1])
 
-        return mat[row_permute, :][:, col_permute]
+        # Column indexing leaves the column indices of each row unsorted, sort them before writing
+        mat = mat[row_permute, :][:, col_permute]
+        mat.sort_indices()
+
+        return mat
 
 
 if __name__ == "__main__":
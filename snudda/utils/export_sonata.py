@@ -14,6 +14,7 @@ import os
 
 from conv_hurt import ConvHurt
 from load import SnuddaLoad
+from load_input import SnuddaLoadInput
 
 
 class ExportSonata(object):
@@ -27,8 +28,8 @@ class ExportSonata(object):
 
         self.out_dir = out_dir
 
-        # Read the data
-        nl = SnuddaLoad(network_file)
+        # Read the data, the synapses are read from the file in chunks when writing the edges
+        nl = SnuddaLoad(network_file, load_synapses=False)
         self.network_file = nl.network_file  # If file was "last", this sets right one
 
         if input_file == "last":
@@ -160,17 +161,10 @@ class ExportSonata(object):
                            edge_type_id=edge_type_id,
                            data=edge_csv_data)
 
-        (edge_group, edge_group_index, edge_type_id, source_gid, target_gid, edgeData) \
-            = self.setup_edge_info(nl, edge_group_lookup, edge_type_lookup)
-
-        ch.write_edges(edge_file="Striatum/Striatum_edges.hdf5",
-                       edge_population_name="Striatum",
-                       edge_group=edge_group,
-                       edge_group_index=edge_group_index,
-                       edge_type_id=edge_type_id,
-                       source_id=source_gid,
-                       target_id=target_gid,
-                       data=edgeData)
+        # The synapses are read, converted and written one chunk at a time
+        ch.write_edges_chunks(edge_file="Striatum/Striatum_edges.hdf5",
+                              edge_population_name="Striatum",
+                              edge_chunks=self.setup_edge_info(nl, edge_group_lookup, edge_type_lookup))
 
         # Next we need to setup virtual nodes for the cortical and thalamic input
 
@@ -519,23 +513,25 @@ class ExportSonata(object):
 
     ############################################################################
 
-    # This code sets up the info about edges
+    # This code sets up the info about edges, one chunk of synapses at a time.
+    # Yields (edge_group, edge_group_index, edge_type_id, source_gid, target_gid, edge_data)
+    # for each chunk, edge_group_index continues counting from the previous chunks.
+
+    def setup_edge_info(self, nl, edge_group_lookup, edge_type_lookup, chunk_size=1000000):
 
-    def setup_edge_info(self, nl, edge_group_lookup, edge_type_lookup):
+        # Lookup tables indexed by (pre type, post type), -1 for type pairs not in the lookups
+        neuron_types = [nl.data["neurons"][idx]["type"] for idx in range(0, len(nl.data["neurons"]))]
+        unique_types, neuron_type_idx = np.unique(neuron_types, return_inverse=True)
 
-        n_synapses = nl.data["synapses"].shape[0]
-        edge_group = np.zeros(n_synapses, dtype=int)
-        edge_group_index = np.zeros(n_synapses, dtype=int)
-        edge_type_id = np.zeros(n_synapses, dtype=int)
-        source_gid = np.zeros(n_synapses, dtype=int)
-        target_gid = np.zeros(n_synapses, dtype=int)
+        edge_group_mat = np.full((len(unique_types), len(unique_types)), -1, dtype=int)
+        edge_type_mat = np.full((len(unique_types), len(unique_types)), -1, dtype=int)
 
-        sec_id = np.zeros(n_synapses, dtype=int)
-        sec_x = np.zeros(n_synapses)
-        syn_weight = np.zeros(n_synapses)
-        delay = np.zeros(n_synapses)
+        for pre_idx, pre_type in enumerate(unique_types):
+            for post_idx, post_type in enumerate(unique_types):
+                edge_group_mat[pre_idx, post_idx] = edge_group_lookup.get((pre_type, post_type), -1)
+                edge_type_mat[pre_idx, post_idx] = edge_type_lookup.get((pre_type, post_type), -1)
 
-        edge_group_count = np.zeros(len(edge_group_lookup.keys()))
+        edge_group_count = np.zeros((max(np.max(edge_group_mat), 0) + 1,), dtype=int)
 
         # Check if these speeds are reasonable?
         axon_speed = 25.0  # 25m/s
@@ -546,35 +542,49 @@ class ExportSonata(object):
         # 4: locType, 5: synapseType, 6: somaDistDend 7:somaDistAxon
         # somaDist is an int, representing micrometers
 
-        for i_syn, syn_row in enumerate(nl.data["synapses"]):
-            source_gid[i_syn] = syn_row[0]
-            target_gid[i_syn] = syn_row[1]
-            sec_id[i_syn] = syn_row[9]
-            sec_x[i_syn] = syn_row[10] / 1000.0
+        synapses = nl.hdf5_file["network/synapses"]
+        n_synapses = synapses.shape[0]
+
+        for row_start in range(0, n_synapses, chunk_size):
+            syn_rows = synapses[row_start:min(row_start + chunk_size, n_synapses), :]
+
+            source_gid = syn_rows[:, 0].astype(int)
+            target_gid = syn_rows[:, 1].astype(int)
+            sec_id = syn_rows[:, 9].astype(int)
+            sec_x = syn_rows[:, 10] / 1000.0
 
-            pre_type = nl.data["neurons"][source_gid[i_syn]]["type"]
-            post_type = nl.data["neurons"][target_gid[i_syn]]["type"]
+            pre_type_idx = neuron_type_idx[source_gid]
+            post_type_idx = neuron_type_idx[target_gid]
 
-            edge_group[i_syn] = edge_group_lookup[pre_type, post_type]
-            edge_type_id[i_syn] = edge_type_lookup[pre_type, post_type]
+            edge_group = edge_group_mat[pre_type_idx, post_type_idx]
+            edge_type_id = edge_type_mat[pre_type_idx, post_type_idx]
 
-            edge_group_index[i_syn] = edge_group_count[edge_group[i_syn]]
-            edge_group_count[edge_group[i_syn]] += 1
+            bad_idx = np.where(np.logical_or(edge_group < 0, edge_type_id < 0))[0]
+            if len(bad_idx) > 0:
+                raise KeyError((neuron_types[source_gid[bad_idx[0]]], neuron_types[target_gid[bad_idx[0]]]))
 
-            dend_dist = syn_row[6] * 1e-6
-            axon_dist = syn_row[7] * 1e-6
-            delay[i_syn] = axon_dist / axon_speed + dend_dist / dend_speed
-            syn_weight[i_syn] = 1.0  # !!! THIS NEEDS TO BE SET DEPENDING ON CONNECTION TYPE
+            # Index of each edge within its group, the edges of each group are numbered in order
+            group_count = np.bincount(edge_group, minlength=len(edge_group_count))
+            sort_idx = np.argsort(edge_group, kind="stable")
+            group_start = np.cumsum(group_count) - group_count
 
-        edge_data = OrderedDict([("sec_id", sec_id),
-                                 ("sec_x", sec_x),
-                                 ("syn_weight", syn_weight),
-                                 ("delay", delay)])
+            edge_group_index = np.zeros((len(edge_group),), dtype=int)
+            edge_group_index[sort_idx] = np.arange(len(edge_group)) - group_start[edge_group[sort_idx]] \
+                + edge_group_count[edge_group[sort_idx]]
+            edge_group_count += group_count
 
-        # Need to set edgeGroup, edgeGroupIndex, edgeType also
+            dend_dist = syn_rows[:, 6] * 1e-6
+            axon_dist = syn_rows[:, 7] * 1e-6
+            delay = axon_dist / axon_speed + dend_dist / dend_speed
+            syn_weight = np.ones((len(source_gid),))  # !!! THIS NEEDS TO BE SET DEPENDING ON CONNECTION TYPE
 
-        return (edge_group, edge_group_index, edge_type_id,
-                source_gid, target_gid, edge_data)
+            edge_data = OrderedDict([("sec_id", sec_id),
+                                     ("sec_x", sec_x),
+                                     ("syn_weight", syn_weight),
+                                     ("delay", delay)])
+
+            yield (edge_group, edge_group_index, edge_type_id,
+                   source_gid, target_gid, edge_data)
 
     ############################################################################
 
@@ -957,35 +967,37 @@ class ExportSonata(object):
         else:
             print("Processing all virtual inputs")
 
-        with h5py.File(self.input_file) as f:
-
-            try:
-                for inp in f["input"]:
-
-                    if input_name is not None and input_name != inp:
-                        # Does not match required inputName
-                        continue
-
-                    if "activity" in f["input"][inp]:
-                        # This is a virtual neuron, save it
-                        gid = node_type_id_lookup[inp]
-
-                        for spikeTime in f["input"][inp]["activity"]["spikes"]:
-                            input_mat[input_ctr, :] = [spikeTime, gid]
-                            input_ctr += 1
-
-                            if input_ctr >= max_input:
-                                print(f"Expanding input matrix to {max_input}")
-                                max_input *= 2
-                                new_input_mat = np.zeros((max_input, 2))
-                                new_input_mat[:input_ctr, :] = input_mat
-                                input_mat = new_input_mat
-            except:
-                import traceback
-                tstr = traceback.format_exc()
-                print(tstr)
-                import pdb
-                pdb.set_trace()
+        input_loader = SnuddaLoadInput(self.input_file)
+
+        try:
+            for inp in input_loader.get_neuron_id():
+
+                if input_name is not None and input_name != str(inp):
+                    # Does not match required inputName
+                    continue
+
+                if "activity" in input_loader.get_input_types(inp):
+                    # This is a virtual neuron, save it
+                    gid = node_type_id_lookup[str(inp)]
+
+                    for spikeTime in input_loader.get_virtual_neuron_spikes(inp):
+                        input_mat[input_ctr, :] = [spikeTime, gid]
+                        input_ctr += 1
+
+                        if input_ctr >= max_input:
+                            print(f"Expanding input matrix to {max_input}")
+                            max_input *= 2
+                            new_input_mat = np.zeros((max_input, 2))
+                            new_input_mat[:input_ctr, :] = input_mat
+                            input_mat = new_input_mat
+        except:
+            import traceback
+            tstr = traceback.format_exc()
+            print(tstr)
+            import pdb
+            pdb.set_trace()
+
+        input_loader.close()
 
         print("About to sort spikes in order")
 
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
+import os
 from collections import OrderedDict
+from collections.abc import Sequence
 
 import numpy as np
 import timeit
@@ -17,7 +19,7 @@ class SnuddaLoad(object):
 
     ############################################################################
 
-    def __init__(self, network_file, load_synapses=True, verbose=False):
+    def __init__(self, network_file, load_synapses=True, verbose=False, lazy=False):
 
         """
         Constructor
@@ -26,6 +28,8 @@ class SnuddaLoad(object):
             network_file (str) : Data file to load
             load_synapses (bool) : Whether to read synapses into memory, or keep them on disk (this keeps file open)
             verbose (bool) : Print more info during execution
+            lazy (bool) : Lazy loading, neuron data is kept as columns and synapses are memory mapped
+                          (see load_hdf5)
 
         """
 
@@ -38,8 +42,11 @@ class SnuddaLoad(object):
 
         self.network_file = None
 
+        # Index of synapse rows by post_id, (post_id, pre_id) and pre_id, see build_synapse_index
+        self.synapse_index = None
+
         if network_file:
-            self.data = self.load_hdf5(network_file, load_synapses)
+            self.data = self.load_hdf5(network_file, load_synapses, lazy=lazy)
         else:
             self.data = None
 
@@ -80,7 +87,7 @@ class SnuddaLoad(object):
 
     ############################################################################
 
-    def load_hdf5(self, network_file, load_synapses=True, load_morph=False):
+    def load_hdf5(self, network_file, load_synapses=True, load_morph=False, lazy=False):
 
         """
         Load data from hdf5 file.
@@ -88,6 +95,10 @@ class SnuddaLoad(object):
         Args:
             network_file (str) : Network file to load data from
             load_synapses (bool) : Load synapses into memory, or read on demand from file (keeps file open)
+            lazy (bool) : Lazy loading, the neuron data is read as columns ("neuronColumns") and the neuron
+                          dictionaries in "neurons" are created when accessed (see SnuddaLazyNeurons).
+                          The synapse and gap junction matrices are memory mapped (see get_synapse_memmap),
+                          load_synapses is ignored.
 
         Returns:
             data (dictionary) : Dictionary with data.
@@ -117,6 +128,7 @@ class SnuddaLoad(object):
             "nGapJunctions" (int) : Number of gap junctions
             "nSynapses" (int) : Number of synapses
             "neurons" : Neuron data structure (see below for format)
+            "neuronColumns" : Neuron data as columns, one array per attribute (only when lazy loading)
             "synapses" : Synapse data matrix (see below for format)
 
     Neuron data format:
@@ -191,14 +203,20 @@ class SnuddaLoad(object):
             except:
                 data["nGapJunctions"] = f["network/gapJunctions"].shape[0]
 
-            if data["nSynapses"] > 100e6:
+            if data["nSynapses"] > 100e6 and not lazy:
                 print(f"Found {data['nSynapses']} synapses (too many!), not loading them into memory!")
                 load_synapses = False
 
             if "network/hyperVoxelIDs" in f:
                 data["hyperVoxelIDs"] = f["network/hyperVoxelIDs"][()]
 
-            if load_synapses:
+            if lazy:
+                # Zero-copy views of the synapses and gap junctions on disk, the hdf5 file is not kept open
+                synapse_memmap = self.get_synapse_memmap(f)
+                data["synapses"] = synapse_memmap["synapses"]
+                data["gapJunctions"] = synapse_memmap["gapJunctions"]
+
+            elif load_synapses:
                 # 0: sourceCellID, 1: destCellID, 2: voxelX, 3: voxelY, 4: voxelZ,
                 # 5: hyperVoxelID, 6: channelModelID,
                 # 7: sourceAxonSomaDist (not SI scaled 1e6, micrometers),
@@ -261,7 +279,18 @@ class SnuddaLoad(object):
         if "meta/axonStumpIDFlag" in f:
             data["axonStumpIDFlag"] = f["meta/axonStumpIDFlag"][()]
 
-        data["neurons"] = self.extract_neurons(f)
+        if lazy:
+            columns = self.extract_neuron_columns(f)
+
+            # Naming convention is TYPE_X, the type is derived from the (few) unique names
+            unique_names, name_idx = np.unique(columns["name"], return_inverse=True)
+            unique_types = np.array([SnuddaLoad.to_str(x).split("_")[0] for x in unique_names], dtype=str)
+            columns["type"] = unique_types[name_idx.ravel()]
+
+            data["neuronColumns"] = columns
+            data["neurons"] = SnuddaLazyNeurons(columns)
+        else:
+            data["neurons"] = self.extract_neurons(f)
 
         # This is for old format, update for new format
         if "parameters" in f:
@@ -271,7 +300,10 @@ class SnuddaLoad(object):
             data["minSynapseSpacing"] = f["parameters/minSynapseSpacing"][()]
 
         data["neuronPositions"] = f["network/neurons/position"][()]
-        data["name"] = [SnuddaLoad.to_str(x) for x in f["network/neurons/name"][()]]
+        if lazy:
+            data["name"] = np.char.decode(data["neuronColumns"]["name"], "utf-8")
+        else:
+            data["name"] = [SnuddaLoad.to_str(x) for x in f["network/neurons/name"][()]]
 
         if "populationUnitID" in f["network/neurons"]:
             data["populationUnit"] = f["network/neurons/populationUnitID"][()]
@@ -310,10 +342,10 @@ class SnuddaLoad(object):
         if self.verbose:
             print(f"Load done. {timeit.default_timer() - start_time:.1f}")
 
-        if load_synapses:
-            f.close()
-        else:
+        if self.hdf5_file is f or not (load_synapses or lazy):
             self.hdf5_file = f
+        else:
+            f.close()
 
         return data
 
@@ -333,87 +365,239 @@ class SnuddaLoad(object):
 
         """
 
-        neurons = []
-
-        for name, neuron_id, hoc, pos, rot, dend_radius, axon_radius, virtual, vID, \
-            axon_density_type, axon_density, axon_density_radius, \
-            axon_density_bounds_xyz, \
-            morph, neuron_path, \
-            parameter_id, morphology_id, modulation_id,\
-            parameter_key, morphology_key, modulation_key \
-                in zip(hdf5_file["network/neurons/name"][:],
-                       hdf5_file["network/neurons/neuronID"][:],
-                       hdf5_file["network/neurons/hoc"][:],
-                       hdf5_file["network/neurons/position"][()],
-                       hdf5_file["network/neurons/rotation"][()],
-                       hdf5_file["network/neurons/maxDendRadius"][:],
-                       hdf5_file["network/neurons/maxAxonRadius"][:],
-                       hdf5_file["network/neurons/virtualNeuron"][:],
-                       hdf5_file["network/neurons/volumeID"][:],
-                       hdf5_file["network/neurons/axonDensityType"][:],
-                       hdf5_file["network/neurons/axonDensity"][:],
-                       hdf5_file["network/neurons/axonDensityRadius"][:],
-                       hdf5_file["network/neurons/axonDensityBoundsXYZ"][:],
-                       hdf5_file["network/neurons/morphology"][:],
-                       hdf5_file["network/neurons/neuronPath"][:],
-                       hdf5_file["network/neurons/parameterID"][:],
-                       hdf5_file["network/neurons/morphologyID"][:],
-                       hdf5_file["network/neurons/modulationID"][:],
-                       hdf5_file["network/neurons/parameterKey"][:],
-                       hdf5_file["network/neurons/morphologyKey"][:],
-                       hdf5_file["network/neurons/modulationKey"][:]
-                       ):
-
-            n = dict([])
-
-            n["name"] = SnuddaLoad.to_str(name)
-
-            if morph is not None:
-                n["morphology"] = SnuddaLoad.to_str(morph)
-
-            # Naming convention is TYPE_X, where XX is a number starting from 0
-            n["type"] = n["name"].split("_")[0]
-
-            n["neuronID"] = neuron_id
-            n["volumeID"] = SnuddaLoad.to_str(vID)
-            n["hoc"] = SnuddaLoad.to_str(hoc)
-            n["neuronPath"] = SnuddaLoad.to_str(neuron_path)
-
-            n["position"] = pos
-            n["rotation"] = rot.reshape(3, 3)
-            n["maxDendRadius"] = dend_radius
-            n["maxAxonRadius"] = axon_radius
-            n["virtualNeuron"] = virtual
-
-            if len(axon_density_type) > 0:
-                n["axonDensityType"] = SnuddaLoad.to_str(axon_density_type)
-            else:
-                n["axonDensityType"] = None
+        columns = SnuddaLoad.extract_neuron_columns(hdf5_file)
 
-            if len(axon_density) > 0:
-                n["axonDensity"] = SnuddaLoad.to_str(axon_density)
-            else:
-                n["axonDensity"] = None
+        return [SnuddaLoad.make_neuron_dict(columns, idx) for idx in range(len(columns["neuronID"]))]
 
-            if n["axonDensityType"] == "xyz":
-                n["axonDensityBoundsXYZ"] = axon_density_bounds_xyz
-            else:
-                n["axonDensityBoundsXYZ"] = None
+    ############################################################################
+
+    @staticmethod
+    def extract_neuron_columns(hdf5_file):
+
+        """
+        Helper function to extract neuron data from hdf5 file as columns, one array per neuron attribute
+        (as stored in network/neurons, strings are kept as bytes).
+
+        Args:
+            hdf5_file : hdf5 file object
+
+        Returns:
+            OrderedDict with one array per neuron attribute.
+        """
+
+        neuron_group = hdf5_file["network/neurons"]
+        columns = OrderedDict()
+
+        for name in ["name", "neuronID", "hoc", "position", "rotation", "maxDendRadius", "maxAxonRadius",
+                     "virtualNeuron", "volumeID", "axonDensityType", "axonDensity", "axonDensityRadius",
+                     "axonDensityBoundsXYZ", "morphology", "neuronPath", "parameterID", "morphologyID",
+                     "modulationID", "parameterKey", "morphologyKey", "modulationKey"]:
+            columns[name] = neuron_group[name][()]
+
+        return columns
+
+    ############################################################################
+
+    @staticmethod
+    def make_neuron_dict(columns, idx):
+
+        """
+        Helper function to create the dictionary of one neuron from the neuron columns.
+
+        Args:
+            columns (OrderedDict) : Neuron data columns, see extract_neuron_columns
+            idx (int) : Row of the neuron
+
+        Returns:
+            Dictionary with neuron data.
+        """
+
+        n = dict([])
+
+        n["name"] = SnuddaLoad.to_str(columns["name"][idx])
+
+        morph = columns["morphology"][idx]
+        if morph is not None:
+            n["morphology"] = SnuddaLoad.to_str(morph)
+
+        # Naming convention is TYPE_X, where XX is a number starting from 0
+        n["type"] = n["name"].split("_")[0]
+
+        n["neuronID"] = columns["neuronID"][idx]
+        n["volumeID"] = SnuddaLoad.to_str(columns["volumeID"][idx])
+        n["hoc"] = SnuddaLoad.to_str(columns["hoc"][idx])
+        n["neuronPath"] = SnuddaLoad.to_str(columns["neuronPath"][idx])
+
+        n["position"] = columns["position"][idx]
+        n["rotation"] = columns["rotation"][idx].reshape(3, 3)
+        n["maxDendRadius"] = columns["maxDendRadius"][idx]
+        n["maxAxonRadius"] = columns["maxAxonRadius"][idx]
+        n["virtualNeuron"] = columns["virtualNeuron"][idx]
+
+        axon_density_type = columns["axonDensityType"][idx]
+        if len(axon_density_type) > 0:
+            n["axonDensityType"] = SnuddaLoad.to_str(axon_density_type)
+        else:
+            n["axonDensityType"] = None
+
+        axon_density = columns["axonDensity"][idx]
+        if len(axon_density) > 0:
+            n["axonDensity"] = SnuddaLoad.to_str(axon_density)
+        else:
+            n["axonDensity"] = None
+
+        if n["axonDensityType"] == "xyz":
+            n["axonDensityBoundsXYZ"] = columns["axonDensityBoundsXYZ"][idx]
+        else:
+            n["axonDensityBoundsXYZ"] = None
+
+        n["axonDensityRadius"] = columns["axonDensityRadius"][idx]
+
+        parameter_id = columns["parameterID"][idx]
+        morphology_id = columns["morphologyID"][idx]
+        modulation_id = columns["modulationID"][idx]
+
+        n["parameterID"] = None if parameter_id < 0 else parameter_id
+        n["morphologyID"] = None if morphology_id < 0 else morphology_id
+        n["modulationID"] = None if modulation_id < 0 else modulation_id
+
+        # If the code fails here, use snudda/utils/upgrade_old_network_file.py to upgrade your old data files
+        n["parameterKey"] = SnuddaLoad.to_str(columns["parameterKey"][idx])
+        n["morphologyKey"] = SnuddaLoad.to_str(columns["morphologyKey"][idx])
+        n["modulationKey"] = SnuddaLoad.to_str(columns["modulationKey"][idx])
+
+        return n
+
+    ############################################################################
+
+    def get_memmap_file(self):
+
+        """
+        Returns path to the sidecar file with uncompressed, contiguous copies of the synapse and gap junction
+        matrices (network file name ending with -memmap.hdf5), used for memory mapping when the matrices in
+        the network file are compressed or chunked.
+        """
+
+        return f"{os.path.splitext(self.network_file)[0]}-memmap.hdf5"
 
-            n["axonDensityRadius"] = axon_density_radius
+    ############################################################################
+
+    @staticmethod
+    def memmap_dataset(file_name, dataset):
+
+        """
+        Memory maps an hdf5 dataset, this requires that the dataset is uncompressed and contiguous.
+
+        Args:
+            file_name (str) : Path to hdf5 file containing the dataset
+            dataset : hdf5 dataset
+
+        Returns:
+            Read only np.memmap of the dataset, or None if the dataset can not be memory mapped.
+        """
+
+        if dataset.chunks is not None or dataset.compression is not None or dataset.external is not None:
+            return None
+
+        if dataset.size == 0:
+            return np.zeros(dataset.shape, dtype=dataset.dtype)
+
+        offset = dataset.id.get_offset()
+
+        if offset is None:
+            # Storage not allocated
+            return None
+
+        return np.memmap(file_name, mode="r", dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+    ############################################################################
+
+    def write_memmap_file(self, hdf5_file, file_signature, chunk_size=10000000):
+
+        """
+        Writes uncompressed, contiguous copies of network/synapses and network/gapJunctions to the sidecar
+        file (see get_memmap_file).
+
+        Args:
+            hdf5_file : hdf5 file object of the network file
+            file_signature (np.array) : Network file signature, used to detect if the network file has changed
+            chunk_size (int) : Number of rows copied at a time
+        """
+
+        import h5py
+
+        memmap_file = self.get_memmap_file()
+
+        if self.verbose:
+            print(f"Writing uncompressed synapse matrix to {memmap_file}")
+
+        # Write to temp file and rename, in case multiple processes write the file at the same time
+        tmp_file = f"{memmap_file}-{os.getpid()}.hdf5"
+
+        with h5py.File(tmp_file, "w") as f:
+            f.attrs["fileSignature"] = file_signature
+
+            for data_type in ["synapses", "gapJunctions"]:
+                source = hdf5_file["network"][data_type]
+                dest = f.create_dataset(data_type, shape=source.shape, dtype=source.dtype)
 
-            n["parameterID"] = None if parameter_id < 0 else parameter_id
-            n["morphologyID"] = None if morphology_id < 0 else morphology_id
-            n["modulationID"] = None if modulation_id < 0 else modulation_id
+                for row_start in range(0, source.shape[0], chunk_size):
+                    row_end = min(row_start + chunk_size, source.shape[0])
+                    dest[row_start:row_end, :] = source[row_start:row_end, :]
 
-            # If the code fails here, use snudda/utils/upgrade_old_network_file.py to upgrade your old data files
-            n["parameterKey"] = SnuddaLoad.to_str(parameter_key)
-            n["morphologyKey"] = SnuddaLoad.to_str(morphology_key)
-            n["modulationKey"] = SnuddaLoad.to_str(modulation_key)
+        os.replace(tmp_file, memmap_file)
 
-            neurons.append(n)
+    ############################################################################
+
+    def get_synapse_memmap(self, hdf5_file):
+
+        """
+        Returns the synapse and gap junction matrices as read only memory mapped arrays. If the matrices
+        in the network file are compressed or chunked (as written by SnuddaPrune), uncompressed copies
+        are written to a sidecar file the first time (see get_memmap_file), later calls reuse it.
+        The sidecar file is rewritten if the network file has changed.
+
+        If the sidecar file can not be written, the hdf5 datasets are returned instead (keeps file open).
+
+        Args:
+            hdf5_file : hdf5 file object of the network file
+
+        Returns:
+            Dictionary with "synapses" and "gapJunctions"
+        """
+
+        import h5py
 
-        return neurons
+        synapse_memmap = dict([(data_type, self.memmap_dataset(self.network_file, hdf5_file["network"][data_type]))
+                               for data_type in ["synapses", "gapJunctions"]])
+
+        if all([x is not None for x in synapse_memmap.values()]):
+            return synapse_memmap
+
+        memmap_file = self.get_memmap_file()
+        file_stat = os.stat(self.network_file)
+        file_signature = np.array([file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64)
+
+        try:
+            with h5py.File(memmap_file, "r") as f:
+                if (f.attrs["fileSignature"] == file_signature).all():
+                    synapse_memmap = dict([(data_type, self.memmap_dataset(memmap_file, f[data_type]))
+                                           for data_type in ["synapses", "gapJunctions"]])
+                    if all([x is not None for x in synapse_memmap.values()]):
+                        return synapse_memmap
+        except (OSError, KeyError):
+            pass
+
+        try:
+            self.write_memmap_file(hdf5_file=hdf5_file, file_signature=file_signature)
+        except OSError:
+            print(f"Unable to write {memmap_file}, reading synapses from {self.network_file} (keeps file open)")
+            self.hdf5_file = hdf5_file
+            return dict([(data_type, hdf5_file["network"][data_type]) for data_type in ["synapses", "gapJunctions"]])
+
+        with h5py.File(memmap_file, "r") as f:
+            return dict([(data_type, self.memmap_dataset(memmap_file, f[data_type]))
+                         for data_type in ["synapses", "gapJunctions"]])
 
     ############################################################################
 
@@ -518,18 +702,6 @@ class SnuddaLoad(object):
 
     ############################################################################
 
-    # Helper methods for sorting
-
-    @staticmethod
-    def _row_eval_post_pre(row, num_neurons):
-        return row[1] * num_neurons + row[0]
-
-    @staticmethod
-    def _row_eval_post(row, num_neurons):
-        return row[1]
-
-    ############################################################################
-
     def find_synapses_slow(self, pre_id, n_max=1000000):
 
         """
@@ -570,103 +742,263 @@ class SnuddaLoad(object):
 
     ############################################################################
 
-    # Either give preID and postID, or just postID
+    def get_synapse_index_file(self):
 
-    def find_synapses(self, pre_id=None, post_id=None, silent=True):
+        """ Returns path to the sidecar file with the synapse index (network file name ending with -index.npz). """
+
+        return f"{os.path.splitext(self.network_file)[0]}-index.npz"
+
+    ############################################################################
+
+    def build_synapse_index(self, chunk_size=10000000):
 
         """
-        Returns subset of synapses.
+        Builds a CSR style index of the synapse matrix, so that the synapses of a post synaptic neuron, of a
+        pre synaptic neuron, or of a neuron pair can be found with a couple of slices.
+
+        The synapse matrix is sorted on post_id, then pre_id, so the rows of a post_id (and of a pair) are
+        contiguous. The rows of a pre_id are listed in pre_row_idx.
+
+        Index arrays (num_neurons = N):
+            post_row_ptr (N+1) : rows post_row_ptr[post_id]:post_row_ptr[post_id+1] have post_id
+            post_pair_ptr (N+1) : pairs post_pair_ptr[post_id]:post_pair_ptr[post_id+1] have post_id
+            pair_pre_id : pre_id of each pair (sorted for each post_id)
+            pair_row_ptr : rows pair_row_ptr[pair]:pair_row_ptr[pair+1] belong to pair
+            pre_row_ptr (N+1) : pre_row_idx[pre_row_ptr[pre_id]:pre_row_ptr[pre_id+1]] are the rows with pre_id
+            pre_row_idx : rows sorted on pre_id (rows with same pre_id in increasing order)
 
         Args:
-            pre_id (int) : Pre-synaptic neuron ID
-            post_id (int) : Post-synaptic neuron ID
-            silent (bool) : Work quietly or verbosely
+            chunk_size (int) : Number of synapse rows read at a time, if synapses are kept on disk
 
         Returns:
-            Subset of synapse matrix.
+            Index as dictionary
+        """
+
+        num_neurons = len(self.data["neuronID"])
+        num_rows = self.data["synapses"].shape[0]
+
+        pre_id = np.zeros((num_rows,), dtype=np.int32)
+        post_id = np.zeros((num_rows,), dtype=np.int32)
+
+        for row_start in range(0, num_rows, chunk_size):
+            row_end = min(row_start + chunk_size, num_rows)
+            synapses = self.data["synapses"][row_start:row_end, 0:2]
+            pre_id[row_start:row_end] = synapses[:, 0]
+            post_id[row_start:row_end] = synapses[:, 1]
+
+        assert (np.diff(post_id) >= 0).all(), "build_synapse_index: Synapses are not sorted on post_id"
+
+        # First row of each (post_id, pre_id) pair
+        pair_start = np.flatnonzero(np.diff(post_id.astype(np.int64) * num_neurons + pre_id, prepend=-1) != 0)
+
+        neuron_range = np.arange(0, num_neurons + 1)
+        row_type = np.int32 if num_rows < np.iinfo(np.int32).max else np.int64
+
+        synapse_index = {"num_rows": num_rows,
+                         "num_neurons": num_neurons,
+                         "post_row_ptr": np.searchsorted(post_id, neuron_range, side="left").astype(row_type),
+                         "post_pair_ptr": np.searchsorted(post_id[pair_start], neuron_range,
+                                                          side="left").astype(row_type),
+                         "pair_pre_id": pre_id[pair_start],
+                         "pair_row_ptr": np.append(pair_start, num_rows).astype(row_type),
+                         "pre_row_ptr": np.append(0, np.cumsum(np.bincount(pre_id, minlength=num_neurons)))
+                                          .astype(row_type),
+                         "pre_row_idx": np.argsort(pre_id, kind="stable").astype(row_type)}
+
+        return synapse_index
+
+    ############################################################################
+
+    def get_synapse_index(self):
 
         """
+        Returns the synapse index (see build_synapse_index). The index is built the first time, and saved to a
+        sidecar file next to the network file (see get_synapse_index_file), later calls (also by other
+        SnuddaLoad objects) reuse it. The sidecar file is rebuilt if the network file has changed.
+        """
 
-        if self.data["synapses"].shape[0] == 0:
-            if not silent:
-                print("No synapses in network")
-            return None, None
+        if self.synapse_index is not None:
+            return self.synapse_index
+
+        index_file = self.get_synapse_index_file()
+        file_stat = os.stat(self.network_file)
+        file_signature = np.array([file_stat.st_size, file_stat.st_mtime_ns, self.data["synapses"].shape[0]],
+                                  dtype=np.int64)
+
+        if os.path.isfile(index_file):
+            try:
+                with np.load(index_file) as index_data:
+                    if (index_data["file_signature"] == file_signature).all():
+                        self.synapse_index = dict([(k, index_data[k]) for k in index_data.files])
+            except (OSError, ValueError, KeyError):
+                if self.verbose:
+                    print(f"Unable to read synapse index {index_file}, rebuilding it")
+
+        if self.synapse_index is None:
+
+            if self.verbose:
+                print(f"Building synapse index {index_file}")
+
+            self.synapse_index = self.build_synapse_index()
+            self.synapse_index["file_signature"] = file_signature
+
+            try:
+                # Write to temp file and rename, in case multiple processes write the index at the same time
+                tmp_file = f"{index_file}-{os.getpid()}.npz"
+                np.savez(tmp_file, **self.synapse_index)
+                os.replace(tmp_file, index_file)
+            except OSError:
+                if self.verbose:
+                    print(f"Unable to write synapse index {index_file}, keeping it in memory only")
+
+        return self.synapse_index
+
+    ############################################################################
+
+    def find_synapse_rows(self, pre_id=None, post_id=None):
+
+        """
+        Returns the synapse matrix rows of the synapses between pre_id and post_id, uses the synapse index.
+        If post_id is a slice object is returned, otherwise an array of row indexes.
+
+        Args:
+            pre_id (int or list) : Pre-synaptic neuron ID (or list of IDs if post_id is None)
+            post_id (int) : Post-synaptic neuron ID
+        """
+
+        synapse_index = self.get_synapse_index()
 
         if post_id is None:
-            return self.find_synapses_slow(pre_id=pre_id)
+            pre_row_ptr = synapse_index["pre_row_ptr"]
+            pre_row_idx = synapse_index["pre_row_idx"]
 
-        assert post_id is not None, "Must specify at least postID"
+            if np.issubdtype(type(pre_id), np.integer):
+                return pre_row_idx[pre_row_ptr[pre_id]:pre_row_ptr[pre_id + 1]]
 
-        num_rows = self.data["synapses"].shape[0]
-        num_neurons = len(self.data["neuronID"])
+            # Each synapse only once, even if pre_id lists a neuron more than once
+            return np.sort(np.concatenate([pre_row_idx[pre_row_ptr[x]:pre_row_ptr[x + 1]] for x in np.unique(pre_id)]
+                                          + [np.zeros((0,), dtype=pre_row_idx.dtype)]))
 
         if pre_id is None:
-            row_eval = self._row_eval_post
-            val_target = post_id
+            post_row_ptr = synapse_index["post_row_ptr"]
+            return slice(int(post_row_ptr[post_id]), int(post_row_ptr[post_id + 1]))
+
+        pair_start, pair_end = synapse_index["post_pair_ptr"][post_id:post_id + 2]
+        pair_idx = pair_start + np.searchsorted(synapse_index["pair_pre_id"][pair_start:pair_end], pre_id)
+
+        if pair_idx < pair_end and synapse_index["pair_pre_id"][pair_idx] == pre_id:
+            pair_row_ptr = synapse_index["pair_row_ptr"]
+            return slice(int(pair_row_ptr[pair_idx]), int(pair_row_ptr[pair_idx + 1]))
+
+        return slice(0, 0)
+
+    ############################################################################
+
+    def get_synapse_row_ptr(self):
+
+        """
+        Returns the row ranges of the synapses onto each neuron, the synapses onto neuron_id are in rows
+        row_ptr[neuron_id] to row_ptr[neuron_id+1]-1. Uses network/synapseRowPtr written by prune, older
+        network files use the synapse index (see get_synapse_index).
+        """
+
+        if self.hdf5_file is not None:
+            if "network/synapseRowPtr" in self.hdf5_file:
+                return self.hdf5_file["network/synapseRowPtr"][()]
         else:
-            row_eval = self._row_eval_post_pre
-            val_target = post_id * num_neurons + pre_id
+            import h5py
+            with h5py.File(self.network_file, "r") as f:
+                if "network/synapseRowPtr" in f:
+                    return f["network/synapseRowPtr"][()]
 
-        idx_a1 = 0
-        idx_a2 = num_rows - 1
+        return self.get_synapse_index()["post_row_ptr"]
 
-        idx_found = None
+    ############################################################################
 
-        # We use idxA1 and idxA2 as upper and lower range within which we
-        # hope to find one of the synapses. Once we found a synapse row
-        # we go up and down in matrix to find the range of the synapses
-        # matching the requested condition. This works because the matrix is
-        # sorted on postID, and then preID if postID matches
+    def load_post_synapses(self, post_id):
 
-        if row_eval(self.data["synapses"][idx_a1, :], num_neurons) == val_target:
-            idx_found = idx_a1
+        """
+        Reads the synapses onto the neurons in post_id, only the rows of those neurons are read from file.
+        Neighbouring neurons are read together.
 
-        if row_eval(self.data["synapses"][idx_a2, :], num_neurons) == val_target:
-            idx_found = idx_a2
+        Args:
+            post_id (list) : Post-synaptic neuron IDs, sorted in increasing order
 
-        # -1 since if idx_a1 and idx_a2 are one apart, we have checked all values
-        while idx_a1 < idx_a2 - 1 and idx_found is None:
+        Returns:
+            Synapse matrix with the synapses onto post_id
+        """
 
-            idx_next = int(np.round((idx_a1 + idx_a2) / 2))
-            val_next = row_eval(self.data["synapses"][idx_next, :], num_neurons)
+        post_id = np.array(post_id, dtype=int)
+        assert (np.diff(post_id) > 0).all(), "load_post_synapses: post_id must be sorted and unique"
 
-            if val_next < val_target:
-                idx_a1 = idx_next
-            elif val_next > val_target:
-                idx_a2 = idx_next
-            else:
-                # We found a hit
-                idx_found = idx_next
-                break
+        if len(post_id) == 0:
+            return np.zeros((0, 13), dtype=np.int32)
 
-        if idx_found is None:
-            # No synapses found
-            if self.verbose:
-                print("No synapses found")
-            return None, None
+        row_ptr = self.get_synapse_row_ptr()
+        start_row = row_ptr[post_id]
+        end_row = row_ptr[post_id + 1]
 
-        # Find start of synapse range
-        idx_b1 = idx_found
-        val_b1 = row_eval(self.data["synapses"][idx_b1 - 1, :], num_neurons)
+        # Join ranges that follow each other in the file, then skip empty ranges
+        range_start = np.flatnonzero(np.append(True, start_row[1:] != end_row[:-1]))
+        range_end = np.append(range_start[1:], len(post_id)) - 1
 
-        while val_b1 == val_target and idx_b1 > 0:
-            idx_b1 -= 1
-            val_b1 = row_eval(self.data["synapses"][idx_b1 - 1, :], num_neurons)
+        read_ranges = [(start_row[a], end_row[b]) for a, b in zip(range_start, range_end) if start_row[a] < end_row[b]]
 
-        # Find end of synapse range
-        idx_b2 = idx_found
+        synapses = np.zeros((end_row.sum() - start_row.sum(), 13), dtype=np.int32)
+        row_ctr = 0
 
-        if idx_b2 + 1 < self.data["synapses"].shape[0]:
-            val_b2 = row_eval(self.data["synapses"][idx_b2 + 1, :], num_neurons)
+        for read_start, read_end in read_ranges:
+            synapses[row_ctr:row_ctr + read_end - read_start, :] = self.data["synapses"][read_start:read_end, :]
+            row_ctr += read_end - read_start
 
-            while val_b2 == val_target and idx_b2 + 1 < self.data["synapses"].shape[0]:
-                idx_b2 += 1
-                val_b2 = row_eval(self.data["synapses"][idx_b2 + 1, :], num_neurons)
+        return synapses
 
-        synapses = self.data["synapses"][idx_b1:idx_b2 + 1, :].copy()
+    ############################################################################
+
+    # Either give pre_id and post_id, or just post_id, or just pre_id
+
+    def find_synapses(self, pre_id=None, post_id=None, silent=True):
+
+        """
+        Returns subset of synapses, using the synapse index (see get_synapse_index).
+
+        Args:
+            pre_id (int) : Pre-synaptic neuron ID (or list of IDs, if post_id is not given)
+            post_id (int) : Post-synaptic neuron ID
+            silent (bool) : Work quietly or verbosely
+
+        Returns:
+            Subset of synapse matrix, synapse coordinates. If post_id is given and no synapses are found
+            (None, None) is returned.
+
+        """
+
+        if self.data["synapses"].shape[0] == 0:
+            if not silent:
+                print("No synapses in network")
+            return None, None
+
+        assert pre_id is not None or post_id is not None, "Must specify at least pre_id or post_id"
+
+        rows = self.find_synapse_rows(pre_id=pre_id, post_id=post_id)
+
+        if isinstance(rows, slice):
+            if rows.start == rows.stop:
+                # No synapses found
+                if self.verbose:
+                    print("No synapses found")
+                return None, None
+
+            # Copy, so the user does not get a view of the synapse matrix
+            synapses = np.array(self.data["synapses"][rows, :])
+
+        elif len(rows) > 0:
+            synapses = self.data["synapses"][rows, :]
+        else:
+            synapses = np.zeros((0, 13), dtype=np.int32)
 
         if not silent and self.verbose:
-            print(f"Synapse range, first {idx_b1}, last {idx_b2}")
+            print(f"Synapse rows {rows}")
             print(f"{synapses}")
 
         # Calculate coordinates
@@ -676,9 +1008,39 @@ class SnuddaLoad(object):
 
     ############################################################################
 
+    def get_neuron_column(self, column_name):
+
+        """
+        Returns array with an attribute of all neurons, e.g. "type", "name" or "neuronID". When lazy loading
+        the neuron columns are used, otherwise the values are collected from the neuron dictionaries.
+
+        Args:
+            column_name (str) : Name of neuron attribute
+        """
+
+        if "neuronColumns" in self.data:
+            column = self.data["neuronColumns"][column_name]
+
+            if column.dtype.kind == "S":
+                column = np.char.decode(column, "utf-8")
+
+            return column
+
+        return np.array([x[column_name] for x in self.data["neurons"]])
+
+    ############################################################################
+
     def get_neuron_types(self, neuron_id=None, return_set=False):
 
-        if neuron_id:
+        if "neuronColumns" in self.data:
+            neuron_types = self.data["neuronColumns"]["type"]
+
+            if neuron_id:
+                neuron_types = neuron_types[neuron_id]
+
+            neuron_types = neuron_types.tolist()
+
+        elif neuron_id:
             neuron_types = [self.data["neurons"][x]["type"] for x in neuron_id]
         else:
             neuron_types = [x["type"] for x in self.data["neurons"]]
@@ -708,7 +1070,8 @@ class SnuddaLoad(object):
 
         """
 
-        neuron_id = np.array([x["neuronID"] for x in self.data["neurons"] if x["type"] == neuron_type])
+        neuron_types = self.get_neuron_column("type")
+        neuron_id = self.get_neuron_column("neuronID")[neuron_types == neuron_type]
 
         assert not random_permute or num_neurons is not None, "random_permute is only valid when num_neurons is given"
 
@@ -732,7 +1095,7 @@ class SnuddaLoad(object):
                           f"neurons of type {neuron_type}")
 
         # Double check that all of the same type
-        assert np.array([self.data["neurons"][x]["type"] == neuron_type for x in neuron_id]).all()
+        assert (neuron_types[neuron_id] == neuron_type).all()
 
         return neuron_id
 
@@ -748,7 +1111,7 @@ class SnuddaLoad(object):
             List of neuron ID
         """
 
-        neuron_id = [x["neuronID"] for x in self.data["neurons"] if x["name"] == neuron_name]
+        neuron_id = list(self.get_neuron_column("neuronID")[self.get_neuron_column("name") == neuron_name])
 
         return neuron_id
 
@@ -784,6 +1147,45 @@ class SnuddaLoad(object):
     ############################################################################
 
 
+class SnuddaLazyNeurons(Sequence):
+
+    """
+    Read only list of neurons used by SnuddaLoad when lazy loading. The neuron data is kept as columns,
+    one array per attribute (see SnuddaLoad.extract_neuron_columns), and the dictionary of a neuron is
+    created when it is accessed (see SnuddaLoad.make_neuron_dict).
+    """
+
+    def __init__(self, columns):
+
+        """
+        Constructor
+
+        Args:
+            columns (OrderedDict) : Neuron data columns
+        """
+
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["neuronID"])
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, slice):
+            return [self[x] for x in range(*idx.indices(len(self)))]
+
+        if np.ndim(idx) > 0:
+            return [self[x] for x in idx]
+
+        if idx < 0:
+            idx += len(self)
+
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Neuron index {idx} out of range")
+
+        return SnuddaLoad.make_neuron_dict(self.columns, idx)
+
+
 def snudda_load_cli():
 
     """ Command line parser for SnuddaLoad script """
@@ -799,11 +1201,13 @@ def snudda_load_cli():
                         default=None)
     parser.add_argument("--listPre", help="List pre synaptic neurons",
                         type=int)
-    parser.add_argument("--listPost", help="List post synaptic neurons (slow)",
+    parser.add_argument("--listPost", help="List post synaptic neurons",
                         type=int)
     parser.add_argument("--keepOpen", help="This prevents loading of synapses to memory, and keeps HDF5 file open",
                         action="store_true")
     parser.add_argument("--detailed", help="More information", action="store_true")
+    parser.add_argument("--lazy", help="Lazy loading, neuron data is read as columns and synapses are memory mapped",
+                        action="store_true")
 
     args = parser.parse_args()
 
@@ -812,7 +1216,7 @@ def snudda_load_cli():
     else:
         load_synapses = True
 
-    nl = SnuddaLoad(args.networkFile, load_synapses=load_synapses)
+    nl = SnuddaLoad(args.networkFile, load_synapses=load_synapses, lazy=args.lazy)
 
     if args.listN:
         print("Neurons in network: ")
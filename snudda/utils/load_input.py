@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+import json
+from collections import OrderedDict
+
+import numpy as np
+import h5py
+
+from snudda.utils.load import SnuddaLoad
+from snudda.utils.snudda_path import snudda_parse_path
+
+
+class SnuddaLoadInput:
+
+    """
+    Reads input spike files written by SnuddaInput.
+
+    Two layouts are supported:
+
+    Compact layout (inputFormat = "csr"), written by SnuddaInput.write_hdf5:
+        inputTypes : names of all input types
+        neuronInput/ : one row per (neuron, input type) block, sorted by neuronID
+            neuronPtr : rows of neuron i are neuronPtr[i]:neuronPtr[i+1]
+            neuronID, inputType (index into inputTypes), conductance, populationUnitID
+            synapsePtr : synapses of block b are rows synapsePtr[b]:synapsePtr[b+1] of synapses/
+            spikeRow, numSpikeTrains : spike trains of block b are rows spikeRow[b]:spikeRow[b]+numSpikeTrains[b]
+                                       of spikes/<input type>/
+            infoID : row in info of the block
+            info : unique JSON strings with freq, start, end, correlation, jitter, synapseDensity, generator, modFile,
+                   parameterFile, parameterList, populationUnitSpikes (path to the shared spikes, or None)
+        synapses/ : one row per input synapse in the network, sectionID, sectionX, distanceToSoma, parameterID
+        spikes/<input type>/ : spikeTimes (concatenated float32 spike trains), spikePtr (offsets, one per train + 1)
+        populationUnitSpikes/<neuron type>/<input type>/<population unit> : shared population unit spikes
+
+    Old layout, input/<neuron id>/<input type>/ with a padded spikes matrix, nSpikes, sectionID, ... per group.
+
+    Virtual neurons have a single spike train, stored as input type "activity".
+    """
+
+    def __init__(self, input_file=None):
+
+        """
+        Constructor.
+
+        Args:
+            input_file (str): Path to input spike file
+        """
+
+        self.input_file_name = input_file
+        self.input_file = None
+        self.compact = None
+
+        self.input_types = None
+        self.neuron_ptr = None
+        self.block_neuron_id = None
+        self.block_input_type = None
+        self.synapse_ptr = None
+        self.spike_row = None
+        self.num_spike_trains = None
+        self.info_cache = dict()
+
+        # Block scalars and dataset handles, looking up datasets by name in h5py is slow
+        self.block_conductance = None
+        self.block_population_unit_id = None
+        self.block_info_id = None
+        self.dataset_cache = None
+
+        if input_file:
+            self.load()
+
+    def load(self, input_file=None):
+
+        """ Opens input_file, for the compact layout the (small) block index is read into memory. """
+
+        if input_file:
+            self.input_file_name = input_file
+
+        self.close()
+        self.input_file = h5py.File(snudda_parse_path(self.input_file_name), "r")
+        self.info_cache = dict()
+
+        self.compact = "inputFormat" in self.input_file \
+            and SnuddaLoad.to_str(self.input_file["inputFormat"][()]) == "csr"
+
+        if self.compact:
+            self.input_types = [SnuddaLoad.to_str(x) for x in self.input_file["inputTypes"][()]]
+
+            block_data = self.input_file["neuronInput"]
+            self.neuron_ptr = block_data["neuronPtr"][()]
+            self.block_neuron_id = block_data["neuronID"][()]
+            self.block_input_type = block_data["inputType"][()]
+            self.synapse_ptr = block_data["synapsePtr"][()]
+            self.spike_row = block_data["spikeRow"][()]
+            self.num_spike_trains = block_data["numSpikeTrains"][()]
+            self.block_conductance = block_data["conductance"][()]
+            self.block_population_unit_id = block_data["populationUnitID"][()]
+            self.block_info_id = block_data["infoID"][()]
+
+            self.dataset_cache = dict()
+            for name in ["sectionID", "sectionX", "distanceToSoma", "parameterID"]:
+                self.dataset_cache[name] = self.input_file["synapses"][name]
+
+            for input_type in self.input_types:
+                self.dataset_cache[input_type] = (self.input_file["spikes"][input_type]["spikePtr"],
+                                                  self.input_file["spikes"][input_type]["spikeTimes"])
+
+    def close(self):
+
+        if self.input_file:
+            self.input_file.close()
+            self.input_file = None
+
+    def get_config(self):
+
+        """ Returns the input config used to generate the input. """
+
+        return json.loads(self.input_file["config"][()], object_pairs_hook=OrderedDict)
+
+    def get_neuron_id(self):
+
+        """ Returns sorted array with the ID of all neurons that receive input. """
+
+        if self.compact:
+            return np.unique(self.block_neuron_id)
+
+        return np.sort(np.array([int(x) for x in self.input_file["input"].keys()], dtype=int))
+
+    def get_blocks(self, neuron_id):
+
+        """ Returns the block index of each input type of neuron_id (compact layout). """
+
+        if neuron_id + 1 >= len(self.neuron_ptr):
+            return OrderedDict()
+
+        return OrderedDict([(self.input_types[self.block_input_type[b]], b)
+                            for b in range(self.neuron_ptr[neuron_id], self.neuron_ptr[neuron_id + 1])])
+
+    def get_input_types(self, neuron_id):
+
+        """ Returns list with the input types of neuron_id. """
+
+        if self.compact:
+            return list(self.get_blocks(neuron_id).keys())
+
+        if str(neuron_id) not in self.input_file["input"]:
+            return []
+
+        return list(self.input_file["input"][str(neuron_id)].keys())
+
+    def get_input(self, neuron_id, input_type=None):
+
+        """
+        Returns OrderedDict with the input of neuron_id, one dictionary per input type. The spike trains
+        are returned as concatenated spike times (spikeTimes) and offsets (spikePtr), spike train i is
+        spikeTimes[spikePtr[i]:spikePtr[i+1]]. Times are in seconds.
+
+        Args:
+            neuron_id (int): Neuron ID
+            input_type (str, optional): Only return this input type
+        """
+
+        input_data = OrderedDict()
+
+        for inp_type in self.get_input_types(neuron_id):
+            if input_type is not None and inp_type != input_type:
+                continue
+
+            if self.compact:
+                input_data[inp_type] = self.get_block(self.get_blocks(neuron_id)[inp_type])
+            else:
+                input_data[inp_type] = self.get_group(self.input_file["input"][str(neuron_id)][inp_type])
+
+        return input_data
+
+    def get_block(self, block_idx):
+
+        """ Returns dictionary with the input of one (neuron, input type) block (compact layout). """
+
+        input_type = self.input_types[self.block_input_type[block_idx]]
+        info_id = self.block_info_id[block_idx]
+
+        # Parsing the parameter list is slow, and many blocks share the same info (and parameter list object)
+        if info_id not in self.info_cache:
+            self.info_cache[info_id] = json.loads(SnuddaLoad.to_str(self.input_file["neuronInput/info"][info_id]),
+                                                  object_pairs_hook=OrderedDict)
+
+        info = OrderedDict(self.info_cache[info_id])
+
+        spike_ptr_data, spike_times_data = self.dataset_cache[input_type]
+
+        spike_row = self.spike_row[block_idx]
+        spike_ptr = spike_ptr_data[spike_row:spike_row + self.num_spike_trains[block_idx] + 1]
+        spike_times = spike_times_data[spike_ptr[0]:spike_ptr[-1]]
+
+        syn_range = slice(self.synapse_ptr[block_idx], self.synapse_ptr[block_idx + 1])
+
+        data = OrderedDict()
+        data["spikeTimes"] = spike_times
+        data["spikePtr"] = spike_ptr - spike_ptr[0]
+        data["nSpikes"] = np.diff(spike_ptr)
+
+        for name in ["sectionID", "sectionX", "distanceToSoma", "parameterID"]:
+            data[name] = self.dataset_cache[name][syn_range]
+
+        data["conductance"] = self.block_conductance[block_idx]
+        data["populationUnitID"] = self.block_population_unit_id[block_idx]
+
+        population_unit_spikes = info.pop("populationUnitSpikes", None)
+        data.update(info)
+
+        if population_unit_spikes is not None:
+            data["populationUnitSpikes"] = self.input_file[population_unit_spikes][()]
+        else:
+            data["populationUnitSpikes"] = np.array([])
+
+        return data
+
+    @staticmethod
+    def get_group(input_group):
+
+        """ Returns dictionary with the input in input_group (old layout). """
+
+        data = OrderedDict()
+
+        spikes = input_group["spikes"][()]
+
+        if "nSpikes" in input_group:
+            if spikes.size == 0:
+                # No input synapses
+                num_spikes = np.zeros((0,), dtype=int)
+            else:
+                num_spikes = input_group["nSpikes"][()]
+
+            spikes = np.atleast_2d(spikes)
+            data["spikeTimes"] = np.concatenate([spikes[idx, :n] for idx, n in enumerate(num_spikes)] + [[]])
+        else:
+            # Virtual neuron activity, a single spike train
+            num_spikes = np.array([spikes.size])
+            data["spikeTimes"] = spikes.ravel()
+
+        data["spikePtr"] = np.concatenate([[0], np.cumsum(num_spikes)]).astype(int)
+        data["nSpikes"] = num_spikes
+
+        for name, value in input_group.items():
+            if name in ["spikes", "nSpikes"]:
+                continue
+
+            value = value[()]
+
+            if isinstance(value, bytes):
+                value = SnuddaLoad.to_str(value)
+
+            if name == "parameterList":
+                value = json.loads(value, object_pairs_hook=OrderedDict)
+
+            data[name] = value
+
+        return data
+
+    def get_spike_trains(self, neuron_id, input_type):
+
+        """ Returns list with the spike trains (in seconds) of input_type to neuron_id. """
+
+        data = self.get_input(neuron_id=neuron_id, input_type=input_type)[input_type]
+
+        return [data["spikeTimes"][start:end] for start, end in zip(data["spikePtr"][:-1], data["spikePtr"][1:])]
+
+    def get_spike_matrix(self, neuron_id, input_type):
+
+        """ Returns spike trains of input_type to neuron_id as a matrix, one row per spike train, padded with -1. """
+
+        data = self.get_input(neuron_id=neuron_id, input_type=input_type)[input_type]
+
+        num_spikes = data["nSpikes"]
+        spike_mat = -1 * np.ones((len(num_spikes), max(np.max(num_spikes, initial=0), 1)))
+
+        row_idx = np.repeat(np.arange(len(num_spikes)), num_spikes)
+        col_idx = np.arange(np.sum(num_spikes)) - np.repeat(data["spikePtr"][:-1], num_spikes)
+        spike_mat[row_idx, col_idx] = data["spikeTimes"]
+
+        return spike_mat
+
+    def get_virtual_neuron_spikes(self, neuron_id):
+
+        """ Returns the spike train of the virtual neuron neuron_id. """
+
+        return self.get_input(neuron_id=neuron_id, input_type="activity")["activity"]["spikeTimes"]
+
+    def get_input_count(self, num_neurons):
+
+        """
+        Returns the number of input synapses and the number of input spikes for each neuron. The spikes
+        of virtual neurons are counted, but they have no input synapses.
+
+        Args:
+            num_neurons (int): Number of neurons in the network
+        """
+
+        num_input_synapses = np.zeros((num_neurons,), dtype=int)
+        num_input_spikes = np.zeros((num_neurons,), dtype=int)
+
+        if self.compact:
+            np.add.at(num_input_synapses, self.block_neuron_id, np.diff(self.synapse_ptr))
+
+            for type_idx, input_type in enumerate(self.input_types):
+                block_idx = np.where(self.block_input_type == type_idx)[0]
+
+                if len(block_idx) == 0:
+                    continue
+
+                spike_ptr = self.input_file["spikes"][input_type]["spikePtr"][()]
+                block_spikes = spike_ptr[self.spike_row[block_idx] + self.num_spike_trains[block_idx]] \
+                    - spike_ptr[self.spike_row[block_idx]]
+                np.add.at(num_input_spikes, self.block_neuron_id[block_idx], block_spikes)
+        else:
+            for neuron_id_str, neuron_input in self.input_file["input"].items():
+                for input_type, input_info in neuron_input.items():
+                    if "nSpikes" in input_info:
+                        num_input_synapses[int(neuron_id_str)] += input_info["spikes"].shape[0]
+                        num_input_spikes[int(neuron_id_str)] += np.sum(input_info["nSpikes"][()])
+                    else:
+                        num_input_spikes[int(neuron_id_str)] += input_info["spikes"].size
+
+        return num_input_synapses, num_input_spikes
+
+    def get_num_inputs(self, neuron_id):
+
+        """ Returns the total number of input synapses to neuron_id. """
+
+        if self.compact:
+            blocks = np.array(list(self.get_blocks(neuron_id).values()), dtype=int)
+            return int(np.sum(self.synapse_ptr[blocks + 1] - self.synapse_ptr[blocks]))
+
+        num_inputs = 0
+        for input_type, input_info in self.input_file["input"][str(neuron_id)].items():
+            if "nSpikes" in input_info:
+                num_inputs += input_info["spikes"].shape[0]
+
+        return num_inputs
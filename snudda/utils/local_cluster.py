@@ -0,0 +1,360 @@
+import atexit
+import builtins
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+# Namespace of the worker process, the commands sent by execute run in it (the engine's "globals")
+_engine_namespace = dict()
+
+
+def _engine_execute(cmd_str):
+
+    """ Runs cmd_str in the worker namespace. """
+
+    exec(cmd_str, _engine_namespace)
+
+
+def _engine_push(ns):
+
+    """ Assigns the values in ns to the names (keys) in the worker namespace, names can be e.g. "sd.hyper_voxels". """
+
+    try:
+        for name, value in ns.items():
+            _engine_namespace["_local_push_value"] = value
+            exec(f"{name} = _local_push_value", _engine_namespace)
+    finally:
+        _engine_namespace.pop("_local_push_value", None)
+
+
+def _engine_pull(name):
+
+    """ Returns the value of name (an expression) in the worker namespace. """
+
+    return eval(name, _engine_namespace)
+
+
+def _engine_apply(f, args, kwargs):
+
+    """ Calls f on the worker, arguments that are a LocalReference are replaced by their value on the worker. """
+
+    args = [_engine_pull(x.name) if isinstance(x, LocalReference) else x for x in args]
+    kwargs = dict([(k, _engine_pull(v.name) if isinstance(v, LocalReference) else v) for k, v in kwargs.items()])
+
+    return f(*args, **kwargs)
+
+
+def parse_local_parallel(parallel):
+
+    """
+    Returns the number of local workers requested by parallel, or None if local workers are not requested.
+
+    Args:
+        parallel: Parallel option (--localWorkers on the command line), "local" uses all cores, "local:N" uses N workers
+    """
+
+    if not isinstance(parallel, str) or not (parallel == "local" or parallel.startswith("local:")):
+        return None
+
+    if parallel == "local":
+        return os.cpu_count()
+
+    n_workers = int(parallel.split(":")[1])
+    assert n_workers > 0, f"parse_local_parallel: Number of workers must be positive ({parallel})"
+
+    return n_workers
+
+
+class LocalReference(object):
+
+    """ Reference to a variable on the workers, the local equivalent of ipyparallel.Reference. """
+
+    def __init__(self, name):
+        self.name = name
+
+
+class LocalAsyncResult(object):
+
+    """ Result of a call to one or more workers, mimics the ipyparallel AsyncResult methods used by Snudda. """
+
+    def __init__(self, futures, single=False):
+
+        self.futures = futures
+        self.single = single
+
+    def get(self, timeout=None):
+
+        """ Waits for the workers, and returns their results (raises the worker's exception if one failed). """
+
+        result = [f.result(timeout=timeout) for f in self.futures]
+
+        if self.single:
+            return result[0] if len(result) > 0 else None
+
+        return result
+
+    def wait(self, timeout=None):
+        for f in self.futures:
+            f.exception(timeout=timeout)
+
+    def ready(self):
+        return all([f.done() for f in self.futures])
+
+    def add_done_callback(self, fn):
+
+        """ Calls fn(self) when all workers are done. """
+
+        remaining = [len(self.futures)]
+
+        def _done(future):
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                fn(self)
+
+        for f in self.futures:
+            f.add_done_callback(_done)
+
+
+class LocalClient(object):
+
+    """
+    Local replacement for ipyparallel.Client, runs the workers as processes on this machine, no ipcluster needed.
+
+    Each worker is a single process ProcessPoolExecutor, so that variables (e.g. the worker's SnuddaDetect object)
+    persist between calls, like on an ipyparallel engine. Only the parts of the ipyparallel API that Snudda uses
+    are implemented (direct_view, push, pull, scatter, gather, execute, apply_async, sync_imports).
+
+    Since the workers receive the same data and random seeds as ipyparallel engines, the result is the same as
+    when running with the same number of ipyparallel engines.
+
+    The workers are started with "spawn", scripts creating a LocalClient need an if __name__ == "__main__" guard.
+
+    Example:
+        rc = LocalClient(n_workers=4)
+        sd = SnuddaDetect(network_path=network_path, rc=rc)
+        sd.detect()
+        rc.shutdown()
+    """
+
+    def __init__(self, n_workers=None):
+
+        """
+        Constructor.
+
+        Args:
+            n_workers (int, optional): Number of worker processes, default is the number of cores
+        """
+
+        if n_workers is None:
+            n_workers = os.cpu_count()
+
+        # Spawn, not fork, the master might have threads running (e.g. callbacks of the futures)
+        mp_context = multiprocessing.get_context("spawn")
+        self.engines = [ProcessPoolExecutor(max_workers=1, mp_context=mp_context) for _ in range(0, n_workers)]
+
+        # Objects cleaning up their worker variables in __del__ (e.g. SnuddaDetect) might be deleted after the
+        # executors are closed at exit, without workers the cleanup does nothing
+        atexit.register(self.shutdown)
+
+    @property
+    def ids(self):
+        return list(range(0, len(self.engines)))
+
+    def __len__(self):
+        return len(self.engines)
+
+    def __getitem__(self, key):
+
+        """ View of a single worker (int), or a list of workers. """
+
+        if isinstance(key, slice):
+            return LocalView(self, self.ids[key])
+
+        return LocalView(self, key)
+
+    def direct_view(self, targets="all"):
+
+        """ View of the workers, "all" for all workers. """
+
+        if isinstance(targets, str) and targets == "all":
+            targets = self.ids
+
+        return LocalView(self, targets)
+
+    def shutdown(self, hub=False):
+
+        """ Stops the worker processes, after this all views of the client have no workers. """
+
+        for engine in self.engines:
+            engine.shutdown(wait=True)
+
+        self.engines = []
+
+
+class LocalView(object):
+
+    """ View of one or more workers of a LocalClient, mimics ipyparallel DirectView. """
+
+    def __init__(self, client, targets):
+
+        self.client = client
+        self.single = isinstance(targets, (int, np.integer))
+        self.targets = [targets] if self.single else list(targets)
+
+    def __len__(self):
+        return len(self.get_engines())
+
+    def get_engines(self):
+
+        # Shut down clients have no workers
+        if len(self.client.engines) == 0:
+            return []
+
+        return [self.client.engines[x] for x in self.targets]
+
+    def submit(self, fn, *args):
+
+        return LocalAsyncResult([engine.submit(fn, *args) for engine in self.get_engines()], single=self.single)
+
+    def finish(self, result, block):
+
+        if block:
+            return result.get()
+
+        return result
+
+    ############################################################################
+
+    def execute(self, cmd_str, block=False):
+
+        """ Runs cmd_str on the workers. """
+
+        result = self.submit(_engine_execute, cmd_str)
+
+        if block:
+            result.get()
+            return None
+
+        return result
+
+    def push(self, ns, block=False):
+
+        """ Assigns the variables in the dictionary ns on all workers. """
+
+        result = self.submit(_engine_push, ns)
+
+        if block:
+            result.get()
+            return None
+
+        return result
+
+    def pull(self, name, block=True):
+
+        """ Returns the value of name from the workers (a list, unless the view is for a single worker). """
+
+        return self.finish(self.submit(_engine_pull, name), block=block)
+
+    def __getitem__(self, name):
+        return self.pull(name, block=True)
+
+    def scatter(self, name, seq, block=False):
+
+        """ Partitions seq between the workers, same partitioning as ipyparallel, each worker gets a list. """
+
+        engines = self.get_engines()
+        num_elements = len(seq)
+        futures = []
+
+        for idx, engine in enumerate(engines):
+            lo = idx * (num_elements // len(engines)) + min(idx, num_elements % len(engines))
+            hi = lo + num_elements // len(engines) + (idx < num_elements % len(engines))
+
+            part = seq[lo:hi] if isinstance(seq, (np.ndarray, list)) else list(seq)[lo:hi]
+            futures.append(engine.submit(_engine_push, {name: part}))
+
+        result = LocalAsyncResult(futures)
+
+        if block:
+            result.get()
+            return None
+
+        return result
+
+    def gather(self, name, block=True):
+
+        """ Pulls name from the workers and joins the parts, same as ipyparallel gather. """
+
+        parts = self.submit(_engine_pull, name).get()
+
+        if len(parts) == 0:
+            return []
+
+        if isinstance(parts[0], np.ndarray):
+            return np.concatenate(parts)
+
+        if isinstance(parts[0], (list, tuple)):
+            return [x for part in parts for x in part]
+
+        return parts
+
+    def apply_async(self, f, *args, **kwargs):
+
+        """ Calls f(*args, **kwargs) on the workers, ipyparallel.Reference arguments are resolved on the worker. """
+
+        args = [self.convert_reference(x) for x in args]
+        kwargs = dict([(k, self.convert_reference(v)) for k, v in kwargs.items()])
+
+        return self.submit(_engine_apply, f, args, kwargs)
+
+    def apply_sync(self, f, *args, **kwargs):
+        return self.apply_async(f, *args, **kwargs).get()
+
+    @staticmethod
+    def convert_reference(value):
+
+        # An ipyparallel.Reference can only exist if ipyparallel has been imported
+        ipp = sys.modules.get("ipyparallel")
+
+        if ipp is not None and isinstance(value, ipp.Reference):
+            return LocalReference(value.name)
+
+        return value
+
+    @contextmanager
+    def sync_imports(self):
+
+        """
+        Context manager, imports inside the with block are also done on the workers.
+
+        Example:
+            with d_view.sync_imports():
+                from snudda.detect.detect import SnuddaDetect
+        """
+
+        local_import = builtins.__import__
+
+        # Frame with the with statement (0 is this generator, 1 is contextmanager's __enter__)
+        caller_globals = sys._getframe(2).f_globals
+
+        def view_import(name, globals=None, locals=None, fromlist=(), level=0):
+
+            # Only the import statements of the with block, not the imports they trigger
+            if globals is caller_globals and level == 0:
+                if fromlist:
+                    self.execute(f"from {name} import {', '.join(fromlist)}", block=True)
+                else:
+                    self.execute(f"import {name}", block=True)
+
+            return local_import(name, globals, locals, fromlist, level)
+
+        builtins.__import__ = view_import
+
+        try:
+            yield
+        finally:
+            builtins.__import__ = local_import
@@ -8,41 +8,83 @@ from neuron import h  # , gui
 
 class SnuddaSaveNetworkActivity:
 
-    def __init__(self, output_file, network_data=None):
+    def __init__(self, output_file, network_data=None, chunk_size=10000):
+
+        """ Constructor
+
+        Args:
+            output_file : path to network output file
+            network_data : network data, as loaded by SnuddaLoad (optional, used for meta data)
+            chunk_size : chunk length of the extendable datasets written by write_window
+        """
 
         self.output_file = output_file
         self.network_data = network_data
+        self.chunk_size = chunk_size
+
+        # Each rank appends its time windows to its own file, see write_window
+        self.rank_file = None
 
         self.pc = h.ParallelContext()
 
     def spike_sort(self, t_spikes, id_spikes):
 
-        spike_count = dict()
+        """ Splits spike times by neuron ID, returns dictionary with an array of spike times for each neuron. """
+
+        t_spikes = np.array(t_spikes, dtype=float)
+        id_spikes = np.array(id_spikes, dtype=float)
+
+        if len(id_spikes) == 0:
+            return dict()
+
+        # Stable sort keeps the spikes of each neuron in time order
+        sort_idx = np.argsort(id_spikes, kind="stable")
+        unique_id, start_idx = np.unique(id_spikes[sort_idx], return_index=True)
+
+        return dict(zip(unique_id, np.split(t_spikes[sort_idx], start_idx[1:])))
+
+    def write_meta_data(self, out_file):
 
-        for t, idx in zip(t_spikes, id_spikes):
-            if idx in spike_count:
-                spike_count[idx] += 1
-            else:
-                spike_count[idx] = 1
+        """ Creates the metaData, voltData and spikeData groups in out_file, and writes the neuron meta data. """
 
-        spikes = dict()
-        spike_ctr = dict()
+        meta_data = out_file.create_group("metaData")
+        out_file.create_group("voltData")
+        out_file.create_group("spikeData")
 
-        for idx, num in spike_count.items():
-            spikes[idx] = np.full((num,), np.nan)  # Initialise to NaN to catch any unassigned values
-            spike_ctr[idx] = 0
+        if self.network_data:
+            neuron_id = np.array([x["neuronID"] for x in self.network_data["neurons"]])
+            meta_data.create_dataset("ID", data=neuron_id)
 
-        for t, idx in zip(t_spikes, id_spikes):
-            spikes[idx][spike_ctr[idx]] = t
-            spike_ctr[idx] += 1
+            neuron_names = [x["name"] for x in self.network_data["neurons"]]
+            str_type = 'S' + str(max(1, max([len(x) for x in neuron_names])))
+            meta_data.create_dataset("name", (len(neuron_names),), str_type, neuron_names, compression="gzip")
 
-        # Internal consistency
-        for idx in spikes:
-            assert len(spikes[idx]) == 0 or not np.isnan(spikes[idx][-1])
-            assert (idx in spike_ctr and spikes[idx].shape[0] == spike_ctr[idx]) \
-                or (idx not in spike_ctr and len(spikes[idx]) == 0)
+            neuron_types = [x["type"] for x in self.network_data["neurons"]]
+            str_type = 'S' + str(max(1, max([len(x) for x in neuron_types])))
+            meta_data.create_dataset("type", (len(neuron_names),), str_type, neuron_names, compression="gzip")
 
-        return spikes
+            swc_list = [n["morphology"] for n in self.network_data["neurons"]]
+            max_swc_len = max([len(x) for x in swc_list])
+            meta_data.create_dataset("morphology", (len(swc_list),), f"S{max_swc_len}",
+                                     swc_list, compression="gzip")
+
+            parameter_keys = [n["parameterKey"] for n in self.network_data["neurons"]]
+            parameter_key_length = max([len(x) for x in parameter_keys])
+            meta_data.create_dataset("parameterKey", (len(parameter_keys),), f"S{parameter_key_length}",
+                                     parameter_keys, compression="gzip")
+
+            morphology_keys = [n["morphologyKey"] for n in self.network_data["neurons"]]
+            morphology_key_length = max(1, max([len(x) for x in morphology_keys]))
+            meta_data.create_dataset("morphologyKey", (len(morphology_keys),), f"S{morphology_key_length}",
+                                     morphology_keys, compression="gzip")
+
+            modulation_keys = [n["modulationKey"] for n in self.network_data["neurons"]]
+            modulation_key_length = max(1, max([len(x) for x in modulation_keys]))
+            meta_data.create_dataset("modulationKey", (len(modulation_keys),), f"S{modulation_key_length}",
+                                     modulation_keys, compression="gzip")
+
+            meta_data.create_dataset("populationUnit", data=self.network_data["populationUnit"], compression="gzip")
+            meta_data.create_dataset("position", data=self.network_data["neuronPositions"], compression="gzip")
 
     def write(self, t_save, v_save, v_key, t_spikes, id_spikes, output_file=None):
 
@@ -69,44 +111,7 @@ class SnuddaSaveNetworkActivity:
             print(f"Writing network output to {output_file}")
             out_file = h5py.File(output_file, "w")
 
-            meta_data = out_file.create_group("metaData")
-            out_file.create_group("voltData")
-            out_file.create_group("spikeData")
-
-            if self.network_data:
-                neuron_id = np.array([x["neuronID"] for x in self.network_data["neurons"]])
-                meta_data.create_dataset("ID", data=neuron_id)
-
-                neuron_names = [x["name"] for x in self.network_data["neurons"]]
-                str_type = 'S' + str(max(1, max([len(x) for x in neuron_names])))
-                meta_data.create_dataset("name", (len(neuron_names),), str_type, neuron_names, compression="gzip")
-
-                neuron_types = [x["type"] for x in self.network_data["neurons"]]
-                str_type = 'S' + str(max(1, max([len(x) for x in neuron_types])))
-                meta_data.create_dataset("type", (len(neuron_names),), str_type, neuron_names, compression="gzip")
-
-                swc_list = [n["morphology"] for n in self.network_data["neurons"]]
-                max_swc_len = max([len(x) for x in swc_list])
-                meta_data.create_dataset("morphology", (len(swc_list),), f"S{max_swc_len}",
-                                         swc_list, compression="gzip")
-
-                parameter_keys = [n["parameterKey"] for n in self.network_data["neurons"]]
-                parameter_key_length = max([len(x) for x in parameter_keys])
-                meta_data.create_dataset("parameterKey", (len(parameter_keys),), f"S{parameter_key_length}",
-                                         parameter_keys, compression="gzip")
-
-                morphology_keys = [n["morphologyKey"] for n in self.network_data["neurons"]]
-                morphology_key_length = max(1, max([len(x) for x in morphology_keys]))
-                meta_data.create_dataset("morphologyKey", (len(morphology_keys),), f"S{morphology_key_length}",
-                                         morphology_keys, compression="gzip")
-
-                modulation_keys = [n["modulationKey"] for n in self.network_data["neurons"]]
-                modulation_key_length = max(1, max([len(x) for x in modulation_keys]))
-                meta_data.create_dataset("modulationKey", (len(modulation_keys),), f"S{modulation_key_length}",
-                                         modulation_keys, compression="gzip")
-
-                meta_data.create_dataset("populationUnit", data=self.network_data["populationUnit"], compression="gzip")
-                meta_data.create_dataset("position", data=self.network_data["neuronPositions"], compression="gzip")
+            self.write_meta_data(out_file)
 
             out_file.close()
 
@@ -146,6 +151,133 @@ class SnuddaSaveNetworkActivity:
 
             self.pc.barrier()
 
+    def get_rank_file_name(self, rank=None, output_file=None):
+
+        """ Returns name of the file holding the time windows written by rank (default current rank). """
+
+        if not output_file:
+            output_file = self.output_file
+
+        if rank is None:
+            rank = int(self.pc.id())
+
+        base_name, ext = os.path.splitext(output_file)
+        return f"{base_name}-rank-{rank}{ext}"
+
+    def append_data(self, group, name, data):
+
+        """ Appends data to the extendable dataset name in group, the dataset is created if it does not exist. """
+
+        if name not in group:
+            group.create_dataset(name, data=data, maxshape=(None,), chunks=(self.chunk_size,), compression="gzip")
+        elif len(data) > 0:
+            dataset = group[name]
+            old_size = dataset.shape[0]
+            dataset.resize((old_size + len(data),))
+            dataset[old_size:] = data
+
+    def write_window(self, t_save, v_save, v_key, t_spikes, id_spikes):
+
+        """ Appends one time window of recorded data to the rank file of this worker. No synchronisation
+            between workers is needed, each rank only writes to its own file. The rank files are combined
+            into the network output file by write_virtual once the simulation is done.
+
+        Args:
+            t_save : array with time (of this window)
+            v_save : list of arrays with voltage (of this window)
+            v_key : neuron_id of voltage data
+            t_spikes : spike times (of this window)
+            id_spikes : neuron_id of spike times
+        """
+
+        if self.rank_file is None:
+            rank_file_name = self.get_rank_file_name()
+
+            if not os.path.isdir(os.path.dirname(rank_file_name)):
+                os.makedirs(os.path.dirname(rank_file_name), exist_ok=True)
+
+            self.rank_file = h5py.File(rank_file_name, "w")
+            self.rank_file.create_group("voltData")
+            self.rank_file.create_group("spikeData")
+
+        if t_save is not None and len(t_save) > 0 and v_key:
+            self.append_data(self.rank_file["voltData"], "time", np.array(t_save) * 1e-3)
+
+            for neuron_id, voltage in zip(v_key, v_save):
+                self.append_data(self.rank_file["voltData"], str(neuron_id), np.array(voltage) * 1e-3)
+
+        spikes = self.spike_sort(t_spikes=t_spikes, id_spikes=id_spikes)
+
+        for idx, spike_times in spikes.items():
+            self.append_data(self.rank_file["spikeData"], f"{idx:.0f}", spike_times * 1e-3)
+
+        self.rank_file.flush()
+
+    def close_window_file(self):
+
+        """ Closes the rank file written to by write_window. """
+
+        if self.rank_file is not None:
+            self.rank_file.close()
+            self.rank_file = None
+
+    def write_virtual(self, output_file=None, merge_rank_files=False):
+
+        """ Combines the rank files written by write_window into output_file, with the same layout as write.
+            Must be called on all workers.
+
+        Args:
+            output_file : network output file (optional)
+            merge_rank_files : if False the voltage and spike datasets are virtual datasets referencing the
+                               rank files (which must be kept next to the output file), if True the data is
+                               copied into output_file and the rank files are removed
+        """
+
+        if not output_file:
+            output_file = self.output_file
+
+        self.close_window_file()
+        self.pc.barrier()
+
+        if int(self.pc.id()) == 0:
+
+            print(f"Writing network output to {output_file}")
+
+            rank_file_list = [self.get_rank_file_name(rank=rank) for rank in range(int(self.pc.nhost()))]
+
+            with h5py.File(output_file, "w") as out_file:
+                self.write_meta_data(out_file)
+
+                for rank_file_name in rank_file_list:
+                    if not os.path.isfile(rank_file_name):
+                        continue
+
+                    # Relative path, so the network directory can be moved together with its rank files
+                    source_name = os.path.relpath(rank_file_name, os.path.dirname(os.path.abspath(output_file)))
+
+                    with h5py.File(rank_file_name, "r") as rank_file:
+                        for group_name in ["voltData", "spikeData"]:
+                            for name, dataset in rank_file[group_name].items():
+
+                                # All ranks record the same time points, only keep the first one
+                                if name in out_file[group_name]:
+                                    continue
+
+                                if merge_rank_files:
+                                    rank_file.copy(dataset, out_file[group_name], name=name)
+                                else:
+                                    layout = h5py.VirtualLayout(shape=dataset.shape, dtype=dataset.dtype)
+                                    layout[:] = h5py.VirtualSource(source_name, f"{group_name}/{name}",
+                                                                   shape=dataset.shape)
+                                    out_file[group_name].create_virtual_dataset(name, layout)
+
+            if merge_rank_files:
+                for rank_file_name in rank_file_list:
+                    if os.path.isfile(rank_file_name):
+                        os.remove(rank_file_name)
+
+        self.pc.barrier()
+
     def write_currents(self, t_save, i_save, pre_id, post_id, section_id=None, section_x=None, output_file=None):
 
         """ This adds currents to an already existing hdf5 output file.
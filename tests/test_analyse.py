@@ -0,0 +1,196 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+import scipy.sparse as sps
+
+from snudda.analyse import SnuddaAnalyse
+from snudda.utils.load import SnuddaLoad
+
+
+class AnalyseTestCase(unittest.TestCase):
+
+    @staticmethod
+    def get_analyse(connection_matrix, positions=None):
+
+        # Skip __init__, the tests only need the connection matrix and the positions
+        sa = object.__new__(SnuddaAnalyse)
+        sa.debug = False
+        sa.connection_matrix = sps.csr_matrix(connection_matrix)
+
+        if positions is None:
+            positions = np.zeros((connection_matrix.shape[0], 3))
+
+        sa.positions = positions
+
+        return sa
+
+    @staticmethod
+    def get_synthetic_network(num_neurons=20, num_pairs=60, rng=None):
+
+        """ Returns synapse matrix sorted on (post, pre), with several synapses per connected pair """
+
+        if rng is None:
+            rng = np.random.default_rng(1234)
+
+        pair_key = rng.choice(num_neurons * num_neurons, num_pairs, replace=False)
+        num_syn = rng.integers(1, 6, num_pairs)
+
+        synapses = np.zeros((np.sum(num_syn), 13), dtype=np.int32)
+        synapses[:, 0] = np.repeat(pair_key % num_neurons, num_syn)    # pre
+        synapses[:, 1] = np.repeat(pair_key // num_neurons, num_syn)   # post
+        synapses[:, 6] = rng.integers(1, 3, synapses.shape[0])         # synapse type
+        synapses[:, 8] = rng.integers(0, 300, synapses.shape[0])       # dendrite distance to soma
+
+        sort_idx = np.lexsort(synapses[:, [0, 1]].T)
+
+        return synapses[sort_idx, :]
+
+    def get_analyse_synapses(self, synapses, num_neurons, file_hash="network-hash",
+                             hdf5_file_name="network-synapses.hdf5", save_cache=False):
+
+        sa = self.get_analyse(sps.csr_matrix((num_neurons, num_neurons)))
+        sa.num_neurons = num_neurons
+        sa.network = {"nSynapses": synapses.shape[0]}
+        sa.file_hash = file_hash
+        sa.connection_matrix_cache = dict()
+        sa.hdf5_file_name = hdf5_file_name
+        sa.save_cache = save_cache
+
+        # Skip __init__, no network file is opened (SnuddaLoad.__del__ closes hdf5_file)
+        sa.network_load = object.__new__(SnuddaLoad)
+        sa.network_load.hdf5_file = None
+        sa.network_load.data = {"synapses": synapses}
+
+        return sa
+
+    def test_create_connection_matrix(self):
+
+        num_neurons = 20
+        synapses = self.get_synthetic_network(num_neurons=num_neurons)
+        sa = self.get_analyse_synapses(synapses, num_neurons)
+
+        for chunk_size in [1000, 3]:
+            for filters in [dict(), dict(syn_type=2), dict(min_dend_dist=100, max_dend_dist=200)]:
+                with self.subTest(chunk_size=chunk_size, filters=filters):
+                    con_mat = sa.create_connection_matrix(chunk_size=chunk_size, **filters)
+                    ref_mat = sa.create_connection_matrix_python(chunk_size=chunk_size, **filters)
+
+                    self.assertTrue(ref_mat.nnz > 0)
+                    self.assertEqual((con_mat != ref_mat).nnz, 0)
+
+        with self.subTest(stage="synapse count"):
+            con_mat = sa.create_connection_matrix(chunk_size=3)
+            self.assertEqual(con_mat.sum(), synapses.shape[0])
+
+    def test_connection_matrix_cache(self):
+
+        num_neurons = 20
+        synapses = self.get_synthetic_network(num_neurons=num_neurons)
+        filters = dict(syn_type=2, min_dend_dist=100)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            network_file = os.path.join(temp_dir, "network-synapses.hdf5")
+            cache_file = network_file + "-cache"
+
+            # get_connection_matrix adds the matrix to an existing cache file
+            h5py.File(cache_file, "w").close()
+
+            sa = self.get_analyse_synapses(synapses, num_neurons, hdf5_file_name=network_file,
+                                           save_cache=True)
+            con_mat = sa.get_connection_matrix(**filters)
+            self.assertEqual((con_mat != sa.create_connection_matrix(**filters)).nnz, 0)
+
+            with self.subTest(stage="reuse_cache"):
+                sa2 = self.get_analyse_synapses(synapses, num_neurons)
+
+                with h5py.File(cache_file, "r") as f:
+                    sa2.read_connection_matrix_cache(f)
+
+                with mock.patch.object(sa2, "create_connection_matrix") as create_mock:
+                    self.assertEqual((sa2.get_connection_matrix(**filters) != con_mat).nnz, 0)
+                    create_mock.assert_not_called()
+
+                    # Other filters are not in the cache
+                    sa2.get_connection_matrix(syn_type=2)
+                    create_mock.assert_called_once()
+
+            with self.subTest(stage="changed_file_hash"):
+                sa3 = self.get_analyse_synapses(synapses, num_neurons, file_hash="modified-network-hash")
+
+                with h5py.File(cache_file, "r") as f:
+                    sa3.read_connection_matrix_cache(f)
+
+                self.assertEqual(len(sa3.connection_matrix_cache), 0)
+
+                with mock.patch.object(sa3, "create_connection_matrix", return_value=con_mat) as create_mock:
+                    sa3.get_connection_matrix(**filters)
+                    create_mock.assert_called_once()
+
+    def test_count_motifs_exact(self):
+
+        # Random graph with self connections and reciprocal connections
+        num_neurons = 15
+        rng = np.random.default_rng(1234)
+        con_mat = (rng.random((num_neurons, num_neurons)) < 0.3).astype(int)
+        np.fill_diagonal(con_mat, rng.random(num_neurons) < 0.5)
+        self.assertTrue(np.sum(con_mat * con_mat.T) > np.trace(con_mat) > 0)
+
+        sa = self.get_analyse(con_mat)
+        sa.populations = {"A": np.arange(0, 10), "B": np.arange(5, 15), "C": np.arange(0, 15)}
+
+        for type_a, type_b, type_c in [("A", "A", "A"), ("A", "B", "C"), ("C", "A", "B"), ("B", "C", "A")]:
+
+            # Brute force, enumerate all triples of distinct neurons
+            ref_ctr = np.zeros((64,), dtype=int)
+            for a in sa.populations[type_a]:
+                for b in sa.populations[type_b]:
+                    for c in sa.populations[type_c]:
+                        if a == b or b == c or a == c:
+                            continue
+
+                        ref_ctr[con_mat[a, b] + 2 * con_mat[b, a] + 4 * con_mat[a, c]
+                                + 8 * con_mat[c, a] + 16 * con_mat[b, c] + 32 * con_mat[c, b]] += 1
+
+            for num_workers, block_size in [(None, 1000), (None, 3), (2, 4)]:
+                with self.subTest(types=(type_a, type_b, type_c), num_workers=num_workers, block_size=block_size):
+                    motif_ctr, _, _, _ = sa.count_motifs_exact(type_a, type_b, type_c,
+                                                               num_workers=num_workers, block_size=block_size)
+                    self.assertTrue((motif_ctr == ref_ctr).all())
+
+    def test_connection_probability_sampling(self):
+
+        # All pre synaptic neurons at origo, post synaptic neuron i is placed in distance bin i
+        num_pre, num_post, num_bins = 1000, 10, 86
+        delta_dist = 1700e-6 / (num_bins - 1)
+
+        positions = np.zeros((num_pre + num_post, 3))
+        positions[num_pre:, 0] = (np.arange(num_post) + 0.5) * delta_dist
+
+        sa = self.get_analyse(sps.csr_matrix((num_pre + num_post, num_pre + num_post)), positions=positions)
+
+        pre_id = np.arange(num_pre)
+        post_id = np.arange(num_pre, num_pre + num_post)
+
+        # 9.5 points per pre neuron samples all post neurons, 1.5 only a subset
+        for num_per_pre in [9.5, 1.5]:
+            with self.subTest(num_per_pre=num_per_pre):
+                dist, p_con, count_con, count_all = \
+                    sa.connection_probability(pre_id=pre_id, post_id=post_id, num_bins=num_bins,
+                                              num_points=num_per_pre * num_pre,
+                                              rng=np.random.default_rng(1234), batch_size=1000)
+
+                post_count = count_all[:num_post, 0]
+                expected_count = num_per_pre * num_pre / num_post
+
+                # Rows using fewer points must not always skip the last post synaptic neurons
+                self.assertAlmostEqual(np.sum(post_count), num_per_pre * num_pre, delta=0.05 * num_per_pre * num_pre)
+                self.assertTrue((np.abs(post_count - expected_count) < 0.15 * expected_count).all(),
+                                f"Sample count per post neuron {post_count}, expected {expected_count}")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,30 @@ class TestCLI(unittest.TestCase):
     def test_0_basics(self):
         self.assertRaises(argparse.ArgumentError, run_cli_command, "doesntexist")
 
+    def test_parallel_args(self):
+
+        from unittest import mock
+        from snudda.core import Snudda
+
+        actions = {"place": "place_neurons", "detect": "touch_detection",
+                   "prune": "prune_synapses", "input": "setup_input"}
+
+        for action, method_name in actions.items():
+            for command, parallel in [(f"{action} --parallel my_network", True),
+                                      (f"{action} my_network --parallel", True),
+                                      (f"{action} my_network", False),
+                                      (f"{action} --localWorkers 3 my_network", "local:3"),
+                                      (f"{action} --localWorkers 0 my_network", "local")]:
+                with self.subTest(command=command), \
+                        mock.patch.object(Snudda, method_name) as action_method, \
+                        mock.patch("snudda.cli.BenchmarkLogging"):
+
+                    run_cli_command(command)
+
+                    args = action_method.call_args[0][0]
+                    self.assertEqual(args.path, "my_network")
+                    self.assertEqual(args.parallel, parallel)
+
     def test_workflow(self):
 
         #with self.subTest(stage="create"):
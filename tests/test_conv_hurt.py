@@ -0,0 +1,94 @@
+import os
+import unittest
+
+import h5py
+import numpy as np
+
+from snudda.utils.conv_hurt import ConvHurt
+
+
+class ConvHurtTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        os.chdir(os.path.dirname(__file__))
+
+        self.base_dir = os.path.join("networks", "conv_hurt_test") + os.sep
+        self.ch = ConvHurt(simulation_structure="Striatum", input_structures=[], base_dir=self.base_dir)
+
+        # Every target has at least 4 edges, so a chunk size of 3 splits the edges of each target
+        rng = np.random.default_rng(1234)
+        num_edges_per_target = rng.integers(4, 10, 20)
+        self.target_id = np.repeat(np.arange(len(num_edges_per_target)), num_edges_per_target)
+        num_edges = len(self.target_id)
+
+        self.source_id = rng.integers(0, 20, num_edges)
+        self.edge_group = rng.integers(0, 2, num_edges)
+        self.edge_group_index = np.arange(num_edges)
+        self.edge_type_id = rng.integers(0, 3, num_edges)
+        self.data = {"sec_id": rng.integers(0, 100, num_edges),
+                     "sec_x": rng.uniform(size=num_edges),
+                     "syn_weight": rng.uniform(size=num_edges)}
+
+    def edge_chunks(self, chunk_size):
+
+        for start_idx in range(0, len(self.target_id), chunk_size):
+            idx = slice(start_idx, start_idx + chunk_size)
+            yield self.edge_group[idx], self.edge_group_index[idx], self.edge_type_id[idx], \
+                self.source_id[idx], self.target_id[idx], {k: v[idx] for k, v in self.data.items()}
+
+    def read_all_datasets(self, group):
+
+        all_data = dict()
+        group.visititems(lambda name, obj: all_data.update({name: obj[()]}) if isinstance(obj, h5py.Dataset) else None)
+        return all_data
+
+    def test_write_edges_chunks(self):
+
+        ref_file = "edges-reference.hdf5"
+        chunk_file = "edges-chunks.hdf5"
+
+        self.ch.write_edges(edge_file=ref_file, edge_population_name="Striatum",
+                            edge_group=self.edge_group, edge_group_index=self.edge_group_index,
+                            edge_type_id=self.edge_type_id, source_id=self.source_id, target_id=self.target_id,
+                            data=self.data)
+
+        self.ch.write_edges_chunks(edge_file=chunk_file, edge_population_name="Striatum",
+                                   edge_chunks=self.edge_chunks(chunk_size=3), chunk_size=3)
+
+        with h5py.File(os.path.join(self.ch.network_dir, ref_file), "r") as f_ref, \
+                h5py.File(os.path.join(self.ch.network_dir, chunk_file), "r") as f_chunk:
+
+            ref_data = self.read_all_datasets(f_ref)
+            chunk_data = self.read_all_datasets(f_chunk)
+
+            self.assertEqual(set(ref_data.keys()), set(chunk_data.keys()))
+
+            for name in ref_data:
+                with self.subTest(dataset=name):
+                    self.assertTrue(np.array_equal(ref_data[name], chunk_data[name]))
+
+    def test_create_index(self):
+
+        index_file = os.path.join(self.ch.network_dir, "edges-index.hdf5")
+
+        with h5py.File(index_file, "w") as f:
+            f.create_dataset("source_node_id", data=self.source_id)
+            f.create_dataset("target_node_id", data=self.target_id)
+
+            for node_ids, index_source in [("source_node_id", True), ("target_node_id", False)]:
+                with self.subTest(node_ids=node_ids):
+                    self.ch.create_index(f[node_ids], f.require_group("chunks"),
+                                         index_source=index_source, chunk_size=3)
+                    self.ch.create_index_python(f[node_ids], f.require_group("reference"),
+                                                index_source=index_source)
+
+            self.assertEqual(self.read_all_datasets(f["chunks"]).keys(), self.read_all_datasets(f["reference"]).keys())
+
+            for name, values in self.read_all_datasets(f["reference"]).items():
+                with self.subTest(dataset=name):
+                    self.assertTrue(np.array_equal(f["chunks"][name][()], values))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import unittest
+
+import h5py
+import numpy as np
+
+from snudda.utils.cut import SnuddaCut
+
+
+class CutTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        os.chdir(os.path.dirname(__file__))
+
+        self.network_path = os.path.join("networks", "network_testing_cut")
+        self.config_file = os.path.join(self.network_path, "network-config.json")
+        self.position_file = os.path.join(self.network_path, "network-neuron-positions.hdf5")
+        self.save_file = os.path.join(self.network_path, "voxels", "network-putative-synapses.hdf5")
+        self.network_file = os.path.join(self.network_path, "network-synapses.hdf5")
+
+        from snudda.init.init import SnuddaInit
+        cell_spec = os.path.join(os.path.dirname(__file__), "validation")
+        cnc = SnuddaInit(struct_def={}, config_file=self.config_file, random_seed=1234)
+        cnc.define_striatum(num_dSPN=10, num_iSPN=0, num_FS=10, num_LTS=0, num_ChIN=0,
+                            volume_type="cube", neurons_dir=cell_spec)
+        cnc.write_json(self.config_file)
+
+        from snudda.place.place import SnuddaPlace
+        npn = SnuddaPlace(config_file=self.config_file, log_file=None, verbose=True, d_view=None,
+                          h5libver="latest")
+        npn.parse_config()
+        npn.write_data(self.position_file)
+
+        from snudda.detect.detect import SnuddaDetect
+        sd = SnuddaDetect(config_file=self.config_file, position_file=self.position_file,
+                          save_file=self.save_file, rc=None, hyper_voxel_size=120, verbose=True)
+        sd.detect(restart_detection_flag=True)
+
+        from snudda.detect.prune import SnuddaPrune
+        sp = SnuddaPrune(network_path=self.network_path, config_file=None)
+        sp.prune()
+
+    def test_cut(self):
+
+        cut_file = os.path.join(self.network_path, "network-cut-slice.hdf5")
+
+        with h5py.File(self.network_file, "r") as f:
+            neuron_pos = f["network/neurons/position"][()]
+            synapses = f["network/synapses"][()]
+            gap_junctions = f["network/gapJunctions"][()]
+            voxel_size = f["meta/voxelSize"][()]
+            sim_origo = f["meta/simulationOrigo"][()]
+
+        z_cut = np.median(neuron_pos[:, 2])
+
+        sc = SnuddaCut(network_file=self.network_file, cut_equation=f"z>{z_cut}", out_file_name=cut_file,
+                       show_plot=False)
+        sc.out_file.close()
+
+        # Reference: neurons with soma above the cut, and synapses above the cut between them
+        keep_id = np.where(neuron_pos[:, 2] > z_cut)[0]
+        remap_id = np.full((neuron_pos.shape[0],), -1)
+        remap_id[keep_id] = np.arange(len(keep_id))
+
+        with h5py.File(cut_file, "r") as f:
+
+            with self.subTest(stage="neurons"):
+                self.assertTrue((f["network/neurons/neuronID"][()] == np.arange(len(keep_id))).all())
+                self.assertTrue((f["network/neurons/position"][()] == neuron_pos[keep_id, :]).all())
+
+            for data_type, syn_mat, pos_cols in [("synapses", synapses, slice(2, 5)),
+                                                 ("gapJunctions", gap_junctions, slice(6, 9))]:
+                with self.subTest(stage=data_type):
+                    syn_z = (syn_mat[:, pos_cols] * voxel_size + sim_origo)[:, 2]
+                    keep = np.logical_and(syn_z > z_cut,
+                                          np.logical_and(np.isin(syn_mat[:, 0], keep_id),
+                                                         np.isin(syn_mat[:, 1], keep_id)))
+
+                    ref_mat = syn_mat[keep, :].copy()
+                    ref_mat[:, 0:2] = remap_id[ref_mat[:, 0:2]]
+
+                    self.assertTrue(np.array_equal(f[f"network/{data_type}"][()], ref_mat))
+
+            self.assertEqual(f["network/nSynapses"][0], f["network/synapses"].shape[0])
+            self.assertEqual(f["network/nGapJunctions"][0], f["network/gapJunctions"].shape[0])
+
+        # Writing in small chunks gives the same result
+        with self.subTest(stage="chunks"), \
+                h5py.File(self.network_file, "r") as in_file, \
+                h5py.File(os.path.join(self.network_path, "network-cut-chunks.hdf5"), "w") as out_file:
+
+            SnuddaCut.write_network_subset(in_file=in_file, out_file=out_file, keep_neuron_id=keep_id,
+                                           chunk_size=7)
+
+            ref_mat = synapses[np.logical_and(np.isin(synapses[:, 0], keep_id),
+                                              np.isin(synapses[:, 1], keep_id)), :].copy()
+            ref_mat[:, 0:2] = remap_id[ref_mat[:, 0:2]]
+
+            self.assertTrue(np.array_equal(out_file["network/synapses"][()], ref_mat))
+
+            if "synapseRowPtr" in out_file["network"]:
+                self.assertTrue((out_file["network/synapseRowPtr"][()]
+                                 == np.append(0, np.cumsum(np.bincount(ref_mat[:, 1],
+                                                                       minlength=len(keep_id))))).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -155,6 +155,34 @@ class TestDetect(unittest.TestCase):
         self.assertTrue((self.sd.hyper_voxel_synapses >= 0).all())
         self.assertTrue((self.sd.hyper_voxel_gap_junctions >= 0).all())
 
+        with self.subTest(stage="numba_python_identical_check"):
+            hyper_id = self.sd.hyper_voxel_id
+            synapses = dict()
+
+            for use_numba in [True, False]:
+                self.sd.hyper_voxel_rng = np.random.default_rng(self.sd.hyper_voxels[hyper_id]["randomSeed"])
+                self.sd.hyper_voxel_synapse_ctr = 0
+                synapses[use_numba] = self.sd.detect_synapses(use_numba=use_numba).copy()
+
+            self.assertEqual(synapses[True].shape[0], 101)
+            self.assertTrue((synapses[True] == synapses[False]).all())
+
+        with self.subTest(stage="sparse_voxel_storage_check"):
+            dense_synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :].copy()
+            dense_gap_junctions = self.sd.hyper_voxel_gap_junctions[:self.sd.hyper_voxel_gap_junction_ctr, :].copy()
+
+            self.sd.voxel_storage = "sparse"
+            self.sd.detect(restart_detection_flag=True)
+            self.sd.voxel_storage = "dense"
+
+            self.assertEqual(self.sd.voxel_overflow_counter, 0)
+            self.assertEqual(self.sd.hyper_voxel_synapse_ctr, dense_synapses.shape[0])
+            self.assertEqual(self.sd.hyper_voxel_gap_junction_ctr, dense_gap_junctions.shape[0])
+            self.assertTrue((self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :]
+                             == dense_synapses).all())
+            self.assertTrue((self.sd.hyper_voxel_gap_junctions[:self.sd.hyper_voxel_gap_junction_ctr, :]
+                             == dense_gap_junctions).all())
+
         with self.subTest(stage="resiz_matrix_check"):
             old = self.sd.hyper_voxel_synapses.copy()
             self.sd.resize_hyper_voxel_synapses_matrix()
@@ -180,6 +208,144 @@ class TestDetect(unittest.TestCase):
 
         print("Checking detect done.")
 
+    def test_detect_gap_junctions_vectorised(self):
+
+        self.sd.detect(restart_detection_flag=True)
+
+        # Fill part of the hyper voxel with random dendrites, to get many gap junction candidates
+        rng = np.random.default_rng(1234)
+        num_neurons = len(self.sd.neurons)
+
+        self.sd.dend_voxel_ctr[:] = 0
+        self.sd.dend_voxel_ctr[:20, :20, :20] = rng.integers(0, 6, size=(20, 20, 20))
+        self.sd.dend_voxels[:20, :20, :20, :6] = rng.integers(0, num_neurons, size=(20, 20, 20, 6))
+        self.sd.dend_sec_id[:20, :20, :20, :6] = rng.integers(0, 50, size=(20, 20, 20, 6))
+        self.sd.dend_sec_x[:20, :20, :20, :6] = rng.random(size=(20, 20, 20, 6))
+
+        hyper_id = self.sd.hyper_voxel_id
+        gap_junctions = dict()
+
+        for vectorised in [True, False]:
+            self.sd.hyper_voxel_rng = np.random.default_rng(self.sd.hyper_voxels[hyper_id]["randomSeed"])
+            self.sd.hyper_voxel_gap_junction_ctr = 0
+            gap_junctions[vectorised] = self.sd.detect_gap_junctions(vectorised=vectorised).copy()
+
+        num_pairs = np.sum(self.sd.dend_voxel_ctr * (self.sd.dend_voxel_ctr - 1) // 2)
+        self.assertEqual(gap_junctions[True].shape[0], num_pairs)
+        self.assertTrue((gap_junctions[True] == gap_junctions[False]).all())
+
+    def test_hyper_voxel_order_and_neuron_cache(self):
+
+        # 4 x 4 x 4 hyper voxels, IDs are not in spatial order
+        rng = np.random.default_rng(1234)
+        self.sd.hyper_voxel_id_lookup = rng.permutation(64).reshape((4, 4, 4))
+
+        sorted_id = self.sd.sort_remaining_spatially(np.arange(0, 64))
+        self.assertEqual(sorted(sorted_id), list(range(0, 64)))
+
+        # Morton order: every group of 8 consecutive hyper voxels forms a 2 x 2 x 2 block
+        for block_start in range(0, 64, 8):
+            block = [np.argwhere(self.sd.hyper_voxel_id_lookup == x)[0] for x in sorted_id[block_start:block_start+8]]
+            self.assertEqual(len(set([tuple(x // 2) for x in block])), 1)
+
+        self.sd.neuron_cache_size = 2
+        self.sd.neuron_cache.clear()
+
+        neuron_a = self.sd.load_placed_neuron(0)
+        self.sd.load_placed_neuron(1)
+        self.assertIs(self.sd.load_placed_neuron(0), neuron_a)
+        self.sd.load_placed_neuron(2)  # Evicts neuron 1, the least recently used
+
+        self.assertEqual(list(self.sd.neuron_cache.keys()), [0, 2])
+        self.assertEqual(self.sd.neuron_cache_hits, 1)
+        self.assertEqual(self.sd.neuron_cache_misses, 3)
+        self.assertTrue((neuron_a.soma == self.sd.load_neuron(self.sd.neurons[0]).soma).all())
+
+    def test_hyper_voxel_parts(self):
+
+        self.sd.hyper_voxel_parts = 4
+        self.sd.detect(restart_detection_flag=True)
+
+        neuron_ctr = dict([(hid, self.sd.hyper_voxels[hid]["neuronCtr"]) for hid in self.sd.hyper_voxels])
+        hyper_id = max(neuron_ctr, key=neuron_ctr.get)
+
+        self.sd.process_hyper_voxel(hyper_id)
+        synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :].copy()
+        gap_junctions = self.sd.hyper_voxel_gap_junctions[:self.sd.hyper_voxel_gap_junction_ctr, :].copy()
+
+        with self.subTest(stage="split_and_merge_identical"):
+            part_lists = [[0], [1, 2], [3]]
+
+            for part_list in part_lists:
+                self.sd.process_hyper_voxel(hyper_id, part_list=part_list)
+                self.assertTrue(os.path.isfile(self.sd.get_hyper_voxel_file_name(hyper_id, part_list)))
+
+            self.sd.merge_hyper_voxel_parts(hyper_id, part_lists)
+
+            self.assertTrue(self.sd.hyper_voxel_synapse_ctr > 0)
+            self.assertEqual(self.sd.hyper_voxel_synapse_ctr, synapses.shape[0])
+            self.assertTrue((self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :] == synapses).all())
+            self.assertTrue((self.sd.hyper_voxel_gap_junctions[:self.sd.hyper_voxel_gap_junction_ctr, :]
+                             == gap_junctions).all())
+
+            for part_list in part_lists:
+                self.assertFalse(os.path.isfile(self.sd.get_hyper_voxel_file_name(hyper_id, part_list)))
+
+        with self.subTest(stage="neuron_cache_parts"):
+            # The neurons are kept in the cache until the last part, so each neuron is placed at most once
+            self.sd.neuron_cache.clear()
+            self.sd.neuron_cache_remaining = None
+            self.sd.neuron_cache_misses = 0
+
+            for part_list in part_lists:
+                self.sd.process_hyper_voxel(hyper_id, part_list=part_list)
+
+            self.sd.merge_hyper_voxel_parts(hyper_id, part_lists)
+
+            self.assertTrue(0 < self.sd.neuron_cache_misses <= neuron_ctr[hyper_id])
+            self.assertTrue(all([self.sd.neuron_cache_remaining[x] > 0 for x in self.sd.neuron_cache]))
+
+        with self.subTest(stage="part_fills_own_slab"):
+            self.sd.process_hyper_voxel(hyper_id, part_list=[1])
+            os.remove(self.sd.get_hyper_voxel_file_name(hyper_id, [1]))
+
+            x_start, x_end = self.sd.get_hyper_voxel_fill_range()
+            self.assertTrue(0 < x_start < x_end < self.sd.num_bins[0])
+
+            for voxel_ctr in [self.sd.axon_voxel_ctr, self.sd.dend_voxel_ctr]:
+                self.assertTrue(voxel_ctr[x_start:x_end, :, :].any())
+                self.assertFalse(voxel_ctr[:x_start, :, :].any())
+                self.assertFalse(voxel_ctr[x_end:, :, :].any())
+
+            # Neurons that do not reach the slab are not placed
+            hyper_voxel_neurons = self.sd.hyper_voxels[hyper_id]["neurons"][:neuron_ctr[hyper_id]]
+            self.assertFalse(all([self.sd.neuron_in_fill_range(x) for x in hyper_voxel_neurons]))
+
+        with self.subTest(stage="merge_overflow_counter"):
+            # Too small voxels, so the hyper voxel overflows. Each part fills its own slab,
+            # so the merged hyper voxel should have the same overflow count as when processed at once
+            self.sd.max_axon, self.sd.max_dend = 1, 1
+            self.sd.axon_voxels, self.sd.dend_voxels = None, None
+
+            self.sd.process_hyper_voxel(hyper_id)
+            voxel_overflow_counter = self.sd.voxel_overflow_counter
+            self.assertTrue(voxel_overflow_counter > 0)
+
+            for part_list in part_lists:
+                self.sd.process_hyper_voxel(hyper_id, part_list=part_list)
+
+            self.sd.merge_hyper_voxel_parts(hyper_id, part_lists)
+            self.assertEqual(self.sd.voxel_overflow_counter, voxel_overflow_counter)
+
+        with self.subTest(stage="plan_jobs"):
+            # A single hyper voxel, with two workers it should be split in two
+            job_list = self.sd.plan_hyper_voxel_jobs([hyper_id], n_workers=2)
+            self.assertEqual([x[1] for x in job_list], [[0, 1], [2, 3]])
+
+            self.sd.hyper_voxel_parts = 1
+            job_list = self.sd.plan_hyper_voxel_jobs([hyper_id], n_workers=2)
+            self.assertEqual([x[1] for x in job_list], [None])
+
     def check_neuron_pair_has_synapse(self, pre_neuron, post_neuron):
 
         connections = dict()
@@ -205,6 +371,47 @@ class TestDetect(unittest.TestCase):
     def compare_voxels_to_coordinates(self, voxel_index, coordinates):
         return (np.abs(self.convert_to_coordinates(voxel_index) - np.array(coordinates)) < self.sd.voxel_size).all()
 
+    def test_detect_local_parallel(self):
+
+        import h5py
+        from snudda.utils.local_cluster import LocalClient
+
+        def read_hyper_voxel_files(sd):
+            data = dict()
+            for hyper_id in sd.hyper_voxels:
+                if not os.path.isfile(sd.get_hyper_voxel_file_name(hyper_id)):
+                    # Hyper voxels without neurons are skipped
+                    continue
+
+                with h5py.File(sd.get_hyper_voxel_file_name(hyper_id), "r") as f:
+                    data[hyper_id] = (f["network/synapses"][()], f["network/gapJunctions"][()])
+            return data
+
+        self.sd.detect(restart_detection_flag=True)
+        serial_data = read_hyper_voxel_files(self.sd)
+
+        for file_name in [self.sd.get_hyper_voxel_file_name(x) for x in serial_data]:
+            os.remove(file_name)
+
+        rc = LocalClient(n_workers=2)
+
+        try:
+            sd_local = SnuddaDetect(config_file=self.sd.config_file, position_file=self.sd.position_file,
+                                    save_file=self.sd.save_file, rc=rc,
+                                    hyper_voxel_size=130, verbose=True)
+            sd_local.detect(restart_detection_flag=True)
+            local_data = read_hyper_voxel_files(sd_local)
+        finally:
+            rc.shutdown()
+
+        self.assertEqual(serial_data.keys(), local_data.keys())
+        self.assertTrue(sum([x[0].shape[0] for x in serial_data.values()]) > 0)
+
+        for hyper_id in serial_data:
+            with self.subTest(hyper_id=hyper_id):
+                self.assertTrue((serial_data[hyper_id][0] == local_data[hyper_id][0]).all())
+                self.assertTrue((serial_data[hyper_id][1] == local_data[hyper_id][1]).all())
+
     def test_detect_lines(self):
 
         # Cases to test
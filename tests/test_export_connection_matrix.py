@@ -0,0 +1,137 @@
+import os
+import unittest
+
+import h5py
+import numpy as np
+import scipy.sparse
+
+from snudda.utils.export_connection_matrix import SnuddaExportConnectionMatrix
+from snudda.utils.export_eroded_connection_matrix import SnuddaExportErodedConnectionMatrix
+
+
+class ExportConnectionMatrixTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        os.chdir(os.path.dirname(__file__))
+
+        self.network_path = os.path.join("networks", "network_testing_export_con_mat")
+        self.config_file = os.path.join(self.network_path, "network-config.json")
+        self.position_file = os.path.join(self.network_path, "network-neuron-positions.hdf5")
+        self.save_file = os.path.join(self.network_path, "voxels", "network-putative-synapses.hdf5")
+        self.network_file = os.path.join(self.network_path, "network-synapses.hdf5")
+
+        from snudda.init.init import SnuddaInit
+        cell_spec = os.path.join(os.path.dirname(__file__), "validation")
+        cnc = SnuddaInit(struct_def={}, config_file=self.config_file, random_seed=1234)
+        cnc.define_striatum(num_dSPN=10, num_iSPN=0, num_FS=10, num_LTS=0, num_ChIN=0,
+                            volume_type="cube", neurons_dir=cell_spec)
+        cnc.write_json(self.config_file)
+
+        from snudda.place.place import SnuddaPlace
+        npn = SnuddaPlace(config_file=self.config_file, log_file=None, verbose=True, d_view=None,
+                          h5libver="latest")
+        npn.parse_config()
+        npn.write_data(self.position_file)
+
+        from snudda.detect.detect import SnuddaDetect
+        sd = SnuddaDetect(config_file=self.config_file, position_file=self.position_file,
+                          save_file=self.save_file, rc=None, hyper_voxel_size=120, verbose=True)
+        sd.detect(restart_detection_flag=True)
+
+        from snudda.detect.prune import SnuddaPrune
+        sp = SnuddaPrune(network_path=self.network_path, config_file=None)
+        sp.prune()
+
+    def test_export(self):
+
+        npz_file = os.path.join(self.network_path, "con-mat.npz")
+        hdf5_file = os.path.join(self.network_path, "con-mat.hdf5")
+        sparse_csv_file = os.path.join(self.network_path, "con-mat-sparse.csv")
+        dense_csv_file = os.path.join(self.network_path, "con-mat-dense.csv")
+
+        secm = SnuddaExportConnectionMatrix(in_file=self.network_file, out_file=npz_file, save_type_pairs=True,
+                                            chunk_size=7)
+        ref_mat = secm.create_con_mat_python()
+        num_neurons = ref_mat.shape[0]
+
+        self.assertTrue(np.sum(ref_mat) > 0)
+
+        with self.subTest(stage="npz"):
+            self.assertTrue((scipy.sparse.load_npz(npz_file).toarray() == ref_mat).all())
+
+            neuron_type = np.array(secm.neuron_type)
+            for pre_type in set(secm.neuron_type):
+                for post_type in set(secm.neuron_type):
+                    type_pair_file = os.path.join(self.network_path, f"con-mat-{pre_type}-{post_type}.npz")
+                    sub_mat = ref_mat[neuron_type == pre_type, :][:, neuron_type == post_type]
+                    self.assertTrue((scipy.sparse.load_npz(type_pair_file).toarray() == sub_mat).all())
+
+        with self.subTest(stage="hdf5"):
+            SnuddaExportConnectionMatrix(in_file=self.network_file, out_file=hdf5_file, save_type_pairs=True)
+
+            with h5py.File(hdf5_file, "r") as f:
+                con_mat = SnuddaExportConnectionMatrix.read_csr_group(f["connectionMatrix"])
+                self.assertTrue((con_mat.toarray() == ref_mat).all())
+
+                for pair_group in f["typePairs"].values():
+                    sub_mat = ref_mat[pair_group["preID"][()], :][:, pair_group["postID"][()]]
+                    self.assertTrue((SnuddaExportConnectionMatrix.read_csr_group(pair_group).toarray()
+                                     == sub_mat).all())
+
+        with self.subTest(stage="sparse_csv"):
+            SnuddaExportConnectionMatrix(in_file=self.network_file, out_file=sparse_csv_file, save_sparse=True)
+            sparse_data = np.loadtxt(sparse_csv_file, delimiter=",", dtype=int, ndmin=2)
+            con_mat = scipy.sparse.coo_matrix((sparse_data[:, 2], (sparse_data[:, 0], sparse_data[:, 1])),
+                                              shape=(num_neurons, num_neurons))
+            self.assertTrue((con_mat.toarray() == ref_mat).all())
+
+        with self.subTest(stage="dense_csv"):
+            SnuddaExportConnectionMatrix(in_file=self.network_file, out_file=dense_csv_file, save_sparse=False)
+            self.assertTrue((np.loadtxt(dense_csv_file, delimiter=",", dtype=int) == ref_mat).all())
+
+        with self.subTest(stage="csv_type_pairs"):
+            with self.assertRaises(AssertionError):
+                SnuddaExportConnectionMatrix(in_file=self.network_file, out_file=sparse_csv_file,
+                                             save_type_pairs=True)
+
+    def test_export_eroded_permuted(self):
+
+        sparse_csv_file = os.path.join(self.network_path, "con-mat-permuted.csv")
+
+        np.random.seed(1234)
+        seecm = SnuddaExportErodedConnectionMatrix(in_file=self.network_file, out_file=sparse_csv_file,
+                                                   fraction_kept=1.0, permute=True)
+        ref_mat = seecm.create_con_mat_python()
+
+        # Same permutations as in permute_all
+        np.random.seed(1234)
+        np.random.uniform(size=seecm.con_mat.nnz)
+        row_permute = np.random.permutation(ref_mat.shape[0])
+        col_permute = np.random.permutation(ref_mat.shape[1])
+
+        self.assertTrue(seecm.con_mat.has_sorted_indices)
+        self.assertTrue((seecm.con_mat.toarray() == ref_mat[row_permute, :][:, col_permute]).all())
+
+        # Rows written in (src, dest) order
+        sparse_data = np.loadtxt(sparse_csv_file, delimiter=",", dtype=int, ndmin=2)
+        self.assertTrue((np.lexsort(sparse_data[:, [1, 0]].T) == np.arange(sparse_data.shape[0])).all())
+
+        with self.subTest(stage="permute_all"):
+            mat = scipy.sparse.random(50, 50, density=0.3, format="csr", random_state=1234)
+
+            np.random.seed(1234)
+            perm_mat = SnuddaExportErodedConnectionMatrix.permute_all(mat)
+
+            np.random.seed(1234)
+            row_permute = np.random.permutation(mat.shape[0])
+            col_permute = np.random.permutation(mat.shape[1])
+
+            self.assertTrue(perm_mat.has_sorted_indices)
+            self.assertTrue(all((np.diff(perm_mat.indices[perm_mat.indptr[i]:perm_mat.indptr[i + 1]]) > 0).all()
+                                for i in range(perm_mat.shape[0])))
+            self.assertTrue((perm_mat.toarray() == mat.toarray()[row_permute, :][:, col_permute]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
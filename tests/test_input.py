@@ -7,6 +7,7 @@ import numpy as np
 from snudda.detect.detect import SnuddaDetect
 from snudda.input.input import SnuddaInput
 from snudda.detect.prune import SnuddaPrune
+from snudda.utils.load_input import SnuddaLoadInput
 
 
 class InputTestCase(unittest.TestCase):
@@ -63,28 +64,30 @@ class InputTestCase(unittest.TestCase):
                          time=input_time, verbose=True)
         si.generate()
 
-        input_data = h5py.File(spike_file, 'r')
-        config_data = json.loads(input_data["config"][()])
+        input_data = SnuddaLoadInput(spike_file)
+        config_data = input_data.get_config()
 
         # TODO: Add checks
 
         # Loop through all inputs, and verify them
 
-        for neuron_id_str in input_data["input"].keys():
-            neuron_id = int(neuron_id_str)
+        for neuron_id in input_data.get_neuron_id():
+            neuron_id_str = str(neuron_id)
             neuron_name = si.network_data["neurons"][neuron_id]["name"]
             neuron_type = neuron_name.split("_")[0]
 
             # Check frequency is as advertised...
-            for input_type in input_data["input"][neuron_id_str]:
-                input_info = input_data["input"][neuron_id_str][input_type]
+            for input_type, input_info in input_data.get_input(neuron_id).items():
 
-                start_time = input_info["start"][()].copy()
-                end_time = input_info["end"][()].copy()
-                freq = input_info["freq"][()].copy()
-                spikes = input_info["spikes"][()]
+                start_time = np.array(input_info["start"])
+                end_time = np.array(input_info["end"])
+                freq = np.array(input_info["freq"])
+                spikes = input_data.get_spike_matrix(neuron_id, input_type)
                 n_traces = spikes.shape[0]
 
+                self.assertEqual(n_traces, len(input_info["sectionID"]))
+                self.assertEqual(n_traces, len(input_info["parameterID"]))
+
                 if "nInputs" in config_data[neuron_type][input_type]:
                     if "clusterSize" in config_data[neuron_type][input_type]:
                         cluster_size = config_data[neuron_type][input_type]["clusterSize"]
@@ -94,24 +97,16 @@ class InputTestCase(unittest.TestCase):
                     print(f"Checking number of inputs is {config_data[neuron_type][input_type]['nInputs']} * {cluster_size}")
                     self.assertEqual(config_data[neuron_type][input_type]["nInputs"]*cluster_size, n_traces)
 
-                max_len = 1
-                if type(start_time) is np.ndarray:
-                    max_len = np.maximum(max_len, len(start_time))
-
-                if type(end_time) is np.ndarray:
-                    max_len = np.maximum(max_len, len(end_time))
-
-                if type(freq) is np.ndarray:
-                    max_len = np.maximum(max_len, len(freq))
+                max_len = max(start_time.size, end_time.size, freq.size)
 
-                if type(start_time) != np.ndarray:
-                    start_time = np.array([start_time]*max_len)
+                if start_time.size == 1:
+                    start_time = np.full((max_len,), start_time.item())
 
-                if type(end_time) != np.ndarray:
-                    end_time = np.array([end_time]*max_len)
+                if end_time.size == 1:
+                    end_time = np.full((max_len,), end_time.item())
 
-                if type(freq) != np.ndarray:
-                    freq = np.array([freq]*max_len)
+                if freq.size == 1:
+                    freq = np.full((max_len,), freq.item())
 
                 for st, et, f in zip(start_time, end_time, freq):
                     idx_x, idx_y = np.where(np.logical_and(st <= spikes, spikes <= et))
@@ -122,6 +117,126 @@ class InputTestCase(unittest.TestCase):
                     self.assertTrue(f_gen > f - 4*np.sqrt(f)/np.sqrt(n_traces))
                     self.assertTrue(f_gen < f + 4*np.sqrt(f)/np.sqrt(n_traces))
 
+    def test_correlated_spikes_batch(self):
+
+        si = SnuddaInput(hdf5_network_file=self.network_file, time=10)
+
+        num_spike_trains = 500
+
+        for freq, time_range, p_keep, jitter_dt in [(20, (0, 10), 0.0, None),
+                                                    (20, (0, 10), 0.3, None),
+                                                    (20, (1, 10), 0.3, 0.01),
+                                                    ([10, 40], ([0, 5], [3, 10]), 0.5, None)]:
+
+            with self.subTest(freq=freq, time_range=time_range, p_keep=p_keep, jitter_dt=jitter_dt):
+
+                population_unit_spikes = si.generate_spikes(freq=freq, time_range=time_range,
+                                                            rng=np.random.default_rng(1234))
+
+                spike_trains = si.make_correlated_spikes(freq=freq, time_range=time_range,
+                                                         num_spike_trains=num_spike_trains, p_keep=p_keep,
+                                                         rng=np.random.default_rng(5678),
+                                                         population_unit_spikes=population_unit_spikes,
+                                                         jitter_dt=jitter_dt)
+
+                # Same seed gives the same spikes
+                spike_trains2 = si.make_correlated_spikes(freq=freq, time_range=time_range,
+                                                          num_spike_trains=num_spike_trains, p_keep=p_keep,
+                                                          rng=np.random.default_rng(5678),
+                                                          population_unit_spikes=population_unit_spikes,
+                                                          jitter_dt=jitter_dt)
+
+                self.assertEqual(len(spike_trains), num_spike_trains)
+                self.assertTrue(all([np.array_equal(a, b) for a, b in zip(spike_trains, spike_trains2)]))
+                self.assertTrue(all([(np.diff(st) >= 0).all() for st in spike_trains]))
+
+                # Compare mean spike count with the reference implementation
+                spike_trains_ref = si.make_correlated_spikes_python(freq=freq, time_range=time_range,
+                                                                    num_spike_trains=num_spike_trains,
+                                                                    p_keep=p_keep,
+                                                                    rng=np.random.default_rng(5678),
+                                                                    population_unit_spikes=population_unit_spikes,
+                                                                    jitter_dt=jitter_dt)
+
+                num_spikes = np.array([len(st) for st in spike_trains])
+                num_spikes_ref = np.array([len(st) for st in spike_trains_ref])
+                std_error = np.sqrt(np.mean(num_spikes) / num_spike_trains)
+
+                self.assertTrue(abs(np.mean(num_spikes) - np.mean(num_spikes_ref)) < 6 * std_error)
+
+                # Without jitter, the fraction of population unit spikes in each train is p_keep on average
+                if jitter_dt is None:
+                    num_shared = np.array([np.sum(np.isin(st, population_unit_spikes)) for st in spike_trains])
+                    p_shared = np.sum(num_shared) / (num_spike_trains * len(population_unit_spikes))
+                    self.assertTrue(abs(p_shared - p_keep) < 0.02)
+
+    def test_load_input_old_format(self):
+
+        input_config = os.path.join(self.network_path, "input-test-1.json")
+        spike_file = os.path.join(self.network_path, "input-spikes.hdf5")
+        old_spike_file = os.path.join(self.network_path, "input-spikes-old-format.hdf5")
+
+        si = SnuddaInput(input_config_file=input_config,
+                         hdf5_network_file=self.network_file,
+                         spike_data_filename=spike_file,
+                         time=5, verbose=True)
+        si.generate()
+
+        input_data = SnuddaLoadInput(spike_file)
+
+        # Write the same input using the old layout, one group per neuron and input type
+        with h5py.File(old_spike_file, "w") as f:
+            f.create_dataset("config", data=json.dumps(input_data.get_config()))
+            input_group = f.create_group("input")
+
+            for neuron_id in input_data.get_neuron_id():
+                nid_group = input_group.create_group(str(neuron_id))
+
+                for input_type, input_info in input_data.get_input(neuron_id).items():
+                    it_group = nid_group.create_group(input_type)
+                    it_group.create_dataset("spikes", data=input_data.get_spike_matrix(neuron_id, input_type))
+                    it_group.create_dataset("nSpikes", data=input_info["nSpikes"])
+
+                    for name in ["sectionID", "sectionX", "distanceToSoma", "parameterID", "conductance", "freq",
+                                 "start", "end", "modFile"]:
+                        it_group.create_dataset(name, data=input_info[name])
+
+                    it_group.create_dataset("parameterList", data=json.dumps(input_info["parameterList"]))
+
+        old_input_data = SnuddaLoadInput(old_spike_file)
+
+        self.assertFalse(old_input_data.compact)
+        self.assertTrue((input_data.get_neuron_id() == old_input_data.get_neuron_id()).all())
+
+        num_neurons = len(si.network_data["neurons"])
+        for count, old_count in zip(input_data.get_input_count(num_neurons),
+                                    old_input_data.get_input_count(num_neurons)):
+            self.assertTrue((count == old_count).all())
+
+        for neuron_id in input_data.get_neuron_id():
+            with self.subTest(neuron_id=neuron_id):
+                input_dict = input_data.get_input(neuron_id)
+                old_input_dict = old_input_data.get_input(neuron_id)
+
+                self.assertEqual(list(input_dict.keys()), list(old_input_dict.keys()))
+                self.assertEqual(input_data.get_num_inputs(neuron_id), old_input_data.get_num_inputs(neuron_id))
+
+                for input_type, input_info in input_dict.items():
+                    old_input_info = old_input_dict[input_type]
+
+                    for name in ["spikeTimes", "spikePtr", "sectionID", "sectionX", "parameterID"]:
+                        self.assertTrue(np.allclose(input_info[name], old_input_info[name]))
+
+                    self.assertEqual(input_info["modFile"], old_input_info["modFile"])
+                    self.assertEqual(input_info["parameterList"], old_input_info["parameterList"])
+
+                    spike_trains = input_data.get_spike_trains(neuron_id, input_type)
+                    self.assertEqual(len(spike_trains), len(input_info["sectionID"]))
+                    self.assertTrue(all([(np.diff(st) >= 0).all() for st in spike_trains]))
+
+        input_data.close()
+        old_input_data.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import queue
+import unittest
+
+import numpy as np
+
+from snudda.utils.local_cluster import LocalClient, parse_local_parallel
+
+
+class TestLocalCluster(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.rc = LocalClient(n_workers=3)
+        cls.d_view = cls.rc.direct_view(targets="all")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.rc.shutdown()
+
+    def test_parse_local_parallel(self):
+
+        self.assertEqual(parse_local_parallel("local:4"), 4)
+        self.assertTrue(parse_local_parallel("local") > 0)
+        self.assertIsNone(parse_local_parallel(True))
+        self.assertIsNone(parse_local_parallel("ipyparallel"))
+
+    def test_direct_view(self):
+
+        with self.subTest(stage="push_execute_pull"):
+            self.d_view.push({"a": 2}, block=True)
+            self.d_view.execute("b = a * 3", block=True)
+            self.assertEqual(self.d_view["b"], [6, 6, 6])
+
+        with self.subTest(stage="scatter_gather"):
+            # Same partitioning as ipyparallel
+            self.d_view.scatter("x", np.arange(0, 10), block=True)
+            self.assertEqual([len(x) for x in self.d_view["x"]], [4, 3, 3])
+
+            self.d_view.execute("y = x * 2", block=True)
+            self.assertTrue((self.d_view.gather("y") == np.arange(0, 10) * 2).all())
+
+            self.d_view.scatter("z", ["a", "b", "c", "d"], block=True)
+            self.assertEqual(self.d_view.gather("z"), ["a", "b", "c", "d"])
+
+        with self.subTest(stage="sync_imports"):
+            with self.d_view.sync_imports():
+                from snudda.utils.numpy_encoder import NumpyEncoder
+
+            self.d_view.execute("name = NumpyEncoder.__name__", block=True)
+            self.assertEqual(self.d_view["name"], ["NumpyEncoder"] * 3)
+
+        with self.subTest(stage="push_attribute"):
+            self.d_view.execute("import types; obj = types.SimpleNamespace(val=1)", block=True)
+            self.d_view.push({"obj.val": 5}, block=True)
+            self.assertEqual(self.d_view["obj.val"], [5, 5, 5])
+
+    def test_apply_async(self):
+
+        import operator
+        from ipyparallel import Reference
+
+        self.rc[1].execute("data = [3, 1, 2]", block=True)
+
+        result = self.rc[1].apply_async(operator.methodcaller("index", 2), Reference("data"))
+
+        done = queue.Queue()
+        result.add_done_callback(lambda f: done.put(f))
+
+        self.assertTrue(done.get(timeout=60) is result)
+        self.assertEqual(result.get(), 2)
+
+        with self.assertRaises(NameError):
+            self.rc[0].apply_async(operator.methodcaller("index", 2), Reference("data")).get()
+
+
+if __name__ == '__main__':
+    unittest.main()
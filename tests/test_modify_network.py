@@ -126,6 +126,43 @@ class SnuddaModifyNetworkTestCase(unittest.TestCase):
                 else:
                     self.assertEqual(new_type_count[neuron_type], self.original_type_count[neuron_type])
 
+    def test_ablate_reproducible(self):
+
+        """ Verify that ablation with a random seed is reproducible, and that neuron pairs are removed together """
+
+        new_file = os.path.join(self.network_path, "ispn-dspn-connections-half-removed.hdf5")
+        new_file_chunks = os.path.join(self.network_path, "ispn-dspn-connections-half-removed-chunks.hdf5")
+
+        synapses = self.snudda_load_original.data["synapses"]
+        neuron_types = np.array(self.snudda_load_original.get_neuron_types())
+
+        for out_file, chunk_size in [(new_file, 1000000), (new_file_chunks, 17)]:
+            mod_network = SnuddaAblateNetwork(network_file=self.original_file, random_seed=1234)
+            mod_network.remove_connection(pre_neuron_type="iSPN", post_neuron_type="dSPN", p_remove=0.5)
+            mod_network.write_network(out_file_name=out_file, chunk_size=chunk_size)
+
+        snudda_load_new = SnuddaLoad(network_file=new_file, load_synapses=True)
+        snudda_load_chunks = SnuddaLoad(network_file=new_file_chunks, load_synapses=True)
+
+        with self.subTest(msg="Same seed gives same result, independent of chunk size"):
+            self.assertTrue(np.array_equal(snudda_load_new.data["synapses"], snudda_load_chunks.data["synapses"]))
+
+        with self.subTest(msg="All synapses between a neuron pair are kept or removed together"):
+            keep_flag = mod_network.filter_synapses(data_type="synapses", chunk_size=13)
+
+            pair_id = synapses[:, 0].astype(np.int64) * len(neuron_types) + synapses[:, 1]
+            _, pair_idx = np.unique(pair_id, return_inverse=True)
+            pair_keep_count = np.bincount(pair_idx, weights=keep_flag)
+            pair_count = np.bincount(pair_idx)
+
+            self.assertTrue(np.logical_or(pair_keep_count == 0, pair_keep_count == pair_count).all())
+
+            # Only iSPN -> dSPN connections are removed
+            is_ispn_dspn = np.logical_and(neuron_types[synapses[:, 0]] == "iSPN",
+                                          neuron_types[synapses[:, 1]] == "dSPN")
+            self.assertTrue(keep_flag[~is_ispn_dspn].all())
+            self.assertTrue(0 < np.sum(keep_flag[is_ispn_dspn]) < np.sum(is_ispn_dspn))
+
     def get_number_of_type(self, snudda_load_data):
 
         type_counting = dict()
@@ -41,6 +41,56 @@ class NeuronMorphologyTestCase(unittest.TestCase):
         # 3e-6 due to compartment length sampled at 3 micrometers
         self.assertTrue((dist_to_soma < 200e-6 + 3e-6).all())
 
+    def test_input_location_batch(self, stage="input_location_batch"):
+
+        for synapse_density, num_locations, cluster_size in [("(d > 100e-6)*1", None, None),
+                                                             ("(d > 100e-6)*1", 100, None),
+                                                             ("exp(-d/50e-6)", None, 4),
+                                                             ("1", 30, 5)]:
+            with self.subTest(synapse_density=synapse_density, num_locations=num_locations,
+                              cluster_size=cluster_size):
+
+                # Same random stream gives the same locations as the reference implementation
+                input_loc = self.nm.dendrite_input_locations(synapse_density=synapse_density,
+                                                             rng=np.random.default_rng(1234),
+                                                             num_locations=num_locations, cluster_size=cluster_size)
+                input_loc_ref = self.nm.dendrite_input_locations_python(synapse_density=synapse_density,
+                                                                        rng=np.random.default_rng(1234),
+                                                                        num_locations=num_locations,
+                                                                        cluster_size=cluster_size)
+
+                for data, data_ref in zip(input_loc, input_loc_ref):
+                    self.assertTrue(np.array_equal(data, data_ref))
+
+                # A batch of one neuron is the same as a single call
+                xyz, sec_id, sec_x, dist_to_soma, location_ptr = \
+                    self.nm.dendrite_input_locations_batch(synapse_density=synapse_density,
+                                                           rng=np.random.default_rng(1234), num_neurons=1,
+                                                           num_locations=num_locations, cluster_size=cluster_size)
+
+                for data, data_ref in zip([xyz, sec_id, sec_x, dist_to_soma], input_loc):
+                    self.assertTrue(np.array_equal(data, data_ref))
+
+                self.assertEqual(location_ptr[-1], len(sec_id))
+
+                num_neurons = 20
+                xyz, sec_id, sec_x, dist_to_soma, location_ptr = \
+                    self.nm.dendrite_input_locations_batch(synapse_density=synapse_density,
+                                                           rng=np.random.default_rng(1234), num_neurons=num_neurons,
+                                                           num_locations=num_locations, cluster_size=cluster_size)
+
+                self.assertEqual(len(location_ptr), num_neurons + 1)
+                self.assertEqual(location_ptr[-1], xyz.shape[0])
+                self.assertEqual(len(dist_to_soma), len(sec_id))
+
+                if num_locations is not None:
+                    self.assertTrue((np.diff(location_ptr) == num_locations * (cluster_size or 1)).all())
+
+                if synapse_density == "(d > 100e-6)*1":
+                    self.assertTrue((dist_to_soma > 100e-6 - 3e-6).all())
+
+                self.assertTrue(((0 <= sec_x) & (sec_x <= 1)).all())
+
     def test_rand_rotation(self, stage="rand_rotation"):
 
         for idx in range(0, 100):
@@ -73,6 +123,23 @@ class NeuronMorphologyTestCase(unittest.TestCase):
         new_nm.place(position=np.array([1, 2, 3]))
         self.assertTrue((np.abs(new_nm.soma[0,:3] - np.array([1, 2, 3])) < 1e-6).all())
 
+    def test_lazy_clone_rotation_check(self, stage="lazy_clone_rotation_check"):
+
+        # Lazy clones defer the rotation, but should reject an invalid rotation matrix like place does
+        bad_rotation = 2 * np.eye(3)
+
+        with self.assertRaises(AssertionError):
+            self.nm.clone(load_morphology=True, position=np.array([0, 0, 0]), rotation=bad_rotation, lazy=True)
+
+        with self.assertRaises(AssertionError):
+            self.nm.clone(load_morphology=True, position=np.array([0, 0, 0]), rotation=bad_rotation, lazy=False)
+
+        rotation = self.nm.rand_rotation_matrix()
+        lazy_nm = self.nm.clone(load_morphology=True, position=np.array([1, 2, 3]), rotation=rotation, lazy=True)
+        ref_nm = self.nm.clone(load_morphology=True, position=np.array([1, 2, 3]), rotation=rotation, lazy=False)
+
+        self.assertTrue((lazy_nm.dend == ref_nm.dend).all())
+
 
 if __name__ == '__main__':
     unittest.main()
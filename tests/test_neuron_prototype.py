@@ -3,6 +3,8 @@ import os
 import unittest
 import numpy as np
 
+from snudda.neurons.morphology_pool import MorphologyPool
+from snudda.neurons.neuron_morphology import NeuronMorphology
 from snudda.neurons.neuron_prototype import NeuronPrototype
 
 
@@ -80,6 +82,45 @@ class NeuronPrototypeTestCase(unittest.TestCase):
 
             print(f"Compartment length sums: {res_sum} vs {res2_sum}")
 
+    def test_morphology_pool(self):
+
+        neuron_path = os.path.join("validation", "striatum-var", "dspn",
+                                   "str-dspn-e150917_c9_d1-mWT-1215MSN03-v20210212")
+
+        np1 = NeuronPrototype(neuron_path=neuron_path, neuron_name="np1")
+
+        pool = MorphologyPool(os.path.join("networks", "morphology_pool_test"))
+        pool.publish({"np1": np1})
+
+        np2 = NeuronPrototype(neuron_path=neuron_path, neuron_name="np1")
+        MorphologyPool(pool.pool_dir).attach("np1", np2)
+
+        self.assertEqual(set(np1.morphology_cache.keys()), set(np2.morphology_cache.keys()))
+
+        rotation = NeuronMorphology.rand_rotation_matrix(rand_nums=[0.1, 0.2, 0.3])
+        position = np.array([1e-3, 2e-3, 3e-3])
+
+        for morph_id in range(0, np1.get_num_morphologies(parameter_id=3)):
+
+            nm1 = np1.clone(parameter_id=3, morphology_id=morph_id, modulation_id=0,
+                            position=position, rotation=rotation)
+            nm2 = np2.clone(parameter_id=3, morphology_id=morph_id, modulation_id=0,
+                            position=position, rotation=rotation, lazy=True)
+
+            with self.subTest(msg=f"Pooled lazy clone identical, morphology {morph_id}"):
+                self.assertTrue("axon" not in nm2.__dict__)
+
+                for array_name in MorphologyPool.array_names:
+                    self.assertTrue((getattr(nm1, array_name) == getattr(nm2, array_name)).all())
+
+                self.assertEqual(nm1.max_dend_radius, nm2.max_dend_radius)
+
+            # The pool is read-only, but the placed coordinates of the clone are its own copy
+            self.assertFalse(nm2.dend_links.flags.writeable)
+            nm2.dend[:, :3] += 1
+            self.assertTrue((np2.clone(parameter_id=3, morphology_id=morph_id, modulation_id=0,
+                                       position=position, rotation=rotation).dend == nm1.dend).all())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "snudda", "synaptic_fitting"))
+
+from snudda.synaptic_fitting.optimise_synapses_full import OptimiseSynapsesFull
+from snudda.synaptic_fitting.parameter_bookkeeper import ParameterBookkeeper
+from snudda.utils.local_cluster import LocalClient
+
+
+class SobolStub(object):
+
+    """ Stands in for the worker's OptimiseSynapsesFull (ly), error is the sum of the parameters. """
+
+    def __init__(self):
+        self.smooth_exp_volt8 = None
+        self.smooth_exp_volt9 = None
+        self.evaluated = []
+
+    def sobol_evaluate(self, t_stim, h_peak, parameter_sets, smooth_exp_trace8, smooth_exp_trace9):
+        self.evaluated += [tuple(p) for p in parameter_sets]
+        return np.sum(np.array(parameter_sets), axis=1)
+
+
+class OptimiseSynapsesFullTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.temp_dir.name, "trace.json-sobol-cache.jsonl")
+
+        # Same parameter points for every scan, a longer scan extends a shorter one (like the sobol sequence)
+        self.parameter_points = [tuple(p) for p in np.random.default_rng(1234).uniform(size=(50, 5))]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_optimiser(self, d_view=None):
+
+        # Skip __init__, no trace data or NEURON model is needed to test the sobol cache
+        ly = object.__new__(OptimiseSynapsesFull)
+        ly.role = "master"
+        ly.d_view = d_view
+        ly.verbose = False
+        ly.log_file = None
+        ly.sobol_cache_file_name = self.cache_file
+        ly.sobol_cache = None
+        ly.synapse_parameter_data = ParameterBookkeeper(n_max=5)
+
+        return ly
+
+    def test_sobol_cache(self):
+
+        ly = self.get_optimiser()
+        errors = np.sum(np.array(self.parameter_points[:5]), axis=1)
+        errors[2] = np.inf
+
+        ly.add_sobol_results(cache_key="a", parameter_points=self.parameter_points[:5], errors=errors,
+                             section_id=[1], section_x=[0.5])
+
+        with self.subTest(stage="failed_points_not_cached"):
+            cache_data = self.get_optimiser().load_sobol_cache()["a"]
+            self.assertEqual(len(cache_data["parameters"]), 4)
+            self.assertTrue(np.allclose(cache_data["error"], errors[[0, 1, 3, 4]]))
+
+        with self.subTest(stage="use_cache"):
+            ly2 = self.get_optimiser()
+            new_points = ly2.use_sobol_cache(cache_key="a", parameter_points=self.parameter_points[:10],
+                                             section_id=[1], section_x=[0.5])
+
+            self.assertEqual(new_points, [self.parameter_points[2]] + self.parameter_points[5:10])
+            self.assertEqual(len(ly2.synapse_parameter_data.book), 4)
+            self.assertTrue(np.allclose(ly2.synapse_parameter_data.get_best_parameterset(),
+                                        self.parameter_points[int(np.argmin(errors))]))
+
+        with self.subTest(stage="other_cache_key"):
+            new_points = self.get_optimiser().use_sobol_cache(cache_key="b", parameter_points=self.parameter_points,
+                                                              section_id=[1], section_x=[0.5])
+            self.assertEqual(new_points, self.parameter_points)
+
+        with self.subTest(stage="interrupted_write"):
+            with open(self.cache_file, "a") as f:
+                f.write('{"key": "a", "parameters": [[0.1, ')
+
+            ly.add_sobol_results(cache_key="a", parameter_points=self.parameter_points[5:7], errors=[1.0, 2.0],
+                                 section_id=[1], section_x=[0.5])
+
+            cache_data = self.get_optimiser().load_sobol_cache()["a"]
+            self.assertEqual(len(cache_data["parameters"]), 6)
+            self.assertEqual(cache_data["error"][-2:], [1.0, 2.0])
+
+    def test_sobol_scan_parallel(self):
+
+        rc = LocalClient(n_workers=2)
+        d_view = rc.direct_view(targets="all")
+        d_view.push({"ly": SobolStub(), "stim_time": None, "peak_height": None}, block=True)
+
+        try:
+            for n_trials, n_cached in [(20, 0), (50, 20)]:
+                with self.subTest(n_trials=n_trials):
+                    ly = self.get_optimiser(d_view=d_view)
+                    new_points = ly.use_sobol_cache(cache_key="a", parameter_points=self.parameter_points[:n_trials],
+                                                    section_id=[1], section_x=[0.5])
+
+                    # The second scan only evaluates the points not in the cache
+                    self.assertEqual(new_points, self.parameter_points[n_cached:n_trials])
+
+                    ly.sobol_scan_parallel(parameter_points=new_points, cache_key="a",
+                                           section_id=[1], section_x=[0.5], batch_size=3)
+
+                    d_view.execute("evaluated = ly.evaluated", block=True)
+                    evaluated = [p for worker_evaluated in d_view["evaluated"] for p in worker_evaluated]
+
+                    # Every point evaluated once, over both scans
+                    self.assertEqual(sorted(evaluated), sorted(self.parameter_points[:n_trials]))
+
+                    # Best of both cached and new points
+                    ref_errors = np.sum(np.array(self.parameter_points[:n_trials]), axis=1)
+                    self.assertTrue(np.allclose(ly.synapse_parameter_data.get_best_parameterset(),
+                                                self.parameter_points[int(np.argmin(ref_errors))]))
+
+                    cache_data = self.get_optimiser().load_sobol_cache()["a"]
+                    self.assertEqual(sorted([tuple(p) for p in cache_data["parameters"]]),
+                                     sorted(self.parameter_points[:n_trials]))
+        finally:
+            rc.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -109,6 +109,74 @@ class TestPrune(unittest.TestCase):
             self.sd.process_hyper_voxel(1)
             self.sd.plot_hyper_voxel(plot_neurons=True)
 
+    def test_prune_kernel(self):
+
+        import h5py
+
+        # Putative synapses, sorted, from the merge file
+        sp = SnuddaPrune(network_path=self.network_path, config_file=None, keep_files=True)
+        sp.prune()
+
+        merge_file = os.path.join(self.network_path, "temp", "synapses-for-neurons-0-to-28-MERGE-ME.hdf5")
+        with h5py.File(merge_file, "r") as f:
+            synapses = f["network/synapses"][()]
+
+        merge_file_gj = os.path.join(self.network_path, "temp", "gapJunctions-for-neurons-0-to-28-MERGE-ME.hdf5")
+        with h5py.File(merge_file_gj, "r") as f:
+            gap_junctions = f["network/gapJunctions"][()]
+
+        for config_id in range(1, 11):
+            testing_config_file = os.path.join(self.network_path, f"network-config-test-{config_id}.json")
+            sp = SnuddaPrune(network_path=self.network_path, config_file=testing_config_file)
+
+            for cluster_flag in [False, True]:
+                for c_info in [x for con_info in sp.connectivity_distributions.values() for x in con_info
+                               if x is not None]:
+                    c_info["cluster"] = cluster_flag
+                sp.setup_pruning_parameters()
+
+                for merge_data_type, data in [("synapses", synapses), ("gapJunctions", gap_junctions)]:
+                    with self.subTest(config_id=config_id, cluster=cluster_flag, merge_data_type=merge_data_type):
+                        try:
+                            keep_python = sp.get_keep_row_flag_python(synapses=data.copy(),
+                                                                      merge_data_type=merge_data_type)
+                        except AssertionError:
+                            # Distance dependent pruning of gap junctions is not supported
+                            with self.assertRaises(AssertionError):
+                                sp.get_keep_row_flag(synapses=data.copy(), merge_data_type=merge_data_type)
+                            continue
+
+                        keep_numba = sp.get_keep_row_flag(synapses=data.copy(), merge_data_type=merge_data_type)
+                        self.assertTrue((keep_python == keep_numba).all())
+
+    def test_merge_buffer_size(self):
+
+        import h5py
+
+        # The merged file should not depend on how many rows are read at a time from the hyper voxel files
+        merge_data = dict()
+
+        for merge_buffer_size in [2000000, 3]:
+            sp = SnuddaPrune(network_path=self.network_path, config_file=None, keep_files=True,
+                             merge_buffer_size=merge_buffer_size)
+            sp.prune()
+
+            for merge_data_type in ["synapses", "gapJunctions"]:
+                merge_file = os.path.join(self.network_path, "temp",
+                                          f"{merge_data_type}-for-neurons-0-to-28-MERGE-ME.hdf5")
+                with h5py.File(merge_file, "r") as f:
+                    merge_data[merge_buffer_size, merge_data_type] = f[f"network/{merge_data_type}"][()]
+
+        for merge_data_type in ["synapses", "gapJunctions"]:
+            with self.subTest(merge_data_type=merge_data_type):
+                data = merge_data[2000000, merge_data_type]
+                self.assertTrue(data.shape[0] > 0)
+                self.assertTrue(np.array_equal(data, merge_data[3, merge_data_type]))
+
+                # Sorted on dest_id, then source_id
+                sort_idx = np.lexsort((data[:, 0], data[:, 1]))
+                self.assertTrue((sort_idx == np.arange(data.shape[0])).all())
+
     def test_prune(self):
 
         pruned_output = os.path.join(self.network_path, "network-synapses.hdf5")
@@ -168,6 +236,32 @@ class TestPrune(unittest.TestCase):
             self.assertTrue((syn[:, 1] == 3).all())
             self.assertEqual(syn.shape[0], 36)
 
+            # A neuron listed twice in pre_id, each synapse should only be returned once
+            all_syn = sl.data["synapses"]
+            syn, syn_coords = sl.find_synapses(pre_id=[14, 10, 14])
+            syn_ref = all_syn[np.isin(all_syn[:, 0], [10, 14]), :]
+            self.assertTrue(np.array_equal(syn, syn_ref))
+
+            # The synapse index should give the same result as a full scan of the synapse matrix
+            for pre_id, post_id in [(14, 3), (10, 0), (0, 14)]:
+                syn, syn_coords = sl.find_synapses(pre_id=pre_id, post_id=post_id)
+                syn_ref = all_syn[np.logical_and(all_syn[:, 0] == pre_id, all_syn[:, 1] == post_id), :]
+
+                if syn_ref.shape[0] == 0:
+                    self.assertIsNone(syn)
+                else:
+                    self.assertTrue(np.array_equal(syn, syn_ref))
+
+            self.assertTrue(os.path.isfile(sl.get_synapse_index_file()))
+
+            # Synapses onto a subset of the neurons, as read by each worker in SnuddaSimulate
+            self.assertEqual(sl.get_synapse_row_ptr()[-1], sl.data["nSynapses"])
+
+            for post_id in [[3], [0, 1, 2, 5, 9], list(range(0, 28, 3)), []]:
+                syn = sl.load_post_synapses(post_id)
+                syn_ref = all_syn[np.isin(all_syn[:, 1], post_id), :]
+                self.assertTrue(np.array_equal(syn, syn_ref))
+
             cell_id_perm = sl.get_neuron_id_of_type("ballanddoublestick", random_permute=True, num_neurons=28)
             cell_id = sl.get_neuron_id_of_type("ballanddoublestick", random_permute=False)
 
@@ -177,6 +271,37 @@ class TestPrune(unittest.TestCase):
             for cid in cell_id_perm:
                 self.assertTrue(cid in cell_id)
 
+        with self.subTest(stage="lazy-loading"):
+            sl = SnuddaLoad(pruned_output)
+            sl_lazy = SnuddaLoad(pruned_output, lazy=True)
+
+            # The pruned synapses are compressed, so a sidecar file with uncompressed synapses is memory mapped
+            self.assertTrue(os.path.isfile(sl_lazy.get_memmap_file()))
+            self.assertTrue(isinstance(sl_lazy.data["synapses"], np.memmap))
+            self.assertTrue(np.array_equal(sl.data["synapses"], sl_lazy.data["synapses"]))
+            self.assertTrue(np.array_equal(sl.data["gapJunctions"], sl_lazy.data["gapJunctions"]))
+            self.assertIsNone(sl_lazy.hdf5_file)
+
+            self.assertEqual(len(sl.data["neurons"]), len(sl_lazy.data["neurons"]))
+
+            for neuron, lazy_neuron in zip(sl.data["neurons"], sl_lazy.data["neurons"]):
+                self.assertEqual(neuron.keys(), lazy_neuron.keys())
+                self.assertEqual(neuron["name"], lazy_neuron["name"])
+                self.assertEqual(neuron["neuronID"], lazy_neuron["neuronID"])
+                self.assertTrue((neuron["rotation"] == lazy_neuron["rotation"]).all())
+
+            self.assertEqual(sl_lazy.data["neurons"][-1]["neuronID"], len(sl_lazy.data["neurons"]) - 1)
+            self.assertTrue((sl.get_neuron_id_of_type("ballanddoublestick")
+                             == sl_lazy.get_neuron_id_of_type("ballanddoublestick")).all())
+
+            syn, syn_coords = sl_lazy.find_synapses(post_id=3)
+            self.assertTrue((syn[:, 1] == 3).all())
+            self.assertEqual(syn.shape[0], 36)
+
+            # Second load reuses the sidecar file
+            sl_lazy2 = SnuddaLoad(pruned_output, lazy=True)
+            self.assertTrue(np.array_equal(sl_lazy2.data["synapses"], sl_lazy.data["synapses"]))
+
         # It is important merge file has synapses sorted with dest_id, source_id as sort order since during pruning
         # we assume this to be able to quickly find all synapses on post synaptic cell.
         # TODO: Also include the ChannelModelID in sorting check
@@ -0,0 +1,90 @@
+import os
+import unittest
+
+import h5py
+import numpy as np
+
+from snudda.simulate.simulate import SnuddaSimulate
+from snudda.utils.save_network_activity import SnuddaSaveNetworkActivity
+
+
+class TestSimulate(unittest.TestCase):
+
+    def test_partition_neurons(self):
+
+        rng = np.random.default_rng(1234)
+
+        for neuron_cost, num_workers in [(np.ones((10,)), 3),
+                                         (rng.uniform(1, 10, size=1000), 7),
+                                         (np.array([100, 1, 1, 1, 1]), 3),
+                                         (np.zeros((5,)), 2),
+                                         (np.ones((4,)), 4)]:
+
+            with self.subTest(num_neurons=len(neuron_cost), num_workers=num_workers):
+                range_borders = SnuddaSimulate.partition_neurons(neuron_cost=neuron_cost, num_workers=num_workers)
+
+                # Contiguous ranges covering all neurons, at least one neuron per worker
+                self.assertEqual(len(range_borders), num_workers + 1)
+                self.assertEqual(range_borders[0], 0)
+                self.assertEqual(range_borders[-1], len(neuron_cost))
+                self.assertTrue((np.diff(range_borders) >= 1).all())
+
+                # The cost of each worker is within one neuron of the average
+                if np.sum(neuron_cost) > 0:
+                    worker_cost = np.add.reduceat(neuron_cost, range_borders[:-1])
+                    self.assertTrue((np.abs(worker_cost - np.mean(worker_cost))
+                                     <= np.max(neuron_cost) + 1e-9).all())
+
+    def test_write_spikes_output_window(self):
+
+        # Skip __init__, no network is needed. With output_window the spikes are cleared after each window
+        ss = object.__new__(SnuddaSimulate)
+        ss.output_stream = SnuddaSaveNetworkActivity(output_file="network-output.hdf5")
+
+        with self.assertRaises(AssertionError):
+            ss.write_spikes(output_file="network-spikes.txt")
+
+    def test_write_window(self):
+
+        output_path = os.path.join(os.path.dirname(__file__), "networks", "test_write_window")
+        os.makedirs(output_path, exist_ok=True)
+
+        t_save = np.arange(0, 100, 0.025)
+        v_save = [np.sin(t_save), np.cos(t_save)]
+        v_key = [3, 5]
+        t_spikes = np.array([1.0, 2.0, 3.0, 50.0, 60.0, 70.0, 99.0])
+        id_spikes = np.array([3, 5, 3, 5, 3, 7, 3])
+
+        for merge_rank_files in [False, True]:
+            with self.subTest(merge_rank_files=merge_rank_files):
+                output_file = os.path.join(output_path, f"network-output-{merge_rank_files}.hdf5")
+                sv = SnuddaSaveNetworkActivity(output_file=output_file, chunk_size=1000)
+
+                # Time windows of 25 ms
+                for t_start in np.arange(0, 100, 25):
+                    t_idx = np.where((t_start <= t_save) & (t_save < t_start + 25))[0]
+                    spike_idx = np.where((t_start <= t_spikes) & (t_spikes < t_start + 25))[0]
+
+                    sv.write_window(t_save=t_save[t_idx], v_save=[v[t_idx] for v in v_save], v_key=v_key,
+                                    t_spikes=t_spikes[spike_idx], id_spikes=id_spikes[spike_idx])
+
+                sv.write_virtual(merge_rank_files=merge_rank_files)
+
+                self.assertEqual(os.path.isfile(sv.get_rank_file_name()), not merge_rank_files)
+
+                with h5py.File(output_file, "r") as f:
+                    self.assertTrue(np.allclose(f["voltData"]["time"][()], t_save * 1e-3))
+
+                    for neuron_id, voltage in zip(v_key, v_save):
+                        self.assertTrue(np.allclose(f["voltData"][str(neuron_id)][()], voltage * 1e-3))
+                        self.assertEqual(f["voltData"][str(neuron_id)].is_virtual, not merge_rank_files)
+
+                    self.assertEqual(set(f["spikeData"].keys()), {"3", "5", "7"})
+
+                    for neuron_id in [3, 5, 7]:
+                        self.assertTrue(np.allclose(f["spikeData"][str(neuron_id)][()],
+                                                    t_spikes[id_spikes == neuron_id] * 1e-3))
+
+
+if __name__ == '__main__':
+    unittest.main()